@@ -13,12 +13,16 @@ import allmydata
 from allmydata.storage.server import StorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.keycache import ConvergentKeyCache
 from allmydata.immutable.offloaded import Helper
+from allmydata.immutable.downloader.segcache import SegmentCache
+from allmydata.immutable.downloader.metacache import DownloadMetadataCache
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import hashutil, base32, pollmixin, log
 from allmydata.util.encodingutil import get_filesystem_encoding
 from allmydata.util.abbreviate import parse_abbreviated_size
+from allmydata.util.workerpool import WorkerPool
 from allmydata.util.time_format import parse_duration, parse_date
 from allmydata.stats import StatsProvider
 from allmydata.history import History
@@ -256,6 +260,37 @@ class Client(node.Node, pollmixin.PollMixin):
         if self.get_config("storage", "expire.mutable", True, boolean=True):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
+        expiration_workers = int(self.get_config("storage", "expire.workers", 0))
+
+        share_index = self.get_config("storage", "share_index.enabled", False,
+                                      boolean=True)
+        share_index_rebuild = self.get_config("storage", "share_index.rebuild",
+                                              False, boolean=True)
+        leasedb = self.get_config("storage", "leasedb.enabled", False,
+                                  boolean=True)
+        incremental = self.get_config("storage", "crawler.incremental", False,
+                                      boolean=True)
+        mmap_max_files = int(self.get_config("storage", "mmap.max_files", 0))
+        data = self.get_config("storage", "read_cache.size", None)
+        read_cache_size = None
+        try:
+            read_cache_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[storage]read_cache.size= contains unparseable value %s"
+                    % data)
+        if read_cache_size is None:
+            read_cache_size = 0
+        data = self.get_config("storage", "fsync", "none")
+        if data.lower() in ("none", "close"):
+            fsync_policy = data.lower()
+        else:
+            try:
+                fsync_policy = parse_abbreviated_size(data)
+            except ValueError:
+                fsync_policy = None
+            if not fsync_policy:
+                raise ValueError("[storage]fsync= must be 'none', 'close', or"
+                                 " a positive size, not '%s'" % data)
 
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
@@ -266,7 +301,15 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           expiration_workers=expiration_workers,
+                           share_index_enabled=share_index,
+                           share_index_rebuild=share_index_rebuild,
+                           leasedb_enabled=leasedb,
+                           incremental_crawlers=incremental,
+                           fsync_policy=fsync_policy,
+                           mmap_max_files=mmap_max_files,
+                           read_cache_size=read_cache_size)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -291,10 +334,63 @@ class Client(node.Node, pollmixin.PollMixin):
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
-        self.add_service(Uploader(helper_furl, self.stats_provider))
+        lookahead = self.get_config("client", "upload.lookahead_segments", None)
+        if lookahead is not None:
+            lookahead = int(lookahead)
+        parallel_queries = int(self.get_config("client",
+                                               "upload.parallel_queries", 1))
+        check_existing = self.get_config("client", "upload.check_existing",
+                                         False, boolean=True)
+        self.init_worker_pool()
+        self.init_convergent_key_cache()
+        self.init_segment_cache()
+        self.init_metadata_cache()
+        self.add_service(Uploader(helper_furl, self.stats_provider,
+                                  lookahead_segments=lookahead,
+                                  worker_pool=self.worker_pool,
+                                  parallel_queries=parallel_queries,
+                                  check_existing=check_existing))
         self.init_stub_client()
         self.init_nodemaker()
 
+    def init_worker_pool(self):
+        workers = int(self.get_config("client", "workers", 0))
+        self.worker_pool = None
+        if workers > 0:
+            self.worker_pool = WorkerPool(workers, self.stats_provider)
+            self.add_service(self.worker_pool)
+
+    def init_convergent_key_cache(self):
+        self.convergent_key_cache = None
+        if self.get_config("client", "upload.cache_convergent_keys", False,
+                           boolean=True):
+            dbfile = os.path.join(self.basedir, "private",
+                                  "convergent-keys.sqlite")
+            self.convergent_key_cache = ConvergentKeyCache(dbfile)
+            self.add_service(self.convergent_key_cache)
+
+    def init_segment_cache(self):
+        data = self.get_config("client", "download.segment_cache.size", None)
+        size = None
+        try:
+            size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]download.segment_cache.size= contains"
+                    " unparseable value %s" % data)
+        self.segment_cache = None
+        if size:
+            self.segment_cache = SegmentCache(size, self.stats_provider)
+
+    def init_metadata_cache(self):
+        self.metadata_cache = None
+        if self.get_config("client", "download.cache_metadata", False,
+                           boolean=True):
+            dbfile = os.path.join(self.basedir, "private",
+                                  "download-metadata.sqlite")
+            self.metadata_cache = DownloadMetadataCache(dbfile,
+                                                        self.stats_provider)
+            self.add_service(self.metadata_cache)
+
     def init_client_storage_broker(self):
         # create a StorageFarmBroker object, for use by Uploader/Downloader
         # (and everybody else who wants to use storage servers)
@@ -352,7 +448,36 @@ class Client(node.Node, pollmixin.PollMixin):
                                    self.getServiceNamed("uploader"),
                                    self.terminator,
                                    self.get_encoding_parameters(),
-                                   self._key_generator)
+                                   self._key_generator,
+                                   self.get_download_parameters())
+
+    def get_download_parameters(self):
+        segments = int(self.get_config("client", "download.readahead_segments",
+                                       2))
+        if segments < 0:
+            raise ValueError("[client]download.readahead_segments= must not"
+                             " be negative, not %d" % segments)
+        data = self.get_config("client", "download.readahead_bytes", "1MiB")
+        try:
+            size = parse_abbreviated_size(data)
+        except ValueError:
+            size = None
+        if size is None:
+            raise ValueError("[client]download.readahead_bytes= must be a"
+                             " size, not '%s'" % data)
+        hedge_percentile = int(self.get_config("client",
+                                               "download.hedge_percentile",
+                                               0))
+        if not 0 <= hedge_percentile <= 100:
+            raise ValueError("[client]download.hedge_percentile= must be"
+                             " between 0 and 100, not %d" % hedge_percentile)
+        return {"readahead_segments": segments,
+                "readahead_bytes": size,
+                "segment_cache": self.segment_cache,
+                "metadata_cache": self.metadata_cache,
+                "worker_pool": self.worker_pool,
+                "hedge_percentile": hedge_percentile,
+                }
 
     def get_history(self):
         return self.history
@@ -369,11 +494,43 @@ class Client(node.Node, pollmixin.PollMixin):
                      level=log.BAD, umid="d3tNXA")
 
     def init_helper(self):
+        pipeline_depth = int(self.get_config("helper", "fetch.pipeline_depth",
+                                             4))
+        if pipeline_depth < 1:
+            raise ValueError("[helper]fetch.pipeline_depth= must be at least"
+                             " 1, not %d" % pipeline_depth)
+        encode_early = self.get_config("helper", "fetch.encode_early", False,
+                                       boolean=True)
+        data = self.get_config("helper", "fetch.max_ahead", "10MB")
+        try:
+            fetch_ahead = parse_abbreviated_size(data)
+        except ValueError:
+            fetch_ahead = None
+        if not fetch_ahead:
+            raise ValueError("[helper]fetch.max_ahead= must be a positive"
+                             " size, not '%s'" % data)
+        max_active_uploads = int(self.get_config("helper",
+                                                 "max_active_uploads", 0))
+        data = self.get_config("helper", "max_disk_usage", None)
+        max_disk_usage = None
+        if data is not None:
+            try:
+                max_disk_usage = parse_abbreviated_size(data)
+            except ValueError:
+                max_disk_usage = None
+            if not max_disk_usage:
+                raise ValueError("[helper]max_disk_usage= must be a positive"
+                                 " size, not '%s'" % data)
         d = self.when_tub_ready()
         def _publish(self):
             self.helper = Helper(os.path.join(self.basedir, "helper"),
                                  self.storage_broker, self._secret_holder,
-                                 self.stats_provider, self.history)
+                                 self.stats_provider, self.history,
+                                 fetch_pipeline_depth=pipeline_depth,
+                                 encode_while_fetching=encode_early,
+                                 fetch_ahead=fetch_ahead,
+                                 max_active_uploads=max_active_uploads,
+                                 max_disk_usage=max_disk_usage)
             # TODO: this is confusing. BASEDIR/private/helper.furl is created
             # by the helper. BASEDIR/helper.furl is consumed by the client
             # who wants to use the helper. I like having the filename be the
@@ -497,3 +654,7 @@ class Client(node.Node, pollmixin.PollMixin):
     def upload(self, uploadable):
         uploader = self.getServiceNamed("uploader")
         return uploader.upload(uploadable, history=self.get_history())
+
+    def upload_batch(self, uploadables):
+        uploader = self.getServiceNamed("uploader")
+        return uploader.upload_batch(uploadables, history=self.get_history())
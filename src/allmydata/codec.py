@@ -34,6 +34,11 @@ class CRSEncoder(object):
         return self.share_size
 
     def encode(self, inshares, desired_share_ids=None):
+        return defer.succeed(self.encode_blocks(inshares, desired_share_ids))
+
+    def encode_blocks(self, inshares, desired_share_ids=None):
+        """Like encode(), but return the (shares, shareids) tuple directly
+        instead of a Deferred."""
         precondition(desired_share_ids is None or len(desired_share_ids) <= self.max_shares, desired_share_ids, self.max_shares)
 
         if desired_share_ids is None:
@@ -43,7 +48,7 @@ class CRSEncoder(object):
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
         shares = self.encoder.encode(inshares, desired_share_ids)
 
-        return defer.succeed((shares, desired_share_ids))
+        return (shares, desired_share_ids)
 
 class CRSDecoder(object):
     implements(ICodecDecoder)
@@ -58,17 +63,24 @@ class CRSDecoder(object):
         self.share_size = self.num_chunks
         self.decoder = zfec.Decoder(self.required_shares, self.max_shares)
 
+    def get_params(self):
+        return (self.data_size, self.required_shares, self.max_shares)
+
     def get_needed_shares(self):
         return self.required_shares
 
     def decode(self, some_shares, their_shareids):
+        return defer.succeed(self.decode_blocks(some_shares, their_shareids))
+
+    def decode_blocks(self, some_shares, their_shareids):
+        """Like decode(), but return the list of buffers directly instead of
+        a Deferred."""
         precondition(len(some_shares) == len(their_shareids),
                      len(some_shares), len(their_shareids))
         precondition(len(some_shares) == self.required_shares,
                      len(some_shares), self.required_shares)
-        data = self.decoder.decode(some_shares,
+        return self.decoder.decode(some_shares,
                                    [int(s) for s in their_shareids])
-        return defer.succeed(data)
 
 def parse_params(serializedparams):
     pieces = serializedparams.split("-")
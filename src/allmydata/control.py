@@ -61,7 +61,8 @@ class ControlServer(Referenceable, service.Service):
 
     def remote_upload_from_file_to_uri(self, filename, convergence):
         uploader = self.parent.getServiceNamed("uploader")
-        u = upload.FileName(filename, convergence=convergence)
+        u = upload.FileName(filename, convergence=convergence,
+                            key_cache=self.parent.convergent_key_cache)
         d = uploader.upload(u)
         d.addCallback(lambda results: results.uri)
         return d
@@ -170,6 +171,16 @@ class SpeedTest:
 
         def _record_uri(uri, i):
             self.uris[i] = uri
+        def _upload_batch(ignored):
+            ups = [upload.FileName(os.path.join(self.basedir, str(i)),
+                                   convergence=None)
+                   for i in range(self.count)]
+            d1 = self.parent.upload_batch(ups)
+            def _record_uris(results):
+                for i in range(self.count):
+                    _record_uri(results[i].uri, i)
+            d1.addCallback(_record_uris)
+            return d1
         def _upload_one_file(ignored, i):
             if i >= self.count:
                 return
@@ -189,7 +200,10 @@ class SpeedTest:
             d1.addCallback(_record_uri, i)
             d1.addCallback(_upload_one_file, i+1)
             return d1
-        d.addCallback(_upload_one_file, 0)
+        if self.mutable_mode == "batch":
+            d.addCallback(_upload_batch)
+        else:
+            d.addCallback(_upload_one_file, 0)
         def _upload_done(ignored):
             stop = time.time()
             self.upload_time = stop - self._start
@@ -15,7 +15,7 @@ from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
-from allmydata.util import hashutil, mathutil, base32, log
+from allmydata.util import hashutil, mathutil, base32, log, deferredutil
 from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
 from allmydata.util.netstring import netstring, split_netstring
@@ -903,6 +903,14 @@ class ManifestWalker(DeepStats):
 
 
 class DeepChecker:
+    # When adding leases, we start the checks of this many nodes at a time,
+    # all in the same reactor turn, so that their add-lease requests can be
+    # combined into a single add_leases() call per server (see
+    # storage_client.LeaseBatcher). We wait for each batch to finish before
+    # starting the next, to keep the memory footprint of a big traversal
+    # bounded.
+    LEASE_BATCH_SIZE = 20
+
     def __init__(self, root, verify, repair, add_lease):
         root_si = root.get_storage_index()
         if root_si:
@@ -920,6 +928,7 @@ class DeepChecker:
         else:
             self._results = DeepCheckResults(root_si)
         self._stats = DeepStats(root)
+        self._batch = []
 
     def set_monitor(self, monitor):
         self.monitor = monitor
@@ -933,15 +942,29 @@ class DeepChecker:
             d = node.check(self.monitor, self._verify, self._add_lease)
             d.addCallback(self._results.add_check, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
-        return d
+        if not self._add_lease:
+            return d
+        self._batch.append(d)
+        if len(self._batch) < self.LEASE_BATCH_SIZE:
+            # let the traversal hand us the next node in this same turn
+            return None
+        return self._finish_batch()
+
+    def _finish_batch(self):
+        batch, self._batch = self._batch, []
+        return deferredutil.gatherResults(batch)
 
     def enter_directory(self, parent, children):
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
-        log.msg("deep-check done", parent=self._lp)
-        self._results.update_stats(self._stats.get_results())
-        return self._results
+        d = self._finish_batch()
+        def _done(ignored):
+            log.msg("deep-check done", parent=self._lp)
+            self._results.update_stats(self._stats.get_results())
+            return self._results
+        d.addCallback(_done)
+        return d
 
 
 # use client.create_dirnode() to make one of these
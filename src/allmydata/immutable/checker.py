@@ -5,6 +5,7 @@ from allmydata import hashtree, codec, uri
 from allmydata.interfaces import IValidatedThingProxy, IVerifierURI
 from allmydata.hashtree import IncompleteHashTree
 from allmydata.check_results import CheckResults
+from allmydata.storage_client import add_lease, get_buckets, AddLeaseError
 from allmydata.uri import CHKFileVerifierURI
 from allmydata.util.assertutil import precondition
 from allmydata.util import base32, deferredutil, dictutil, log, mathutil
@@ -498,14 +499,14 @@ class Checker(log.PrefixingLogMixin):
         rref = s.get_rref()
         lease_seed = s.get_lease_seed()
         serverid = s.get_serverid()
+        d2 = None
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = rref.callRemote("add_lease", storageindex,
-                                 renew_secret, cancel_secret)
+            d2 = add_lease(rref, storageindex, renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+        d = get_buckets(rref, storageindex)
         def _wrap_results(res):
             return (res, serverid, True)
 
@@ -519,6 +520,14 @@ class Checker(log.PrefixingLogMixin):
             return ({}, serverid, False)
 
         d.addCallbacks(_wrap_results, _trap_errs)
+        if d2:
+            # the lease request may be batched with others and sent after
+            # get_buckets, so wait for it: when the check is done, the lease
+            # should be in place.
+            def _wait_for_lease(res):
+                d2.addCallback(lambda ign: res)
+                return d2
+            d.addCallback(_wait_for_lease)
         return d
 
     def _add_lease_failed(self, f, server_name, storage_index):
@@ -547,6 +556,14 @@ class Checker(log.PrefixingLogMixin):
                      failure=f,
                      level=log.WEIRD, umid="atbAxw")
             return
+        if f.check(AddLeaseError):
+            # only servers with add_leases() report these, and they are
+            # too new to have any of the problems described above
+            self.log(format="error in add_leases from [%(name)s]: %(f_value)s",
+                     name=server_name,
+                     f_value=str(f.value),
+                     level=log.WEIRD, umid="0ZbSQg")
+            return
         # local errors are cause for alarm
         log.err(f,
                 format="local error in add_lease to [%(name)s]: %(f_value)s",
@@ -1,5 +1,8 @@
 
+import time
+now = time.time
 from twisted.python.failure import Failure
+from twisted.internet import reactor
 from foolscap.api import eventually
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError
 from allmydata.util import log
@@ -20,7 +23,15 @@ class SegmentFetcher:
     If I am unable to provide enough blocks, I will call my parent's
     fetch_failed() method with (self, f). After either of these events, I
     will shut down and do no further work. My parent can also call my stop()
-    method to have me shut down early."""
+    method to have me shut down early.
+
+    I prefer shares on the servers that have answered my parent's recent
+    block requests most quickly (or, for servers that have not been asked
+    for a block yet, that answered their DYHB query most quickly). If my
+    parent's get_hedge_timeout() returns a number, I treat any block request
+    that has been outstanding for longer than that as OVERDUE, which makes me
+    ask another share for a block (a "hedge"). Whichever k blocks arrive
+    first are used, and the other requests are cancelled."""
 
     def __init__(self, node, segnum, k, logparent):
         self._node = node # _Node
@@ -49,10 +60,29 @@ class SegmentFetcher:
         self._no_more_shares = False
         self._last_failure = None
         self._running = True
+        self._request_sent = {} # maps Share to the time we asked it for a
+                                # block
+        self._hedged = set() # Shares we stopped waiting for, because they
+                             # were too slow
+        self._hedge_timer = None
+        self._unhedgeable = set() # active Shares that were overdue when
+                                  # there was nobody else to ask. They are
+                                  # not timed again until add_shares() or a
+                                  # finished request gives us a reason.
 
     def stop(self):
         log.msg("SegmentFetcher(%s).stop" % self._node._si_prefix,
                 level=log.NOISY, parent=self._lp, umid="LWyqpg")
+        if self._hedge_timer:
+            self._hedge_timer.cancel()
+            self._hedge_timer = None
+        for share in self._hedged:
+            if share in self._overdue_share_map.get(share._shnum, ()):
+                # we'll never know how slow this one really was, but it was
+                # at least this slow, which should discourage its use for
+                # the next segment
+                self._node.add_block_latency(share._server,
+                                             now() - self._request_sent[share])
         self._cancel_all_requests()
         self._running = False
         # help GC ??? XXX
@@ -67,7 +97,8 @@ class SegmentFetcher:
         # segment fetch is started and we already know about shares from the
         # previous segment
         self._shares.extend(shares)
-        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        self._shares.sort(key=self._share_rank)
+        self._recheck_hedges()
         eventually(self.loop)
 
     def no_more_shares(self):
@@ -143,6 +174,10 @@ class SegmentFetcher:
         # are we done?
         if len(set(self._blocks.keys())) >= k:
             # yay!
+            for share in self._hedged:
+                if share in self._overdue_share_map.get(share._shnum, ()):
+                    # we finished without waiting for this slow one
+                    self._node._download_status.add_hedge_won()
             self.stop()
             self._node.process_blocks(self.segnum, self._blocks)
             return
@@ -185,9 +220,17 @@ class SegmentFetcher:
         self.stop()
         self._node.fetch_failed(self, f)
 
+    def _share_rank(self, share):
+        latency = self._node.get_server_latency(share._server) # XXX
+        if latency is None:
+            latency = share._dyhb_rtt
+        return (latency, share._shnum)
+
     def _find_and_use_share(self):
         sent_something = False
         want_more_diversity = False
+        # the latencies may have changed since the shares arrived
+        self._shares.sort(key=self._share_rank)
         for sh in self._shares: # find one good share to fetch
             shnum = sh._shnum ; server = sh._server # XXX
             if shnum in self._blocks:
@@ -205,11 +248,70 @@ class SegmentFetcher:
             self._shares.remove(sh)
             self._active_share_map[shnum] = sh
             self._shares_from_server.add(server, sh)
+            self._request_sent[sh] = now()
             self._start_share(sh, shnum)
+            self._schedule_hedge_check()
             sent_something = True
             break
         return (sent_something, want_more_diversity)
 
+    def _schedule_hedge_check(self):
+        if self._hedge_timer:
+            return
+        timeout = self._node.get_hedge_timeout()
+        if timeout is None:
+            return
+        sent = [self._request_sent[sh]
+                for sh in self._active_share_map.values()
+                if sh not in self._unhedgeable]
+        if not sent:
+            return
+        delay = max(0, min(sent) + timeout - now())
+        self._hedge_timer = reactor.callLater(delay, self._hedge_slow_requests)
+
+    def _recheck_hedges(self):
+        # the overdue requests that we could not hedge before may be
+        # hedgeable now
+        if not self._unhedgeable:
+            return
+        self._unhedgeable.clear()
+        if self._hedge_timer:
+            self._hedge_timer.cancel()
+            self._hedge_timer = None
+        self._schedule_hedge_check()
+
+    def _hedge_slow_requests(self):
+        self._hedge_timer = None
+        if not self._running:
+            return
+        timeout = self._node.get_hedge_timeout()
+        if timeout is None:
+            return
+        cutoff = now() - timeout
+        hedges = 0
+        for (shnum, sh) in self._active_share_map.items():
+            if self._request_sent[sh] > cutoff:
+                continue
+            spares = [s for s in self._shares
+                      if s._shnum not in self._blocks
+                      and s._shnum not in self._active_share_map]
+            # each hedge will use up one of the spares
+            if len(spares) <= hedges:
+                # there is nobody else to ask. Don't time this request again
+                # until there might be.
+                self._unhedgeable.add(sh)
+                continue
+            log.msg(format="SegmentFetcher(%(si)s) hedging slow request"
+                    " to %(share)s after %(elapsed).3fs",
+                    si=self._node._si_prefix, share=repr(sh),
+                    elapsed=now() - self._request_sent[sh],
+                    level=log.NOISY, parent=self._lp, umid="nvYk3g")
+            hedges += 1
+            self._hedged.add(sh)
+            self._node._download_status.add_hedge_issued()
+            self._block_request_activity(sh, shnum, OVERDUE)
+        self._schedule_hedge_check()
+
     def _start_share(self, share, shnum):
         self._share_observers[share] = o = share.get_block(self.segnum)
         o.subscribe(self._block_request_activity, share=share, shnum=shnum)
@@ -240,11 +342,15 @@ class SegmentFetcher:
             self._shares_from_server.discard(server, share)
             if self._active_share_map.get(shnum) is share:
                 del self._active_share_map[shnum]
+                self._recheck_hedges()
             self._overdue_share_map.discard(shnum, share)
+            self._unhedgeable.discard(share)
 
         if state is COMPLETE:
             # 'block' is fully validated and complete
             self._blocks[shnum] = block
+            self._node.add_block_latency(share._server,
+                                         now() - self._request_sent[share])
 
         if state is OVERDUE:
             # no longer active, but still might complete
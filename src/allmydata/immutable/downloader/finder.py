@@ -3,6 +3,7 @@ import time
 now = time.time
 from foolscap.api import eventually
 from allmydata.util import base32, log
+from allmydata.storage_client import get_buckets
 from twisted.internet import reactor
 
 from share import Share, CommonShare
@@ -63,6 +64,13 @@ class ShareFinder:
         if not self._started:
             si = self.verifycap.storage_index
             servers = self._storage_broker.get_servers_for_psi(si)
+            # ask the servers that had shares the last time we downloaded
+            # this file (if we remember) before the rest
+            cached = self.node.get_cached_share_locations()
+            if cached:
+                servers = ([s for s in servers if s.get_serverid() in cached]
+                           + [s for s in servers
+                              if s.get_serverid() not in cached])
             self._servers = iter(servers)
             self._started = True
 
@@ -140,7 +148,7 @@ class ShareFinder:
         # TODO: get the timer from a Server object, it knows best
         self.overdue_timers[req] = reactor.callLater(self.OVERDUE_TIMEOUT,
                                                      self.overdue, req)
-        d = server.get_rref().callRemote("get_buckets", self._storage_index)
+        d = get_buckets(server.get_rref(), self._storage_index)
         d.addBoth(incidentally, self._request_retired, req)
         d.addCallbacks(self._got_response, self._got_error,
                        callbackArgs=(server, req, d_ev, time_sent, lp),
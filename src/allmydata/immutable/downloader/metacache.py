@@ -0,0 +1,157 @@
+"""
+I remember the metadata that a download of an immutable file must fetch
+before it can deliver the first byte, so that files which are read again
+(every few minutes, or after the node restarts) can start with it instead.
+
+Entries are keyed by storage index and hold the URI extension block (which
+includes the segment size and the roots of the ciphertext and share hash
+trees), the validated nodes of the share hash tree, and the servers where
+shares were found. Nothing here is trusted: the UEB is checked against the
+hash in the verifycap before it is used, the share hashes are checked
+against the root in that UEB, and the locations are only used to decide
+which servers to ask first. A damaged or stale entry costs round trips, not
+correctness.
+
+The oldest entries are discarded to keep at most MAX_FILES of them. Since
+losing the newest entries costs nothing but round trips, new entries are
+only committed every COMMIT_INTERVAL seconds, and when the node stops.
+"""
+
+import os, struct, time
+from zope.interface import implements
+from twisted.application import service
+from allmydata.interfaces import IStatsProducer, HASH_SIZE
+from allmydata.util import base32
+from allmydata.util.dbutil import get_sqlite
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE files
+(
+ storage_index VARCHAR(26) PRIMARY KEY, -- base32
+ ueb           BLOB,    -- the URI extension block
+ share_hashes  BLOB,    -- (hashnum,hash) pairs, as in the share layout
+ added         NUMBER
+);
+
+CREATE TABLE locations
+(
+ storage_index VARCHAR(26), -- base32
+ serverid      VARCHAR(32), -- base32
+ shnum         INTEGER,
+ PRIMARY KEY (storage_index, serverid, shnum)
+);
+"""
+
+class DownloadMetadataCache(service.Service):
+    implements(IStatsProducer)
+    name = "download-metadata-cache"
+    VERSION = 1
+    MAX_FILES = 10000
+    COMMIT_INTERVAL = 10 # seconds
+
+    def __init__(self, dbfile, stats_provider=None):
+        self.sqlite_module = sqlite = get_sqlite()
+        must_create = not os.path.exists(dbfile)
+        self.connection = sqlite.connect(dbfile)
+        self.cursor = self.connection.cursor()
+        if must_create:
+            self.cursor.executescript(SCHEMA_v1)
+            self.cursor.execute("INSERT INTO version (version) VALUES (?)",
+                                (self.VERSION,))
+            self.connection.commit()
+        self.cursor.execute("SELECT version FROM version")
+        version = self.cursor.fetchone()[0]
+        if version != self.VERSION:
+            raise ValueError("unable to handle download metadata cache"
+                             " version %s" % version)
+        # an upper bound on the number of files: add() counts files that it
+        # replaces, too. It is corrected after each _prune().
+        self.cursor.execute("SELECT COUNT(*) FROM files")
+        self._num_files = self.cursor.fetchone()[0]
+        self._last_commit = time.time()
+        self.hits = 0
+        self.misses = 0
+        if stats_provider:
+            stats_provider.register_producer(self)
+
+    def get(self, storage_index):
+        """Return (UEB, share_hashes, locations) for the given file, or None
+        if I don't have it. share_hashes is a dict that maps hashnum to hash,
+        and locations maps serverid to a set of shnums."""
+        si_s = base32.b2a(storage_index)
+        c = self.cursor
+        c.execute("SELECT ueb,share_hashes FROM files WHERE storage_index=?",
+                  (si_s,))
+        row = c.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        UEB_s = str(row[0])
+        hashdata = str(row[1])
+        share_hashes = {}
+        for i in range(0, len(hashdata) - len(hashdata) % (2+HASH_SIZE),
+                       2+HASH_SIZE):
+            (hashnum,) = struct.unpack(">H", hashdata[i:i+2])
+            share_hashes[hashnum] = hashdata[i+2:i+2+HASH_SIZE]
+        locations = {}
+        c.execute("SELECT serverid,shnum FROM locations WHERE storage_index=?",
+                  (si_s,))
+        for (serverid_s, shnum) in c.fetchall():
+            serverid = base32.a2b(str(serverid_s))
+            locations.setdefault(serverid, set()).add(shnum)
+        return (UEB_s, share_hashes, locations)
+
+    def add(self, storage_index, UEB_s, share_hashes, locations):
+        """Remember the metadata of a file, replacing anything I knew about
+        it before. The arguments are the same as the results of get()."""
+        si_s = base32.b2a(storage_index)
+        hashdata = "".join([struct.pack(">H", hashnum) + share_hashes[hashnum]
+                            for hashnum in sorted(share_hashes)])
+        c = self.cursor
+        c.execute("REPLACE INTO files VALUES (?,?,?,?)",
+                  (si_s, self.sqlite_module.Binary(UEB_s),
+                   self.sqlite_module.Binary(hashdata), time.time()))
+        c.execute("DELETE FROM locations WHERE storage_index=?", (si_s,))
+        for serverid, shnums in locations.items():
+            for shnum in shnums:
+                c.execute("INSERT INTO locations VALUES (?,?,?)",
+                          (si_s, base32.b2a(serverid), shnum))
+        self._num_files += 1
+        if self._num_files > self.MAX_FILES:
+            self._prune()
+        now = time.time()
+        if now - self._last_commit >= self.COMMIT_INTERVAL:
+            self.connection.commit()
+            self._last_commit = now
+
+    def _prune(self):
+        # make room for a tenth of MAX_FILES, so that we don't have to do
+        # this again for every new file
+        keep = self.MAX_FILES - self.MAX_FILES // 10
+        c = self.cursor
+        c.execute("DELETE FROM files WHERE storage_index NOT IN"
+                  " (SELECT storage_index FROM files"
+                  "  ORDER BY added DESC, rowid DESC LIMIT ?)", (keep,))
+        c.execute("DELETE FROM locations WHERE storage_index NOT IN"
+                  " (SELECT storage_index FROM files)")
+        c.execute("SELECT COUNT(*) FROM files")
+        self._num_files = c.fetchone()[0]
+
+    def get_stats(self):
+        return {"downloader.metadata_cache.hits": self.hits,
+                "downloader.metadata_cache.misses": self.misses,
+                }
+
+    def stopService(self):
+        self.close()
+        return service.Service.stopService(self)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -17,6 +17,17 @@ from fetcher import SegmentFetcher
 from segmentation import Segmentation
 from common import BadCiphertextHashError
 
+def decode_segment(codec_params, blocks, shareids, segment_size):
+    """Erasure-decode one segment from k blocks, and hash it. I return a
+    (segment, crypttext segment hash) tuple. Only the first 'segment_size'
+    bytes of the decoded data are kept: the rest is the padding of a short
+    tail segment. I touch nothing but my arguments, so that a DownloadNode
+    can hand me to a WorkerPool."""
+    codec = CRSDecoder()
+    codec.set_params(*codec_params)
+    segment = "".join(codec.decode_blocks(blocks, shareids))[:segment_size]
+    return (segment, hashutil.crypttext_segment_hash(segment))
+
 class Cancel:
     def __init__(self, f):
         self._f = f
@@ -30,9 +41,16 @@ class DownloadNode:
     """Internal class which manages downloads and holds state. External
     callers use CiphertextFileNode instead."""
 
+    # how many recent block-request latencies to remember, for each server
+    # and in total, and how many we need before hedging any requests
+    SERVER_LATENCY_SAMPLES = 10
+    LATENCY_SAMPLES = 100
+    MIN_HEDGE_SAMPLES = 10
+
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history, download_status):
+                 terminator, history, download_status,
+                 download_parameters=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
@@ -49,6 +67,27 @@ class DownloadNode:
         self._secret_holder = secret_holder
         self._history = history
         self._download_status = download_status
+        if download_parameters is None:
+            download_parameters = {}
+        # how far past the segment it is delivering each read() may fetch.
+        # See Segmentation for details.
+        self.readahead_segments = download_parameters.get(
+            "readahead_segments", 0)
+        self.readahead_bytes = download_parameters.get("readahead_bytes", 0)
+        # a SegmentCache shared with the other nodes of this client, or None
+        self._segment_cache = download_parameters.get("segment_cache")
+        # if set, SegmentFetchers hedge any block request that takes longer
+        # than this percentile of the recent ones
+        self.hedge_percentile = download_parameters.get("hedge_percentile", 0)
+        self._server_latencies = {} # maps server to recent latencies
+        # a DownloadMetadataCache shared with the other nodes of this client,
+        # or None
+        self._metadata_cache = download_parameters.get("metadata_cache")
+        self._cached_locations = {} # serverid -> set(shnums), from the cache
+        self._metadata_saved = False
+        self._latencies = [] # recent latencies, from all servers
+        # if set, segments are decoded and hashed by this WorkerPool
+        self._worker_pool = download_parameters.get("worker_pool")
 
         k, N = self._verifycap.needed_shares, self._verifycap.total_shares
         self.share_hash_tree = IncompleteHashTree(N)
@@ -62,6 +101,7 @@ class DownloadNode:
 
         # filled in when we parse a valid UEB
         self.have_UEB = False
+        self._UEB_s = None
         self.segment_size = None
         self.tail_segment_size = None
         self.tail_segment_padded = None
@@ -74,6 +114,9 @@ class DownloadNode:
         # _segment_requests can have duplicates
         self._segment_requests = [] # (segnum, d, cancel_handle, logparent)
         self._active_segment = None # a SegmentFetcher, with .segnum
+        # segnums whose blocks have arrived and are being decoded. The next
+        # SegmentFetcher is started while this happens.
+        self._decoding = set()
 
         self._segsize_observers = observer.OneShotObserverList()
 
@@ -94,6 +137,8 @@ class DownloadNode:
         self._sharefinder = ShareFinder(storage_broker, verifycap, self,
                                         self._download_status, lp)
         self._shares = set()
+        if self._metadata_cache:
+            self._load_cached_metadata()
 
     def _build_guessed_tables(self, max_segment_size):
         size = min(self._verifycap.size, max_segment_size)
@@ -106,6 +151,51 @@ class DownloadNode:
         self.ciphertext_hash_tree = IncompleteHashTree(self.guessed_num_segments)
         self.ciphertext_hash_tree_leaves = self.guessed_num_segments
 
+    def _load_cached_metadata(self):
+        cached = self._metadata_cache.get(self._verifycap.storage_index)
+        if cached is None:
+            return
+        (UEB_s, share_hashes, locations) = cached
+        try:
+            self.validate_and_store_UEB(UEB_s)
+            # this checks them against the share_root_hash in the UEB
+            self.share_hash_tree.set_hashes(share_hashes)
+        except (BadHashError, NotEnoughHashesError):
+            # the shares will provide whatever we could not use
+            log.msg("unusable cached metadata", failure=Failure(),
+                    level=log.UNUSUAL, parent=self._lp, umid="Ux3VbQ")
+            return
+        self._cached_locations = locations
+        log.msg(format="using cached metadata, segsize=%(segsize)d",
+                segsize=self.segment_size,
+                level=log.NOISY, parent=self._lp, umid="hBq0Dg")
+
+    def _save_metadata(self):
+        # called when the first segment has been validated, at which point
+        # we know the UEB and the share hash chains of the shares we used
+        self._metadata_saved = True
+        locations = {}
+        for s in self._shares:
+            locations.setdefault(s._server.get_serverid(), set()).add(s._shnum)
+        known = True
+        for serverid, shnums in locations.items():
+            if not shnums.issubset(self._cached_locations.get(serverid, ())):
+                known = False
+        if self._cached_locations and known:
+            return # nothing new to remember
+        share_hashes = {}
+        for (hashnum, h) in enumerate(self.share_hash_tree):
+            if h:
+                share_hashes[hashnum] = h
+        self._metadata_cache.add(self._verifycap.storage_index, self._UEB_s,
+                                 share_hashes, locations)
+
+    def get_cached_share_locations(self):
+        """Return a dict that maps the serverid of each server which held
+        shares of this file the last time it was downloaded to a set of
+        shnums. It is empty unless a metadata cache is in use."""
+        return self._cached_locations
+
     def __repr__(self):
         return "ImmutableDownloadNode(%s)" % (self._si_prefix,)
 
@@ -189,6 +279,18 @@ class DownloadNode:
         self._download_status.add_segment_request(segnum, now())
         d = defer.Deferred()
         c = Cancel(self._cancel_request)
+        if self._segment_cache and self.segment_size is not None:
+            # we only trust the cache once we know the segment size, so that
+            # Segmentation can tell what it is being given
+            cached = self._segment_cache.get(self._verifycap.storage_index,
+                                             segnum)
+            if cached is not None:
+                (offset, segment) = cached
+                self._download_status.add_segment_delivery(segnum, now(),
+                                                           offset,
+                                                           len(segment), 0)
+                eventually(self._deliver, d, c, (offset, segment, 0))
+                return (d, c)
         self._segment_requests.append( (segnum, d, c, lp) )
         self._start_new_segment()
         return (d, c)
@@ -212,10 +314,13 @@ class DownloadNode:
     # arbitrary-sized read() calls into quantized segment fetches
 
     def _start_new_segment(self):
-        if self._active_segment is None and self._segment_requests:
-            segnum = self._segment_requests[0][0]
+        if self._active_segment is not None:
+            return
+        waiting = [t for t in self._segment_requests
+                   if t[0] not in self._decoding]
+        if waiting:
+            (segnum, d, c, lp) = waiting[0]
             k = self._verifycap.needed_shares
-            lp = self._segment_requests[0][3]
             log.msg(format="%(node)s._start_new_segment: segnum=%(segnum)d",
                     node=repr(self), segnum=segnum,
                     level=log.NOISY, parent=lp, umid="wAlnHQ")
@@ -243,6 +348,7 @@ class DownloadNode:
         if h != self._verifycap.uri_extension_hash:
             raise BadHashError
         self._parse_and_store_UEB(UEB_s) # sets self._stuff
+        self._UEB_s = UEB_s
         # TODO: a malformed (but authentic) UEB could throw an assertion in
         # _parse_and_store_UEB, and we should abandon the download.
         self.have_UEB = True
@@ -380,6 +486,32 @@ class DownloadNode:
     def want_more_shares(self):
         self._sharefinder.hungry()
 
+    def add_block_latency(self, server, latency):
+        latencies = self._server_latencies.setdefault(server, [])
+        latencies.append(latency)
+        del latencies[:-self.SERVER_LATENCY_SAMPLES]
+        self._latencies.append(latency)
+        del self._latencies[:-self.LATENCY_SAMPLES]
+
+    def get_server_latency(self, server):
+        """Return the median of the recent block-request latencies of the
+        given server, or None if it has not been asked for any blocks."""
+        latencies = self._server_latencies.get(server)
+        if not latencies:
+            return None
+        return sorted(latencies)[len(latencies)//2]
+
+    def get_hedge_timeout(self):
+        """Return how long a block request may take before a SegmentFetcher
+        should ask another share for a block, or None to never do that."""
+        if (not self.hedge_percentile
+            or len(self._latencies) < self.MIN_HEDGE_SAMPLES):
+            return None
+        latencies = sorted(self._latencies)
+        i = min(len(latencies)-1,
+                len(latencies) * self.hedge_percentile // 100)
+        return latencies[i]
+
     def fetch_failed(self, sf, f):
         assert sf is self._active_segment
         # deliver error upwards
@@ -389,6 +521,12 @@ class DownloadNode:
         self._start_new_segment()
 
     def process_blocks(self, segnum, blocks):
+        # the network part of this segment is done, so the fetch of the next
+        # one (if some Segmentation is reading ahead) can overlap with the
+        # decoding and delivery of this one
+        self._active_segment = None
+        self._decoding.add(segnum)
+        self._start_new_segment()
         d = defer.maybeDeferred(self._decode_blocks, segnum, blocks)
         d.addCallback(self._check_ciphertext_hash, segnum)
         def _deliver(result):
@@ -399,13 +537,18 @@ class DownloadNode:
                 (offset, segment, decodetime) = result
                 ds.add_segment_delivery(segnum, now(),
                                         offset, len(segment), decodetime)
+                if self._segment_cache:
+                    self._segment_cache.add(self._verifycap.storage_index,
+                                            segnum, offset, segment)
+                if self._metadata_cache and not self._metadata_saved:
+                    self._save_metadata()
             log.msg(format="delivering segment(%(segnum)d)",
                     segnum=segnum,
                     level=log.OPERATIONAL, parent=self._lp,
                     umid="j60Ojg")
+            self._decoding.discard(segnum)
             for (d,c) in self._extract_requests(segnum):
                 eventually(self._deliver, d, c, result)
-            self._active_segment = None
             self._start_new_segment()
         d.addBoth(_deliver)
         d.addErrback(lambda f:
@@ -414,10 +557,12 @@ class DownloadNode:
                              parent=self._lp, umid="MkEsCg"))
 
     def _decode_blocks(self, segnum, blocks):
+        # I fire with (segment, decodetime, crypttext segment hash)
         tail = (segnum == self.num_segments-1)
         codec = self._codec
         block_size = self.block_size
         decoded_size = self.segment_size
+        segment_size = self.segment_size
         if tail:
             # account for the padding in the last segment
             codec = CRSDecoder()
@@ -425,6 +570,7 @@ class DownloadNode:
             codec.set_params(self.tail_segment_padded, k, N)
             block_size = self.tail_block_size
             decoded_size = self.tail_segment_padded
+            segment_size = self.tail_segment_size
 
         shares = []
         shareids = []
@@ -435,6 +581,15 @@ class DownloadNode:
         del blocks
 
         start = now()
+        if self._worker_pool:
+            # the worker hashes the segment too, while it has it
+            d = self._worker_pool.run(decode_segment, codec.get_params(),
+                                      shares, shareids, segment_size)
+            del shares
+            def _decoded((segment, h)):
+                return (segment, now() - start, h)
+            d.addCallback(_decoded)
+            return d
         d = codec.decode(shares, shareids)   # segment
         del shares
         def _process(buffers):
@@ -444,16 +599,15 @@ class DownloadNode:
             del buffers
             if tail:
                 segment = segment[:self.tail_segment_size]
-            return (segment, decodetime)
+            return (segment, decodetime,
+                    hashutil.crypttext_segment_hash(segment))
         d.addCallback(_process)
         return d
 
-    def _check_ciphertext_hash(self, (segment, decodetime), segnum):
-        assert self._active_segment.segnum == segnum
+    def _check_ciphertext_hash(self, (segment, decodetime, h), segnum):
         assert self.segment_size is not None
         offset = segnum * self.segment_size
 
-        h = hashutil.crypttext_segment_hash(segment)
         try:
             self.ciphertext_hash_tree.set_hashes(leaves={segnum: h})
             return (offset, segment, decodetime)
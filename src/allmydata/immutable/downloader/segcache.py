@@ -0,0 +1,90 @@
+"""
+I remember recently downloaded segments of immutable files, so that clients
+which read overlapping ranges of the same file over and over (video players
+seeking through the web gateway, SFTP and FUSE frontends doing small random
+reads) do not fetch and decode the same segments again for each read.
+
+Entries are keyed by (storage_index, segnum) and hold the decoded ciphertext
+segment, which has already been checked against the ciphertext hash tree. The
+least recently used ones are discarded to keep the total size of the cached
+segments under a byte budget. Immutable files never change, so entries never
+need to be invalidated.
+"""
+
+from zope.interface import implements
+from allmydata.interfaces import IStatsProducer
+
+class _Entry(object):
+    __slots__ = ["key", "offset", "segment", "prev", "next"]
+    def __init__(self, key, offset, segment):
+        self.key = key
+        self.offset = offset
+        self.segment = segment
+        self.prev = self.next = None
+
+class SegmentCache:
+    """I am an LRU cache of decoded segments holding at most max_bytes of
+    them. I am shared by all the immutable files of a client."""
+    implements(IStatsProducer)
+
+    def __init__(self, max_bytes, stats_provider=None):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = {} # (storage_index, segnum) -> _Entry
+        # a circular doubly-linked list, most recently used first
+        self._head = _Entry(None, None, None)
+        self._head.prev = self._head.next = self._head
+        self.hits = 0
+        self.misses = 0
+        if stats_provider:
+            stats_provider.register_producer(self)
+
+    def get(self, storage_index, segnum):
+        """Return (offset, segment) for the given segment, or None if I don't
+        have it."""
+        entry = self._entries.get((storage_index, segnum))
+        if entry is None:
+            self.misses += 1
+            return None
+        self._unlink(entry)
+        self._link(entry)
+        self.hits += 1
+        return (entry.offset, entry.segment)
+
+    def add(self, storage_index, segnum, offset, segment):
+        key = (storage_index, segnum)
+        if len(segment) > self.max_bytes or key in self._entries:
+            return
+        entry = _Entry(key, offset, segment)
+        self._entries[key] = entry
+        self._link(entry)
+        self.bytes += len(segment)
+        while self.bytes > self.max_bytes:
+            self._remove(self._head.prev)
+
+    def _link(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self.bytes -= len(entry.segment)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return {"downloader.segment_cache.hits": self.hits,
+                "downloader.segment_cache.misses": self.misses,
+                "downloader.segment_cache.hit_rate": hit_rate,
+                "downloader.segment_cache.bytes": self.bytes,
+                "downloader.segment_cache.entries": len(self._entries),
+                }
@@ -3,6 +3,7 @@ import time
 now = time.time
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from twisted.internet.interfaces import IPushProducer
 from foolscap.api import eventually
 from allmydata.util import log
@@ -15,14 +16,26 @@ class Segmentation:
     segmentation: I figure out which segments are necessary, request them
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
-    request one segment at a time.
+    deliver data while my consumer wants it.
+
+    Once the segment size is known, I also request up to
+    node.readahead_segments of the segments that follow the one I am waiting
+    for (but no more than node.readahead_bytes worth of them, and never any
+    that lie beyond the end of my span), so that they are fetched while
+    earlier segments are being decoded and written, or while my consumer is
+    paused. They are delivered to the consumer in order. Any of them that
+    are still outstanding are cancelled if the consumer calls
+    stopProducing().
     """
     implements(IPushProducer)
     def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
         self._node = node
         self._hungry = True
-        self._active_segnum = None
-        self._cancel_segment_request = None
+        # outstanding and not-yet-delivered segment requests, in segnum
+        # order. Each is [segnum, cancel_handle, result, guessed], where
+        # result is None until the request is retired, and guessed is True
+        # if the segnum was computed from a guessed segment size.
+        self._requests = []
         # these are updated as we deliver data. At any given time, we still
         # want to download file[offset:offset+size]
         self._offset = offset
@@ -46,51 +59,90 @@ class Segmentation:
         return res
 
     def _maybe_fetch_next(self):
-        if not self._alive or not self._hungry:
-            return
-        if self._active_segnum is not None:
+        if not self._alive:
             return
-        self._fetch_next()
-
-    def _fetch_next(self):
-        if self._size == 0:
+        while (self._hungry and self._requests
+               and self._requests[0][2] is not None):
+            (segnum, c, result, guessed) = self._requests.pop(0)
+            if isinstance(result, Failure):
+                if guessed and result.check(WrongSegmentError,
+                                            BadSegmentNumberError):
+                    self._retry_bad_segment()
+                    continue
+                self._error(result)
+                return
+            try:
+                self._got_segment(result, segnum)
+            except WrongSegmentError:
+                if guessed:
+                    self._retry_bad_segment()
+                    continue
+                self._error(Failure())
+                return
+            # the consumer might have called our .stopProducing() inside
+            # that write() call
+            if not self._alive:
+                return
+        if self._hungry and self._size == 0:
             # done!
             self._alive = False
             self._hungry = False
             self._deferred.callback(self._consumer)
             return
+        self._fetch_next()
+
+    def _fetch_next(self):
         n = self._node
-        have_actual_segment_size = n.segment_size is not None
-        guess_s = ""
-        if not have_actual_segment_size:
-            guess_s = "probably "
-        segment_size = n.segment_size or n.guessed_segment_size
-        if self._offset == 0:
-            # great! we want segment0 for sure
-            wanted_segnum = 0
-        else:
-            # this might be a guess
-            wanted_segnum = self._offset // segment_size
-        log.msg(format="_fetch_next(offset=%(offset)d) %(guess)swants segnum=%(segnum)d",
-                offset=self._offset, guess=guess_s, segnum=wanted_segnum,
-                level=log.NOISY, parent=self._lp, umid="5WfN0w")
-        self._active_segnum = wanted_segnum
-        d,c = n.get_segment(wanted_segnum, self._lp)
-        self._cancel_segment_request = c
-        d.addBoth(self._request_retired)
-        d.addCallback(self._got_segment, wanted_segnum)
-        if not have_actual_segment_size:
-            # we can retry once
-            d.addErrback(self._retry_bad_segment)
+        if not self._requests:
+            if not self._hungry:
+                return
+            have_actual_segment_size = n.segment_size is not None
+            guess_s = ""
+            if not have_actual_segment_size:
+                guess_s = "probably "
+            segment_size = n.segment_size or n.guessed_segment_size
+            if self._offset == 0:
+                # great! we want segment0 for sure
+                wanted_segnum = 0
+            else:
+                # this might be a guess
+                wanted_segnum = self._offset // segment_size
+            log.msg(format="_fetch_next(offset=%(offset)d) %(guess)swants segnum=%(segnum)d",
+                    offset=self._offset, guess=guess_s, segnum=wanted_segnum,
+                    level=log.NOISY, parent=self._lp, umid="5WfN0w")
+            self._request_segment(wanted_segnum, not have_actual_segment_size)
+        if n.segment_size is None:
+            # we can't tell which segments come next until we know how big
+            # they are
+            return
+        first_segnum = self._offset // n.segment_size
+        if self._requests[0][0] != first_segnum:
+            # this request was based upon a bad guess, and will be retried
+            return
+        last_segnum = (self._offset + self._size - 1) // n.segment_size
+        readahead = min(n.readahead_segments,
+                        n.readahead_bytes // n.segment_size)
+        while len(self._requests) <= readahead:
+            segnum = first_segnum + len(self._requests)
+            if segnum > last_segnum:
+                break
+            log.msg(format="_fetch_next reading ahead to segnum=%(segnum)d",
+                    segnum=segnum,
+                    level=log.NOISY, parent=self._lp, umid="c2Yk3A")
+            self._request_segment(segnum, False)
+
+    def _request_segment(self, segnum, guessed):
+        d,c = self._node.get_segment(segnum, self._lp)
+        req = [segnum, c, None, guessed]
+        self._requests.append(req)
+        d.addBoth(self._request_retired, req)
         d.addErrback(self._error)
 
-    def _request_retired(self, res):
-        self._active_segnum = None
-        self._cancel_segment_request = None
-        return res
+    def _request_retired(self, res, req):
+        req[2] = res
+        self._maybe_fetch_next()
 
     def _got_segment(self, (segment_start,segment,decodetime), wanted_segnum):
-        self._cancel_segment_request = None
         # we got file[segment_start:segment_start+len(segment)]
         # we want file[self._offset:self._offset+self._size]
         log.msg(format="Segmentation got data:"
@@ -123,22 +175,27 @@ class Segmentation:
         # the consumer might call our .pauseProducing() inside that write()
         # call, setting self._hungry=False
         self._read_ev.update(len(desired_data), 0, 0)
-        self._maybe_fetch_next()
 
-    def _retry_bad_segment(self, f):
-        f.trap(WrongSegmentError, BadSegmentNumberError)
+    def _retry_bad_segment(self):
         # we guessed the segnum wrong: either one that doesn't overlap with
         # the start of our desired region, or one that's beyond the end of
         # the world. Now that we have the right information, we're allowed to
         # retry once.
         assert self._node.segment_size is not None
-        return self._maybe_fetch_next()
+        self._cancel_requests()
+
+    def _cancel_requests(self):
+        for (segnum, c, result, guessed) in self._requests:
+            if result is None:
+                c.cancel()
+        self._requests = []
 
     def _error(self, f):
         log.msg("Error in Segmentation", failure=f,
                 level=log.WEIRD, parent=self._lp, umid="EYlXBg")
         self._alive = False
         self._hungry = False
+        self._cancel_requests()
         self._deferred.errback(f)
 
     def stopProducing(self):
@@ -146,10 +203,9 @@ class Segmentation:
                 level=log.NOISY, parent=self._lp, umid="XIyL9w")
         self._hungry = False
         self._alive = False
-        # cancel any outstanding segment request
-        if self._cancel_segment_request:
-            self._cancel_segment_request.cancel()
-            self._cancel_segment_request = None
+        # cancel any outstanding segment requests, including the ones we
+        # were reading ahead
+        self._cancel_requests()
         e = DownloadStopped("our Consumer called stopProducing()")
         self._deferred.errback(e)
 
@@ -32,16 +32,18 @@ class Share:
     # this is a specific implementation of IShare for tahoe's native storage
     # servers. A different backend would use a different class.
 
+    MAX_READV_LENGTH = 30 # ReadVector's limit
+
     def __init__(self, rref, server, verifycap, commonshare, node,
                  download_status, shnum, dyhb_rtt, logparent):
         self._rref = rref
         self._server = server
         self._node = node # holds share_hash_tree and UEB
         self.actual_segment_size = node.segment_size # might still be None
-        # XXX change node.guessed_segment_size to
-        # node.best_guess_segment_size(), which should give us the real ones
-        # if known, else its guess.
-        self._guess_offsets(verifycap, node.guessed_segment_size)
+        # if the node already knows the real segment size (from another
+        # share, or from its metadata cache), our guess will be right
+        self._guess_offsets(verifycap, (node.segment_size or
+                                        node.guessed_segment_size))
         self.actual_offsets = None
         self._UEB_length = None
         self._commonshare = commonshare # holds block_hash_tree
@@ -718,6 +720,7 @@ class Share:
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
+        requests = []
         for (start, length) in ask:
             # TODO: quantize to reasonably-large blocks
             self._pending.add(start, length)
@@ -729,6 +732,24 @@ class Share:
             req_ev = ds.add_request_sent(self._server.get_serverid(),
                                          self._shnum,
                                          start, length, now())
+            requests.append((start, length, req_ev, lp))
+
+        if len(requests) > 1 and self._server_supports_readv():
+            # everything we want goes out in a single round trip, in as few
+            # readv() calls as the ReadVector constraint allows
+            for i in range(0, len(requests), self.MAX_READV_LENGTH):
+                chunk = requests[i:i+self.MAX_READV_LENGTH]
+                d = self._send_readv([r[:2] for r in chunk])
+                d.addCallbacks(self._got_readv_data, self._got_readv_error,
+                               callbackArgs=(chunk,), errbackArgs=(chunk,))
+                d.addCallback(self._trigger_loop)
+                d.addErrback(lambda f:
+                             log.err(format="unhandled error during send_readv",
+                                     failure=f, parent=self._lp,
+                                     level=log.WEIRD, umid="Hq2d8A"))
+            return
+
+        for (start, length, req_ev, lp) in requests:
             d = self._send_request(start, length)
             d.addCallback(self._got_data, start, length, req_ev, lp)
             d.addErrback(self._got_error, start, length, req_ev, lp)
@@ -738,9 +759,32 @@ class Share:
                                  failure=f, parent=self._lp,
                                  level=log.WEIRD, umid="qZu0wg"))
 
+    def _server_supports_readv(self):
+        version = self._server.get_version()
+        if not version:
+            return False
+        v1 = version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        return v1.get("supports-immutable-readv", False)
+
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
+    def _send_readv(self, readv):
+        return self._rref.callRemote("readv", readv)
+
+    def _got_readv_data(self, datav, requests):
+        if len(datav) != len(requests):
+            e = LayoutInvalid("readv() of %d ranges returned %d strings"
+                              % (len(requests), len(datav)))
+            self._got_readv_error(Failure(e), requests)
+            return
+        for ((start, length, req_ev, lp), data) in zip(requests, datav):
+            self._got_data(data, start, length, req_ev, lp)
+
+    def _got_readv_error(self, f, requests):
+        for (start, length, req_ev, lp) in requests:
+            self._got_error(f, start, length, req_ev, lp)
+
     def _got_data(self, data, start, length, req_ev, lp):
         req_ev.finished(len(data), now())
         if not self._alive:
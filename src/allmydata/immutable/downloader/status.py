@@ -77,6 +77,12 @@ class DownloadStatus:
         self.known_shares = [] # (serverid, shnum)
         self.problems = []
 
+        # a hedge is issued when a block request is so slow that we ask
+        # another share for a block instead. It is won if the segment is
+        # finished without waiting for the slow request.
+        self.hedges_issued = 0
+        self.hedges_won = 0
+
 
     def add_dyhb_sent(self, serverid, when):
         r = (when, None, None)
@@ -149,6 +155,11 @@ class DownloadStatus:
     def add_problem(self, p):
         self.problems.append(p)
 
+    def add_hedge_issued(self):
+        self.hedges_issued += 1
+    def add_hedge_won(self):
+        self.hedges_won += 1
+
     # IDownloadStatus methods
     def get_counter(self):
         return self.counter
@@ -3,6 +3,7 @@
 import time
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
@@ -36,8 +37,12 @@ Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
 information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+is read and encoded at a time, but the encoder may read and encode a few
+segments ahead of the ones whose blocks are still being delivered (see
+Encoder.LOOKAHEAD_SEGMENTS), so the CPU work for segment B can overlap with
+the network transfer of segment A. If the Encoder was given a WorkerPool,
+the erasure coding and the segment and block hashing are done by another
+process (see encode_segment), so several uploads can use several cores.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -62,6 +67,24 @@ hash tree is put into the URI.
 
 """
 
+def encode_segment(codec_params, chunks, length):
+    """Erasure-code one segment of crypttext, and hash the results. I
+    return a (crypttext segment hash, shares, shareids, block hashes) tuple.
+    Only the first 'length' bytes of the chunks are crypttext: the rest is
+    the padding of a short tail segment. I touch nothing but my arguments,
+    so that the Encoder can hand me to a WorkerPool."""
+    codec = CRSEncoder()
+    codec.set_params(*codec_params)
+    crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+    left = length
+    for c in chunks:
+        piece = c[:left]
+        crypttext_segment_hasher.update(piece)
+        left -= len(piece)
+    (shares, shareids) = codec.encode_blocks(chunks)
+    block_hashes = [hashutil.block_hash(block) for block in shares]
+    return (crypttext_segment_hasher.digest(), shares, shareids, block_hashes)
+
 class UploadAborted(Exception):
     pass
 
@@ -74,13 +97,26 @@ PiB=1024*TiB
 class Encoder(object):
     implements(IEncoder)
 
-    def __init__(self, log_parent=None, upload_status=None):
+    # how many segments may be read, encrypted, and encoded before the
+    # blocks of the segment being sent have been accepted by all of the
+    # shareholders. 0 means strictly one segment at a time.
+    LOOKAHEAD_SEGMENTS = 2
+    # but never hold more than this many bytes of encoded-but-unsent blocks
+    LOOKAHEAD_MEMORY = 4*1024*1024
+
+    def __init__(self, log_parent=None, upload_status=None,
+                 lookahead_segments=None, worker_pool=None):
         object.__init__(self)
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
         if upload_status:
             self._status = IUploadStatus(upload_status)
+        if lookahead_segments is None:
+            lookahead_segments = self.LOOKAHEAD_SEGMENTS
+        self._lookahead_segments = lookahead_segments
+        # if set, a WorkerPool that does the erasure coding and hashing
+        self._worker_pool = worker_pool
         precondition(log_parent is None or isinstance(log_parent, int),
                      log_parent)
         self._log_number = log.msg("creating Encoder %s" % self,
@@ -218,29 +254,36 @@ class Encoder(object):
         self.share_root_hashes = [None] * self.num_shares
 
         self._times = {
+            "cumulative_reading": 0.0,
             "cumulative_encoding": 0.0,
             "cumulative_sending": 0.0,
+            "cumulative_encode_wait": 0.0,
             "hashes_and_close": 0.0,
             "total_encode_and_push": 0.0,
             }
         self._start_total_timestamp = time.time()
 
+        # segments are encoded one after another on their own Deferred
+        # chain, which runs up to self._lookahead segments ahead of the
+        # chain that sends them.
+        self._lookahead = self._get_lookahead()
+        self._encoding = defer.succeed(None)
+        self._encoded_segments = {} # segnum -> Deferred
+        self._next_segment_to_encode = 0
+        self._encoding_failed = False
+
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
 
-        for i in range(self.num_segments-1):
+        for i in range(self.num_segments):
             # note to self: this form doesn't work, because lambda only
             # captures the slot, not the value
             #d.addCallback(lambda res: self.do_segment(i))
             # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
+            d.addCallback(lambda res, i=i: self._get_encoded_segment(i))
             d.addCallback(self._send_segment, i)
             d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
 
         d.addCallback(lambda res: self.finish_hashing())
 
@@ -296,6 +339,62 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    def _get_lookahead(self):
+        # each segment in the look-ahead queue holds num_shares blocks
+        encoded_size = self._codec.get_block_size() * self.num_shares
+        by_memory = self.LOOKAHEAD_MEMORY // max(encoded_size, 1)
+        return max(0, min(self._lookahead_segments, by_memory))
+
+    def _get_encoded_segment(self, segnum):
+        """Return a Deferred that fires with the (shares, shareids,
+        block_hashes) of the given segment, after making sure that the
+        segments after it (up to the look-ahead limit) are being encoded
+        too."""
+        last = min(segnum + self._lookahead, self.num_segments - 1)
+        while self._next_segment_to_encode <= last:
+            self._queue_encode(self._next_segment_to_encode)
+            self._next_segment_to_encode += 1
+        d = self._encoded_segments.pop(segnum)
+        if d.called:
+            return d
+        # the sender is waiting for the encoder
+        start = time.time()
+        def _waited(res):
+            self._times["cumulative_encode_wait"] += time.time() - start
+            return res
+        d.addBoth(_waited)
+        return d
+
+    def _queue_encode(self, segnum):
+        done = defer.Deferred()
+        self._encoded_segments[segnum] = done
+        def _encode(ign):
+            if self._encoding_failed:
+                # an earlier segment failed, which will stop the upload
+                # before anybody asks for this one
+                return
+            if segnum == self.num_segments - 1:
+                d = defer.maybeDeferred(self._encode_tail_segment, segnum)
+            else:
+                d = defer.maybeDeferred(self._encode_segment, segnum)
+            def _encoded(res):
+                if isinstance(res, Failure):
+                    self._encoding_failed = True
+                done.callback(res)
+            d.addBoth(_encoded)
+            # give the reactor a chance to move the previous segment's
+            # blocks onto the wire before we encode another one
+            d.addCallback(self._turn_barrier)
+            return d
+        self._encoding.addCallback(_encode)
+
+    def _discard_encoded_segments(self):
+        # the upload failed: any failure waiting in a segment that will
+        # never be sent is not interesting
+        for d in self._encoded_segments.values():
+            d.addErrback(lambda f: None)
+        self._encoded_segments.clear()
+
     def _encode_segment(self, segnum):
         codec = self._codec
         start = time.time()
@@ -319,7 +418,9 @@ class Encoder(object):
         # we read data from the source one segment at a time, and then chop
         # it into 'input_piece_size' pieces before handing it to the codec
 
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+        crypttext_segment_hasher = None
+        if not self._worker_pool:
+            crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
 
         # memory footprint: we only hold a tiny piece of the plaintext at any
         # given time. We build up a segment's worth of cryptttext, then hand
@@ -333,14 +434,32 @@ class Encoder(object):
         def _done_gathering(chunks):
             for c in chunks:
                 assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
+            self._times["cumulative_reading"] += time.time() - start
             # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
+            return self._encode_chunks(codec, chunks, crypttext_segment_hasher,
+                                       self.segment_size)
         d.addCallback(_done_gathering)
-        def _done(res):
+        return d
+
+    def _encode_chunks(self, codec, chunks, crypttext_segment_hasher, length):
+        # I fire with (shares, shareids, block_hashes)
+        start = time.time()
+        if self._worker_pool:
+            # the worker computes the crypttext segment hash too
+            d = self._worker_pool.run(encode_segment, codec.get_params(),
+                                      chunks, length)
+        else:
+            d = codec.encode(chunks)
+            def _hash((shares, shareids)):
+                block_hashes = [hashutil.block_hash(block) for block in shares]
+                return (crypttext_segment_hasher.digest(), shares, shareids,
+                        block_hashes)
+            d.addCallback(_hash)
+        def _done((crypttext_segment_hash, shares, shareids, block_hashes)):
+            self._crypttext_hashes.append(crypttext_segment_hash)
             elapsed = time.time() - start
             self._times["cumulative_encoding"] += elapsed
-            return res
+            return (shares, shareids, block_hashes)
         d.addCallback(_done)
         return d
 
@@ -350,7 +469,10 @@ class Encoder(object):
         codec = self._tail_codec
         input_piece_size = codec.get_block_size()
 
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+        crypttext_segment_hasher = None
+        if not self._worker_pool:
+            crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+        tail_size = self.file_size - segnum * self.segment_size
 
         d = self._gather_data(self.required_shares, input_piece_size,
                               crypttext_segment_hasher, allow_short=True)
@@ -359,14 +481,10 @@ class Encoder(object):
                 # a short trailing chunk will have been padded by
                 # _gather_data
                 assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            return codec.encode(chunks)
+            self._times["cumulative_reading"] += time.time() - start
+            return self._encode_chunks(codec, chunks, crypttext_segment_hasher,
+                                       tail_size)
         d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
         return d
 
     def _gather_data(self, num_chunks, input_chunk_size,
@@ -374,7 +492,9 @@ class Encoder(object):
                      allow_short=False):
         """Return a Deferred that will fire when the required number of
         chunks have been read (and hashed and encrypted). The Deferred fires
-        with a list of chunks, each of size input_chunk_size."""
+        with a list of chunks, each of size input_chunk_size. If
+        crypttext_segment_hasher is None, the caller will hash the segment
+        itself."""
 
         # I originally built this to allow read_encrypted() to behave badly:
         # to let it return more or less data than you asked for. It would
@@ -406,7 +526,8 @@ class Encoder(object):
             precondition(len(data) <= read_size, len(data), read_size)
             if not allow_short:
                 precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
+            if crypttext_segment_hasher:
+                crypttext_segment_hasher.update(data)
             self._crypttext_hasher.update(data)
             if allow_short and len(data) < read_size:
                 # padding
@@ -417,7 +538,7 @@ class Encoder(object):
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, (shares, shareids), segnum):
+    def _send_segment(self, (shares, shareids, block_hashes), segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
@@ -436,7 +557,7 @@ class Encoder(object):
             shareid = shareids[i]
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -455,10 +576,22 @@ class Encoder(object):
                      level=log.OPERATIONAL)
             elapsed = time.time() - start
             self._times["cumulative_sending"] += elapsed
+            self._update_pipeline_windows()
             return res
         dl.addCallback(_logit)
         return dl
 
+    def _update_pipeline_windows(self):
+        if not self._status:
+            return
+        windows = {}
+        for shareid, sh in self.landlords.items():
+            # only real WriteBucketProxies have a pipeline
+            if hasattr(sh, "get_pipeline_capacity"):
+                windows[shareid] = (sh.get_peerid(),
+                                    sh.get_pipeline_capacity())
+        self._status.set_pipeline_windows(windows)
+
     def send_block(self, shareid, segment_num, block, lognum):
         if shareid not in self.landlords:
             return defer.succeed(None)
@@ -659,6 +792,7 @@ class Encoder(object):
     def err(self, f):
         self.log("upload failed", failure=f, level=log.UNUSUAL)
         self.set_status("Failed")
+        self._discard_encoded_segments()
         # we need to abort any remaining shareholders, so they'll delete the
         # partial share, allowing someone else to upload it again.
         self.log("aborting shareholders", level=log.UNUSUAL)
@@ -5,7 +5,8 @@ import time
 now = time.time
 from zope.interface import implements, Interface
 from twisted.internet import defer
-from twisted.internet.interfaces import IConsumer
+from twisted.python.failure import Failure
+from twisted.internet.interfaces import IConsumer, IPushProducer
 
 from allmydata.interfaces import IImmutableFileNode, IUploadResults
 from allmydata import uri
@@ -18,6 +19,7 @@ from allmydata.immutable.checker import Checker
 from allmydata.immutable.repairer import Repairer
 from allmydata.immutable.downloader.node import DownloadNode
 from allmydata.immutable.downloader.status import DownloadStatus
+from allmydata.immutable.upload import encrypt_at
 
 class IDownloadStatusHandlingConsumer(Interface):
     def set_download_status_read_event(read_ev):
@@ -26,13 +28,14 @@ class IDownloadStatusHandlingConsumer(Interface):
 
 class CiphertextFileNode:
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, download_parameters=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._download_parameters = download_parameters
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -47,7 +50,8 @@ class CiphertextFileNode:
             self._node = DownloadNode(self._verifycap, self._storage_broker,
                                       self._secret_holder,
                                       self._terminator,
-                                      self._history, self._download_status)
+                                      self._history, self._download_status,
+                                      self._download_parameters)
 
     def read(self, consumer, offset=0, size=None):
         """I am the main entry point, from which FileNode.read() can get
@@ -208,19 +212,160 @@ class DecryptingConsumer:
             self._read_event.update(0, elapsed, 0)
         self._consumer.write(plaintext)
 
+    def when_done(self, res):
+        """Add me to the Deferred chain of the read() that I am decrypting
+        for. I return 'res' (or a Deferred that fires with it) once all of
+        the plaintext has been written to the real Consumer."""
+        return res
+
+class PooledDecryptingConsumer(DecryptingConsumer):
+    """I am a DecryptingConsumer that decrypts in a WorkerPool, so several
+    writes can be decrypted at once while the Producer fetches more. The
+    plaintext is still written to the real Consumer in order. I sit between
+    the real Producer and the real Consumer as a Producer too, so that I can
+    pause the real Producer while too much ciphertext is waiting to be
+    decrypted, and hold unregisterProducer() back until all of the
+    plaintext has been written."""
+    implements(IPushProducer)
+
+    MAX_PENDING_BYTES = 1*1000*1000
+
+    def __init__(self, consumer, readkey, offset, worker_pool):
+        self._consumer = consumer
+        self._read_event = None
+        self._readkey = readkey
+        self._offset = offset # of the next ciphertext to be written to me
+        self._worker_pool = worker_pool
+        self._pending = [] # [length, plaintext or None], in order
+        self._pending_bytes = 0
+        self._producer = None
+        self._streaming = False
+        self._consumer_paused = False
+        self._backlogged = False
+        self._unregister_when_done = False
+        self._failure = None
+        self._done_waiters = [] # (Deferred, res)
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._streaming = streaming
+        self._consumer.registerProducer(self, streaming)
+    def unregisterProducer(self):
+        self._producer = None
+        if self._pending:
+            self._unregister_when_done = True
+        else:
+            self._consumer.unregisterProducer()
+
+    def pauseProducing(self):
+        self._consumer_paused = True
+        if self._producer and not self._backlogged:
+            self._producer.pauseProducing()
+    def resumeProducing(self):
+        self._consumer_paused = False
+        if self._producer and not self._backlogged:
+            self._producer.resumeProducing()
+    def stopProducing(self):
+        if self._producer:
+            self._producer.stopProducing()
+
+    def write(self, ciphertext):
+        if self._failure:
+            return
+        started = now()
+        entry = [len(ciphertext), None]
+        self._pending.append(entry)
+        self._pending_bytes += len(ciphertext)
+        # AES-CTR decryption is the same operation as encryption
+        d = self._worker_pool.run(encrypt_at, self._readkey, self._offset,
+                                  [ciphertext])
+        self._offset += len(ciphertext)
+        def _decrypted(chunks):
+            if self._read_event:
+                elapsed = now() - started
+                self._read_event.update(0, elapsed, 0)
+            entry[1] = chunks[0]
+            self._deliver()
+        d.addCallbacks(_decrypted, self._failed)
+        if (self._streaming and self._producer and not self._backlogged
+            and self._pending_bytes > self.MAX_PENDING_BYTES):
+            self._backlogged = True
+            if not self._consumer_paused:
+                self._producer.pauseProducing()
+
+    def _deliver(self):
+        while self._pending and self._pending[0][1] is not None:
+            (length, plaintext) = self._pending.pop(0)
+            self._pending_bytes -= length
+            self._consumer.write(plaintext)
+        if self._backlogged and self._pending_bytes <= self.MAX_PENDING_BYTES:
+            self._backlogged = False
+            if self._producer and not self._consumer_paused:
+                self._producer.resumeProducing()
+        if not self._pending:
+            if self._unregister_when_done:
+                self._unregister_when_done = False
+                self._consumer.unregisterProducer()
+            self._fire_done_waiters()
+
+    def _failed(self, f):
+        if self._failure:
+            return
+        self._failure = f
+        self._pending = []
+        self._pending_bytes = 0
+        if self._producer:
+            # the read() will errback with DownloadStopped, which when_done
+            # replaces with this failure
+            self._producer.stopProducing()
+            return
+        if self._unregister_when_done:
+            self._unregister_when_done = False
+            self._consumer.unregisterProducer()
+        self._fire_done_waiters()
+
+    def _fire_done_waiters(self):
+        waiters, self._done_waiters = self._done_waiters, []
+        for (d, res) in waiters:
+            if self._failure:
+                d.errback(self._failure)
+            else:
+                d.callback(res)
+
+    def when_done(self, res):
+        if isinstance(res, Failure) and not self._failure:
+            # the download failed, so nobody wants the plaintext that is
+            # still being decrypted
+            self._failure = res
+            self._pending = []
+            self._pending_bytes = 0
+            if self._unregister_when_done:
+                self._unregister_when_done = False
+                self._consumer.unregisterProducer()
+            return res
+        d = defer.Deferred()
+        self._done_waiters.append((d, res))
+        if not self._pending:
+            self._fire_done_waiters()
+        return d
+
 class ImmutableFileNode:
     implements(IImmutableFileNode)
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, download_parameters=None):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         download_parameters)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
+        self._worker_pool = None
+        if download_parameters:
+            self._worker_pool = download_parameters.get("worker_pool")
 
     # TODO: I'm not sure about this.. what's the use case for node==node? If
     # we keep it here, we should also put this on CiphertextFileNode
@@ -238,8 +383,13 @@ class ImmutableFileNode:
             return True
 
     def read(self, consumer, offset=0, size=None):
-        decryptor = DecryptingConsumer(consumer, self._readkey, offset)
+        if self._worker_pool:
+            decryptor = PooledDecryptingConsumer(consumer, self._readkey,
+                                                 offset, self._worker_pool)
+        else:
+            decryptor = DecryptingConsumer(consumer, self._readkey, offset)
         d = self._cnode.read(decryptor, offset, size)
+        d.addBoth(decryptor.when_done)
         d.addCallback(lambda dc: consumer)
         return d
 
@@ -0,0 +1,109 @@
+"""
+I remember the convergent encryption keys of local files that have been
+uploaded before, so that uploading an unchanged file again does not need a
+separate pass over its contents just to derive the key.
+
+Entries are keyed by the file's absolute path, size, mtime and ctime (the
+same test that 'tahoe backup' uses to decide that a file is unchanged), and
+by a hash of the encoding parameters and convergence secret that went into
+the key. A file that is rewritten within one timestamp tick without changing
+its size keeps the same stamp, and a stale key would give the new contents
+the old file's storage index: the upload could then return the old file's
+cap, or leave the new UEB next to the old shares. So a key is neither
+remembered nor used while the file's mtime or ctime is less than MIN_AGE
+seconds old (coarse timestamps could hide a later change), and FileName only
+remembers a key if the file's stamp did not change while it was hashed.
+
+The database holds encryption keys, so it must live somewhere as private as
+the node's other secrets.
+"""
+
+import os, time
+from twisted.application import service
+from allmydata.util.dbutil import get_sqlite
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE keys
+(
+ path   BLOB,          -- absolute local filename, UTF-8 if it was unicode
+ params VARCHAR(64),   -- base32(convergent_key_cache_params(k,n,segsize,convergence))
+ size   INTEGER,
+ mtime  NUMBER,
+ ctime  NUMBER,
+ key    VARCHAR(32),   -- base32(convergent encryption key)
+ PRIMARY KEY (path, params)
+);
+"""
+
+class ConvergentKeyCache(service.Service):
+    name = "convergent-key-cache"
+    VERSION = 1
+    MIN_AGE = 2 # seconds
+
+    def __init__(self, dbfile):
+        self.sqlite_module = sqlite = get_sqlite()
+        must_create = not os.path.exists(dbfile)
+        self.connection = sqlite.connect(dbfile)
+        self.cursor = self.connection.cursor()
+        if must_create:
+            self.cursor.executescript(SCHEMA_v1)
+            self.cursor.execute("INSERT INTO version (version) VALUES (?)",
+                                (self.VERSION,))
+            self.connection.commit()
+        self.cursor.execute("SELECT version FROM version")
+        version = self.cursor.fetchone()[0]
+        if version != self.VERSION:
+            raise ValueError("unable to handle convergent key cache"
+                             " version %s" % version)
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, path):
+        # filenames are bytes on most unix systems, and need not be valid
+        # in any encoding
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        return self.sqlite_module.Binary(path)
+
+    def get_key(self, path, params, size, mtime, ctime):
+        """Return the key that was remembered for this file with these
+        parameters, or None if there is none or the file has changed since.
+        'params' and the key are base32-encoded strings."""
+        if self._too_recent(mtime, ctime):
+            self.misses += 1
+            return None
+        c = self.cursor
+        c.execute("SELECT size,mtime,ctime,key FROM keys"
+                  " WHERE path=? AND params=?", (self._path(path), params))
+        row = c.fetchone()
+        if row is None or tuple(row[:3]) != (size, mtime, ctime):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return str(row[3])
+
+    def set_key(self, path, params, size, mtime, ctime, key):
+        """Remember the key of a file, unless it changed too recently for
+        its stamp to be trusted."""
+        if self._too_recent(mtime, ctime):
+            return
+        self.cursor.execute("REPLACE INTO keys VALUES (?,?,?,?,?,?)",
+                            (self._path(path), params, size, mtime, ctime,
+                             key))
+        self.connection.commit()
+
+    def _too_recent(self, mtime, ctime):
+        return max(mtime, ctime) >= time.time() - self.MIN_AGE
+
+    def stopService(self):
+        self.close()
+        return service.Service.stopService(self)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
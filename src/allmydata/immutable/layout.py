@@ -96,9 +96,15 @@ class WriteBucketProxy:
     fieldsize = 4
     fieldstruct = ">L"
 
+    # don't hold more than this many bytes of small writes before sending
+    # them. Blocks are never held back: the header goes out with the first
+    # block, and all of the hash trees go out together at close().
+    COALESCE_SIZE = 16*1024
+    MAX_WRITEV_LENGTH = 30 # DataVector's limit
+
     def __init__(self, rref, data_size, block_size, num_segments,
                  num_share_hashes, uri_extension_size_max, nodeid,
-                 pipeline_size=50000):
+                 pipeline_size=50000, use_writev=False, batcher=None):
         self._rref = rref
         self._data_size = data_size
         self._block_size = block_size
@@ -116,10 +122,28 @@ class WriteBucketProxy:
         self._create_offsets(block_size, data_size)
 
         # k=3, max_segment_size=128KiB gives us a typical segment of 43691
-        # bytes. Setting the default pipeline_size to 50KB lets us get two
-        # segments onto the wire but not a third, which would keep the pipe
-        # filled.
-        self._pipeline = pipeline.Pipeline(pipeline_size)
+        # bytes. Starting the pipeline at 50KB lets us get two segments onto
+        # the wire but not a third, which would keep the pipe filled. From
+        # there, the pipeline grows for servers that answer promptly (which
+        # matters on long fat links), and shrinks for servers that fall
+        # behind.
+        self._pipeline = pipeline.AdaptivePipeline(pipeline_size)
+
+        # if the server supports writev, small writes (the header, the hash
+        # trees, and the UEB) are held here and sent along with the next
+        # write, instead of costing one message each.
+        self._use_writev = use_writev or batcher is not None
+        self._pending_writes = []
+        # uploads that run as part of a batch send their writev() and
+        # close() messages through a ServerUploadBatcher, which combines
+        # them with those of the other uploads of the batch
+        self._batcher = batcher
+        self._pending_size = 0
+
+    def get_pipeline_capacity(self):
+        """Return how many bytes I am currently willing to have in flight
+        to the server."""
+        return self._pipeline.capacity
 
     def get_allocated_size(self):
         return (self._offsets['uri_extension'] + self.fieldsize +
@@ -182,7 +206,7 @@ class WriteBucketProxy:
                                        (self._block_size *
                                         (self._num_segments - 1))),
                          len(data), self._block_size)
-        return self._write(offset, data)
+        return self._write(offset, data, flush=True)
 
     def put_crypttext_hashes(self, hashes):
         offset = self._offsets['crypttext_hash_tree']
@@ -228,22 +252,55 @@ class WriteBucketProxy:
         length = struct.pack(self.fieldstruct, len(data))
         return self._write(offset, length+data)
 
-    def _write(self, offset, data):
-        # use a Pipeline to pipeline several writes together. TODO: another
-        # speedup would be to coalesce small writes into a single call: this
-        # would reduce the foolscap CPU overhead per share, but wouldn't
-        # reduce the number of round trips, so it might not be worth the
-        # effort.
-
-        return self._pipeline.add(len(data),
-                                  self._rref.callRemote, "write", offset, data)
+    def _write(self, offset, data, flush=False):
+        # use a Pipeline to pipeline several writes together. When the server
+        # can take a writev, we also hold small writes until the next block
+        # (or until flush=True), and send them along with it, which reduces
+        # the foolscap overhead per share.
+        if not self._use_writev:
+            return self._pipeline.add(len(data), self._rref.callRemote,
+                                      "write", offset, data)
+        self._pending_writes.append( (offset, data) )
+        self._pending_size += len(data)
+        if (flush
+            or self._pending_size >= self.COALESCE_SIZE
+            or len(self._pending_writes) >= self.MAX_WRITEV_LENGTH):
+            return self._flush_writes()
+        return defer.succeed(None)
+
+    def _flush_writes(self):
+        datav = self._pending_writes
+        size = self._pending_size
+        self._pending_writes = []
+        self._pending_size = 0
+        if not datav:
+            return defer.succeed(None)
+        if self._batcher:
+            return self._pipeline.add(size, self._batcher.writev,
+                                      self._rref, datav)
+        if len(datav) == 1:
+            (offset, data) = datav[0]
+            return self._pipeline.add(size, self._rref.callRemote,
+                                      "write", offset, data)
+        return self._pipeline.add(size, self._rref.callRemote,
+                                  "writev", datav)
 
     def close(self):
-        d = self._pipeline.add(0, self._rref.callRemote, "close")
+        d = self._flush_writes()
+        if self._batcher:
+            d.addCallback(lambda ign:
+                          self._pipeline.add(0, self._batcher.close,
+                                             self._rref))
+        else:
+            d.addCallback(lambda ign:
+                          self._pipeline.add(0, self._rref.callRemote,
+                                             "close"))
         d.addCallback(lambda ign: self._pipeline.flush())
         return d
 
     def abort(self):
+        self._pending_writes = []
+        self._pending_size = 0
         return self._rref.callRemoteOnly("abort")
 
 
@@ -2,14 +2,17 @@
 import os, stat, time, weakref
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python import failure
 from foolscap.api import Referenceable, DeadReferenceError, eventually
 import allmydata # for __full_version__
 from allmydata import interfaces, uri
 from allmydata.storage.server import si_b2a
+from allmydata.storage_client import get_buckets
 from allmydata.immutable import upload
 from allmydata.immutable.layout import ReadBucketProxy
 from allmydata.util.assertutil import precondition
 from allmydata.util import log, observer, fileutil, hashutil, dictutil
+from allmydata.util.rrefutil import add_version_to_remote_reference
 
 
 class NotEnoughWritersError(Exception):
@@ -54,7 +57,7 @@ class CHKCheckerAndUEBFetcher:
     def _get_all_shareholders(self, storage_index):
         dl = []
         for s in self._peer_getter(storage_index):
-            d = s.get_rref().callRemote("get_buckets", storage_index)
+            d = get_buckets(s.get_rref(), storage_index)
             d.addCallbacks(self._got_response, self._got_error,
                            callbackArgs=(s,))
             dl.append(d)
@@ -148,21 +151,44 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
         self._upload_status = upload.UploadStatus()
         self._upload_status.set_helper(False)
         self._upload_status.set_storage_index(storage_index)
-        self._upload_status.set_status("fetching ciphertext")
+        self._upload_status.set_status("waiting to start")
         self._upload_status.set_progress(0, 1.0)
         self._helper.log("CHKUploadHelper starting for SI %s" % self._upload_id,
                          parent=log_number)
 
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._lookahead_segments = None # use the Encoder's default
+        self._worker_pool = None
+        self._parallel_queries = 1
+        self._check_existing = False # the Helper has already looked
+        self._batch = None
         self._fetcher = CHKCiphertextFetcher(self, incoming_file, encoding_file,
-                                             self._log_number)
+                                             self._log_number,
+                                             helper.fetch_pipeline_depth)
         self._reader = LocalCiphertextReader(self, storage_index, encoding_file)
         self._finished_observers = observer.OneShotObserverList()
-
-        d = self._fetcher.when_done()
-        d.addCallback(lambda res: self._reader.start())
-        d.addCallback(lambda res: self.start_encrypted(self._reader))
+        self._admitted = False
+        self._waiting_readers = []
+
+        if helper.encode_while_fetching:
+            # start encoding as soon as the ciphertext starts to arrive, but
+            # don't let the fetch get too far ahead of the encoder
+            self._fetcher.set_fetch_ahead(helper.fetch_ahead)
+            d = self._fetcher.when_size_known()
+            d.addCallback(lambda size:
+                          self._reader.start_streaming(self._fetcher, size))
+            d.addCallback(lambda res: self.start_encrypted(self._reader))
+            def _wait_for_fetcher(uploadresults):
+                # the fetcher still has to move the ciphertext into place
+                d2 = self._fetcher.when_done()
+                d2.addCallback(lambda ign: uploadresults)
+                return d2
+            d.addCallback(_wait_for_fetcher)
+        else:
+            d = self._fetcher.when_done()
+            d.addCallback(lambda res: self._reader.start())
+            d.addCallback(lambda res: self.start_encrypted(self._reader))
         d.addCallback(self._finished)
         d.addErrback(self._failed)
 
@@ -197,14 +223,28 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
         # reader is an RIEncryptedUploadable. I am specified to return an
         # UploadResults dictionary.
 
-        # let our fetcher pull ciphertext from the reader.
-        self._fetcher.add_reader(reader)
+        # let our fetcher pull ciphertext from the reader, once the Helper
+        # lets us start
+        if self._admitted:
+            self._fetcher.add_reader(reader)
+        else:
+            self._waiting_readers.append(reader)
+            if len(self._waiting_readers) == 1:
+                self._helper.request_admission(self, reader)
         # and also hashes
         self._reader.add_reader(reader)
 
         # and inform the client when the upload has finished
         return self._finished_observers.when_fired()
 
+    def admit(self):
+        """The Helper has room for me: start fetching ciphertext."""
+        self._admitted = True
+        self._upload_status.set_status("fetching ciphertext")
+        readers, self._waiting_readers = self._waiting_readers, []
+        for reader in readers:
+            self._fetcher.add_reader(reader)
+
     def _finished(self, uploadresults):
         precondition(isinstance(uploadresults.verifycapstr, str), uploadresults.verifycapstr)
         assert interfaces.IUploadResults.providedBy(uploadresults), uploadresults
@@ -226,10 +266,21 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
                  si=si_b2a(self._storage_index)[:5],
                  failure=f,
                  level=log.UNUSUAL)
+        self._fetcher.stop()
         self._finished_observers.fire(f)
         self._helper.upload_finished(self._storage_index, 0)
         del self._reader
 
+    def get_progress(self):
+        """Return (size, fetched, encoded): the size of the ciphertext (None
+        if not known yet), how much of it is on disk, and how much of it has
+        been read by the encoder."""
+        (size, fetched) = self._fetcher.get_progress()
+        encoded = 0
+        if hasattr(self, "_reader"):
+            encoded = self._reader.get_bytes_read()
+        return (size, fetched, encoded)
+
 class AskUntilSuccessMixin:
     # create me with a _reader array
     _last_failure = None
@@ -263,17 +314,29 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
     when they have any sort of error. If the last reader is removed, I fire
     my when_done() Deferred with a failure.
 
+    I keep up to 'pipeline_depth' read_encrypted() requests outstanding at a
+    time, if the reader says that it can handle that, so that a long
+    round-trip time does not throttle the transfer. Readers that cannot
+    handle it are asked for one chunk at a time.
+
+    If set_fetch_ahead() is called, I will not get more than that many bytes
+    ahead of the LocalCiphertextReader that is consuming my ciphertext as it
+    arrives (see when_fetched()).
+
     I fire my when_done() Deferred (with None) immediately after I have moved
     the ciphertext to 'encoded_file'.
     """
 
-    def __init__(self, helper, incoming_file, encoded_file, logparent):
+    def __init__(self, helper, incoming_file, encoded_file, logparent,
+                 pipeline_depth=1):
         self._upload_helper = helper
         self._incoming_file = incoming_file
         self._encoding_file = encoded_file
         self._upload_id = helper._upload_id
         self._log_parent = logparent
+        self._pipeline_depth = pipeline_depth
         self._done_observers = observer.OneShotObserverList()
+        self._size_observers = observer.OneShotObserverList()
         self._readers = []
         self._started = False
         self._f = None
@@ -282,6 +345,18 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
             "total": 0.0,
             }
         self._ciphertext_fetched = 0
+        self._expected_size = None
+        self._have = 0 # bytes of ciphertext on disk
+        self._requested = 0 # end of the last read_encrypted() we asked for
+        self._requests = None # [offset, length, data], in offset order
+        self._generation = 0 # bumped to ignore responses to old requests
+        self._fetching = False
+        self._renamed = False
+        self._fetch_ahead = None
+        self._consumed = 0
+        self._wanted = 0
+        self._waiters = [] # (offset, Deferred), for when_fetched()
+        self._asking_version = set()
 
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
@@ -294,6 +369,9 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
         AskUntilSuccessMixin.add_reader(self, reader)
         eventually(self._start)
 
+    def set_fetch_ahead(self, fetch_ahead):
+        self._fetch_ahead = fetch_ahead
+
     def _start(self):
         if self._started:
             return
@@ -303,13 +381,16 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
         if os.path.exists(self._encoding_file):
             self.log("ciphertext already present, bypassing fetch",
                      level=log.UNUSUAL)
+            have = os.stat(self._encoding_file)[stat.ST_SIZE]
+            self._have = self._expected_size = have
+            self._renamed = True
+            self._size_observers.fire(have)
             # we'll still need the plaintext hashes (when
             # LocalCiphertextReader.get_plaintext_hashtree_leaves() is
             # called), and currently the easiest way to get them is to ask
             # the sender for the last byte of ciphertext. That will provoke
             # them into reading and hashing (but not sending) everything
             # else.
-            have = os.stat(self._encoding_file)[stat.ST_SIZE]
             d = self.call("read_encrypted", have-1, 1)
             d.addCallback(self._done2, started)
             return
@@ -338,77 +419,141 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
             self.log("we do not have any ciphertext yet", level=log.NOISY)
         self.log("starting ciphertext fetch", level=log.NOISY)
         self._f = open(self._incoming_file, "ab")
-
-        # now loop to pull the data from the readers
-        d = defer.Deferred()
-        self._loop(d)
+        self._requested = self._have
+        self._requests = []
+        self._fetching = True
+        self._fetch_started = time.time()
+        self._size_observers.fire(self._expected_size)
+
+        # now keep requests outstanding until we have all the data
+        self._fetched_all = defer.Deferred()
+        self._fill()
         # this Deferred will be fired once the last byte has been written to
         # self._f
-        return d
-
-    # read data in 50kB chunks. We should choose a more considered number
-    # here, possibly letting the client specify it. The goal should be to
-    # keep the RTT*bandwidth to be less than 10% of the chunk size, to reduce
-    # the upload bandwidth lost because this protocol is non-windowing. Too
-    # large, however, means more memory consumption for both ends. Something
-    # that can be transferred in, say, 10 seconds sounds about right. On my
-    # home DSL line (50kBps upstream), that suggests 500kB. Most lines are
-    # slower, maybe 10kBps, which suggests 100kB, and that's a bit more
-    # memory than I want to hang on to, so I'm going to go with 50kB and see
-    # how that works.
+        return self._fetched_all
+
+    # read data in 50kB chunks. The goal should be to keep the RTT*bandwidth
+    # to be less than 10% of the amount of data in flight, to reduce the
+    # upload bandwidth lost to round trips. Too large, however, means more
+    # memory consumption for both ends. We used to ask for one chunk at a
+    # time, which on a home DSL line (50kBps upstream) suggested 500kB
+    # chunks. Now that several chunks can be outstanding at once, the chunks
+    # can stay small and the pipeline depth provides the window.
     CHUNK_SIZE = 50*1024
 
-    def _loop(self, fire_when_done):
-        # this slightly weird structure is needed because Deferreds don't do
-        # tail-recursion, so it is important to let each one retire promptly.
-        # Simply chaining them will cause a stack overflow at the end of a
-        # transfer that involves more than a few hundred chunks.
-        # 'fire_when_done' lives a long time, but the Deferreds returned by
-        # the inner _fetch() call do not.
-        start = time.time()
-        d = defer.maybeDeferred(self._fetch)
-        def _done(finished):
-            elapsed = time.time() - start
-            self._times["cumulative_fetch"] += elapsed
-            if finished:
-                self.log("finished reading ciphertext", level=log.NOISY)
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(f):
+    def _fill(self):
+        # issue as many read_encrypted() requests as our window allows
+        if not self._fetching:
+            return
+        if self._have == self._expected_size:
+            self._finish_fetching()
+            return
+        if not self._readers:
+            self._fetching = False
+            self._times["cumulative_fetch"] += time.time() - self._fetch_started
+            f = failure.Failure(NotEnoughWritersError("ran out of assisted uploaders, last failure was %s" % self._last_failure))
             self.log(format="[%(si)s] ciphertext read failed",
                      si=self._upload_id, failure=f, level=log.UNUSUAL)
-            fire_when_done.errback(f)
-        d.addCallbacks(_done, _err)
-        return None
-
-    def _fetch(self):
-        needed = self._expected_size - self._have
-        fetch_size = min(needed, self.CHUNK_SIZE)
-        if fetch_size == 0:
-            self._upload_helper._upload_status.set_progress(1, 1.0)
-            return True # all done
-        percent = 0.0
-        if self._expected_size:
-            percent = 1.0 * (self._have+fetch_size) / self._expected_size
-        self.log(format="fetching [%(si)s] %(start)d-%(end)d of %(total)d (%(percent)d%%)",
-                 si=self._upload_id,
-                 start=self._have,
-                 end=self._have+fetch_size,
-                 total=self._expected_size,
-                 percent=int(100.0*percent),
-                 level=log.NOISY)
-        d = self.call("read_encrypted", self._have, fetch_size)
-        def _got_data(ciphertext_v):
-            for data in ciphertext_v:
+            self._fetched_all.errback(f)
+            return
+        rr = self._readers[0]
+        if not hasattr(rr, "version"):
+            # find out whether this reader can handle more than one request
+            # at a time. Older clients can't: they have no get_version().
+            if rr not in self._asking_version:
+                self._asking_version.add(rr)
+                d = add_version_to_remote_reference(rr, {})
+                d.addCallbacks(lambda ign: self._fill(),
+                               self._read_failed,
+                               errbackArgs=(rr, self._generation))
+                d.addErrback(self._fill_failed)
+            return
+        depth = 1
+        v = rr.version.get(upload.RemoteEncryptedUploadable.VERSION_KEY, {})
+        if v.get("concurrent-reads", False):
+            depth = self._pipeline_depth
+        limit = self._expected_size
+        if self._fetch_ahead is not None:
+            limit = min(limit, max(self._consumed + self._fetch_ahead,
+                                   self._wanted))
+        while (len(self._requests) < depth
+               and self._requested < self._expected_size
+               and self._requested < limit):
+            length = min(self._expected_size - self._requested,
+                         self.CHUNK_SIZE)
+            req = [self._requested, length, None]
+            self._requests.append(req)
+            self._requested += length
+            self.log(format="fetching [%(si)s] %(start)d-%(end)d of %(total)d",
+                     si=self._upload_id,
+                     start=req[0], end=req[0]+length,
+                     total=self._expected_size,
+                     level=log.NOISY)
+            d = rr.callRemote("read_encrypted", req[0], length)
+            d.addCallbacks(self._got_data, self._read_failed,
+                           callbackArgs=(req, rr, self._generation),
+                           errbackArgs=(rr, self._generation))
+            d.addErrback(self._fill_failed)
+
+    def _got_data(self, ciphertext_v, req, rr, generation):
+        if generation != self._generation:
+            return # a response to a request we have given up on
+        (offset, length, ignored) = req
+        got = sum([len(data) for data in ciphertext_v])
+        if got != length:
+            # the requests that follow this one assumed that it would be
+            # filled, so they will leave a gap
+            f = failure.Failure(ValueError("read_encrypted(%d,%d) returned"
+                                           " %d bytes" % (offset, length, got)))
+            return self._read_failed(f, rr, generation)
+        req[2] = ciphertext_v
+        # write out everything that has arrived in order
+        wrote = False
+        while self._requests and self._requests[0][2] is not None:
+            for data in self._requests.pop(0)[2]:
                 self._f.write(data)
                 self._have += len(data)
                 self._ciphertext_fetched += len(data)
                 self._upload_helper._helper.count("chk_upload_helper.fetched_bytes", len(data))
-                self._upload_helper._upload_status.set_progress(1, percent)
-            return False # not done
-        d.addCallback(_got_data)
-        return d
+            wrote = True
+        if wrote:
+            # the LocalCiphertextReader may be reading this file already
+            self._f.flush()
+            percent = 1.0
+            if self._expected_size:
+                percent = 1.0 * self._have / self._expected_size
+            self._upload_helper._upload_status.set_progress(1, percent)
+            self._notify_waiters()
+        self._fill()
+
+    def _read_failed(self, f, rr, generation):
+        if generation != self._generation:
+            return
+        self._last_failure = f
+        if rr in self._readers:
+            self._readers.remove(rr)
+        self._upload_helper.log("call to assisted uploader %s failed" % rr,
+                                failure=f, level=log.UNUSUAL)
+        # forget the outstanding requests, and start again from the end of
+        # what we have, with someone else who's left
+        self._generation += 1
+        self._requests = []
+        self._requested = self._have
+        self._fill()
+
+    def _fill_failed(self, f):
+        if not self._fetching:
+            return
+        self._fetching = False
+        self._generation += 1
+        self._fetched_all.errback(f)
+
+    def _finish_fetching(self):
+        self._fetching = False
+        self._times["cumulative_fetch"] += time.time() - self._fetch_started
+        self._upload_helper._upload_status.set_progress(1, 1.0)
+        self.log("finished reading ciphertext", level=log.NOISY)
+        self._fetched_all.callback(None)
 
     def _done(self, res):
         self._f.close()
@@ -417,6 +562,7 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
                  size=os.stat(self._incoming_file)[stat.ST_SIZE],
                  level=log.NOISY)
         os.rename(self._incoming_file, self._encoding_file)
+        self._renamed = True
 
     def _done2(self, _ignored, started):
         self.log("done2", level=log.NOISY)
@@ -428,18 +574,82 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
     def _failed(self, f):
         if self._f:
             self._f.close()
+            self._f = None
         self._readers = []
+        if self._requests is None:
+            # we failed before we could start fetching
+            self._size_observers.fire(f)
+        waiters, self._waiters = self._waiters, []
+        for (offset, d) in waiters:
+            d.errback(f)
         self._done_observers.fire(f)
 
+    def stop(self):
+        """Stop fetching, because the upload has failed anyway."""
+        if self._fetching:
+            self._fetching = False
+            self._generation += 1
+            self._readers = []
+
     def when_done(self):
         return self._done_observers.when_fired()
 
+    def when_size_known(self):
+        """Return a Deferred that fires with the size of the ciphertext once
+        I know it and am ready to fetch it."""
+        return self._size_observers.when_fired()
+
+    def when_fetched(self, offset):
+        """Return a Deferred that fires when I have the first 'offset' bytes
+        of ciphertext on disk, where they can be read with read_fetched()."""
+        if self._have >= offset:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append((offset, d))
+        self._wanted = max(self._wanted, offset)
+        self._fill()
+        return d
+
+    def _notify_waiters(self):
+        waiters = []
+        for (offset, d) in self._waiters:
+            if self._have >= offset:
+                eventually(d.callback, None)
+            else:
+                waiters.append((offset, d))
+        self._waiters = waiters
+
+    def read_fetched(self, offset, length):
+        # the ciphertext is in the incoming file until it has all arrived.
+        # Open it afresh for each read, so that nothing holds it open while
+        # we rename it (which Windows would not allow).
+        fn = self._incoming_file
+        if self._renamed:
+            fn = self._encoding_file
+        f = open(fn, "rb")
+        try:
+            f.seek(offset)
+            return f.read(length)
+        finally:
+            f.close()
+
+    def set_consumed(self, offset):
+        """The LocalCiphertextReader has read everything before 'offset', so
+        I may fetch further ahead."""
+        self._consumed = offset
+        self._fill()
+
     def get_times(self):
         return self._times
 
     def get_ciphertext_fetched(self):
         return self._ciphertext_fetched
 
+    def get_progress(self):
+        """Return (size, have): the size of the ciphertext (None if not known
+        yet), and how many bytes of it are on disk."""
+        return (self._expected_size, self._have)
+
 
 class LocalCiphertextReader(AskUntilSuccessMixin):
     implements(interfaces.IEncryptedUploadable)
@@ -450,12 +660,21 @@ class LocalCiphertextReader(AskUntilSuccessMixin):
         self._storage_index = storage_index
         self._encoding_file = encoding_file
         self._status = None
+        self._fetcher = None
+        self.f = None
+        self._offset = 0
 
     def start(self):
         self._upload_helper._upload_status.set_status("pushing")
         self._size = os.stat(self._encoding_file)[stat.ST_SIZE]
         self.f = open(self._encoding_file, "rb")
 
+    def start_streaming(self, fetcher, size):
+        """Read the ciphertext from 'fetcher' while it is still arriving."""
+        self._upload_helper._upload_status.set_status("fetching and pushing")
+        self._fetcher = fetcher
+        self._size = size
+
     def get_size(self):
         return defer.succeed(self._size)
 
@@ -465,14 +684,30 @@ class LocalCiphertextReader(AskUntilSuccessMixin):
     def get_storage_index(self):
         return defer.succeed(self._storage_index)
 
+    def get_bytes_read(self):
+        return self._offset
+
     def read_encrypted(self, length, hash_only):
         assert hash_only is False
-        d = defer.maybeDeferred(self.f.read, length)
-        d.addCallback(lambda data: [data])
+        if self._fetcher is None:
+            d = defer.maybeDeferred(self.f.read, length)
+        else:
+            offset = self._offset
+            length = min(length, self._size - offset)
+            d = self._fetcher.when_fetched(offset + length)
+            d.addCallback(lambda ign:
+                          self._fetcher.read_fetched(offset, length))
+        def _read(data):
+            self._offset += len(data)
+            if self._fetcher:
+                self._fetcher.set_consumed(self._offset)
+            return [data]
+        d.addCallback(_read)
         return d
 
     def close(self):
-        self.f.close()
+        if self.f:
+            self.f.close()
         # ??. I'm not sure if it makes sense to forward the close message.
         return self.call("close")
 
@@ -495,8 +730,15 @@ class Helper(Referenceable):
     MAX_UPLOAD_STATUSES = 10
 
     def __init__(self, basedir, storage_broker, secret_holder,
-                 stats_provider, history):
+                 stats_provider, history, fetch_pipeline_depth=4,
+                 encode_while_fetching=False, fetch_ahead=10*1000*1000,
+                 max_active_uploads=None, max_disk_usage=None):
         self._basedir = basedir
+        self._max_active_uploads = max_active_uploads
+        self._max_disk_usage = max_disk_usage
+        self.fetch_pipeline_depth = fetch_pipeline_depth
+        self.encode_while_fetching = encode_while_fetching
+        self.fetch_ahead = fetch_ahead
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._chk_incoming = os.path.join(basedir, "CHK_incoming")
@@ -504,6 +746,13 @@ class Helper(Referenceable):
         fileutil.make_dirs(self._chk_incoming)
         fileutil.make_dirs(self._chk_encoding)
         self._active_uploads = {}
+        # uploads that are fetching or encoding, mapped to their size
+        self._running_uploads = {}
+        # uploads that are waiting for room, in a queue for each client. The
+        # clients take turns.
+        self._queues = {} # client tubid -> [(uh, size, queued_time)]
+        self._queue_order = [] # client tubids
+        self._queue_waits = [] # seconds, for the last 1000 admitted uploads
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         self.stats_provider = stats_provider
         if stats_provider:
@@ -514,6 +763,7 @@ class Helper(Referenceable):
                           "chk_upload_helper.resumes": 0,
                           "chk_upload_helper.fetched_bytes": 0,
                           "chk_upload_helper.encoded_bytes": 0,
+                          "chk_upload_helper.upload_queued": 0,
                           }
         self._history = history
 
@@ -550,7 +800,20 @@ class Helper(Referenceable):
             enc_size += size
             if now - mtime > OLD:
                 enc_size_old += size
+        queued = 0
+        longest_wait = 0.0
+        for queue in self._queues.values():
+            queued += len(queue)
+            for (uh, size, queued_time) in queue:
+                longest_wait = max(longest_wait, now - queued_time)
+        mean_wait = 0.0
+        if self._queue_waits:
+            mean_wait = sum(self._queue_waits) / len(self._queue_waits)
         stats = { 'chk_upload_helper.active_uploads': len(self._active_uploads),
+                  'chk_upload_helper.running_uploads': len(self._running_uploads),
+                  'chk_upload_helper.queued_uploads': queued,
+                  'chk_upload_helper.queue_wait_longest': longest_wait,
+                  'chk_upload_helper.queue_wait_mean': mean_wait,
                   'chk_upload_helper.incoming_count': inc_count,
                   'chk_upload_helper.incoming_size': inc_size,
                   'chk_upload_helper.incoming_size_old': inc_size_old,
@@ -561,6 +824,96 @@ class Helper(Referenceable):
         stats.update(self._counters)
         return stats
 
+    def request_admission(self, uh, reader):
+        """The upload helper 'uh' wants to start fetching ciphertext from
+        'reader'. I will call uh.admit() when there is room for it: when
+        fewer than max_active_uploads uploads are running, and the ciphertext
+        would not take the helper's directories over max_disk_usage bytes.
+        Each client (identified by the Tub that 'reader' lives in) has its
+        own queue, and the clients take turns, so a client with many uploads
+        does not hold up the others."""
+        if self._max_disk_usage is None:
+            d = defer.succeed(0) # we don't need to know how big it is
+        else:
+            d = reader.callRemote("get_size")
+            # if the reader has gone away, the fetcher will find out soon
+            # enough once the upload starts
+            d.addErrback(lambda f: 0)
+        d.addCallback(self._enqueue, uh, reader.getRemoteTubID())
+        d.addErrback(log.err, facility="tahoe.helper", level=log.WEIRD,
+                     umid="Wq5mCg")
+
+    def _enqueue(self, size, uh, client):
+        if self._active_uploads.get(uh._storage_index) is not uh:
+            return # it failed before it got started
+        self._queues.setdefault(client, []).append((uh, size, time.time()))
+        if client not in self._queue_order:
+            self._queue_order.append(client)
+        if not self._admit_uploads():
+            self.count("chk_upload_helper.upload_queued")
+            self.log(format="upload of SI %(si)s queued, %(running)d running",
+                     si=si_b2a(uh._storage_index),
+                     running=len(self._running_uploads), level=log.NOISY)
+
+    def _admit_uploads(self):
+        # returns True if every queued upload was admitted
+        while self._queue_order:
+            if (self._max_active_uploads
+                and len(self._running_uploads) >= self._max_active_uploads):
+                return False
+            client = self._queue_order[0]
+            queue = self._queues[client]
+            (uh, size, queued_time) = queue[0]
+            if not self._fits_on_disk(uh, size):
+                # wait for some room, rather than letting smaller uploads
+                # from other clients starve this one
+                return False
+            self._queue_order.pop(0)
+            queue.pop(0)
+            if queue:
+                self._queue_order.append(client) # let the others go first
+            else:
+                del self._queues[client]
+            self._queue_waits.append(time.time() - queued_time)
+            self._queue_waits = self._queue_waits[-1000:]
+            self._running_uploads[uh] = size
+            uh.admit()
+        return True
+
+    def _fits_on_disk(self, uh, size):
+        if self._max_disk_usage is None or not self._running_uploads:
+            # a file that is bigger than the whole budget can still be
+            # uploaded, just not alongside anything else
+            return True
+        # the running uploads will grow to their full size
+        reserved = 0
+        for (running, running_size) in self._running_uploads.items():
+            (ignored, fetched, ignored) = running.get_progress()
+            reserved += max(running_size - fetched, 0)
+        si_s = si_b2a(uh._storage_index)
+        have = max(self._file_size(os.path.join(self._chk_incoming, si_s)),
+                   self._file_size(os.path.join(self._chk_encoding, si_s)))
+        needed = max(size - have, 0)
+        used = 0
+        for dirname in (self._chk_incoming, self._chk_encoding):
+            for f in os.listdir(dirname):
+                used += self._file_size(os.path.join(dirname, f))
+        return used + reserved + needed <= self._max_disk_usage
+
+    def _file_size(self, filename):
+        try:
+            return os.stat(filename)[stat.ST_SIZE]
+        except EnvironmentError:
+            return 0
+
+    def get_upload_progress(self):
+        """Return a list of (storage_index, size, fetched, encoded) for each
+        active upload. See CHKUploadHelper.get_progress()."""
+        progress = []
+        for (storage_index, uh) in sorted(self._active_uploads.items()):
+            progress.append((storage_index,) + uh.get_progress())
+        return progress
+
     def remote_get_version(self):
         return self.VERSION
 
@@ -647,5 +1000,8 @@ class Helper(Referenceable):
         self.count("chk_upload_helper.encoded_bytes", size)
         uh = self._active_uploads[storage_index]
         del self._active_uploads[storage_index]
+        if uh in self._running_uploads:
+            del self._running_uploads[uh]
+            self._admit_uploads()
         s = uh.get_upload_status()
         s.set_active(False)
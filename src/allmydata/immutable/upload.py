@@ -1,4 +1,4 @@
-import os, time, weakref, itertools
+import os, time, weakref, itertools, binascii
 from zope.interface import implements
 from twisted.python import failure
 from twisted.internet import defer
@@ -8,22 +8,26 @@ from foolscap.api import Referenceable, Copyable, RemoteCopy, fireEventually
 from allmydata.util.hashutil import file_renewal_secret_hash, \
      file_cancel_secret_hash, bucket_renewal_secret_hash, \
      bucket_cancel_secret_hash, plaintext_hasher, \
-     storage_index_hash, plaintext_segment_hasher, convergence_hasher
+     storage_index_hash, plaintext_segment_hasher, convergence_hasher, \
+     convergent_key_cache_params, streaming_convergence_key
+import allmydata # for __full_version__
 from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
-from allmydata.util import base32, dictutil, idlib, log, mathutil
+from allmydata.util import base32, dictutil, idlib, log, mathutil, observer
 from allmydata.util.happinessutil import servers_of_happiness, \
                                          shares_by_server, merge_servers, \
                                          failure_message
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.storage_client import add_lease, UploadBatcher
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
-     DEFAULT_MAX_SEGMENT_SIZE
+     ContentHashMismatchError, DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.immutable import layout
 from pycryptopp.cipher.aes import AES
+from pycryptopp.hash.sha256 import SHA256
 
 from cStringIO import StringIO
 
@@ -54,6 +58,7 @@ class UploadResults(Copyable, RemoteCopy):
         self.uri = None
         self.preexisting_shares = None # count of shares already present
         self.pushed_shares = None # count of shares we pushed
+        self.dedup_hit = False # True if the file was already in the grid
 
 
 # our current uri_extension is 846 bytes for small files, a few bytes
@@ -72,7 +77,7 @@ class ServerTracker:
     def __init__(self, server,
                  sharesize, blocksize, num_segments, num_share_hashes,
                  storage_index,
-                 bucket_renewal_secret, bucket_cancel_secret):
+                 bucket_renewal_secret, bucket_cancel_secret, batcher=None):
         self._server = server
         self.buckets = {} # k: shareid, v: IRemoteBucketWriter
         self.sharesize = sharesize
@@ -90,6 +95,8 @@ class ServerTracker:
 
         self.renew_secret = bucket_renewal_secret
         self.cancel_secret = bucket_cancel_secret
+        # a ServerUploadBatcher, if this upload is part of a batch
+        self._batcher = batcher
 
     def __repr__(self):
         return ("<ServerTracker for server %s and SI %s>"
@@ -101,6 +108,14 @@ class ServerTracker:
         return self._server.name()
 
     def query(self, sharenums):
+        if self._batcher:
+            d = self._batcher.allocate_buckets(self.storage_index,
+                                               self.renew_secret,
+                                               self.cancel_secret,
+                                               sharenums,
+                                               self.allocated_size)
+            d.addCallback(self._got_reply)
+            return d
         rref = self._server.get_rref()
         d = rref.callRemote("allocate_buckets",
                             self.storage_index,
@@ -119,18 +134,28 @@ class ServerTracker:
     def _got_reply(self, (alreadygot, buckets)):
         #log.msg("%s._got_reply(%s)" % (self, (alreadygot, buckets)))
         b = {}
+        use_writev = self._server_supports_writev()
         for sharenum, rref in buckets.iteritems():
             bp = self.wbp_class(rref, self.sharesize,
                                 self.blocksize,
                                 self.num_segments,
                                 self.num_share_hashes,
                                 EXTENSION_SIZE,
-                                self._server.get_serverid())
+                                self._server.get_serverid(),
+                                use_writev=use_writev,
+                                batcher=self._batcher)
             b[sharenum] = bp
         self.buckets.update(b)
         return (alreadygot, set(b.keys()))
 
 
+    def _server_supports_writev(self):
+        version = self._server.get_version()
+        if not version:
+            return False
+        v1 = version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        return v1.get("supports-immutable-writev", False)
+
     def abort(self):
         """
         I abort the remote bucket writers for all shares. This is a good idea
@@ -153,8 +178,19 @@ def str_shareloc(shnum, bucketwriter):
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None,
+                 parallel_queries=1):
         self.upload_id = upload_id
+        # how many servers to ask at once during the first pass. The first
+        # query to each server asks it to hold a single share, so the
+        # answers can be merged in any order. Later passes ask for more
+        # shares, depending upon the earlier answers, and are sequential.
+        self.parallel_queries = max(1, parallel_queries or 1)
+        # the number of round trips that server selection waited for, one
+        # after another. A query sent in response to an answer belongs to
+        # the round after that answer's query.
+        self.rounds = 0
+        self._round = 0
         self.query_count, self.good_query_count, self.bad_query_count = 0,0,0
         # Servers that are working normally, but full.
         self.full_count = 0
@@ -183,34 +219,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         if self._status:
             self._status.set_status("Contacting Servers..")
 
-        self.total_shares = total_shares
-        self.servers_of_happiness = servers_of_happiness
-        self.needed_shares = needed_shares
-
-        self.homeless_shares = set(range(total_shares))
-        self.contacted_trackers = [] # servers worth asking again
-        self.contacted_trackers2 = [] # servers that we have asked again
-        self._started_second_pass = False
-        self.use_trackers = set() # ServerTrackers that have shares assigned
-                                  # to them
-        self.preexisting_shares = {} # shareid => set(serverids) holding shareid
+        self._prepare(secret_holder, storage_index, share_size, block_size,
+                      num_segments, total_shares, needed_shares,
+                      servers_of_happiness)
 
-        # These servers have shares -- any shares -- for our SI. We keep
-        # track of these to write an error message with them later.
-        self.serverids_with_shares = set()
-
-        # this needed_hashes computation should mirror
-        # Encoder.send_all_share_hash_trees. We use an IncompleteHashTree
-        # (instead of a HashTree) because we don't require actual hashing
-        # just to count the levels.
-        ht = hashtree.IncompleteHashTree(total_shares)
-        num_share_hashes = len(ht.needed_hashes(0, include_leaf=True))
-
-        # figure out how much space to ask for
-        wbp = layout.make_write_bucket_proxy(None, share_size, 0, num_segments,
-                                             num_share_hashes, EXTENSION_SIZE,
-                                             None)
-        allocated_size = wbp.get_allocated_size()
         all_servers = storage_broker.get_servers_for_psi(storage_index)
         if not all_servers:
             raise NoServersError("client gave us zero servers")
@@ -219,44 +231,18 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # this request. This excludes older servers (which used a 4-byte size
         # field) from getting large shares (for files larger than about
         # 12GiB). See #439 for details.
-        def _get_maxsize(server):
-            v0 = server.get_rref().version
-            v1 = v0["http://allmydata.org/tahoe/protocols/storage/v1"]
-            return v1["maximum-immutable-share-size"]
         writable_servers = [server for server in all_servers
-                            if _get_maxsize(server) >= allocated_size]
+                            if self._get_maxsize(server) >= self.allocated_size]
         readonly_servers = set(all_servers[:2*total_shares]) - set(writable_servers)
 
-        # decide upon the renewal/cancel secrets, to include them in the
-        # allocate_buckets query.
-        client_renewal_secret = secret_holder.get_renewal_secret()
-        client_cancel_secret = secret_holder.get_cancel_secret()
-
-        file_renewal_secret = file_renewal_secret_hash(client_renewal_secret,
-                                                       storage_index)
-        file_cancel_secret = file_cancel_secret_hash(client_cancel_secret,
-                                                     storage_index)
-        def _make_trackers(servers):
-            trackers = []
-            for s in servers:
-                seed = s.get_lease_seed()
-                renew = bucket_renewal_secret_hash(file_renewal_secret, seed)
-                cancel = bucket_cancel_secret_hash(file_cancel_secret, seed)
-                st = ServerTracker(s,
-                                   share_size, block_size,
-                                   num_segments, num_share_hashes,
-                                   storage_index,
-                                   renew, cancel)
-                trackers.append(st)
-            return trackers
-        self.uncontacted_trackers = _make_trackers(writable_servers)
+        self.uncontacted_trackers = self._make_trackers(writable_servers)
 
         # We don't try to allocate shares to these servers, since they've
         # said that they're incapable of storing shares of the size that we'd
         # want to store. We ask them about existing shares for this storage
         # index, which we want to know about for accurate
         # servers_of_happiness accounting, then we forget about them.
-        readonly_trackers = _make_trackers(readonly_servers)
+        readonly_trackers = self._make_trackers(readonly_servers)
 
         # We now ask servers that can't hold any new shares about existing
         # shares that they might have for our SI. Once this is done, we
@@ -275,10 +261,146 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             self.query_count += 1
             self.log("asking server %s for any existing shares" %
                      (tracker.name(),), level=log.NOISY)
+        if readonly_trackers:
+            self.rounds = self._round = 1
         dl = defer.DeferredList(ds)
+        if self.parallel_queries > 1:
+            dl.addCallback(lambda ign: self._first_pass())
         dl.addCallback(lambda ign: self._loop())
         return dl
 
+    def _prepare(self, secret_holder, storage_index, share_size, block_size,
+                 num_segments, total_shares, needed_shares,
+                 servers_of_happiness):
+        self.total_shares = total_shares
+        self.servers_of_happiness = servers_of_happiness
+        self.needed_shares = needed_shares
+
+        self.homeless_shares = set(range(total_shares))
+        self.uncontacted_trackers = []
+        self.contacted_trackers = [] # servers worth asking again
+        self.contacted_trackers2 = [] # servers that we have asked again
+        self._started_second_pass = False
+        self.use_trackers = set() # ServerTrackers that have shares assigned
+                                  # to them
+        self.preexisting_shares = {} # shareid => set(serverids) holding shareid
+
+        # These servers have shares -- any shares -- for our SI. We keep
+        # track of these to write an error message with them later.
+        self.serverids_with_shares = set()
+
+        # this needed_hashes computation should mirror
+        # Encoder.send_all_share_hash_trees. We use an IncompleteHashTree
+        # (instead of a HashTree) because we don't require actual hashing
+        # just to count the levels.
+        ht = hashtree.IncompleteHashTree(total_shares)
+        self.num_share_hashes = len(ht.needed_hashes(0, include_leaf=True))
+
+        # figure out how much space to ask for
+        wbp = layout.make_write_bucket_proxy(None, share_size, 0, num_segments,
+                                             self.num_share_hashes,
+                                             EXTENSION_SIZE, None)
+        self.allocated_size = wbp.get_allocated_size()
+
+        self.storage_index = storage_index
+        self.share_size = share_size
+        self.block_size = block_size
+        self.num_segments = num_segments
+
+        # decide upon the renewal/cancel secrets, to include them in the
+        # allocate_buckets query.
+        client_renewal_secret = secret_holder.get_renewal_secret()
+        client_cancel_secret = secret_holder.get_cancel_secret()
+
+        self.file_renewal_secret = file_renewal_secret_hash(client_renewal_secret,
+                                                            storage_index)
+        self.file_cancel_secret = file_cancel_secret_hash(client_cancel_secret,
+                                                          storage_index)
+
+    def _get_maxsize(self, server):
+        v0 = server.get_rref().version
+        v1 = v0["http://allmydata.org/tahoe/protocols/storage/v1"]
+        return v1["maximum-immutable-share-size"]
+
+    def _make_trackers(self, servers):
+        trackers = []
+        for s in servers:
+            seed = s.get_lease_seed()
+            renew = bucket_renewal_secret_hash(self.file_renewal_secret, seed)
+            cancel = bucket_cancel_secret_hash(self.file_cancel_secret, seed)
+            st = ServerTracker(s,
+                               self.share_size, self.block_size,
+                               self.num_segments, self.num_share_hashes,
+                               self.storage_index,
+                               renew, cancel,
+                               batcher=self._get_server_batcher(s))
+            trackers.append(st)
+        return trackers
+
+    def _get_server_batcher(self, server):
+        return None
+
+    def _query(self, tracker, shares_to_ask):
+        query_round = self._round + 1
+        self.rounds = max(self.rounds, query_round)
+        d = tracker.query(shares_to_ask)
+        def _answered(res):
+            self._round = query_round
+            return res
+        d.addBoth(_answered)
+        return d
+
+    def _start_first_query(self, tracker):
+        # TODO: don't pre-convert all serverids to ServerTrackers
+        assert isinstance(tracker, ServerTracker)
+
+        shares_to_ask = set(sorted(self.homeless_shares)[:1])
+        self.homeless_shares -= shares_to_ask
+        self.query_count += 1
+        self.num_servers_contacted += 1
+        if self._status:
+            self._status.set_status("Contacting Servers [%s] (first query),"
+                                    " %d shares left.."
+                                    % (tracker.name(),
+                                       len(self.homeless_shares)))
+        return shares_to_ask
+
+    def _first_pass(self):
+        """Ask up to self.parallel_queries uncontacted servers at a time to
+        hold one share each. I return a Deferred that fires once every
+        server has been asked (or every share has found a home) and all of
+        the questions have been answered. _loop() then checks the result
+        against servers_of_happiness and makes any further queries, exactly
+        as if it had made these first queries itself."""
+        self._first_pass_done = defer.Deferred()
+        self._outstanding_queries = 0
+        self._send_first_queries()
+        return self._first_pass_done
+
+    def _send_first_queries(self):
+        while (self._outstanding_queries < self.parallel_queries
+               and self.uncontacted_trackers and self.homeless_shares):
+            tracker = self.uncontacted_trackers.pop(0)
+            shares_to_ask = self._start_first_query(tracker)
+            self._outstanding_queries += 1
+            d = self._query(tracker, shares_to_ask)
+            d.addBoth(self._got_first_response, tracker, shares_to_ask)
+            d.addErrback(self._first_pass_failed)
+        if not self._outstanding_queries and self._first_pass_done:
+            d, self._first_pass_done = self._first_pass_done, None
+            d.callback(None)
+
+    def _got_first_response(self, res, tracker, shares_to_ask):
+        self._outstanding_queries -= 1
+        self._handle_response(res, tracker, shares_to_ask,
+                              self.contacted_trackers)
+        self._send_first_queries()
+
+    def _first_pass_failed(self, f):
+        if self._first_pass_done:
+            d, self._first_pass_done = self._first_pass_done, None
+            d.errback(f)
+
 
     def _handle_existing_response(self, res, tracker):
         """
@@ -394,19 +516,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         if self.uncontacted_trackers:
             tracker = self.uncontacted_trackers.pop(0)
-            # TODO: don't pre-convert all serverids to ServerTrackers
-            assert isinstance(tracker, ServerTracker)
-
-            shares_to_ask = set(sorted(self.homeless_shares)[:1])
-            self.homeless_shares -= shares_to_ask
-            self.query_count += 1
-            self.num_servers_contacted += 1
-            if self._status:
-                self._status.set_status("Contacting Servers [%s] (first query),"
-                                        " %d shares left.."
-                                        % (tracker.name(),
-                                           len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
+            shares_to_ask = self._start_first_query(tracker)
+            d = self._query(tracker, shares_to_ask)
             d.addBoth(self._got_response, tracker, shares_to_ask,
                       self.contacted_trackers)
             return d
@@ -427,7 +538,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                         " %d shares left.."
                                         % (tracker.name(),
                                            len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
+            d = self._query(tracker, shares_to_ask)
             d.addBoth(self._got_response, tracker, shares_to_ask,
                       self.contacted_trackers2)
             return d
@@ -462,6 +573,11 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 return (self.use_trackers, self.preexisting_shares)
 
     def _got_response(self, res, tracker, shares_to_ask, put_tracker_here):
+        self._handle_response(res, tracker, shares_to_ask, put_tracker_here)
+        # now loop
+        return self._loop()
+
+    def _handle_response(self, res, tracker, shares_to_ask, put_tracker_here):
         if isinstance(res, failure.Failure):
             # This is unusual, and probably indicates a bug or a network
             # problem.
@@ -538,9 +654,6 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 # willing to accept even more.
                 put_tracker_here.append(tracker)
 
-        # now loop
-        return self._loop()
-
 
     def _failed(self, msg):
         """
@@ -555,15 +668,167 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         raise UploadUnhappinessError(msg)
 
 
+class UploadBatch:
+    """I hold what the uploads of one Uploader.upload_batch() share: an
+    UploadBatcher that combines their messages to each storage server, and
+    the share placement that the first of them chose, which the others
+    reuse instead of running server selection themselves."""
+
+    def __init__(self):
+        self.batcher = UploadBatcher()
+        self.selection_started = False
+        self._placement = observer.OneShotObserverList()
+
+    def set_placement(self, placement):
+        """placement is ((k, happy, n), {shnum: IServer}), or None if the
+        first server selection failed."""
+        self._placement.fire(placement)
+
+    def when_placed(self):
+        return self._placement.when_fired()
+
+class BatchedServerSelector(Tahoe2ServerSelector):
+    """I place the shares of one file of an UploadBatch. The first file of
+    the batch runs a full server selection, and the rest ask the same
+    servers for the same share numbers, with one allocate_buckets() query
+    per server. If that leaves any share without a home, or doesn't make
+    the file happy (or the batch's files use different encoding
+    parameters), I abort those buckets and fall back to a full selection
+    of my own. All of the queries go through the batch's UploadBatcher.
+
+    A downloader looks for shares along the file's own permuted server
+    list, so the placement is only reused if all of its servers are among
+    the first 2*N of that list (the servers that a normal upload would ask
+    first). In a grid of many more than 2*N servers, this means that most
+    files of a batch select servers for themselves, and only save the
+    combined messages: spreading them over the same few servers would cost
+    every later download extra DYHB round trips, and put the whole batch
+    on those servers."""
+
+    def __init__(self, batch, upload_id, logparent=None, upload_status=None,
+                 parallel_queries=1):
+        Tahoe2ServerSelector.__init__(self, upload_id, logparent,
+                                      upload_status, parallel_queries)
+        self._batch = batch
+
+    def _get_server_batcher(self, server):
+        return self._batch.batcher.get_server_batcher(server.get_rref())
+
+    def get_shareholders(self, storage_broker, secret_holder,
+                         storage_index, share_size, block_size,
+                         num_segments, total_shares, needed_shares,
+                         servers_of_happiness):
+        args = (storage_broker, secret_holder, storage_index, share_size,
+                block_size, num_segments, total_shares, needed_shares,
+                servers_of_happiness)
+        params = (needed_shares, servers_of_happiness, total_shares)
+        if not self._batch.selection_started:
+            self._batch.selection_started = True
+            d = defer.maybeDeferred(Tahoe2ServerSelector.get_shareholders,
+                                    self, *args)
+            d.addBoth(self._record_placement, params, storage_broker)
+            return d
+        d = self._batch.when_placed()
+        d.addCallback(self._use_placement, params, args)
+        return d
+
+    def _record_placement(self, res, params, storage_broker):
+        placement = None
+        if not isinstance(res, failure.Failure):
+            (upload_trackers, already_servers) = res
+            servers = dict([(s.get_serverid(), s) for s in
+                            storage_broker.get_servers_for_psi(self.storage_index)])
+            shnum_to_server = {}
+            for tracker in upload_trackers:
+                for shnum in tracker.buckets:
+                    shnum_to_server[shnum] = servers[tracker.get_serverid()]
+            for shnum, serverids in already_servers.items():
+                for serverid in sorted(serverids):
+                    if serverid in servers and shnum not in shnum_to_server:
+                        shnum_to_server[shnum] = servers[serverid]
+            if len(shnum_to_server) == self.total_shares:
+                placement = (params, shnum_to_server)
+        self._batch.set_placement(placement)
+        return res
+
+    def _use_placement(self, placement, params, args):
+        if placement is None or placement[0] != params:
+            self.log("no usable placement from the batch, selecting servers",
+                     level=log.NOISY)
+            return Tahoe2ServerSelector.get_shareholders(self, *args)
+        (storage_broker, secret_holder, storage_index) = args[:3]
+        if self._status:
+            self._status.set_status("Contacting Servers (batch placement)..")
+        self._prepare(*args[1:])
+        shnum_to_server = placement[1]
+        all_servers = storage_broker.get_servers_for_psi(storage_index)
+        nearby = set([s.get_serverid()
+                      for s in all_servers[:2*self.total_shares]])
+        shares = {} # IServer -> set of shnums
+        for shnum, server in shnum_to_server.items():
+            if (server.get_serverid() not in nearby
+                or self._get_maxsize(server) < self.allocated_size):
+                self.log("batch placement server %s is not usable" %
+                         server.name(), level=log.NOISY)
+                return Tahoe2ServerSelector.get_shareholders(self, *args)
+            shares.setdefault(server, set()).add(shnum)
+
+        self.rounds = 1
+        ds = []
+        for server, shares_to_ask in shares.items():
+            [tracker] = self._make_trackers([server])
+            self.homeless_shares -= shares_to_ask
+            self.query_count += 1
+            self.num_servers_contacted += 1
+            d = tracker.query(shares_to_ask)
+            d.addBoth(self._handle_response, tracker, shares_to_ask,
+                      self.contacted_trackers)
+            ds.append(d)
+        d = defer.DeferredList(ds)
+        def _placed(ign):
+            merged = merge_servers(self.preexisting_shares, self.use_trackers)
+            if (not self.homeless_shares and
+                servers_of_happiness(merged) >= self.servers_of_happiness):
+                self.log("batch placement successful for %s: %s: %s"
+                         % (self, self._get_progress_message(),
+                            pretty_print_shnum_to_servers(merged)),
+                         level=log.OPERATIONAL)
+                return (self.use_trackers, self.preexisting_shares)
+            self.log("batch placement failed for %s: %s, selecting servers"
+                     % (self, self._get_progress_message()),
+                     level=log.UNUSUAL)
+            for tracker in self.use_trackers:
+                tracker.abort()
+            return Tahoe2ServerSelector.get_shareholders(self, *args)
+        d.addCallback(_placed)
+        return d
+
+
+def encrypt_at(key, offset, chunks):
+    """Encrypt a list of plaintext chunks which start 'offset' bytes into
+    the file, returning a list of ciphertext chunks. This uses the same
+    AES-CTR keystream as a single AES(key) instance that encrypts the whole
+    file, so the pieces can be encrypted in any order (and, through a
+    WorkerPool, in another process)."""
+    offset_big = offset // 16
+    offset_small = offset % 16
+    iv = binascii.unhexlify("%032x" % offset_big)
+    encryptor = AES(key, iv=iv)
+    encryptor.process("\x00"*offset_small)
+    return [encryptor.process(chunk) for chunk in chunks]
+
 class EncryptAnUploadable:
     """This is a wrapper that takes an IUploadable and provides
     IEncryptedUploadable."""
     implements(IEncryptedUploadable)
     CHUNKSIZE = 50*1024
 
-    def __init__(self, original, log_parent=None):
+    def __init__(self, original, log_parent=None, worker_pool=None):
         self.original = IUploadable(original)
         self._log_number = log_parent
+        # if set, a WorkerPool that does the encryption
+        self._worker_pool = worker_pool
+        self._key = None
         self._encryptor = None
         self._plaintext_hasher = plaintext_hasher()
         self._plaintext_segment_hasher = None
@@ -617,6 +882,7 @@ class EncryptAnUploadable:
         d = self.original.get_encryption_key()
         def _got(key):
             e = AES(key)
+            self._key = key
             self._encryptor = e
 
             storage_index = storage_index_hash(key)
@@ -709,10 +975,17 @@ class EncryptAnUploadable:
         def _good(plaintext):
             # and encrypt it..
             # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
-            ciphertext.extend(ct)
-            self._read_encrypted(remaining, ciphertext, hash_only,
-                                 fire_when_done)
+            if self._worker_pool:
+                d2 = self._hash_and_encrypt_in_worker(plaintext, hash_only)
+            else:
+                d2 = defer.succeed(self._hash_and_encrypt_plaintext(plaintext,
+                                                                    hash_only))
+            def _encrypted(ct):
+                ciphertext.extend(ct)
+                self._read_encrypted(remaining, ciphertext, hash_only,
+                                     fire_when_done)
+            d2.addCallback(_encrypted)
+            return d2
         def _err(why):
             fire_when_done.errback(why)
         d.addCallback(_good)
@@ -745,11 +1018,34 @@ class EncryptAnUploadable:
                 cryptdata.append(ciphertext)
             del ciphertext
             del chunk
+        self._processed(bytes_processed)
+        return cryptdata
+
+    def _hash_and_encrypt_in_worker(self, data, hash_only):
+        # the plaintext hashes cover the whole file, so they must be updated
+        # here, in order. Since encrypt_at() can start anywhere in the
+        # keystream, the encryption can go to the pool, and can be skipped
+        # when we only need the hashes.
+        offset = self._ciphertext_bytes_read
+        data = list(data)
+        bytes_processed = 0
+        for chunk in data:
+            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
+                     level=log.NOISY)
+            bytes_processed += len(chunk)
+            self._plaintext_hasher.update(chunk)
+            self._update_segment_hash(chunk)
+        self._processed(bytes_processed)
+        if hash_only:
+            self.log("  skipping encryption", level=log.NOISY)
+            return defer.succeed([])
+        return self._worker_pool.run(encrypt_at, self._key, offset, data)
+
+    def _processed(self, bytes_processed):
         self._ciphertext_bytes_read += bytes_processed
         if self._status:
             progress = float(self._ciphertext_bytes_read) / self._file_size
             self._status.set_progress(1, progress)
-        return cryptdata
 
 
     def get_plaintext_hashtree_leaves(self, first, last, num_segments):
@@ -787,6 +1083,7 @@ class UploadStatus:
         self.helper = False
         self.status = "Not started"
         self.progress = [0.0, 0.0, 0.0]
+        self.pipeline_windows = {}
         self.active = True
         self.results = None
         self.counter = self.statusid_counter.next()
@@ -804,6 +1101,8 @@ class UploadStatus:
         return self.status
     def get_progress(self):
         return tuple(self.progress)
+    def get_pipeline_windows(self):
+        return self.pipeline_windows
     def get_active(self):
         return self.active
     def get_results(self):
@@ -822,6 +1121,8 @@ class UploadStatus:
     def set_progress(self, which, value):
         # [0]: chk, [1]: ciphertext, [2]: encode+push
         self.progress[which] = value
+    def set_pipeline_windows(self, windows):
+        self.pipeline_windows = windows
     def set_active(self, value):
         self.active = value
     def set_results(self, value):
@@ -830,10 +1131,21 @@ class UploadStatus:
 class CHKUploader:
     server_selector_class = Tahoe2ServerSelector
 
-    def __init__(self, storage_broker, secret_holder):
+    def __init__(self, storage_broker, secret_holder,
+                 lookahead_segments=None, worker_pool=None,
+                 parallel_queries=1, check_existing=False, batch=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        # None means the Encoder's default
+        self._lookahead_segments = lookahead_segments
+        self._worker_pool = worker_pool
+        self._parallel_queries = parallel_queries
+        # if True, look for a healthy copy of the file in the grid before
+        # reading and encoding it. Only worth doing for convergent uploads.
+        self._check_existing = check_existing
+        # an UploadBatch, if this file is uploaded as part of a batch
+        self._batch = batch
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._results = UploadResults()
@@ -886,14 +1198,116 @@ class CHKUploader:
 
         started = time.time()
         self._encoder = e = encode.Encoder(self._log_number,
-                                           self._upload_status)
+                                           self._upload_status,
+                                           self._lookahead_segments,
+                                           self._worker_pool)
         d = e.set_encrypted_uploadable(eu)
-        d.addCallback(self.locate_all_shareholders, started)
-        d.addCallback(self.set_shareholders, e)
-        d.addCallback(lambda res: e.start())
-        d.addCallback(self._encrypted_done)
+        d.addCallback(self._check_for_existing_file, started)
+        def _checked(existing_results):
+            if existing_results:
+                return existing_results
+            # the storage_index timing should not include the check
+            d2 = self.locate_all_shareholders(e, started +
+                                              self._existence_check_elapsed)
+            d2.addCallback(self.set_shareholders, e)
+            d2.addCallback(lambda res: e.start())
+            d2.addCallback(self._encrypted_done)
+            return d2
+        d.addCallback(_checked)
         return d
 
+    def _check_for_existing_file(self, encoder, started):
+        """If this is a convergent upload, see whether the grid already
+        holds all N shares of the file. If so, I fire with the UploadResults
+        for it, and nothing needs to be read, encoded, or pushed. Otherwise
+        I fire with None."""
+        self._existence_check_elapsed = 0.0
+        if not self._check_existing:
+            return None
+        # avoid a circular import: offloaded imports us
+        from allmydata.immutable.offloaded import CHKCheckerAndUEBFetcher
+        self._storage_index_elapsed = time.time() - started
+        check_started = time.time()
+        storage_index = encoder.get_param("storage_index")
+        self._storage_index = storage_index
+        self._upload_status.set_status("Checking for an existing copy")
+        lp = self.log("checking for an existing copy of %s"
+                      % si_b2a(storage_index)[:5], level=log.NOISY)
+        sb = self._storage_broker
+        c = CHKCheckerAndUEBFetcher(sb.get_servers_for_psi, storage_index, lp)
+        d = c.check()
+        def _checked(res):
+            self._existence_check_elapsed = time.time() - check_started
+            if not res:
+                return None
+            (sharemap, ueb_data, ueb_hash) = res
+            k, happy, n = encoder.get_param("share_counts")
+            if (ueb_data["needed_shares"] != k
+                or ueb_data["total_shares"] != n
+                or ueb_data["segment_size"] != encoder.get_param("segment_size")
+                or ueb_data["size"] != encoder.file_size):
+                self.log("existing copy has different parameters, uploading",
+                         level=log.UNUSUAL, parent=lp, umid="h1Hq9A")
+                return None
+            self.log("file already in grid, skipping the upload",
+                     level=log.OPERATIONAL, parent=lp)
+            d2 = self._add_leases(storage_index, sharemap)
+            d2.addCallback(lambda ign:
+                           self._existing_file_found(storage_index, sharemap,
+                                                     ueb_data, ueb_hash))
+            return d2
+        d.addCallback(_checked)
+        return d
+
+    def _add_leases(self, storage_index, sharemap):
+        # a normal upload would have added our leases to the shares that
+        # were already there, so do the same here
+        serverids = set()
+        for ids in sharemap.values():
+            serverids.update(ids)
+        renewal_secret = file_renewal_secret_hash(
+            self._secret_holder.get_renewal_secret(), storage_index)
+        cancel_secret = file_cancel_secret_hash(
+            self._secret_holder.get_cancel_secret(), storage_index)
+        def _add_lease_failed(f, server):
+            self.log("add_lease failed for server %s" % server.name(),
+                     failure=f, level=log.UNUSUAL, umid="tZ9rEA")
+        dl = []
+        for server in self._storage_broker.get_servers_for_psi(storage_index):
+            if server.get_serverid() not in serverids:
+                continue
+            seed = server.get_lease_seed()
+            d = add_lease(server.get_rref(), storage_index,
+                          bucket_renewal_secret_hash(renewal_secret, seed),
+                          bucket_cancel_secret_hash(cancel_secret, seed))
+            d.addErrback(_add_lease_failed, server)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def _existing_file_found(self, storage_index, sharemap, ueb_data,
+                             ueb_hash):
+        r = self._results
+        r.dedup_hit = True
+        for shnum, serverids in sharemap.items():
+            for serverid in serverids:
+                r.sharemap.add(shnum, serverid)
+                r.servermap.add(serverid, shnum)
+        r.preexisting_shares = len(sharemap)
+        r.pushed_shares = 0
+        r.file_size = ueb_data["size"]
+        r.uri_extension_data = ueb_data
+        r.verifycapstr = uri.CHKFileVerifierURI(storage_index, ueb_hash,
+                                                ueb_data["needed_shares"],
+                                                ueb_data["total_shares"],
+                                                ueb_data["size"]).to_string()
+        r.timings["total"] = time.time() - self._started
+        r.timings["storage_index"] = self._storage_index_elapsed
+        r.timings["existence_check"] = self._existence_check_elapsed
+        self._upload_status.set_status("Already in grid")
+        self._upload_status.set_progress(1, 1.0)
+        self._upload_status.set_progress(2, 1.0)
+        return r
+
     def locate_all_shareholders(self, encoder, started):
         server_selection_started = now = time.time()
         self._storage_index_elapsed = now - started
@@ -903,9 +1317,16 @@ class CHKUploader:
         self._storage_index = storage_index
         upload_id = si_b2a(storage_index)[:5]
         self.log("using storage index %s" % upload_id)
-        server_selector = self.server_selector_class(upload_id,
-                                                     self._log_number,
-                                                     self._upload_status)
+        if self._batch:
+            server_selector = BatchedServerSelector(self._batch, upload_id,
+                                                    self._log_number,
+                                                    self._upload_status,
+                                                    self._parallel_queries)
+        else:
+            server_selector = self.server_selector_class(upload_id,
+                                                         self._log_number,
+                                                         self._upload_status,
+                                                         self._parallel_queries)
 
         share_size = encoder.get_param("share_size")
         block_size = encoder.get_param("block_size")
@@ -919,6 +1340,7 @@ class CHKUploader:
                                              num_segments, n, k, desired)
         def _done(res):
             self._server_selection_elapsed = time.time() - server_selection_started
+            self._server_selection_rounds = server_selector.rounds
             return res
         d.addCallback(_done)
         return d
@@ -973,6 +1395,9 @@ class CHKUploader:
         r.timings["total"] = now - self._started
         r.timings["storage_index"] = self._storage_index_elapsed
         r.timings["peer_selection"] = self._server_selection_elapsed
+        r.timings["peer_selection_rounds"] = self._server_selection_rounds
+        if self._check_existing:
+            r.timings["existence_check"] = self._existence_check_elapsed
         r.timings.update(self._encoder.get_times())
         r.uri_extension_data = self._encoder.get_uri_extension_data()
         r.verifycapstr = verifycap.to_string()
@@ -1038,10 +1463,17 @@ class LiteralUploader:
 
 class RemoteEncryptedUploadable(Referenceable):
     implements(RIEncryptedUploadable)
+    VERSION_KEY = "http://allmydata.org/tahoe/protocols/helper/chk-upload/v1/encrypted-uploadable"
+    # with concurrent-reads, the helper may send several read_encrypted()
+    # requests without waiting for the answers. We serve them in order.
+    VERSION = { VERSION_KEY : { "concurrent-reads": True },
+                "application-version": str(allmydata.__full_version__),
+                }
 
     def __init__(self, encrypted_uploadable, upload_status):
         self._eu = IEncryptedUploadable(encrypted_uploadable)
         self._offset = 0
+        self._queued_reads = [] # (offset, length, Deferred)
         self._bytes_sent = 0
         self._status = IUploadStatus(upload_status)
         # we are responsible for updating the status string while we run, and
@@ -1058,6 +1490,8 @@ class RemoteEncryptedUploadable(Referenceable):
         d.addCallback(_got_size)
         return d
 
+    def remote_get_version(self):
+        return self.VERSION
     def remote_get_size(self):
         return self.get_size()
     def remote_get_all_encoding_parameters(self):
@@ -1076,6 +1510,26 @@ class RemoteEncryptedUploadable(Referenceable):
         return d
 
     def remote_read_encrypted(self, offset, length):
+        # reading our source may not finish before the next request arrives,
+        # so requests wait their turn
+        d = defer.Deferred()
+        self._queued_reads.append((offset, length, d))
+        if len(self._queued_reads) == 1:
+            self._start_next_read()
+        return d
+
+    def _start_next_read(self):
+        (offset, length, d) = self._queued_reads[0]
+        d2 = defer.maybeDeferred(self._read_at, offset, length)
+        def _done(res):
+            self._queued_reads.pop(0)
+            if self._queued_reads:
+                self._start_next_read()
+            return res
+        d2.addBoth(_done)
+        d2.chainDeferred(d)
+
+    def _read_at(self, offset, length):
         # we don't support seek backwards, but we allow skipping forwards
         precondition(offset >= 0, offset)
         precondition(length >= 0, length)
@@ -1285,6 +1739,9 @@ class BaseUploadable:
         d.addCallback(_got_size)
         return d
 
+# the convergent hashing pass reads files in pieces this big
+HASH_BLOCKSIZE = 1024*1024
+
 class FileHandle(BaseUploadable):
     implements(IUploadable)
 
@@ -1310,25 +1767,13 @@ class FileHandle(BaseUploadable):
         d.addCallback(lambda size: self.get_all_encoding_parameters())
         def _got(params):
             k, happy, n, segsize = params
-            f = self._filehandle
-            enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
-            f.seek(0)
-            BLOCKSIZE = 64*1024
-            bytes_read = 0
-            while True:
-                data = f.read(BLOCKSIZE)
-                if not data:
-                    break
-                enckey_hasher.update(data)
-                # TODO: setting progress in a non-yielding loop is kind of
-                # pointless, but I'm anticipating (perhaps prematurely) the
-                # day when we use a slowjob or twisted's CooperatorService to
-                # make this yield time to other jobs.
-                bytes_read += len(data)
-                if self._status:
-                    self._status.set_progress(0, float(bytes_read)/self._size)
-            f.seek(0)
-            self._key = enckey_hasher.digest()
+            self._key = self._get_remembered_key(params)
+            if self._key is None:
+                enckey_hasher = convergence_hasher(k, n, segsize,
+                                                   self.convergence)
+                self._hash_file(enckey_hasher)
+                self._key = enckey_hasher.digest()
+                self._remember_key(params)
             if self._status:
                 self._status.set_progress(0, 1.0)
             assert len(self._key) == 16
@@ -1336,6 +1781,34 @@ class FileHandle(BaseUploadable):
         d.addCallback(_got)
         return d
 
+    def _hash_file(self, hasher):
+        # read the file in big pieces, to keep the per-read overhead low.
+        # Mapping the file would save a copy, but the hasher only takes
+        # strings, and a file truncated while mapped would kill us with
+        # SIGBUS.
+        f = self._filehandle
+        f.seek(0)
+        bytes_read = 0
+        while True:
+            data = f.read(HASH_BLOCKSIZE)
+            if not data:
+                break
+            hasher.update(data)
+            # TODO: setting progress in a non-yielding loop is kind of
+            # pointless, but I'm anticipating (perhaps prematurely) the
+            # day when we use a slowjob or twisted's CooperatorService to
+            # make this yield time to other jobs.
+            bytes_read += len(data)
+            if self._status:
+                self._status.set_progress(0, float(bytes_read)/self._size)
+        f.seek(0)
+
+    def _get_remembered_key(self, params):
+        return None
+
+    def _remember_key(self, params):
+        pass
+
     def _get_encryption_key_random(self):
         if self._key is None:
             self._key = os.urandom(16)
@@ -1364,15 +1837,52 @@ class FileHandle(BaseUploadable):
         pass
 
 class FileName(FileHandle):
-    def __init__(self, filename, convergence):
+    def __init__(self, filename, convergence, key_cache=None):
         """
         Upload the data from the filename.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
         "convergence" argument to form the encryption key.
+
+        If key_cache (a ConvergentKeyCache) is provided, and it remembers the
+        key for this file from an earlier upload and the file has not
+        changed since, that key is used instead of hashing the file again.
+        A newly computed key is only remembered if the file's size, mtime,
+        and ctime were the same after hashing as before.
         """
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        self._path = os.path.abspath(filename)
+        self._key_cache = key_cache
+        self._stamp = None
+        self._params = None
+
+    def _get_remembered_key(self, params):
+        if self._key_cache is None:
+            return None
+        k, happy, n, segsize = params
+        s = os.fstat(self._filehandle.fileno())
+        self._stamp = (s.st_size, s.st_mtime, s.st_ctime)
+        self._params = base32.b2a(convergent_key_cache_params(k, n, segsize,
+                                                             self.convergence))
+        (size, mtime, ctime) = self._stamp
+        key = self._key_cache.get_key(self._path, self._params,
+                                      size, mtime, ctime)
+        if key is not None:
+            key = base32.a2b(key)
+        return key
+
+    def _remember_key(self, params):
+        if self._key_cache is None:
+            return
+        s = os.fstat(self._filehandle.fileno())
+        if (s.st_size, s.st_mtime, s.st_ctime) != self._stamp:
+            # the file changed while we were hashing it
+            return
+        (size, mtime, ctime) = self._stamp
+        self._key_cache.set_key(self._path, self._params, size, mtime, ctime,
+                                base32.b2a(self._key))
+
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1388,6 +1898,182 @@ class Data(FileHandle):
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, StringIO(data), convergence=convergence)
 
+class StreamingUploadable(BaseUploadable):
+    """I am an uploadable whose data is written into me (by an HTTP request,
+    say) while the upload is running, so it never has to be stored anywhere
+    first. The total size must be known in advance. When more than
+    BUFFER_SIZE bytes are waiting to be read (and nobody is waiting for
+    more), I pause my producer (the connection that the data arrives on)
+    until the upload catches up.
+
+    Since the data cannot be hashed before it is encrypted, I use a random
+    key, unless set_convergence() is used to give me the SHA-256 hash that
+    the data will have. In that case I derive a convergent key from the
+    hash, check the data against it, and fail the upload if it does not
+    match.
+
+    If the upload stops reading early (because the file was already in the
+    grid, say), close() reads and checks the rest of the data before it
+    lets the upload finish."""
+    implements(IUploadable)
+
+    BUFFER_SIZE = 1024*1024
+
+    def __init__(self, size, producer=None):
+        self._size = size
+        self._producer = producer
+        self._paused = False
+        self.convergence = None
+        self._content_hash = None
+        self._hasher = None
+        self._checked = False
+        self._key = None
+        self._buffer = []
+        self._buffered = 0
+        self._received = 0
+        self._consumed = 0 # read by the upload, or discarded after close()
+        self._pending = None # (length, Deferred) of a read() that must wait
+        self._failure = None
+        self._closing = None
+
+    def set_convergence(self, convergence, content_hash):
+        assert len(content_hash) == 32
+        self.convergence = convergence
+        self._content_hash = content_hash
+        self._hasher = SHA256()
+
+    def get_encryption_key(self):
+        if self._key is not None:
+            return defer.succeed(self._key)
+        if self.convergence is None:
+            self._key = os.urandom(16)
+            return defer.succeed(self._key)
+        d = self.get_all_encoding_parameters()
+        def _got(params):
+            k, happy, n, segsize = params
+            self._key = streaming_convergence_key(k, n, segsize,
+                                                  self.convergence,
+                                                  self._content_hash)
+            return self._key
+        d.addCallback(_got)
+        return d
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        precondition(self._pending is None)
+        if self._failure:
+            return defer.fail(self._failure)
+        length = min(length, self._size - self._consumed)
+        if self._buffered >= length:
+            return defer.maybeDeferred(self._take, length)
+        d = defer.Deferred()
+        self._pending = (length, d)
+        self._update_producer()
+        return d
+
+    def _take(self, length):
+        data = []
+        needed = length
+        while needed:
+            s = self._buffer[0]
+            if len(s) <= needed:
+                data.append(self._buffer.pop(0))
+                needed -= len(s)
+            else:
+                data.append(s[:needed])
+                self._buffer[0] = s[needed:]
+                needed = 0
+        self._buffered -= length
+        self._update_producer()
+        self._consume(data)
+        return data
+
+    def _consume(self, data):
+        for s in data:
+            self._consumed += len(s)
+            if self._hasher:
+                self._hasher.update(s)
+        if self._consumed == self._size and self._hasher and not self._checked:
+            self._checked = True
+            if self._hasher.digest() != self._content_hash:
+                raise ContentHashMismatchError()
+
+    def write(self, data):
+        """Add some data. The caller must not write more than the size that
+        I was created with."""
+        if self._failure:
+            return
+        self._received += len(data)
+        assert self._received <= self._size, (self._received, self._size)
+        if self._closing:
+            self._discard([data])
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._pending and self._buffered >= self._pending[0]:
+            (length, d) = self._pending
+            self._pending = None
+            defer.maybeDeferred(self._take, length).chainDeferred(d)
+        else:
+            self._update_producer()
+
+    def _update_producer(self):
+        if not self._producer:
+            return
+        full = (self._buffered >= self.BUFFER_SIZE and not self._pending
+                and not self._closing)
+        if full and not self._paused:
+            self._paused = True
+            self._producer.pauseProducing()
+        elif self._paused and not full:
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def fail(self, why):
+        """The data will never arrive: fail the upload with 'why'."""
+        if self._failure:
+            return
+        self._failure = failure.Failure(why)
+        if self._pending:
+            (length, d) = self._pending
+            self._pending = None
+            d.errback(self._failure)
+        if self._closing and not self._closing.called:
+            self._closing.errback(self._failure)
+
+    def close(self):
+        if self._closing is None:
+            self._closing = defer.Deferred()
+            if self._failure:
+                # our data never arrived, so the upload has failed already
+                self._closing.callback(None)
+                return self._closing
+            leftover = self._buffer
+            self._buffer = []
+            self._buffered = 0
+            self._update_producer()
+            self._discard(leftover)
+        return self._closing
+
+    def _discard(self, data):
+        if self._closing.called:
+            return
+        try:
+            self._consume(data)
+        except ContentHashMismatchError:
+            self._closing.errback(failure.Failure())
+            return
+        if self._consumed == self._size:
+            self._closing.callback(None)
+
+    def drain(self):
+        """Stop buffering (because nobody is going to read the data), and
+        just check it as it arrives."""
+        if self._closing is None:
+            self.close().addErrback(lambda f: None)
+
 class Uploader(service.MultiService, log.PrefixingLogMixin):
     """I am a service that allows file uploading. I am a service-child of the
     Client.
@@ -1395,10 +2081,22 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     implements(IUploader)
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
+    # how many files of an upload_batch() to upload at the same time
+    BATCH_CONCURRENCY = 16
 
-    def __init__(self, helper_furl=None, stats_provider=None):
+    def __init__(self, helper_furl=None, stats_provider=None,
+                 lookahead_segments=None, worker_pool=None,
+                 parallel_queries=1, check_existing=False):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
+        self._lookahead_segments = lookahead_segments
+        # how many storage servers to ask at once during server selection
+        self._parallel_queries = parallel_queries
+        # look for an existing copy before a convergent upload
+        self._check_existing = check_existing
+        # a WorkerPool for the encryption, erasure coding, and hashing, or
+        # None to do it all in the reactor thread
+        self._worker_pool = worker_pool
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
@@ -1438,6 +2136,9 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
         """
         Returns a Deferred that will fire with the UploadResults instance.
         """
+        return self._upload(uploadable, history)
+
+    def _upload(self, uploadable, history=None, batch=None):
         assert self.parent
         assert self.running
 
@@ -1457,7 +2158,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 uploader = LiteralUploader()
                 return uploader.start(uploadable)
             else:
-                eu = EncryptAnUploadable(uploadable, self._parentmsgid)
+                eu = EncryptAnUploadable(uploadable, self._parentmsgid,
+                                         self._worker_pool)
                 d2 = defer.succeed(None)
                 if self._helper:
                     uploader = AssistedUploader(self._helper)
@@ -1466,7 +2168,14 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder)
+                    convergence = getattr(uploadable, "convergence", None)
+                    check_existing = (self._check_existing and
+                                      convergence is not None)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           self._lookahead_segments,
+                                           self._worker_pool,
+                                           self._parallel_queries,
+                                           check_existing, batch)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
@@ -1486,7 +2195,49 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 return d2
         d.addCallback(_got_size)
         def _done(res):
-            uploadable.close()
-            return res
+            d4 = defer.maybeDeferred(uploadable.close)
+            d4.addCallback(lambda ign: res)
+            return d4
         d.addBoth(_done)
         return d
+
+    def upload_batch(self, uploadables, history=None):
+        """
+        Upload each of 'uploadables', keeping BATCH_CONCURRENCY of them in
+        progress at once. Returns a Deferred that will fire with a list of
+        UploadResults instances, in the same order. If any of the uploads
+        fails, no more of them are started, and the Deferred errbacks with
+        the first failure once the others have finished.
+
+        Server selection runs once, for the first file, and the other files
+        put their shares on the same servers (see BatchedServerSelector).
+        Servers which support it get the allocate_buckets(), writev(), and
+        close() messages of all the files in progress as one message of each
+        kind per reactor turn. Files that go through a helper are uploaded
+        as if by upload().
+        """
+        uploadables = list(uploadables)
+        if self.stats_provider:
+            self.stats_provider.count('uploader.batches_uploaded', 1)
+        batch = UploadBatch()
+        sem = defer.DeferredSemaphore(self.BATCH_CONCURRENCY)
+        failures = []
+        def _upload_one(uploadable):
+            if failures:
+                # don't bother, the batch has failed already. The
+                # uploadable still needs closing.
+                return defer.maybeDeferred(IUploadable(uploadable).close)
+            d = self._upload(uploadable, history, batch)
+            def _failed(f):
+                failures.append(f)
+                return f
+            d.addErrback(_failed)
+            return d
+        dl = [sem.run(_upload_one, u) for u in uploadables]
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _done(res):
+            if failures:
+                return failures[0]
+            return [results for (success, results) in res]
+        d.addCallback(_done)
+        return d
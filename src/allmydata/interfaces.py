@@ -14,6 +14,10 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_LEASE_BATCH = 1000 # storage indices per add_leases() call
+MAX_DYHB_BATCH = 100 # storage indices per get_many_buckets() call
+MAX_UPLOAD_BATCH = 100 # requests per allocate_buckets_many(), writev_many(),
+                       # or close_many() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -34,11 +38,23 @@ class RIStubClient(RemoteInterface):
     the grid and the client versions in use. This is the (empty)
     RemoteInterface for the StubClient."""
 
+DataVector = ListOf(TupleOf(Offset, ShareData))
+# (offset, data). This limits us to 30 writes of 1MiB each per call
+
 class RIBucketWriter(RemoteInterface):
     """ Objects of this kind live on the server side. """
     def write(offset=Offset, data=ShareData):
         return None
 
+    def writev(datav=DataVector):
+        """Write several ranges of the share in one message, as if write()
+        had been called with each (offset, data) pair in turn.
+
+        Only servers which set 'supports-immutable-writev' in their version
+        dict implement this.
+        """
+        return None
+
     def close():
         """
         If the data that has been written is incomplete or inconsistent then
@@ -52,10 +68,24 @@ class RIBucketWriter(RemoteInterface):
         """
         return None
 
+ReadVector = ListOf(TupleOf(Offset, ReadSize))
+ReadData = ListOf(ShareData)
+# returns data[offset:offset+length] for each element of TestVector
+
 class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(readv=ReadVector):
+        """Read several ranges of the share in one round trip. Return a
+        list with the data for each (offset, length) pair, in the same
+        order, as if read() had been called with each of them.
+
+        Only servers which set 'supports-immutable-readv' in their version
+        dict implement this.
+        """
+        return ReadData
+
     def advise_corrupt_share(reason=str):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -73,16 +103,11 @@ TestVector = ListOf(TupleOf(Offset, ReadSize, str, str))
 # operator is one of "lt, le, eq, ne, ge, gt"
 # nop always passes and is used to fetch data while writing.
 # you should use length==len(specimen) for everything except nop
-DataVector = ListOf(TupleOf(Offset, ShareData))
-# (offset, data). This limits us to 30 writes of 1MiB each per call
 TestAndWriteVectorsForShares = DictOf(int,
                                       TupleOf(TestVector,
                                               DataVector,
                                               ChoiceOf(None, Offset), # new_length
                                               ))
-ReadVector = ListOf(TupleOf(Offset, ReadSize))
-ReadData = ListOf(ShareData)
-# returns data[offset:offset+length] for each element of TestVector
 
 class RIStorageServer(RemoteInterface):
     __remote_name__ = "RIStorageServer.tahoe.allmydata.com"
@@ -130,6 +155,22 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_leases(leases=ListOf(TupleOf(StorageIndex,
+                                         LeaseRenewSecret,
+                                         LeaseCancelSecret),
+                                 maxLength=MAX_LEASE_BATCH)):
+        """
+        Add or renew leases on many buckets at once, as if add_lease() had
+        been called with each (storage_index, renew_secret, cancel_secret)
+        tuple in turn. Return a list with one entry per tuple, in the same
+        order: None if that add_lease() succeeded, or a string describing
+        the exception it raised.
+
+        Only servers which set 'supports-add-leases' in their version dict
+        implement this.
+        """
+        return ListOf(ChoiceOf(None, str), maxLength=MAX_LEASE_BATCH)
+
     def renew_lease(storage_index=StorageIndex, renew_secret=LeaseRenewSecret):
         """
         Renew the lease on a given bucket, resetting the timer to 31 days.
@@ -162,6 +203,64 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_many_buckets(storage_indexes=ListOf(StorageIndex,
+                                                maxLength=MAX_DYHB_BATCH)):
+        """
+        Ask about many storage indexes in one round trip. Return a list with
+        one entry per storage index, in the same order, each of which is
+        what get_buckets() would have returned for it.
+
+        Only servers which set 'supports-get-many-buckets' in their version
+        dict implement this.
+        """
+        return ListOf(DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxLength=MAX_DYHB_BATCH)
+
+    def allocate_buckets_many(requests=ListOf(TupleOf(StorageIndex,
+                                                      LeaseRenewSecret,
+                                                      LeaseCancelSecret,
+                                                      SetOf(int,
+                                                            maxLength=MAX_BUCKETS),
+                                                      Offset),
+                                              maxLength=MAX_UPLOAD_BATCH),
+                              canary=Referenceable):
+        """
+        Allocate buckets for many files in one round trip, as if
+        allocate_buckets() had been called with each (storage_index,
+        renew_secret, cancel_secret, sharenums, allocated_size) tuple in
+        turn, all with the same canary. Return a list with one (alreadygot,
+        allocated) tuple per request, in the same order.
+
+        Only servers which set 'supports-upload-batches' in their version
+        dict implement this, writev_many(), and close_many().
+        """
+        return ListOf(TupleOf(SetOf(int, maxLength=MAX_BUCKETS),
+                              DictOf(int, RIBucketWriter,
+                                     maxKeys=MAX_BUCKETS)),
+                      maxLength=MAX_UPLOAD_BATCH)
+
+    # the buckets passed to writev_many() and close_many() arrive as the
+    # server's own BucketWriters, which an RIBucketWriter constraint would
+    # refuse. The server checks that each of them is one of its open buckets.
+    def writev_many(writes=ListOf(TupleOf(Any(), DataVector),
+                                  maxLength=MAX_UPLOAD_BATCH)):
+        """
+        Write to many of the buckets that allocate_buckets() or
+        allocate_buckets_many() gave out, in one message, as if writev()
+        had been called on each bucket with its (bucket, datav) pair. Return
+        a list with one entry per pair, in the same order: None if that
+        write succeeded, or a string describing the exception it raised.
+        """
+        return ListOf(ChoiceOf(None, str), maxLength=MAX_UPLOAD_BATCH)
+
+    def close_many(buckets=ListOf(Any(), maxLength=MAX_UPLOAD_BATCH)):
+        """
+        Close many buckets in one message, as if close() had been called on
+        each of them. Return a list with one entry per bucket, like
+        writev_many().
+        """
+        return ListOf(ChoiceOf(None, str), maxLength=MAX_UPLOAD_BATCH)
+
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -1644,7 +1743,8 @@ class IUploadable(Interface):
 
     def close():
         """The upload is finished, and whatever filehandle was in use may be
-        closed."""
+        closed. This may return a Deferred, in which case the upload does not
+        report its results until it fires. If it fails, the upload fails."""
 
 class IUploadResults(Interface):
     """I am returned by upload() methods. I contain a number of public
@@ -1663,17 +1763,25 @@ class IUploadResults(Interface):
                    containing the sequence number, the roothash, and the
                    share number.
      .servermap : dict mapping server peerid to a set of share numbers
+     .dedup_hit : True if all of the file's shares were already in the grid,
+                  so the client skipped encoding and pushing them
      .timings : dict of timing information, mapping name to seconds (float)
        total : total upload time, start to finish
        storage_index : time to compute the storage index
        peer_selection : time to decide which peers will be used
+       peer_selection_rounds : how many round trips to storage servers
+                               peer selection waited for, one after another
+                               (a count, not a time)
        contacting_helper : initial helper query to upload/no-upload decision
-       existence_check : helper pre-upload existence check
+       existence_check : helper (or client) pre-upload existence check
        helper_total : initial helper query to helper finished pushing
        cumulative_fetch : helper waiting for ciphertext requests
        total_fetch : helper start to last ciphertext response
+       cumulative_reading : time spent reading and encrypting segments
        cumulative_encoding : just time spent in zfec
        cumulative_sending : just time spent waiting for storage servers
+       cumulative_encode_wait : time that pushing was stalled waiting for
+                                the next segment to be read and encoded
        hashes_and_close : last segment push to shareholder close
        total_encode_and_push : first encode to shareholder close
 
@@ -1710,6 +1818,15 @@ class IUploader(Interface):
         returns a Deferred which fires with an IUploadResults instance, from
         which the URI of the file can be obtained as results.uri ."""
 
+    def upload_batch(uploadables):
+        """Upload several files, which is faster than uploading them one
+        after another when they are small: server selection runs once, for
+        the first file, and the others reuse its servers, and the messages
+        that the files send to each storage server are combined (for servers
+        which support it). 'uploadables' is a list of IUploadable providers.
+        This returns a Deferred which fires with a list of IUploadResults
+        instances, in the same order, or errbacks if any upload fails."""
+
     def upload_ssk(write_capability, new_version, uploadable):
         """TODO: how should this work?"""
 
@@ -2215,6 +2332,12 @@ class IUploadStatus(Interface):
         process has finished: for helper uploads this is dependent upon the
         helper providing progress reports. It might be reasonable to add all
         three numbers and report the sum to the user."""
+    def get_pipeline_windows():
+        """Return a dict that maps share number to a (serverid, window)
+        tuple, where 'window' is how many bytes of that share the uploader
+        is currently willing to have in flight to the server. The windows
+        grow and shrink as the upload measures each server's latency. This
+        is empty before shares are being pushed, and for helper uploads."""
     def get_active():
         """Return True if the upload is currently active, False if not."""
     def get_results():
@@ -2307,7 +2430,8 @@ class RIControlClient(RemoteInterface):
         Then measure how long it takes to download all of them. If 'mutable'
         is 'create', time creation of mutable files. If 'mutable' is
         'upload', then time access to the same mutable file instead of
-        creating one.
+        creating one. If 'mutable' is 'batch', upload immutable files with a
+        single upload_batch() call instead of one at a time.
 
         Returns a tuple of (upload_time, download_time).
         """
@@ -2328,6 +2452,13 @@ UploadResults = Any() #DictOf(str, str)
 class RIEncryptedUploadable(RemoteInterface):
     __remote_name__ = "RIEncryptedUploadable.tahoe.allmydata.com"
 
+    def get_version():
+        """
+        Return a dictionary of version information. Older clients do not
+        have this method.
+        """
+        return DictOf(str, Any())
+
     def get_size():
         return Offset
 
@@ -2436,6 +2567,10 @@ class RIKeyGenerator(RemoteInterface):
 class FileTooLargeError(Exception):
     pass
 
+class ContentHashMismatchError(Exception):
+    """The data of a streamed upload did not have the hash that the sender
+    said it would have."""
+
 class IValidatedThingProxy(Interface):
     def start():
         """ Acquire a thing and validate it. Return a deferred which is
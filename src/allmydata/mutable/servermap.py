@@ -9,6 +9,7 @@ from allmydata.util import base32, hashutil, idlib, log
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
 from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.storage_client import add_lease, AddLeaseError
 from pycryptopp.publickey import rsa
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, MODE_READ, \
@@ -537,19 +538,24 @@ class ServermapUpdater:
         return d
 
     def _do_read(self, ss, peerid, storage_index, shnums, readv):
+        d2 = None
         if self._add_lease:
             # send an add-lease message in parallel. The results are handled
-            # separately. This is sent before the slot_readv() so that we can
-            # be sure the add_lease is retired by the time slot_readv comes
-            # back (this relies upon our knowledge that the server code for
-            # add_lease is synchronous).
+            # separately. The request may be batched with others (see
+            # storage_client.LeaseBatcher) and sent after the slot_readv(),
+            # so we wait for it before returning, to be sure that the lease
+            # is in place by the time the caller sees the results.
             renew_secret = self._node.get_renewal_secret(peerid)
             cancel_secret = self._node.get_cancel_secret(peerid)
-            d2 = ss.callRemote("add_lease", storage_index,
-                               renew_secret, cancel_secret)
+            d2 = add_lease(ss, storage_index, renew_secret, cancel_secret)
             # we ignore success
             d2.addErrback(self._add_lease_failed, peerid, storage_index)
         d = ss.callRemote("slot_readv", storage_index, shnums, readv)
+        if d2:
+            def _wait_for_lease(res):
+                d2.addCallback(lambda ign: res)
+                return d2
+            d.addCallback(_wait_for_lease)
         return d
 
     def _got_results(self, datavs, peerid, readsize, stuff, started):
@@ -770,6 +776,14 @@ class ServermapUpdater:
                      failure=f,
                      level=log.WEIRD, umid="iqg3mw")
             return
+        if f.check(AddLeaseError):
+            # only servers with add_leases() report these, and they are
+            # too new to have any of the problems described above
+            self.log(format="error in add_leases from [%(peerid)s]: %(f_value)s",
+                     peerid=idlib.shortnodeid_b2a(peerid),
+                     f_value=str(f.value),
+                     level=log.WEIRD, umid="8EZnqw")
+            return
         # local errors are cause for alarm
         log.err(f,
                 format="local error in add_lease to [%(peerid)s]: %(f_value)s",
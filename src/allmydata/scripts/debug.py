@@ -696,6 +696,74 @@ def catalog_shares_one_abbrevdir(si_s, si_dir, now, out, err):
         print >>err, "Error processing %s" % quote_output(si_dir)
         failure.Failure().printTraceback(err)
 
+class MigrateLeasesOptions(usage.Options):
+    def getSynopsis(self):
+        return "Usage: tahoe debug migrate-leases NODEDIR"
+
+    def parseArgs(self, nodedir):
+        from allmydata.util.encodingutil import argv_to_abspath
+        self.nodedir = argv_to_abspath(nodedir)
+
+    def getUsage(self, width=None):
+        t = usage.Options.getUsage(self, width)
+        t += """
+Copy the leases held in the share files of a storage server into its lease
+database (NODEDIR/storage/leasedb.sqlite), for use with
+[storage]leasedb.enabled = true . Buckets which already have leases in the
+database are left alone. Stop the node before running this command.
+
+A server with the lease database enabled will also import the leases of each
+bucket the first time it needs them, so running this command is optional,
+but it lets the lease expirer and the first lease renewals avoid reading the
+share files.
+"""
+        return t
+
+def migrate_leases(options):
+    from allmydata.storage.common import si_a2b
+    from allmydata.storage.leasedb import LeaseDB, leases_from_shares
+    from allmydata.storage.shares import get_share_file
+    from allmydata.util.encodingutil import quote_output
+
+    out = options.stdout
+    err = options.stderr
+    storedir = os.path.join(options.nodedir, "storage")
+    sharedir = os.path.join(storedir, "shares")
+    if not os.path.isdir(sharedir):
+        print >>err, "%s does not hold any shares" % quote_output(options.nodedir)
+        return 1
+    lease_db = LeaseDB(os.path.join(storedir, "leasedb.sqlite"))
+    num_buckets = 0
+    num_imported = 0
+    for prefix in sorted(os.listdir(sharedir)):
+        if prefix == "incoming":
+            continue
+        prefixdir = os.path.join(sharedir, prefix)
+        if not os.path.isdir(prefixdir):
+            continue
+        for si_s in sorted(os.listdir(prefixdir)):
+            bucketdir = os.path.join(prefixdir, si_s)
+            try:
+                si = si_a2b(si_s.encode("ascii"))
+                num_buckets += 1
+                if lease_db.get_leases(si):
+                    continue
+                sharefiles = [get_share_file(os.path.join(bucketdir, shnum_s))
+                              for shnum_s in os.listdir(bucketdir)
+                              if shnum_s.isdigit()]
+                leases = leases_from_shares(sharefiles)
+                if leases:
+                    lease_db.add_leases(si, leases)
+                    num_imported += 1
+            except:
+                print >>err, "Error processing %s" % quote_output(bucketdir)
+                failure.Failure().printTraceback(err)
+    lease_db.close()
+    print >>out, "imported leases for %d of %d buckets" % (num_imported,
+                                                            num_buckets)
+    return 0
+
+
 class CorruptShareOptions(usage.Options):
     def getSynopsis(self):
         return "Usage: tahoe debug corrupt-share SHARE_FILENAME"
@@ -824,6 +892,7 @@ class DebugCommand(usage.Options):
         ["find-shares", None, FindSharesOptions, "Locate sharefiles in node dirs."],
         ["catalog-shares", None, CatalogSharesOptions, "Describe all shares in node dirs."],
         ["corrupt-share", None, CorruptShareOptions, "Corrupt a share by flipping a bit."],
+        ["migrate-leases", None, MigrateLeasesOptions, "Copy leases from shares into the lease database."],
         ["repl", None, ReplOptions, "Open a Python interpreter."],
         ["trial", None, TrialOptions, "Run tests using Twisted Trial with the right imports."],
         ]
@@ -841,6 +910,7 @@ Subcommands:
     tahoe debug find-shares     Locate sharefiles in node directories.
     tahoe debug catalog-shares  Describe all shares in node dirs.
     tahoe debug corrupt-share   Corrupt a share by flipping a bit.
+    tahoe debug migrate-leases  Copy leases from shares into the lease database.
     tahoe debug repl            Open a Python interpreter.
     tahoe debug trial           Run tests using Twisted Trial with the right imports.
 
@@ -870,6 +940,7 @@ subDispatch = {
     "find-shares": find_shares,
     "catalog-shares": catalog_shares,
     "corrupt-share": corrupt_share,
+    "migrate-leases": migrate_leases,
     "repl": repl,
     "trial": trial,
     }
@@ -55,6 +55,13 @@ class ShareCrawler(service.MultiService):
     middle of a time slice will lose progress: the next time the node is
     started, the crawler will repeat some unknown amount of work.
 
+    Large servers can set 'incremental' to True. In this mode, the crawler
+    remembers the sorted list of buckets in each prefixdir (in a directory
+    next to the statefile), along with the prefixdir's mtime, and only lists
+    a prefixdir again when its mtime has changed. It also saves its state
+    after every 'checkpoint_buckets' buckets, so a SIGKILL loses at most
+    that much work.
+
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
     """
@@ -64,6 +71,8 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    incremental = False # cache bucket lists, checkpoint frequently
+    checkpoint_buckets = 100 # in incremental mode, save state this often
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -72,6 +81,7 @@ class ShareCrawler(service.MultiService):
         self.server = server
         self.sharedir = server.sharedir
         self.statefile = statefile
+        self.bucket_list_dir = statefile + ".buckets"
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
@@ -83,6 +93,10 @@ class ShareCrawler(service.MultiService):
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        # for throughput: what this process has done, and how long it spent
+        # doing it (not counting the time spent sleeping)
+        self.buckets_processed = 0
+        self.active_time = 0.0
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -114,6 +128,12 @@ class ShareCrawler(service.MultiService):
                 crawlers (which can process a whole prefix in a single tick)
          estimated-time-per-cycle: float, seconds required to do a complete
                                    cycle
+         buckets-processed: int, number of buckets processed so far in the
+                            current cycle
+         cached-bucket-lists: int, number of prefixdirs in the current cycle
+                              which did not need to be listed again,
+                              because 'incremental' is True and they had
+                              not changed
 
         If cycle-in-progress is False, the following keys are available::
 
@@ -121,6 +141,13 @@ class ShareCrawler(service.MultiService):
          remaining-wait-time: float, seconds from now when next crawl starts
          estimated-time-per-cycle: float, seconds required to do a complete
                                    cycle
+
+        The following keys are always present::
+
+         incremental: bool, True if bucket lists are cached between cycles
+         buckets-per-second: float, the rate at which this process has
+                             processed buckets while it was not sleeping, or
+                             None if it has not processed any yet
         """
 
         d = {}
@@ -147,12 +174,19 @@ class ShareCrawler(service.MultiService):
             # finished_prefix() function
             d["remaining-sleep-time"] = self.minus_or_none(self.next_wake_time,
                                                            time.time())
+            d["buckets-processed"] = self.state["current-cycle-buckets"]
+            d["cached-bucket-lists"] = self.state["current-cycle-cached-prefixes"]
         per_cycle = None
         if self.last_cycle_elapsed_time is not None:
             per_cycle = self.last_cycle_elapsed_time
         elif self.last_prefix_elapsed_time is not None:
             per_cycle = len(self.prefixes) * self.last_prefix_elapsed_time
         d["estimated-time-per-cycle"] = per_cycle
+        d["incremental"] = self.incremental
+        rate = None
+        if self.buckets_processed and self.active_time > 0:
+            rate = self.buckets_processed / self.active_time
+        d["buckets-per-second"] = rate
         return d
 
     def get_state(self):
@@ -190,6 +224,11 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
+        #  ["current-cycle-buckets"]: int, number of buckets processed so far
+        #                             in this cycle
+        #  ["current-cycle-cached-prefixes"]: int, number of prefixdirs in
+        #                                     this cycle whose cached bucket
+        #                                     list was still valid
         try:
             f = open(self.statefile, "rb")
             state = pickle.load(f)
@@ -202,6 +241,8 @@ class ShareCrawler(service.MultiService):
                      "last-complete-bucket": None,
                      }
         state.setdefault("current-cycle-start-time", time.time()) # approximate
+        state.setdefault("current-cycle-buckets", 0)
+        state.setdefault("current-cycle-cached-prefixes", 0)
         self.state = state
         lcp = state["last-complete-prefix"]
         if lcp == None:
@@ -262,6 +303,7 @@ class ShareCrawler(service.MultiService):
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
+        self.active_time += time.time() - start_slice
         self.save_state()
         if not self.running:
             # someone might have used stopService() to shut us down
@@ -296,6 +338,8 @@ class ShareCrawler(service.MultiService):
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
             state["current-cycle-start-time"] = self.last_cycle_started_time
+            state["current-cycle-buckets"] = 0
+            state["current-cycle-cached-prefixes"] = 0
             if state["last-cycle-finished"] is None:
                 state["current-cycle"] = 0
             else:
@@ -309,12 +353,11 @@ class ShareCrawler(service.MultiService):
             prefixdir = os.path.join(self.sharedir, prefix)
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
+            elif self.incremental:
+                buckets = self.get_cached_bucket_list(prefix, prefixdir)
+                self.bucket_cache = (i, buckets)
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self.list_buckets(prefixdir)
                 self.bucket_cache = (i, buckets)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
@@ -342,6 +385,48 @@ class ShareCrawler(service.MultiService):
         self.finished_cycle(cycle)
         self.save_state()
 
+    def list_buckets(self, prefixdir):
+        try:
+            buckets = os.listdir(prefixdir)
+            buckets.sort()
+        except EnvironmentError:
+            buckets = []
+        return buckets
+
+    def get_cached_bucket_list(self, prefix, prefixdir):
+        """Return the sorted list of buckets in this prefixdir, from the
+        bucket list cache if the prefixdir has not been modified since it
+        was last listed. Adding or removing a bucket changes the mtime of
+        its prefixdir."""
+        try:
+            mtime = os.stat(prefixdir).st_mtime
+        except EnvironmentError:
+            return []
+        cachefile = os.path.join(self.bucket_list_dir, prefix)
+        try:
+            f = open(cachefile, "rb")
+            (cached_mtime, buckets) = pickle.load(f)
+            f.close()
+            if cached_mtime is not None and cached_mtime == mtime:
+                self.state["current-cycle-cached-prefixes"] += 1
+                return buckets
+        except Exception:
+            pass # a missing or damaged entry just means we must list it
+        listed = time.time()
+        buckets = self.list_buckets(prefixdir)
+        if mtime >= listed - 2:
+            # on filesystems with coarse timestamps, a bucket added later in
+            # this same second would not change the mtime, so don't trust
+            # this listing next time
+            mtime = None
+        fileutil.make_dirs(self.bucket_list_dir)
+        tmpfile = cachefile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump((mtime, buckets), f)
+        f.close()
+        fileutil.move_into_place(tmpfile, cachefile)
+        return buckets
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
         base32-encoded) in sorted order.
@@ -359,6 +444,11 @@ class ShareCrawler(service.MultiService):
                 continue
             self.process_bucket(cycle, prefix, prefixdir, bucket)
             self.state["last-complete-bucket"] = bucket
+            self.state["current-cycle-buckets"] += 1
+            self.buckets_processed += 1
+            if (self.incremental and
+                self.state["current-cycle-buckets"] % self.checkpoint_buckets == 0):
+                self.save_state()
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
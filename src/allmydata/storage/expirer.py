@@ -1,9 +1,53 @@
 import time, os, pickle, struct
-from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
-from twisted.python import log as twlog
+     UnknownImmutableContainerVersionError, si_a2b
+from allmydata.util import log
+from allmydata.util.workerpool import WorkerPool, _get_multiprocessing
+from twisted.python import log as twlog, failure
+
+def examine_prefixdir(prefixdir, read_leases):
+    """Parse every share in a prefixdir. This runs in a worker process of
+    the LeaseCheckingCrawler's pool, so it must not modify anything. I
+    return a dict mapping base32 storage index to a (bucket_stat, shares)
+    tuple, where 'shares' is a list of (shnum, sharetype, stat, leases)
+    tuples. 'leases' is a list of LeaseInfo instances, or None if
+    read_leases is False (because the server keeps them in its lease
+    database). A corrupt share has a sharetype of None, and the error
+    message in place of its stat. Buckets which could not be read are left
+    out, and the crawler examines them itself."""
+    results = {}
+    try:
+        buckets = os.listdir(prefixdir)
+    except EnvironmentError:
+        return results
+    for storage_index_b32 in buckets:
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            bucket_stat = os.stat(bucketdir)
+            shares = []
+            for fn in os.listdir(bucketdir):
+                try:
+                    shnum = int(fn)
+                except ValueError:
+                    continue # non-numeric means not a sharefile
+                sharefile = os.path.join(bucketdir, fn)
+                try:
+                    sf = get_share_file(sharefile)
+                    leases = None
+                    if read_leases:
+                        leases = list(sf.get_leases())
+                    shares.append((shnum, sf.sharetype, os.stat(sharefile),
+                                   leases))
+                except (UnknownMutableContainerVersionError,
+                        UnknownImmutableContainerVersionError,
+                        struct.error), e:
+                    shares.append((shnum, None, str(e), None))
+        except EnvironmentError:
+            continue
+        results[storage_index_b32] = (bucket_stat, shares)
+    return results
 
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
@@ -47,12 +91,15 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    prefixes_per_worker = 2 # how far ahead of the crawl the pool may run
+    pool_wait_time = 1.0 # longest sleep while the pool is behind the crawl
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
                  override_lease_duration, # used if expiration_mode=="age"
                  cutoff_date, # used if expiration_mode=="cutoff-date"
-                 sharetypes):
+                 sharetypes,
+                 workers=0):
         self.historyfile = historyfile
         self.expiration_enabled = expiration_enabled
         self.mode = mode
@@ -68,6 +115,15 @@ class LeaseCheckingCrawler(ShareCrawler):
         else:
             raise ValueError("GC mode '%s' must be 'age' or 'cutoff-date'" % mode)
         self.sharetypes_to_expire = sharetypes
+        # with workers>0, the shares are parsed by a pool of worker
+        # processes, a few prefixdirs ahead of the crawl, and the crawler
+        # itself only merges their results into the cycle-to-date state and
+        # cancels the expired leases
+        self.workers = workers
+        self.pool = None
+        self._pending_prefixes = {} # prefix -> [] or [results or Failure]
+        self._waiting_for_prefix = None
+        self._prefix_results = None # si_b32 -> results, for this prefixdir
         ShareCrawler.__init__(self, server, statefile)
 
     def add_initial_state(self):
@@ -108,16 +164,102 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def started_cycle(self, cycle):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        self._pending_prefixes = {}
+        self._waiting_for_prefix = None
+
+    def stopService(self):
+        if self.pool:
+            self.pool.stopService()
+            self.pool = None
+        self._pending_prefixes = {}
+        self._waiting_for_prefix = None
+        return ShareCrawler.stopService(self)
+
+    def get_pool(self):
+        if self.pool is None and self.workers:
+            if _get_multiprocessing() is None:
+                log.msg("lease-checker: workers= requires the multiprocessing"
+                        " module, examining shares in the node instead",
+                        facility="tahoe.storage", level=log.UNUSUAL,
+                        umid="Xk4GZQ")
+                self.workers = 0
+                return None
+            self.pool = WorkerPool(self.workers)
+            self.pool.startService()
+        return self.pool
+
+    def start_slice(self):
+        ShareCrawler.start_slice(self)
+        if (self._waiting_for_prefix is not None
+            and self.timer and self.timer.active()):
+            # the workers are still busy with the prefixdir we need. Don't
+            # spin the reactor polling them: _got_prefix_results will wake
+            # us up when they are done.
+            sleep_time = max(self.current_sleep_time, self.pool_wait_time)
+            self.current_sleep_time = sleep_time
+            self.next_wake_time = time.time() + sleep_time
+            self.timer.reset(sleep_time)
+
+    def _got_prefix_results(self, res, prefix, results):
+        results.append(res)
+        if (prefix == self._waiting_for_prefix
+            and self.timer and self.timer.active()):
+            self.timer.reset(0)
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        pool = self.get_pool()
+        if not pool:
+            return ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                                  buckets, start_slice)
+        # keep the pool busy with the next few prefixdirs
+        read_leases = not self.server.lease_db
+        i = self.prefixes.index(prefix)
+        ahead = self.prefixes[i:i+self.workers*self.prefixes_per_worker]
+        for p in ahead:
+            if p not in self._pending_prefixes:
+                pdir = os.path.join(self.sharedir, p)
+                results = self._pending_prefixes[p] = []
+                d = pool.run(examine_prefixdir, pdir, read_leases)
+                d.addBoth(self._got_prefix_results, p, results)
+        results = self._pending_prefixes[prefix]
+        if not results:
+            # yield rather than block the reactor, and look again later
+            self._waiting_for_prefix = prefix
+            raise TimeSliceExceeded()
+        self._waiting_for_prefix = None
+        if isinstance(results[0], failure.Failure):
+            log.err(results[0],
+                    "lease-checker worker failed on prefixdir %s" % prefix,
+                    facility="tahoe.storage", level=log.UNUSUAL, umid="qT7aQw")
+            self._prefix_results = {}
+        else:
+            self._prefix_results = results[0]
+        try:
+            ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                           buckets, start_slice)
+        finally:
+            self._prefix_results = None
+        del self._pending_prefixes[prefix]
 
     def stat(self, fn):
         return os.stat(fn)
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
+        leases = None
+        if self.server.lease_db:
+            # the leases live in the server's database, not in the shares
+            si = si_a2b(storage_index_b32)
+            leases = list(self.server.get_leases(si))
+        examined = None
+        if self._prefix_results:
+            examined = self._prefix_results.get(storage_index_b32)
+        if examined is not None:
+            return self.process_examined_bucket(bucketdir, examined, leases)
+
         s = self.stat(bucketdir)
         would_keep_shares = []
         wks = None
-
         for fn in os.listdir(bucketdir):
             try:
                 shnum = int(fn)
@@ -125,7 +267,7 @@ class LeaseCheckingCrawler(ShareCrawler):
                 continue # non-numeric means not a sharefile
             sharefile = os.path.join(bucketdir, fn)
             try:
-                wks = self.process_share(sharefile)
+                wks = self.process_share(sharefile, leases)
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
@@ -135,7 +277,33 @@ class LeaseCheckingCrawler(ShareCrawler):
                 self.state["cycle-to-date"]["corrupt-shares"].append(which)
                 wks = (1, 1, 1, "unknown")
             would_keep_shares.append(wks)
+        self.finished_bucket(storage_index_b32, s, would_keep_shares, leases)
+
+    def process_examined_bucket(self, bucketdir, examined, leases):
+        # like process_bucket(), but with the results of examine_prefixdir()
+        storage_index_b32 = os.path.basename(bucketdir)
+        (s, shares) = examined
+        would_keep_shares = []
+        for (shnum, sharetype, share_stat, share_leases) in shares:
+            sharefile = os.path.join(bucketdir, str(shnum))
+            if sharetype is None:
+                twlog.msg("lease-checker error processing %s: %s"
+                          % (sharefile, share_stat))
+                which = (storage_index_b32, shnum)
+                self.state["cycle-to-date"]["corrupt-shares"].append(which)
+                would_keep_shares.append((1, 1, 1, "unknown"))
+                continue
+            if leases is not None:
+                share_leases = leases
+            wks = self.account_share(sharefile, sharetype, share_stat,
+                                     share_leases, None)
+            would_keep_shares.append(wks)
+        self.finished_bucket(storage_index_b32, s, would_keep_shares, leases)
 
+    def finished_bucket(self, storage_index_b32, s, would_keep_shares, leases):
+        wks = None
+        if would_keep_shares:
+            wks = would_keep_shares[-1]
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
@@ -156,45 +324,54 @@ class LeaseCheckingCrawler(ShareCrawler):
         if sum([wks[2] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
 
-    def process_share(self, sharefilename):
+        if leases is not None and self.expiration_enabled:
+            expired_leases = [li for li in leases
+                              if self.lease_is_expired(li, sharetype)]
+            if expired_leases:
+                si = si_a2b(storage_index_b32)
+                self.server.remove_expired_leases(si, expired_leases)
+
+    def lease_is_expired(self, li, sharetype):
+        if sharetype not in self.sharetypes_to_expire:
+            return False
+        if self.mode == "age":
+            age_limit = li.get_expiration_time()
+            if self.override_lease_duration is not None:
+                age_limit = self.override_lease_duration
+            return li.get_age() > age_limit
+        assert self.mode == "cutoff-date"
+        return li.get_grant_renew_time_time() < self.cutoff_date
+
+    def process_share(self, sharefilename, leases=None):
+        # 'leases' is provided when the server keeps them in its lease
+        # database, in which case process_bucket() removes the expired ones
+
         # first, find out what kind of a share it is
         sf = get_share_file(sharefilename)
-        sharetype = sf.sharetype
-        now = time.time()
         s = self.stat(sharefilename)
+        if leases is None:
+            leases = sf.get_leases()
+        return self.account_share(sharefilename, sf.sharetype, s, leases, sf)
 
+    def account_share(self, sharefilename, sharetype, s, leases, sf):
+        # 'sf' is None when the share was parsed by a worker process, in
+        # which case we only open it if some of its leases need cancelling
+        now = time.time()
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
         expired_leases_configured = []
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
-            original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
-            age = li.get_age()
-            self.add_lease_age_to_histogram(age)
+            self.add_lease_age_to_histogram(li.get_age())
 
             #  expired-or-not according to original expiration time
-            if original_expiration_time > now:
+            if li.get_expiration_time() > now:
                 num_valid_leases_original += 1
 
             #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
+            if self.lease_is_expired(li, sharetype):
                 expired_leases_configured.append(li)
             else:
                 num_valid_leases_configured += 1
@@ -205,9 +382,21 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         would_keep_share = [1, 1, 1, sharetype]
 
-        if self.expiration_enabled:
+        if (self.expiration_enabled and expired_leases_configured
+            and not self.server.lease_db):
+            if sf is None:
+                # the worker's view of the leases may be out of date by
+                # now, so look again before cancelling anything
+                sf = get_share_file(sharefilename)
+                expired_leases_configured = [li for li in sf.get_leases()
+                                             if self.lease_is_expired(li,
+                                                                      sharetype)]
             for li in expired_leases_configured:
                 sf.cancel_lease(li.cancel_secret)
+            # the share might be gone now, so tell the share index
+            bucketdir, shnum_s = os.path.split(sharefilename)
+            si = si_a2b(os.path.basename(bucketdir))
+            self.server.update_share_index(si, int(shnum_s), sf)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
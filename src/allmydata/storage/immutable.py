@@ -80,31 +80,49 @@ class ShareFile:
     def unlink(self):
         os.unlink(self.home)
 
-    def read_share_data(self, offset, length):
+    def read_share_data(self, offset, length, mapcache=None):
+        """Read from the share. If mapcache (a ShareMapCache) is given, the
+        data is taken from a memory map of the share when possible."""
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
         # beyond the end of the data return an empty string. I wonder why
         # Python doesn't do the following computation for me?
         seekpos = self._data_offset+offset
-        fsize = os.path.getsize(self.home)
+        m = None
+        if mapcache is not None:
+            m = mapcache.get(self.home)
+        if m is not None:
+            fsize = len(m)
+        else:
+            fsize = os.path.getsize(self.home)
         actuallength = max(0, min(length, fsize-seekpos))
         if actuallength == 0:
             return ""
+        if m is not None:
+            return m[seekpos:seekpos+actuallength]
         f = open(self.home, 'rb')
         f.seek(seekpos)
         return f.read(actuallength)
 
-    def write_share_data(self, offset, data):
+    def write_share_data(self, offset, data, f=None):
+        """Write data into the share. If f is given, it must be a file
+        opened (with mode 'rb+') on my home by the caller, who keeps it open
+        across many writes and is responsible for closing it. Otherwise I
+        open and close the file myself."""
         length = len(data)
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        f = open(self.home, 'rb+')
+        close_f = False
+        if f is None:
+            f = open(self.home, 'rb+')
+            close_f = True
         real_offset = self._data_offset+offset
         f.seek(real_offset)
         assert f.tell() == real_offset
         f.write(data)
-        f.close()
+        if close_f:
+            f.close()
 
     def _write_lease_record(self, f, lease_number, lease_info):
         offset = self._lease_offset + lease_number * self.LEASE_SIZE
@@ -199,19 +217,29 @@ class ShareFile:
 class BucketWriter(Referenceable):
     implements(RIBucketWriter)
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 canary, fsync_policy="none"):
         self.ss = ss
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
+        # fsync_policy is "none", "close" (fsync the share before it is
+        # moved into place), or a number of bytes, in which case the storage
+        # server is told about every write and fsyncs all of its open
+        # BucketWriters together once that many bytes have accumulated.
+        self._fsync_policy = fsync_policy
+        self.unsynced_bytes = 0
         self.closed = False
         self.throw_out_all_data = False
         self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
+        # keep the share open until we're closed or aborted, rather than
+        # re-opening it for each block
+        self._f = open(incominghome, 'rb+')
 
     def allocated_size(self):
         return self._max_size
@@ -221,14 +249,45 @@ class BucketWriter(Referenceable):
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
+        self._write(offset, data)
         self.ss.add_latency("write", time.time() - start)
         self.ss.count("write")
 
+    def remote_writev(self, datav):
+        for (offset, data) in datav:
+            self.remote_write(offset, data)
+
+    def _write(self, offset, data):
+        self._sharefile.write_share_data(offset, data, self._f)
+        if not isinstance(self._fsync_policy, str):
+            self.unsynced_bytes += len(data)
+            self.ss.bucket_writer_wrote(self, len(data))
+
+    def sync(self):
+        """Push everything written so far to the disk."""
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self.unsynced_bytes = 0
+
+    def _close_file(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
 
+        if self._fsync_policy == "close":
+            self.sync()
+            self.ss.count("fsync")
+        elif self.unsynced_bytes:
+            # a share that is finished before the server's next group commit
+            # must not be moved into place unsynced, so commit early. This
+            # syncs the other open shares too.
+            self.ss.sync_bucket_writers()
+        self._close_file()
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
         try:
@@ -280,6 +339,7 @@ class BucketWriter(Referenceable):
         if self.closed:
             return
 
+        self._close_file()
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
@@ -298,9 +358,12 @@ class BucketWriter(Referenceable):
 class BucketReader(Referenceable):
     implements(RIBucketReader)
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 mapcache=None, read_cache=None):
         self.ss = ss
         self._share_file = ShareFile(sharefname)
+        self._mapcache = mapcache
+        self._read_cache = read_cache
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -311,11 +374,24 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
+        if self._read_cache:
+            data = self._read_cache.readv(self.storage_index, self.shnum,
+                                          [(offset, length)], self._readv)[0]
+        else:
+            data = self._share_file.read_share_data(offset, length,
+                                                    self._mapcache)
         self.ss.add_latency("read", time.time() - start)
         self.ss.count("read")
         return data
 
+    def _readv(self, readv):
+        return [self._share_file.read_share_data(offset, length,
+                                                 self._mapcache)
+                for (offset, length) in readv]
+
+    def remote_readv(self, readv):
+        return [self.remote_read(offset, length) for (offset, length) in readv]
+
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
                                                    self.storage_index,
@@ -0,0 +1,200 @@
+"""
+I hold the leases for a StorageServer in a database, instead of in the share
+files themselves. With leases in the shares, adding or renewing a lease
+means rewriting a record in every share of the bucket, and the lease expirer
+must open and parse every share on the disk to learn which buckets are no
+longer wanted. With a lease database, both become a single indexed lookup
+keyed by storage index.
+
+Unlike the share index, the lease database is authoritative: once a bucket's
+leases have been moved into it, the copies in the share files are no longer
+updated. So the database is written with the usual sqlite durability, and a
+corrupt database is an error rather than something to quietly rebuild.
+
+Buckets which were created before the database was enabled have no rows
+yet. Their leases are imported from the share files the first time they are
+needed, or all at once with 'tahoe debug migrate-leases'.
+"""
+
+import os
+
+from allmydata.util import base32
+from allmydata.util.dbutil import get_sqlite
+from allmydata.util.hashutil import constant_time_compare
+from allmydata.storage.common import si_b2a
+from allmydata.storage.lease import LeaseInfo
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32
+ owner_num INTEGER NOT NULL,
+ renew_secret VARCHAR(52) NOT NULL,   -- base32. This identifies the owner.
+ cancel_secret VARCHAR(52) NOT NULL,  -- base32
+ expiration_time INTEGER NOT NULL,
+ nodeid VARCHAR(32),                  -- base32 of the server that accepted it
+ PRIMARY KEY (storage_index, renew_secret)
+);
+
+"""
+
+def leases_from_shares(sharefiles):
+    """Merge the leases found in a list of ShareFile or MutableShareFile
+    instances (normally all shares of one bucket) into a list of LeaseInfo
+    instances, one per owner, keeping the latest expiration time."""
+    leases = {} # renew_secret -> LeaseInfo
+    for sf in sharefiles:
+        for li in sf.get_leases():
+            old = leases.get(li.renew_secret)
+            if old is None or li.expiration_time > old.expiration_time:
+                leases[li.renew_secret] = li
+    return leases.values()
+
+class LeaseDB:
+    """I map storage index to the list of leases held on that bucket."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.sqlite = get_sqlite()
+        must_create = not os.path.exists(dbfile)
+        self.db = self.sqlite.connect(dbfile)
+        c = self.db.cursor()
+        if must_create:
+            c.executescript(SCHEMA_v1)
+            c.execute("INSERT INTO version (version) VALUES (?)", (1,))
+            self.db.commit()
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+        if version != 1:
+            raise self.sqlite.DatabaseError("unknown lease database version %s"
+                                            % (version,))
+
+    def close(self):
+        self.db.close()
+
+    def _get_leases(self, c, si_s):
+        c.execute("SELECT owner_num, renew_secret, cancel_secret,"
+                  "       expiration_time, nodeid"
+                  " FROM leases WHERE storage_index=?", (si_s,))
+        leases = []
+        for (owner_num, renew_s, cancel_s, expiration_time, nodeid_s) in c:
+            nodeid = None
+            if nodeid_s:
+                nodeid = base32.a2b(str(nodeid_s))
+            leases.append(LeaseInfo(owner_num,
+                                    base32.a2b(str(renew_s)),
+                                    base32.a2b(str(cancel_s)),
+                                    expiration_time, nodeid))
+        return leases
+
+    def get_leases(self, storage_index):
+        """Return a list of LeaseInfo instances for the given bucket. An
+        empty list means that the bucket has no leases in the database,
+        either because it has none at all or because they have not been
+        imported from its shares yet."""
+        return self._get_leases(self.db.cursor(), si_b2a(storage_index))
+
+    def get_lease_summary(self, storage_index):
+        """Return (num_leases, expiration_time), where expiration_time is
+        the latest expiration time of any lease, or 0 if there are none."""
+        c = self.db.cursor()
+        c.execute("SELECT COUNT(*), MAX(expiration_time) FROM leases"
+                  " WHERE storage_index=?", (si_b2a(storage_index),))
+        (num_leases, expiration_time) = c.fetchone()
+        return (num_leases, expiration_time or 0)
+
+    def _add_lease(self, c, si_s, lease_info):
+        nodeid_s = None
+        if lease_info.nodeid:
+            nodeid_s = base32.b2a(lease_info.nodeid)
+        c.execute("INSERT OR REPLACE INTO leases"
+                  " (storage_index, owner_num, renew_secret, cancel_secret,"
+                  "  expiration_time, nodeid)"
+                  " VALUES (?,?,?,?,?,?)",
+                  (si_s, lease_info.owner_num,
+                   base32.b2a(lease_info.renew_secret),
+                   base32.b2a(lease_info.cancel_secret),
+                   int(lease_info.expiration_time), nodeid_s))
+
+    def add_leases(self, storage_index, leases):
+        """Add a list of LeaseInfo instances in a single transaction. This is
+        used to import the leases that were held in share files."""
+        si_s = si_b2a(storage_index)
+        c = self.db.cursor()
+        for li in leases:
+            self._add_lease(c, si_s, li)
+        self.db.commit()
+
+    def _find_lease(self, c, si_s, secret_attr, secret):
+        # compare the secrets here rather than in the WHERE clause, to avoid
+        # leaking timing information about them
+        for li in self._get_leases(c, si_s):
+            if constant_time_compare(getattr(li, secret_attr), secret):
+                return li
+        return None
+
+    def _renew_lease(self, c, si_s, old, new_expire_time):
+        if new_expire_time > old.expiration_time:
+            c.execute("UPDATE leases SET expiration_time=?"
+                      " WHERE storage_index=? AND renew_secret=?",
+                      (int(new_expire_time), si_s,
+                       base32.b2a(old.renew_secret)))
+
+    def add_or_renew_lease(self, storage_index, lease_info):
+        si_s = si_b2a(storage_index)
+        c = self.db.cursor()
+        old = self._find_lease(c, si_s, "renew_secret", lease_info.renew_secret)
+        if old is None:
+            self._add_lease(c, si_s, lease_info)
+        else:
+            self._renew_lease(c, si_s, old, lease_info.expiration_time)
+        self.db.commit()
+
+    def renew_lease(self, storage_index, renew_secret, new_expire_time):
+        """Raise IndexError if there was no lease with the given
+        renew_secret."""
+        si_s = si_b2a(storage_index)
+        c = self.db.cursor()
+        old = self._find_lease(c, si_s, "renew_secret", renew_secret)
+        if old is None:
+            raise IndexError("unable to renew non-existent lease")
+        self._renew_lease(c, si_s, old, new_expire_time)
+        self.db.commit()
+
+    def cancel_lease(self, storage_index, cancel_secret):
+        """Remove the lease with the given cancel_secret, and return the
+        number of leases that remain on the bucket. Raise IndexError if
+        there was no such lease."""
+        si_s = si_b2a(storage_index)
+        c = self.db.cursor()
+        li = self._find_lease(c, si_s, "cancel_secret", cancel_secret)
+        if li is None:
+            raise IndexError("unable to find matching lease to cancel")
+        self._remove_leases(c, si_s, [li])
+        self.db.commit()
+        return self.get_lease_summary(storage_index)[0]
+
+    def _remove_leases(self, c, si_s, leases):
+        for li in leases:
+            c.execute("DELETE FROM leases"
+                      " WHERE storage_index=? AND renew_secret=?",
+                      (si_s, base32.b2a(li.renew_secret)))
+
+    def remove_leases(self, storage_index, leases):
+        """Remove the given LeaseInfo instances (as returned by
+        get_leases), and return the number of leases that remain."""
+        c = self.db.cursor()
+        self._remove_leases(c, si_b2a(storage_index), leases)
+        self.db.commit()
+        return self.get_lease_summary(storage_index)[0]
+
+    def remove_bucket(self, storage_index):
+        c = self.db.cursor()
+        c.execute("DELETE FROM leases WHERE storage_index=?",
+                  (si_b2a(storage_index),))
+        self.db.commit()
@@ -347,7 +347,15 @@ class MutableShareFile:
         assert magic == self.MAGIC
         return (write_enabler, write_enabler_nodeid)
 
-    def readv(self, readv):
+    def readv(self, readv, mapcache=None):
+        """If mapcache (a ShareMapCache) is given, read from a memory map of
+        the share when possible, instead of opening the file."""
+        m = None
+        if mapcache is not None:
+            m = mapcache.get(self.home)
+        if m is not None:
+            return [self._read_share_data(m, offset, length)
+                    for (offset, length) in readv]
         datav = []
         f = open(self.home, 'rb')
         for (offset, length) in readv:
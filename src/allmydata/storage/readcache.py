@@ -0,0 +1,102 @@
+"""
+I remember the results of recent share reads, so that a storage server which
+hands the same files to many downloaders (like the servers behind a busy
+public gateway) does not read the same blocks from disk over and over.
+
+Entries are keyed by (storage_index, shnum, offset, length), and the least
+recently used ones are discarded to keep the total size of the cached data
+under a byte budget. The storage server drops every entry for a share when it
+modifies or deletes that share (see StorageServer.update_share_index).
+Changes made to share files by other processes are not noticed, so nothing
+else should write to the shares of a server that uses this cache.
+"""
+
+class _Entry(object):
+    __slots__ = ["key", "data", "prev", "next"]
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+        self.prev = self.next = None
+
+class ReadCache:
+    """I am an LRU cache of share data holding at most max_bytes of it."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = {} # key -> _Entry
+        self._shares = {} # (storage_index, shnum) -> set of keys
+        # a circular doubly-linked list, most recently used first
+        self._head = _Entry(None, None)
+        self._head.prev = self._head.next = self._head
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+
+    def readv(self, storage_index, shnum, readv, read):
+        """Return the data for each (offset, length) pair in readv. Pairs
+        that I don't have are passed (in one list) to read(), which must
+        return a list of their data, as MutableShareFile.readv does."""
+        datav = []
+        missing = []
+        for (offset, length) in readv:
+            entry = self._entries.get((storage_index, shnum, offset, length))
+            if entry is None:
+                missing.append(len(datav))
+                datav.append(None)
+                continue
+            self._unlink(entry)
+            self._link(entry)
+            self.hits += 1
+            self.hit_bytes += len(entry.data)
+            datav.append(entry.data)
+        if missing:
+            self.misses += len(missing)
+            fetched = read([readv[i] for i in missing])
+            for (i, data) in zip(missing, fetched):
+                datav[i] = data
+                (offset, length) = readv[i]
+                self._add((storage_index, shnum, offset, length), data)
+        return datav
+
+    def _add(self, key, data):
+        if len(data) > self.max_bytes or key in self._entries:
+            return
+        entry = _Entry(key, data)
+        self._entries[key] = entry
+        self._shares.setdefault(key[:2], set()).add(key)
+        self._link(entry)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            self._remove(self._head.prev)
+
+    def _link(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        keys = self._shares[entry.key[:2]]
+        keys.discard(entry.key)
+        if not keys:
+            del self._shares[entry.key[:2]]
+        self.bytes -= len(entry.data)
+
+    def invalidate_share(self, storage_index, shnum):
+        for key in list(self._shares.get((storage_index, shnum), [])):
+            self._remove(self._entries[key])
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_bytes": self.hit_bytes,
+                "bytes": self.bytes,
+                "entries": len(self._entries),
+                }
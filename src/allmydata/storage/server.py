@@ -1,6 +1,7 @@
-import os, re, weakref, struct, time
+import os, re, weakref, struct, time, stat
 
 from foolscap.api import Referenceable
+from twisted.python.failure import Failure
 from twisted.application import service
 
 from zope.interface import implements
@@ -16,6 +17,11 @@ from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.shareindex import ShareIndex, ShareIndexCrawler, \
+     describe_share
+from allmydata.storage.leasedb import LeaseDB, leases_from_shares
+from allmydata.storage.sharemaps import ShareMapCache
+from allmydata.storage.readcache import ReadCache
 
 # storage/
 # storage/shares/incoming
@@ -23,6 +29,8 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 #   be moved to storage/shares/$START/$STORAGEINDEX/$SHARENUM upon success
 # storage/shares/$START/$STORAGEINDEX
 # storage/shares/$START/$STORAGEINDEX/$SHARENUM
+# storage/share_index.sqlite (only if [storage]share_index.enabled=true)
+# storage/leasedb.sqlite (only if [storage]leasedb.enabled=true)
 
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
@@ -44,7 +52,15 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 expiration_workers=0,
+                 share_index_enabled=False,
+                 share_index_rebuild=False,
+                 leasedb_enabled=False,
+                 incremental_crawlers=False,
+                 fsync_policy="none",
+                 mmap_max_files=0,
+                 read_cache_size=0):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
@@ -66,6 +82,17 @@ class StorageServer(service.MultiService, Referenceable):
         self._clean_incomplete()
         fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        self.incremental_crawlers = incremental_crawlers
+        if isinstance(fsync_policy, str):
+            assert fsync_policy in ("none", "close"), fsync_policy
+        else:
+            assert fsync_policy > 0, fsync_policy
+        self.fsync_policy = fsync_policy
+        self._unsynced_bytes = 0
+        self.share_maps = ShareMapCache(mmap_max_files)
+        self.read_cache = None
+        if read_cache_size:
+            self.read_cache = ReadCache(read_cache_size)
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -86,6 +113,10 @@ class StorageServer(service.MultiService, Referenceable):
                           }
         self.add_bucket_counter()
 
+        self.lease_db = None
+        if leasedb_enabled:
+            self.lease_db = LeaseDB(os.path.join(storedir, "leasedb.sqlite"))
+
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
@@ -93,17 +124,62 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
-                                   expiration_sharetypes)
+                                   expiration_sharetypes,
+                                   workers=expiration_workers)
+        if self.incremental_crawlers:
+            self.lease_checker.incremental = True
         self.lease_checker.setServiceParent(self)
 
+        self.share_index = None
+        self.share_index_crawler = None
+        if share_index_enabled:
+            self.add_share_index(share_index_rebuild)
+
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
+        if self.incremental_crawlers:
+            self.bucket_counter.incremental = True
         self.bucket_counter.setServiceParent(self)
 
+    def add_share_index(self, rebuild=False):
+        dbfile = os.path.join(self.storedir, "share_index.sqlite")
+        statefile = os.path.join(self.storedir, "share_index.state")
+        self.share_index = ShareIndex(dbfile)
+        if rebuild:
+            self.share_index.clear()
+        if self.share_index.was_reset:
+            # any crawl that was in progress was indexing into the old
+            # contents, so start over from the first prefixdir
+            fileutil.remove_if_possible(statefile)
+        if not self.share_index.is_complete():
+            self.share_index_crawler = ShareIndexCrawler(self, statefile,
+                                                         self.share_index)
+            if self.incremental_crawlers:
+                self.share_index_crawler.incremental = True
+            self.share_index_crawler.setServiceParent(self)
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        def _close_share_maps(res):
+            self.share_maps.clear()
+            return res
+        d.addBoth(_close_share_maps)
+        if self.share_index:
+            def _close_share_index(res):
+                self.share_index.close()
+                return res
+            d.addBoth(_close_share_index)
+        if self.lease_db:
+            def _close_lease_db(res):
+                self.lease_db.close()
+                return res
+            d.addBoth(_close_lease_db)
+        return d
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
@@ -192,6 +268,12 @@ class StorageServer(service.MultiService, Referenceable):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
+        if self.share_maps.max_files:
+            for name,v in self.share_maps.get_stats().items():
+                stats['storage_server.mmap.%s' % name] = v
+        if self.read_cache:
+            for name,v in self.read_cache.get_stats().items():
+                stats['storage_server.read_cache.%s' % name] = v
         s = self.bucket_counter.get_state()
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
@@ -222,6 +304,11 @@ class StorageServer(service.MultiService, Referenceable):
                     { "maximum-immutable-share-size": remaining_space,
                       "tolerates-immutable-read-overrun": True,
                       "delete-mutable-shares-with-zero-length-writev": True,
+                      "supports-add-leases": True,
+                      "supports-get-many-buckets": True,
+                      "supports-immutable-readv": True,
+                      "supports-immutable-writev": True,
+                      "supports-upload-batches": True,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -243,10 +330,10 @@ class StorageServer(service.MultiService, Referenceable):
 
         log.msg("storage: allocate_buckets %s" % si_s)
 
-        # in this implementation, the lease information (including secrets)
-        # goes into the share files themselves. It could also be put into a
-        # separate database. Note that the lease should not be added until
-        # the BucketWriter has been closed.
+        # the lease information (including secrets) goes into the share
+        # files themselves, or into the lease database if we have one. Note
+        # that the lease should not be added until the BucketWriter has been
+        # closed.
         expire_time = time.time() + 31*24*60*60
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
@@ -269,8 +356,12 @@ class StorageServer(service.MultiService, Referenceable):
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
-            sf.add_or_renew_lease(lease_info)
+            if not self.lease_db:
+                sf = ShareFile(fn)
+                sf.add_or_renew_lease(lease_info)
+                self.update_share_index(storage_index, shnum, sf)
+        if alreadygot and self.lease_db:
+            self._add_db_lease(storage_index, lease_info)
 
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
@@ -287,11 +378,12 @@ class StorageServer(service.MultiService, Referenceable):
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  fsync_policy=self.fsync_policy)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self._active_writers[bw] = (storage_index, shnum, lease_info)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
@@ -304,9 +396,52 @@ class StorageServer(service.MultiService, Referenceable):
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
+    def remote_allocate_buckets_many(self, requests, canary):
+        self.count("allocate-many")
+        return [self.remote_allocate_buckets(storage_index,
+                                             renew_secret, cancel_secret,
+                                             sharenums, allocated_size,
+                                             canary)
+                for (storage_index, renew_secret, cancel_secret,
+                     sharenums, allocated_size) in requests]
+
+    def _call_bucket_writers(self, calls):
+        # calls is a list of (BucketWriter, methname, args). The buckets are
+        # ones that we handed out ourselves: a caller could not name any
+        # other BucketWriter, but make sure that it is one of ours, and
+        # still open.
+        results = []
+        for (bw, methname, args) in calls:
+            try:
+                if bw not in self._active_writers or bw.closed:
+                    raise ValueError("not an open bucket of this server")
+                getattr(bw, "remote_" + methname)(*args)
+                results.append(None)
+            except Exception, e:
+                self.log(format="%(methname)s_many failed",
+                         methname=methname, failure=Failure(),
+                         level=log.UNUSUAL, umid="Gx3wAQ")
+                results.append("%s: %s" % (e.__class__.__name__, e))
+        return results
+
+    def remote_writev_many(self, writes):
+        self.count("writev-many")
+        return self._call_bucket_writers([(bw, "writev", (datav,))
+                                          for (bw, datav) in writes])
+
+    def remote_close_many(self, buckets):
+        self.count("close-many")
+        return self._call_bucket_writers([(bw, "close", ())
+                                          for bw in buckets])
+
     def _iter_share_files(self, storage_index):
         for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
+            try:
+                f = open(filename, 'rb')
+            except EnvironmentError:
+                if self._share_vanished(storage_index, shnum, filename):
+                    continue
+                raise
             header = f.read(32)
             f.close()
             if header[:32] == MutableShareFile.MAGIC:
@@ -328,19 +463,47 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
-            sf.add_or_renew_lease(lease_info)
+        if self.lease_db:
+            if self._has_shares(storage_index):
+                self._add_db_lease(storage_index, lease_info)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                sf.add_or_renew_lease(lease_info)
+                self.update_share_index(storage_index, None, sf)
         self.add_latency("add-lease", time.time() - start)
         return None
 
+    def remote_add_leases(self, leases):
+        results = []
+        for (storage_index, renew_secret, cancel_secret) in leases:
+            try:
+                self.remote_add_lease(storage_index, renew_secret,
+                                      cancel_secret)
+                results.append(None)
+            except Exception, e:
+                self.log(format="add_leases failed on %(si)s",
+                         si=si_b2a(storage_index), failure=Failure(),
+                         level=log.UNUSUAL, umid="Bg1yPA")
+                results.append("%s: %s" % (e.__class__.__name__, e))
+        return results
+
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
+        if self.lease_db:
+            if self._has_shares(storage_index):
+                found_buckets = True
+                self._get_db_leases(storage_index)
+                self.lease_db.renew_lease(storage_index, renew_secret,
+                                          new_expire_time)
+                self._update_lease_summary(storage_index)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
+                self.update_share_index(storage_index, None, sf)
         self.add_latency("renew", time.time() - start)
         if not found_buckets:
             raise IndexError("no such lease to renew")
@@ -351,14 +514,25 @@ class StorageServer(service.MultiService, Referenceable):
 
         total_space_freed = 0
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            # note: if we can't find a lease on one share, we won't bother
-            # looking in the others. Unless something broke internally
-            # (perhaps we ran out of disk space while adding a lease), the
-            # leases on all shares will be identical.
-            found_buckets = True
-            # this raises IndexError if the lease wasn't present XXXX
-            total_space_freed += sf.cancel_lease(cancel_secret)
+        if self.lease_db:
+            if self._has_shares(storage_index):
+                found_buckets = True
+                self._get_db_leases(storage_index)
+                # this raises IndexError if the lease wasn't present
+                if self.lease_db.cancel_lease(storage_index, cancel_secret):
+                    self._update_lease_summary(storage_index)
+                else:
+                    total_space_freed += self._delete_bucket(storage_index)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                # note: if we can't find a lease on one share, we won't
+                # bother looking in the others. Unless something broke
+                # internally (perhaps we ran out of disk space while adding a
+                # lease), the leases on all shares will be identical.
+                found_buckets = True
+                # this raises IndexError if the lease wasn't present XXXX
+                total_space_freed += sf.cancel_lease(cancel_secret)
+                self.update_share_index(storage_index, None, sf)
 
         if found_buckets:
             storagedir = os.path.join(self.sharedir,
@@ -373,15 +547,138 @@ class StorageServer(service.MultiService, Referenceable):
         if not found_buckets:
             raise IndexError("no such storage index")
 
+    def bucket_writer_wrote(self, bw, length):
+        # only called when fsync_policy is a byte count. Rather than fsync
+        # each share on its own, we let writes from all concurrent uploads
+        # accumulate and then fsync every open share at once (a group
+        # commit), so the number of fsyncs depends upon the amount of data
+        # written and not upon the number of uploaders.
+        self._unsynced_bytes += length
+        if self._unsynced_bytes >= self.fsync_policy:
+            self.sync_bucket_writers()
+
+    def sync_bucket_writers(self):
+        self._unsynced_bytes = 0
+        writers = [bw for bw in self._active_writers.keys()
+                   if not bw.closed and bw.unsynced_bytes]
+        for bw in writers:
+            bw.sync()
+        self.count("fsync", len(writers))
+        self.count("group-commit")
+
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum, lease_info) = self._active_writers.pop(bw)
+        # aborted writers consume nothing, closed ones have moved their
+        # share into place
+        if consumed_size:
+            if self.lease_db:
+                self._add_db_lease(storage_index, lease_info)
+            # this also forgets anything cached about a previous share
+            # that lived at the same place
+            self.update_share_index(storage_index, shnum,
+                                    ShareFile(bw.finalhome))
+
+    def _get_db_leases(self, storage_index):
+        # a bucket which has no leases in the database might be one that was
+        # created before the database was enabled, so import whatever
+        # leases its shares hold. From then on, the database is the only
+        # place where its leases are maintained.
+        leases = self.lease_db.get_leases(storage_index)
+        if not leases:
+            leases = leases_from_shares(self._iter_share_files(storage_index))
+            if leases:
+                self.lease_db.add_leases(storage_index, leases)
+        return leases
+
+    def _add_db_lease(self, storage_index, lease_info):
+        self._get_db_leases(storage_index)
+        self.lease_db.add_or_renew_lease(storage_index, lease_info)
+        self._update_lease_summary(storage_index)
+
+    def _update_lease_summary(self, storage_index):
+        if self.share_index:
+            summary = self.lease_db.get_lease_summary(storage_index)
+            self.share_index.set_lease_summary(storage_index, *summary)
+
+    def _delete_bucket(self, storage_index):
+        # the last lease on a bucket in the lease database has gone away, so
+        # delete its shares. Return the number of bytes freed.
+        space_freed = 0
+        for sf in self._iter_share_files(storage_index):
+            space_freed += os.stat(sf.home)[stat.ST_SIZE]
+            sf.unlink()
+            self.update_share_index(storage_index, None, sf)
+        return space_freed
+
+    def remove_expired_leases(self, storage_index, leases):
+        """Remove the given leases (LeaseInfo instances obtained from
+        get_leases) from the lease database, and delete the bucket's shares
+        if no leases remain. The lease expirer uses this when the server
+        keeps its leases in a LeaseDB."""
+        if self.lease_db.remove_leases(storage_index, leases):
+            self._update_lease_summary(storage_index)
+        else:
+            self._delete_bucket(storage_index)
+
+    def update_share_index(self, storage_index, shnum, sf):
+        """Record the current state of the share held in 'sf' (a ShareFile
+        or MutableShareFile) in the share index, or remove it from the index
+        if the share has been deleted. If shnum is None, it is derived from
+        the share's filename. Crawlers which modify shares (like the lease
+        expirer) call this too. Any memory map or cached reads of the share
+        are dropped, since they may no longer match the file."""
+        self.share_maps.invalidate(sf.home)
+        if shnum is None:
+            shnum = int(os.path.basename(sf.home))
+        if self.read_cache:
+            self.read_cache.invalidate_share(storage_index, shnum)
+        if not self.share_index:
+            return
+        if os.path.exists(sf.home):
+            leases = None
+            if self.lease_db:
+                leases = self.lease_db.get_leases(storage_index)
+            self.share_index.add_share(storage_index, shnum,
+                                       *describe_share(sf, leases))
+        else:
+            self.share_index.remove_share(storage_index, shnum)
+
+    def _share_vanished(self, storage_index, shnum, filename):
+        # the share index claimed we had a share that is no longer on disk,
+        # probably because somebody removed it behind our back. Return True
+        # if that is what happened, after correcting the index.
+        if self.share_index and not os.path.exists(filename):
+            self.log(format="share %(si)s/%(shnum)d vanished from disk",
+                     si=si_b2a(storage_index), shnum=shnum,
+                     level=log.WEIRD, umid="a5Qb2w")
+            self.share_index.remove_share(storage_index, shnum)
+            return True
+        return False
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
-        the integer form of the last component of 'pathname'."""
+        the integer form of the last component of 'pathname'. The share
+        index is consulted first, if we have one."""
+        if self.share_index:
+            shares = self.share_index.get_shares(storage_index)
+            if shares is not None:
+                storagedir = os.path.join(self.sharedir,
+                                          storage_index_to_dir(storage_index))
+                for shnum in sorted(shares):
+                    yield (shnum, os.path.join(storagedir, "%d" % shnum))
+                return
+        for (shnum, filename) in self._list_bucket_shares(storage_index):
+            yield (shnum, filename)
+
+    def _has_shares(self, storage_index):
+        for (shnum, filename) in self._get_bucket_shares(storage_index):
+            return True
+        return False
+
+    def _list_bucket_shares(self, storage_index):
         storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
         try:
             for f in os.listdir(storagedir):
@@ -399,11 +696,23 @@ class StorageServer(service.MultiService, Referenceable):
         log.msg("storage: get_buckets %s" % si_s)
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
-            bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+            try:
+                br = BucketReader(self, filename, storage_index, shnum,
+                                  mapcache=self.share_maps,
+                                  read_cache=self.read_cache)
+            except EnvironmentError:
+                if self._share_vanished(storage_index, shnum, filename):
+                    continue
+                raise
+            bucketreaders[shnum] = br
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
+    def remote_get_many_buckets(self, storage_indexes):
+        self.count("get-many")
+        return [self.remote_get_buckets(storage_index)
+                for storage_index in storage_indexes]
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -411,6 +720,9 @@ class StorageServer(service.MultiService, Referenceable):
         This method is not for client use.
         """
 
+        if self.lease_db:
+            return iter(self._get_db_leases(storage_index))
+
         # since all shares get the same lease data, we just grab the leases
         # from the first share
         try:
@@ -433,16 +745,10 @@ class StorageServer(service.MultiService, Referenceable):
         # shares exist if there is a file for them
         bucketdir = os.path.join(self.sharedir, si_dir)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for sharenum, filename in self._get_bucket_shares(storage_index):
+            msf = MutableShareFile(filename, self)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
         # Now evaluate test vectors.
@@ -466,7 +772,9 @@ class StorageServer(service.MultiService, Referenceable):
         # now gather the read vectors, before we do any writes
         read_data = {}
         for sharenum, share in shares.items():
-            read_data[sharenum] = share.readv(read_vector)
+            read_data[sharenum] = self._read_mutable_share(storage_index,
+                                                           sharenum, share,
+                                                           read_vector)
 
         ownerid = 1 # TODO
         expire_time = time.time() + 31*24*60*60   # one month
@@ -492,7 +800,16 @@ class StorageServer(service.MultiService, Referenceable):
                         shares[sharenum] = share
                     shares[sharenum].writev(datav, new_length)
                     # and update the lease
-                    shares[sharenum].add_or_renew_lease(lease_info)
+                    if not self.lease_db:
+                        shares[sharenum].add_or_renew_lease(lease_info)
+                if sharenum in shares:
+                    self.update_share_index(storage_index, sharenum,
+                                             shares[sharenum])
+            if self.lease_db:
+                if self._has_shares(storage_index):
+                    self._add_db_lease(storage_index, lease_info)
+                else:
+                    self.lease_db.remove_bucket(storage_index)
 
             if new_length == 0:
                 # delete empty bucket directories
@@ -514,28 +831,27 @@ class StorageServer(service.MultiService, Referenceable):
                                          self)
         return share
 
+    def _read_mutable_share(self, storage_index, shnum, msf, readv):
+        def _read(readv):
+            return msf.readv(readv, self.share_maps)
+        if self.read_cache:
+            return self.read_cache.readv(storage_index, shnum, readv, _read)
+        return _read(readv)
+
     def remote_slot_readv(self, storage_index, shares, readv):
         start = time.time()
         self.count("readv")
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
-            self.add_latency("readv", time.time() - start)
-            return {}
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for sharenum, filename in self._get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
                 msf = MutableShareFile(filename, self)
-                datavs[sharenum] = msf.readv(readv)
+                datavs[sharenum] = self._read_mutable_share(storage_index,
+                                                            sharenum, msf,
+                                                            readv)
         log.msg("returning shares %s" % (datavs.keys(),),
                 facility="tahoe.storage", level=log.NOISY, parent=lp)
         self.add_latency("readv", time.time() - start)
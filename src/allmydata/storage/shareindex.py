@@ -0,0 +1,289 @@
+"""
+I maintain a persistent index of the shares held by a StorageServer, so that
+get_buckets, slot_readv, and the lease operations can find the shares for a
+storage index without listing its bucket directory. On a server with
+millions of buckets, that os.listdir() is usually a cold dentry lookup.
+
+The index is a cache of what is on disk: it can always be rebuilt by walking
+the shares/ directory, which is what the ShareIndexCrawler does. The index
+remembers which prefixdirs it has fully walked, and the StorageServer only
+trusts it for storage indices in those prefixes, falling back to the disk
+for everything else. Because it can be rebuilt, the database is written
+without fsync; if the node does not shut down cleanly, the index is
+discarded at the next startup and rebuilt from scratch.
+"""
+
+import os, stat
+
+from allmydata.util import fileutil, log
+from allmydata.util.dbutil import get_sqlite
+from allmydata.storage.common import si_b2a, si_a2b
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.shares import get_share_file
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ prefix VARCHAR(2) NOT NULL,         -- first two characters of storage_index
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(16),              -- "immutable" or "mutable"
+ size INTEGER,                       -- os.stat(fn)[stat.ST_SIZE]
+ num_leases INTEGER,
+ expiration_time INTEGER,            -- latest expiration time of any lease
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_prefix ON shares (prefix);
+
+CREATE TABLE indexed_prefixes
+(
+ prefix VARCHAR(2) PRIMARY KEY       -- prefixdirs that have been walked
+);
+
+CREATE TABLE clean_shutdown
+(
+ clean INTEGER  -- contains one row, 1 if the index was closed properly
+);
+
+"""
+
+NUM_PREFIXES = 2**10
+
+def describe_share(sf, leases=None):
+    """Return a (sharetype, size, num_leases, expiration_time) tuple for the
+    given ShareFile or MutableShareFile, suitable for ShareIndex.add_share().
+    The leases are read from the share unless a list of LeaseInfo instances
+    is provided (by a server which keeps its leases in a LeaseDB).
+    """
+    size = os.stat(sf.home)[stat.ST_SIZE]
+    if leases is None:
+        leases = sf.get_leases()
+    num_leases = 0
+    expiration_time = 0
+    for li in leases:
+        num_leases += 1
+        expiration_time = max(expiration_time, int(li.get_expiration_time()))
+    return (sf.sharetype, size, num_leases, expiration_time)
+
+class ShareIndex:
+    """I map storage index to the set of shares that this server holds for
+    it, along with their type, size, and a summary of their leases."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.sqlite = get_sqlite()
+        # was_reset is True if we started out empty, either because the
+        # database is new or because the previous one could not be trusted
+        self.was_reset = False
+        self.db = None
+        try:
+            self._open()
+        except self.sqlite.DatabaseError, e:
+            log.msg("share index %s is unusable (%s), rebuilding"
+                    % (dbfile, e), facility="tahoe.storage",
+                    level=log.UNUSUAL, umid="yX0fIw")
+            if self.db:
+                self.db.close()
+            fileutil.remove_if_possible(dbfile)
+            self._open()
+
+    def _open(self):
+        must_create = not os.path.exists(self.dbfile)
+        self.db = self.sqlite.connect(self.dbfile)
+        c = self.db.cursor()
+        # we can rebuild the whole thing, so don't pay for fsync
+        c.execute("PRAGMA synchronous = OFF")
+        if must_create:
+            c.executescript(SCHEMA_v1)
+            c.execute("INSERT INTO version (version) VALUES (?)", (1,))
+            c.execute("INSERT INTO clean_shutdown (clean) VALUES (?)", (0,))
+            self.db.commit()
+            self.was_reset = True
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+        if version != 1:
+            raise self.sqlite.DatabaseError("unknown share index version %s"
+                                            % (version,))
+        c.execute("SELECT clean FROM clean_shutdown")
+        if not c.fetchone()[0]:
+            # we crashed (or were killed) while the index was in use, so
+            # some updates might not have made it to disk
+            self._forget_everything(c)
+        # until close() is called, the index is considered dirty
+        c.execute("UPDATE clean_shutdown SET clean=0")
+        self.db.commit()
+        c.execute("SELECT prefix FROM indexed_prefixes")
+        self._indexed_prefixes = set([str(row[0]) for row in c.fetchall()])
+
+    def _forget_everything(self, c):
+        c.execute("DELETE FROM shares")
+        c.execute("DELETE FROM indexed_prefixes")
+        self._indexed_prefixes = set()
+        self.was_reset = True
+
+    def clear(self):
+        """Discard the contents of the index, so it will be rebuilt from
+        disk."""
+        c = self.db.cursor()
+        self._forget_everything(c)
+        self.db.commit()
+
+    def close(self):
+        c = self.db.cursor()
+        c.execute("UPDATE clean_shutdown SET clean=1")
+        self.db.commit()
+        self.db.close()
+
+    def is_prefix_indexed(self, prefix):
+        return prefix in self._indexed_prefixes
+
+    def is_complete(self):
+        return len(self._indexed_prefixes) == NUM_PREFIXES
+
+    def get_num_indexed_prefixes(self):
+        return len(self._indexed_prefixes)
+
+    def mark_prefix_indexed(self, prefix):
+        c = self.db.cursor()
+        c.execute("INSERT OR REPLACE INTO indexed_prefixes (prefix)"
+                  " VALUES (?)", (prefix,))
+        self.db.commit()
+        self._indexed_prefixes.add(prefix)
+
+    def get_shares(self, storage_index):
+        """Return a dict mapping shnum to a (sharetype, size, num_leases,
+        expiration_time) tuple for every share we hold for this storage
+        index. If the index cannot answer authoritatively (because the
+        storage index lives in a prefixdir that has not yet been walked),
+        return None instead, and the caller must look on disk."""
+        si_s = si_b2a(storage_index)
+        if si_s[:2] not in self._indexed_prefixes:
+            return None
+        c = self.db.cursor()
+        c.execute("SELECT shnum, sharetype, size, num_leases, expiration_time"
+                  " FROM shares WHERE storage_index=?", (si_s,))
+        shares = {}
+        for (shnum, sharetype, size, num_leases, expiration_time) in c:
+            shares[shnum] = (str(sharetype), size, num_leases, expiration_time)
+        return shares
+
+    def get_storage_indices_in_prefix(self, prefix):
+        """Return a set of base32 storage index strings."""
+        c = self.db.cursor()
+        c.execute("SELECT DISTINCT storage_index FROM shares WHERE prefix=?",
+                  (prefix,))
+        return set([str(row[0]) for row in c.fetchall()])
+
+    def _add_share(self, c, si_s, shnum, sharetype, size,
+                   num_leases, expiration_time):
+        c.execute("INSERT OR REPLACE INTO shares"
+                  " (storage_index, prefix, shnum, sharetype, size,"
+                  "  num_leases, expiration_time)"
+                  " VALUES (?,?,?,?,?,?,?)",
+                  (si_s, si_s[:2], shnum, sharetype, size,
+                   num_leases, expiration_time))
+
+    def add_share(self, storage_index, shnum, sharetype, size,
+                  num_leases, expiration_time):
+        c = self.db.cursor()
+        self._add_share(c, si_b2a(storage_index), shnum, sharetype, size,
+                        num_leases, expiration_time)
+        self.db.commit()
+
+    def remove_share(self, storage_index, shnum):
+        c = self.db.cursor()
+        c.execute("DELETE FROM shares WHERE storage_index=? AND shnum=?",
+                  (si_b2a(storage_index), shnum))
+        self.db.commit()
+
+    def set_bucket(self, storage_index, shares):
+        """Replace everything we know about this storage index. 'shares' is
+        a dict in the same form as returned by get_shares()."""
+        si_s = si_b2a(storage_index)
+        c = self.db.cursor()
+        c.execute("DELETE FROM shares WHERE storage_index=?", (si_s,))
+        for shnum, (sharetype, size, num_leases, expiration_time) \
+                in shares.items():
+            self._add_share(c, si_s, shnum, sharetype, size,
+                            num_leases, expiration_time)
+        self.db.commit()
+
+    def remove_bucket(self, storage_index):
+        self.set_bucket(storage_index, {})
+
+    def set_lease_summary(self, storage_index, num_leases, expiration_time):
+        """Update the lease summary of every share in this bucket."""
+        c = self.db.cursor()
+        c.execute("UPDATE shares SET num_leases=?, expiration_time=?"
+                  " WHERE storage_index=?",
+                  (num_leases, expiration_time, si_b2a(storage_index)))
+        self.db.commit()
+
+
+class ShareIndexCrawler(ShareCrawler):
+    """I walk every share on disk and record it in the StorageServer's
+    ShareIndex. I only run while the index is incomplete: the first time the
+    index is enabled, after an unclean shutdown, or when a rebuild has been
+    requested with [storage]share_index.rebuild . Once every prefixdir has
+    been indexed, I detach myself from the server.
+    """
+
+    slow_start = 60 # the server falls back to the disk until we're done
+    minimum_cycle_time = 0
+
+    def __init__(self, server, statefile, share_index):
+        self.share_index = share_index
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        if self.share_index.is_prefix_indexed(prefix):
+            return
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+        # forget about buckets that have gone away. We check the disk
+        # rather than trusting 'buckets', since that listing might be stale
+        # by now, and new buckets are added to the index as they arrive.
+        for si_s in self.share_index.get_storage_indices_in_prefix(prefix):
+            if not os.path.isdir(os.path.join(prefixdir, si_s)):
+                self.share_index.remove_bucket(si_a2b(si_s))
+        self.share_index.mark_prefix_indexed(prefix)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        shares = {}
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            filenames = []
+        leases = None
+        if self.server.lease_db:
+            leases = list(self.server.get_leases(si_a2b(storage_index_b32)))
+        for fn in filenames:
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            try:
+                sf = get_share_file(os.path.join(bucketdir, fn))
+                shares[shnum] = describe_share(sf, leases)
+            except Exception:
+                # corrupt shares are the lease-checker's problem. Leave them
+                # out of the index, the server would not be able to serve
+                # them anyways.
+                log.err(None, "share index unable to examine %s/%s"
+                        % (storage_index_b32, fn),
+                        facility="tahoe.storage", level=log.UNUSUAL,
+                        umid="E2PsWA")
+        self.share_index.set_bucket(si_a2b(storage_index_b32), shares)
+
+    def finished_cycle(self, cycle):
+        if self.share_index.is_complete():
+            log.msg("share index is complete", facility="tahoe.storage",
+                    umid="k3ihnQ")
+            self.disownServiceParent()
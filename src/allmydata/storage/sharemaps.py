@@ -0,0 +1,133 @@
+"""
+I keep read-only memory maps of the share files that a StorageServer has read
+recently. Serving a read() from a map replaces an open/seek/read/close
+sequence with a slice of memory that the kernel already has in its page
+cache, which matters for popular files that many downloaders are reading at
+the same time.
+
+The maps are shared with the file (MAP_SHARED), so writes made in place are
+visible through them. Anything that changes the size of a share (adding or
+cancelling leases, extending or truncating a mutable share) or removes it
+makes the map stale. The server invalidates the map whenever it makes such a
+change itself (see StorageServer.update_share_index), so a lookup does not
+need to look at the file. Changes made behind the server's back are only
+noticed when a map is checked again, which happens at most once every
+revalidate_interval seconds: it is compared against the inode, size, and
+modification time of the file it was mapped from.
+"""
+
+import os, sys, mmap, time
+
+class _Entry(object):
+    __slots__ = ["filename", "map", "signature", "checked", "prev", "next"]
+    def __init__(self, filename, map, signature, checked):
+        self.filename = filename
+        self.map = map
+        self.signature = signature # (ino, size, mtime)
+        self.checked = checked
+        self.prev = self.next = None
+
+class ShareMapCache:
+    """I hold up to max_files read-only maps, keyed by share filename, and
+    discard the least recently used one when I need room for another."""
+    revalidate_interval = 10 # seconds
+
+    def __init__(self, max_files=0):
+        if sys.platform == "win32":
+            # Windows refuses to delete a file while it is mapped, which
+            # would get in the way of lease expiration.
+            max_files = 0
+        self.max_files = max_files
+        self._maps = {} # filename -> _Entry
+        # a circular doubly-linked list, most recently used first
+        self._head = _Entry(None, None, None, None)
+        self._head.prev = self._head.next = self._head
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        """Return a read-only mmap of the given file, or None if the file
+        cannot be mapped (or I am disabled). The caller can use seek() and
+        read() on it like a file, but must not close it."""
+        if not self.max_files:
+            return None
+        now = time.time()
+        entry = self._maps.get(filename)
+        if entry is not None:
+            if now - entry.checked < self.revalidate_interval:
+                self._unlink(entry)
+                self._link(entry)
+                self.hits += 1
+                return entry.map
+        try:
+            s = os.stat(filename)
+        except EnvironmentError:
+            # the share is gone. Let the caller report that however it
+            # usually would.
+            self.invalidate(filename)
+            self.misses += 1
+            return None
+        signature = (s.st_ino, s.st_size, s.st_mtime)
+        if entry is not None:
+            if entry.signature == signature:
+                entry.checked = now
+                self._unlink(entry)
+                self._link(entry)
+                self.hits += 1
+                return entry.map
+            self.invalidate(filename)
+        self.misses += 1
+        m = self._map(filename, s.st_size)
+        if m is None:
+            return None
+        if len(self._maps) >= self.max_files:
+            self.invalidate(self._head.prev.filename)
+        entry = _Entry(filename, m, signature, now)
+        self._maps[filename] = entry
+        self._link(entry)
+        return m
+
+    def _map(self, filename, size):
+        if not size:
+            return None # mmap refuses to map empty files
+        try:
+            f = open(filename, "rb")
+            try:
+                return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        except (EnvironmentError, ValueError, OverflowError):
+            # too big for our address space, or a filesystem that can't
+            # be mapped: the caller will fall back to reading the file
+            return None
+
+    def _link(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def invalidate(self, filename):
+        entry = self._maps.pop(filename, None)
+        if entry is not None:
+            self._unlink(entry)
+            entry.map.close()
+
+    def clear(self):
+        for filename in self._maps.keys():
+            self.invalidate(filename)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate,
+                "open": len(self._maps),
+                }
@@ -31,8 +31,10 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 
 import time
 from zope.interface import implements, Interface
-from foolscap.api import eventually
-from allmydata.interfaces import IStorageBroker
+from twisted.internet import defer
+from foolscap.api import eventually, Referenceable
+from allmydata.interfaces import IStorageBroker, MAX_LEASE_BATCH, \
+     MAX_DYHB_BATCH, MAX_UPLOAD_BATCH
 from allmydata.util import idlib, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
@@ -173,6 +175,11 @@ class NativeStorageServer:
         { "maximum-immutable-share-size": 2**32,
           "tolerates-immutable-read-overrun": False,
           "delete-mutable-shares-with-zero-length-writev": False,
+          "supports-add-leases": False,
+          "supports-get-many-buckets": False,
+          "supports-immutable-readv": False,
+          "supports-immutable-writev": False,
+          "supports-upload-batches": False,
           },
         "application-version": "unknown: no get_version()",
         }
@@ -272,3 +279,237 @@ class NativeStorageServer:
 
 class UnknownServerTypeError(Exception):
     pass
+
+class AddLeaseError(Exception):
+    """A storage server could not add one of the leases in an add_leases()
+    call. The argument is the server's description of the problem."""
+
+class BatchReplyError(Exception):
+    """A storage server answered a batched call with a different number of
+    results than the number of requests in it. Every request of that call
+    fails with this error, since we cannot tell which results belong to
+    which requests."""
+
+class LeaseBatcher:
+    """I combine the add-lease requests made during a single reactor turn
+    into one add_leases() call per storage server, for servers which set
+    'supports-add-leases' in their version dict. Other servers get one
+    add_lease() call per request, as before.
+
+    Callers which want their requests to be batched (like the DeepChecker)
+    should issue them in the same turn."""
+
+    def __init__(self):
+        self._pending = {} # rref -> list of ((si, renew, cancel), Deferred)
+
+    def add_lease(self, rref, storage_index, renew_secret, cancel_secret):
+        """Return a Deferred that fires (with None) when the server has
+        added or renewed the lease. A lease that the server rejected is
+        reported with an AddLeaseError, and a failed call with the usual
+        foolscap exceptions."""
+        v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        if not v1.get("supports-add-leases", False):
+            return rref.callRemote("add_lease", storage_index,
+                                   renew_secret, cancel_secret)
+        if not self._pending:
+            eventually(self._flush)
+        d = defer.Deferred()
+        request = (storage_index, renew_secret, cancel_secret)
+        self._pending.setdefault(rref, []).append((request, d))
+        return d
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        for (rref, requests) in pending.items():
+            for i in range(0, len(requests), MAX_LEASE_BATCH):
+                self._send(rref, requests[i:i+MAX_LEASE_BATCH])
+
+    def _send(self, rref, requests):
+        d = rref.callRemote("add_leases", [req for (req, rd) in requests])
+        def _got_results(results):
+            if len(results) != len(requests):
+                _failed(BatchReplyError("add_leases returned %d results for"
+                                        " %d requests"
+                                        % (len(results), len(requests))))
+                return
+            for ((req, rd), error) in zip(requests, results):
+                if error is None:
+                    rd.callback(None)
+                else:
+                    rd.errback(AddLeaseError(error))
+        def _failed(f):
+            for (req, rd) in requests:
+                rd.errback(f)
+        d.addCallbacks(_got_results, _failed)
+
+_lease_batcher = LeaseBatcher()
+
+def add_lease(rref, storage_index, renew_secret, cancel_secret):
+    """Ask a storage server to add or renew a lease, combining the request
+    with others sent to the same server in this reactor turn, if possible.
+    See LeaseBatcher.add_lease for details."""
+    return _lease_batcher.add_lease(rref, storage_index,
+                                    renew_secret, cancel_secret)
+
+
+class BucketQueryBatcher:
+    """I combine the get_buckets() queries (aka DYHB, "Do You Have Block")
+    made during a single reactor turn into as few calls as possible, for
+    servers which set 'supports-get-many-buckets' in their version dict. The
+    first query to each server is sent right away, so a lone query costs no
+    more than it used to. Any further queries to that server in the same
+    turn are sent together at the end of the turn, with one
+    get_many_buckets() call. Older servers get one get_buckets() call per
+    query, as before.
+
+    This saves a round trip per file when many small files are checked or
+    downloaded at the same time, as with deep-check or the web UI."""
+
+    def __init__(self):
+        # rref -> list of (storage_index, Deferred). An rref with an empty
+        # list has been sent its first query of this turn.
+        self._pending = {}
+
+    def get_buckets(self, rref, storage_index):
+        """Return a Deferred that fires with the dict that the server's
+        get_buckets() would have returned for this storage index."""
+        v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        if not v1.get("supports-get-many-buckets", False):
+            return rref.callRemote("get_buckets", storage_index)
+        if not self._pending:
+            eventually(self._flush)
+        if rref not in self._pending:
+            self._pending[rref] = []
+            return rref.callRemote("get_buckets", storage_index)
+        d = defer.Deferred()
+        self._pending[rref].append((storage_index, d))
+        return d
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        for (rref, queries) in pending.items():
+            for i in range(0, len(queries), MAX_DYHB_BATCH):
+                self._send(rref, queries[i:i+MAX_DYHB_BATCH])
+
+    def _send(self, rref, queries):
+        if len(queries) == 1:
+            (storage_index, query_d) = queries[0]
+            d = rref.callRemote("get_buckets", storage_index)
+            d.addCallbacks(query_d.callback, query_d.errback)
+            return
+        d = rref.callRemote("get_many_buckets", [si for (si, qd) in queries])
+        def _got_results(results):
+            if len(results) != len(queries):
+                _failed(BatchReplyError("get_many_buckets returned %d results"
+                                        " for %d queries"
+                                        % (len(results), len(queries))))
+                return
+            for ((si, qd), buckets) in zip(queries, results):
+                qd.callback(buckets)
+        def _failed(f):
+            for (si, qd) in queries:
+                qd.errback(f)
+        d.addCallbacks(_got_results, _failed)
+
+_bucket_query_batcher = BucketQueryBatcher()
+
+def get_buckets(rref, storage_index):
+    """Ask a storage server which shares it holds for a storage index,
+    combining the query with others sent to the same server in this reactor
+    turn, if possible. See BucketQueryBatcher.get_buckets for details."""
+    return _bucket_query_batcher.get_buckets(rref, storage_index)
+
+
+class BucketWriteError(Exception):
+    """A storage server could not carry out one of the writes or closes in
+    a writev_many() or close_many() call. The argument is the server's
+    description of the problem."""
+
+class UploadBatcher:
+    """I combine the allocate_buckets(), writev(), and close() messages that
+    the uploads of one batch send to a storage server during a single
+    reactor turn into one allocate_buckets_many(), writev_many(), or
+    close_many() call, for servers which set 'supports-upload-batches' in
+    their version dict. The calls of each turn are sent in that order, so a
+    bucket's last writev() still reaches the server before its close().
+
+    Unlike the LeaseBatcher and the BucketQueryBatcher, I am not shared by
+    the whole node: Uploader.upload_batch() makes one for each batch, so
+    the messages of unrelated uploads never wait for each other."""
+
+    METHODS = ["allocate_buckets_many", "writev_many", "close_many"]
+
+    def __init__(self):
+        # rref -> dict of methname -> list of (request, Deferred)
+        self._pending = {}
+
+    def get_server_batcher(self, rref):
+        """Return a ServerUploadBatcher for the given storage server, or
+        None if the server cannot take batched messages."""
+        v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        if not v1.get("supports-upload-batches", False):
+            return None
+        return ServerUploadBatcher(self, rref)
+
+    def add(self, rref, methname, request):
+        if not self._pending:
+            eventually(self._flush)
+        d = defer.Deferred()
+        calls = self._pending.setdefault(rref, {})
+        calls.setdefault(methname, []).append((request, d))
+        return d
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        for (rref, calls) in pending.items():
+            for methname in self.METHODS:
+                requests = calls.get(methname, [])
+                for i in range(0, len(requests), MAX_UPLOAD_BATCH):
+                    self._send(rref, methname, requests[i:i+MAX_UPLOAD_BATCH])
+
+    def _send(self, rref, methname, requests):
+        args = [req for (req, rd) in requests]
+        if methname == "allocate_buckets_many":
+            d = rref.callRemote(methname, args, canary=Referenceable())
+        else:
+            d = rref.callRemote(methname, args)
+        def _got_results(results):
+            if len(results) != len(requests):
+                _failed(BatchReplyError("%s returned %d results for %d"
+                                        " requests" % (methname, len(results),
+                                                       len(requests))))
+                return
+            for ((req, rd), res) in zip(requests, results):
+                if methname == "allocate_buckets_many":
+                    rd.callback(res)
+                elif res is None:
+                    rd.callback(None)
+                else:
+                    rd.errback(BucketWriteError(res))
+        def _failed(f):
+            for (req, rd) in requests:
+                rd.errback(f)
+        d.addCallbacks(_got_results, _failed)
+
+class ServerUploadBatcher:
+    """I send the upload messages for one storage server through an
+    UploadBatcher. My methods take the same arguments as the remote methods
+    of the same name (without the canary, of which the batch provides its
+    own), and return Deferreds that fire with the same results."""
+
+    def __init__(self, batcher, rref):
+        self._batcher = batcher
+        self._rref = rref
+
+    def allocate_buckets(self, storage_index, renew_secret, cancel_secret,
+                         sharenums, allocated_size):
+        return self._batcher.add(self._rref, "allocate_buckets_many",
+                                 (storage_index, renew_secret, cancel_secret,
+                                  sharenums, allocated_size))
+
+    def writev(self, bucket, datav):
+        """Write to a bucket that this server gave us."""
+        return self._batcher.add(self._rref, "writev_many", (bucket, datav))
+
+    def close(self, bucket):
+        return self._batcher.add(self._rref, "close_many", bucket)
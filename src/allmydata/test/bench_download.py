@@ -0,0 +1,126 @@
+"""
+Measure the aggregate throughput of immutable downloads by 1, 4, and 16
+concurrent readers (each reading a different file), first with the decoding,
+hashing, and decryption done in the node, and then with a pool of worker
+processes. The storage servers live in the same process (see
+allmydata.test.no_network), so this measures the client's CPU work, not the
+network.
+
+ python src/allmydata/test/bench_download.py [--size=MB] [--workers=N]
+
+--workers defaults to the number of CPU cores.
+"""
+
+import os, sys, time, shutil, tempfile
+from zope.interface import implements
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IConsumer
+from twisted.application import service
+from allmydata.immutable import upload
+from allmydata.test.no_network import NoNetworkGrid
+
+READERS = [1, 4, 16]
+
+class DiscardingConsumer:
+    implements(IConsumer)
+    def __init__(self):
+        self.bytes = 0
+    def registerProducer(self, p, streaming):
+        assert streaming
+        p.resumeProducing()
+    def write(self, data):
+        self.bytes += len(data)
+    def unregisterProducer(self):
+        pass
+
+def make_client(basedir, workers):
+    def _configure(clientdir):
+        f = open(os.path.join(clientdir, "tahoe.cfg"), "a")
+        f.write("[client]\n")
+        f.write("workers = %d\n" % workers)
+        f.close()
+    parent = service.MultiService()
+    parent.startService()
+    g = NoNetworkGrid(basedir, client_config_hooks={0: _configure})
+    g.setServiceParent(parent)
+    return parent, g.clients[0]
+
+def upload_files(c, count, size):
+    caps = []
+    d = defer.succeed(None)
+    for i in range(count):
+        def _upload(ign):
+            return c.upload(upload.Data(os.urandom(size), None))
+        d.addCallback(_upload)
+        d.addCallback(lambda ur: caps.append(ur.uri))
+    d.addCallback(lambda ign: caps)
+    return d
+
+def read_all(c, caps):
+    start = time.time()
+    consumers = []
+    dl = []
+    for cap in caps:
+        mc = DiscardingConsumer()
+        consumers.append(mc)
+        dl.append(c.create_node_from_uri(cap).read(mc))
+    d = defer.DeferredList(dl, fireOnOneErrback=True)
+    def _done(ign):
+        elapsed = time.time() - start
+        total = sum([mc.bytes for mc in consumers])
+        return total / elapsed
+    d.addCallback(_done)
+    return d
+
+def bench(topdir, workers, size):
+    basedir = os.path.join(topdir, "workers-%d" % workers)
+    parent, c = make_client(basedir, workers)
+    d = upload_files(c, max(READERS), size)
+    def _read(caps):
+        d2 = defer.succeed(None)
+        for readers in READERS:
+            def _run(ign, readers=readers):
+                return read_all(c, caps[:readers])
+            def _report(rate, readers=readers):
+                print "workers=%-2d readers=%-2d %8.2f MB/s" % (workers,
+                                                               readers,
+                                                               rate/1e6)
+            d2.addCallback(_run)
+            d2.addCallback(_report)
+        return d2
+    d.addCallback(_read)
+    def _cleanup(res):
+        d3 = defer.maybeDeferred(parent.stopService)
+        d3.addBoth(lambda ign: shutil.rmtree(basedir))
+        d3.addCallback(lambda ign: res)
+        return d3
+    d.addBoth(_cleanup)
+    return d
+
+def main():
+    size = 4
+    workers = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--size="):
+            size = int(arg[len("--size="):])
+        elif arg.startswith("--workers="):
+            workers = int(arg[len("--workers="):])
+        else:
+            print __doc__
+            sys.exit(1)
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    # each Client points tempfile at its own basedir, so make ours first
+    topdir = tempfile.mkdtemp()
+    def _start():
+        d = bench(topdir, 0, size*1000*1000)
+        d.addCallback(lambda ign: bench(topdir, workers, size*1000*1000))
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda ign: reactor.stop())
+    reactor.callWhenRunning(_start)
+    reactor.run()
+    shutil.rmtree(topdir)
+
+if __name__ == "__main__":
+    main()
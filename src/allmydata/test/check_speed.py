@@ -10,6 +10,7 @@ MB = 1000000
 
 class SpeedTest:
     DO_IMMUTABLE = True
+    DO_BATCH = True
     DO_MUTABLE_CREATE = True
     DO_MUTABLE = True
 
@@ -73,6 +74,8 @@ class SpeedTest:
         #   "create" (upload different contents into a new SSK file)
         #   "upload" (upload different contents into the same SSK file. The
         #             time consumed does not include the creation of the file)
+        #   "batch" (upload a different CHK file for each 'count', all in one
+        #            upload_batch() call)
         d = self.client_rref.callRemote("speed_test", count, size, mutable)
         d.addCallback(self.record_times, name)
         return d
@@ -118,6 +121,12 @@ class SpeedTest:
                 return self.one_test(None, "100MB", 1, 100*MB, False)
             d.addCallback(_maybe_do_100MB)
 
+        if self.DO_BATCH:
+            # many small immutable files, one at a time and in a batch
+            d.addCallback(self.one_test, "100x 20kB", 100, 20*1000, False)
+            d.addCallback(self.one_test, "100x 20kB batch", 100, 20*1000,
+                          "batch")
+
         if self.DO_MUTABLE_CREATE:
             # mutable file creation
             d.addCallback(self.one_test, "10x 200B SSK creation", 10, 200,
@@ -175,6 +184,14 @@ class SpeedTest:
                 A3 = 100*MB / (self.download_times["100MB"] - B)
                 print "download speed (100MB):", self.number(A3, "Bps")
 
+        if self.DO_BATCH:
+            for key in ("100x 20kB", "100x 20kB batch"):
+                print "upload rate (%s): %.1f files/s" % \
+                      (key, 100 / self.upload_times[key])
+            print "upload batch speedup: %.2fx" % \
+                  (self.upload_times["100x 20kB"] /
+                   self.upload_times["100x 20kB batch"])
+
         if self.DO_MUTABLE_CREATE:
             # SSK creation
             B = self.upload_times["10x 200B SSK creation"] / 10
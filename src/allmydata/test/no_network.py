@@ -58,6 +58,12 @@ class LocalWrapper:
                 return a
         args = tuple([wrap(a) for a in args])
         kwargs = dict([(k,wrap(kwargs[k])) for k in kwargs])
+        # a real Tub hands a server its own objects back when a caller
+        # passes references to them, which these methods rely upon
+        if methname == "writev_many":
+            args = ([(bw.original, datav) for (bw, datav) in args[0]],)
+        if methname == "close_many":
+            args = ([bw.original for bw in args[0]],)
 
         def _really_call():
             meth = getattr(self.original, "remote_" + methname)
@@ -92,9 +98,17 @@ class LocalWrapper:
                 (alreadygot, allocated) = res
                 for shnum in allocated:
                     allocated[shnum] = LocalWrapper(allocated[shnum])
+            if methname == "allocate_buckets_many":
+                for (alreadygot, allocated) in res:
+                    for shnum in allocated:
+                        allocated[shnum] = LocalWrapper(allocated[shnum])
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "get_many_buckets":
+                for buckets in res:
+                    for shnum in buckets:
+                        buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -1,9 +1,11 @@
 
 import simplejson
 from twisted.trial import unittest
+from twisted.internet import defer
 from allmydata import check_results, uri
 from allmydata.web import check_results as web_check_results
-from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
+from allmydata.storage_client import StorageFarmBroker, NativeStorageServer, \
+     LeaseBatcher, BucketQueryBatcher, BatchReplyError
 from allmydata.monitor import Monitor
 from allmydata.test.no_network import GridTestMixin
 from allmydata.immutable.upload import Data
@@ -319,3 +321,172 @@ class AddLease(GridTestMixin, unittest.TestCase):
 
         d.addCallback(lambda ign: self.failUnless(really_did_break))
         return d
+
+    def test_batched(self):
+        self.basedir = "checker/AddLease/batched"
+        self.set_up_grid(num_servers=1)
+        c0 = self.g.clients[0]
+        c0.DEFAULT_ENCODING_PARAMETERS['happy'] = 1
+        ss = self.g.servers_by_number[0]
+        batches = []
+        original_add_leases = ss.remote_add_leases
+        def add_leases(leases):
+            batches.append(len(leases))
+            return original_add_leases(leases)
+        ss.remote_add_leases = add_leases
+        single = []
+        original_add_lease = ss.remote_add_lease
+        def add_lease(*args, **kwargs):
+            single.append(1)
+            return original_add_lease(*args, **kwargs)
+        ss.remote_add_lease = add_lease
+
+        d = c0.create_dirnode()
+        def _created(dn):
+            self.root = dn
+            d2 = defer.succeed(None)
+            for i in range(5):
+                d2.addCallback(lambda ign, i=i:
+                               dn.add_file(u"%d" % i,
+                                           Data("data%d" % i * 100,
+                                                convergence="")))
+            return d2
+        d.addCallback(_created)
+        d.addCallback(lambda ign:
+                      self.root.start_deep_check(add_lease=True).when_done())
+        def _checked(res):
+            self.failUnlessEqual(res.get_counters()["count-objects-checked"],
+                                 6)
+            # the five files were checked together, and their leases went
+            # out in a single call
+            self.failUnlessEqual(sorted(batches), [1, 5])
+            self.failUnlessEqual(len(single), 6)
+        d.addCallback(_checked)
+
+        # servers that do not advertise add_leases get one call per lease
+        def _downgrade(ign):
+            v1 = ss_rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            del v1["supports-add-leases"]
+            del batches[:]
+            del single[:]
+        ss_rref = list(c0.get_storage_broker().get_connected_servers())[0].get_rref()
+        d.addCallback(_downgrade)
+        d.addCallback(lambda ign:
+                      self.root.start_deep_check(add_lease=True).when_done())
+        def _checked_unbatched(res):
+            self.failUnlessEqual(batches, [])
+            self.failUnlessEqual(len(single), 6)
+        d.addCallback(_checked_unbatched)
+        return d
+
+    def test_short_reply(self):
+        # a server which answers add_leases with too few results must not
+        # leave any of the requests waiting forever
+        class ShortRref:
+            version = {"http://allmydata.org/tahoe/protocols/storage/v1":
+                       {"supports-add-leases": True}}
+            def callRemote(self, methname, requests):
+                return defer.succeed([None] * (len(requests) - 1))
+        rref = ShortRref()
+        batcher = LeaseBatcher()
+        ds = [batcher.add_lease(rref, "si%d" % i, "renew", "cancel")
+              for i in range(2)]
+        results = []
+        for d in ds:
+            d.addErrback(lambda f: results.append(f.trap(BatchReplyError)))
+        d = defer.DeferredList(ds)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(results, [BatchReplyError,
+                                                     BatchReplyError]))
+        return d
+
+class BatchedDYHB(GridTestMixin, unittest.TestCase):
+    # servers that support get_many_buckets should be asked about all the
+    # files of a directory in a couple of calls, not one call per file
+
+    def test_deep_check(self):
+        self.basedir = "checker/BatchedDYHB/deep_check"
+        self.set_up_grid(num_servers=1)
+        c0 = self.g.clients[0]
+        c0.DEFAULT_ENCODING_PARAMETERS['happy'] = 1
+        ss = self.g.servers_by_number[0]
+        batches = []
+        original_get_many_buckets = ss.remote_get_many_buckets
+        def get_many_buckets(storage_indexes):
+            batches.append(len(storage_indexes))
+            return original_get_many_buckets(storage_indexes)
+        ss.remote_get_many_buckets = get_many_buckets
+        queries = []
+        original_get_buckets = ss.remote_get_buckets
+        def get_buckets(storage_index):
+            queries.append(storage_index)
+            return original_get_buckets(storage_index)
+        ss.remote_get_buckets = get_buckets
+
+        d = c0.create_dirnode()
+        def _created(dn):
+            self.root = dn
+            d2 = defer.succeed(None)
+            for i in range(5):
+                d2.addCallback(lambda ign, i=i:
+                               dn.add_file(u"%d" % i,
+                                           Data("data%d" % i * 100,
+                                                convergence="")))
+            return d2
+        d.addCallback(_created)
+        def _check(ign):
+            del batches[:]
+            del queries[:]
+            return self.root.start_deep_check(add_lease=True).when_done()
+        d.addCallback(_check)
+        def _checked(res):
+            self.failUnlessEqual(res.get_counters()["count-objects-checked"],
+                                 6)
+            self.failUnlessEqual(res.get_counters()["count-objects-healthy"],
+                                 6)
+            # the first file was asked about on its own, the other four in
+            # a single call
+            self.failUnlessEqual(batches, [4])
+            self.failUnlessEqual(len(queries), 5)
+        d.addCallback(_checked)
+
+        # older servers get one get_buckets call per file
+        def _downgrade(ign):
+            v1 = ss_rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            del v1["supports-get-many-buckets"]
+        ss_rref = list(c0.get_storage_broker().get_connected_servers())[0].get_rref()
+        d.addCallback(_downgrade)
+        d.addCallback(_check)
+        def _checked_unbatched(res):
+            self.failUnlessEqual(res.get_counters()["count-objects-healthy"],
+                                 6)
+            self.failUnlessEqual(batches, [])
+            self.failUnlessEqual(len(queries), 5)
+        d.addCallback(_checked_unbatched)
+        return d
+
+    def test_short_reply(self):
+        # a server which answers get_many_buckets with too few results must
+        # not leave any of the queries waiting forever
+        class ShortRref:
+            version = {"http://allmydata.org/tahoe/protocols/storage/v1":
+                       {"supports-get-many-buckets": True}}
+            def callRemote(self, methname, *args):
+                if methname == "get_buckets":
+                    return defer.succeed({})
+                storage_indexes = args[0]
+                return defer.succeed([{}] * (len(storage_indexes) - 1))
+        rref = ShortRref()
+        batcher = BucketQueryBatcher()
+        ds = [batcher.get_buckets(rref, "si%d" % i) for i in range(3)]
+        results = []
+        for d in ds:
+            d.addCallbacks(results.append,
+                           lambda f: results.append(f.trap(BatchReplyError)))
+        d = defer.DeferredList(ds)
+        def _check(ign):
+            # the first query was sent on its own, the other two together
+            self.failUnlessEqual(results, [{}, BatchReplyError,
+                                           BatchReplyError])
+        d.addCallback(_check)
+        return d
@@ -123,6 +123,214 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         c = client.Client(basedir)
         self.failUnlessEqual(c.getServiceNamed("storage").reserved_space, 0)
 
+    def test_fsync(self):
+        basedir = "client.Basic.test_fsync"
+        os.mkdir(basedir)
+        def _make_client(fsync):
+            f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+            f.write(BASECONFIG)
+            f.write("[storage]\n")
+            f.write("enabled = true\n")
+            if fsync is not None:
+                f.write("fsync = %s\n" % fsync)
+            f.close()
+            return client.Client(basedir)
+        c = _make_client(None)
+        self.failUnlessEqual(c.getServiceNamed("storage").fsync_policy, "none")
+        c = _make_client("Close")
+        self.failUnlessEqual(c.getServiceNamed("storage").fsync_policy, "close")
+        c = _make_client("8MiB")
+        self.failUnlessEqual(c.getServiceNamed("storage").fsync_policy,
+                             8*1024*1024)
+        self.failUnlessRaises(ValueError, _make_client, "bogus")
+        self.failUnlessRaises(ValueError, _make_client, "0")
+
+    def test_workers(self):
+        basedir = "client.Basic.test_workers"
+        os.mkdir(basedir)
+        def _make_client(workers):
+            f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+            f.write(BASECONFIG)
+            f.write("[client]\n")
+            if workers is not None:
+                f.write("workers = %s\n" % workers)
+            f.close()
+            return client.Client(basedir)
+        c = _make_client(None)
+        self.failUnlessEqual(c.worker_pool, None)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._worker_pool, None)
+        c = _make_client("3")
+        self.failUnlessEqual(c.worker_pool.workers, 3)
+        self.failUnlessIdentical(c.getServiceNamed("uploader")._worker_pool,
+                                 c.worker_pool)
+        self.failUnlessIdentical(c.nodemaker.download_parameters["worker_pool"],
+                                 c.worker_pool)
+
+    def test_parallel_queries(self):
+        basedir = "client.Basic.test_parallel_queries"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._parallel_queries, 1)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("[client]\n")
+        f.write("upload.parallel_queries = 10\n")
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._parallel_queries, 10)
+
+    def test_check_existing(self):
+        basedir = "client.Basic.test_check_existing"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._check_existing,
+                             False)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("[client]\n")
+        f.write("upload.check_existing = true\n")
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._check_existing,
+                             True)
+
+    def test_download_readahead(self):
+        basedir = "client.Basic.test_download_readahead"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.download_parameters,
+                             {"readahead_segments": 2,
+                              "readahead_bytes": 1024*1024,
+                              "segment_cache": None,
+                              "metadata_cache": None,
+                              "worker_pool": None,
+                              "hedge_percentile": 0})
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("[client]\n")
+        f.write("download.readahead_segments = 8\n")
+        f.write("download.readahead_bytes = 4MB\n")
+        f.write("download.hedge_percentile = 95\n")
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.download_parameters,
+                             {"readahead_segments": 8,
+                              "readahead_bytes": 4000000,
+                              "segment_cache": None,
+                              "metadata_cache": None,
+                              "worker_pool": None,
+                              "hedge_percentile": 95})
+        def _make_client(option):
+            f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+            f.write(BASECONFIG)
+            f.write(option + "\n")
+            f.close()
+            return client.Client(basedir)
+        self.failUnlessRaises(ValueError, _make_client,
+                              "download.readahead_segments = -1")
+        self.failUnlessRaises(ValueError, _make_client,
+                              "download.readahead_bytes = bogus")
+        self.failUnlessRaises(ValueError, _make_client,
+                              "download.hedge_percentile = 101")
+
+    def test_segment_cache(self):
+        basedir = "client.Basic.test_segment_cache"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.segment_cache, None)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("download.segment_cache.size = 10MB\n")
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.segment_cache.max_bytes, 10*1000*1000)
+        self.failUnlessIdentical(
+            c.nodemaker.download_parameters["segment_cache"], c.segment_cache)
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["downloader.segment_cache.hits"], 0)
+
+    def test_metadata_cache(self):
+        basedir = "client.Basic.test_metadata_cache"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.metadata_cache, None)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("download.cache_metadata = true\n")
+        f.close()
+        c = client.Client(basedir)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "download-metadata.sqlite")))
+        self.failUnlessIdentical(
+            c.nodemaker.download_parameters["metadata_cache"],
+            c.metadata_cache)
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["downloader.metadata_cache.misses"], 0)
+
+    def test_helper_bad(self):
+        basedir = "client.Basic.test_helper_bad"
+        os.mkdir(basedir)
+        def _make_client(option):
+            f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+            f.write(BASECONFIG)
+            f.write("[helper]\n")
+            f.write("enabled = true\n")
+            f.write(option + "\n")
+            f.close()
+            return client.Client(basedir)
+        self.failUnlessRaises(ValueError, _make_client,
+                              "fetch.pipeline_depth = 0")
+        self.failUnlessRaises(ValueError, _make_client,
+                              "fetch.max_ahead = bogus")
+        self.failUnlessRaises(ValueError, _make_client,
+                              "max_disk_usage = bogus")
+
+    def test_cache_convergent_keys(self):
+        basedir = "client.Basic.test_cache_convergent_keys"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.close()
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.convergent_key_cache, None)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("[client]\n")
+        f.write("upload.cache_convergent_keys = true\n")
+        f.close()
+        c = client.Client(basedir)
+        self.failUnless(c.convergent_key_cache)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "convergent-keys.sqlite")))
+
+    def test_read_cache(self):
+        basedir = "client.Basic.test_read_cache"
+        os.mkdir(basedir)
+        f = open(os.path.join(basedir, "tahoe.cfg"), "w")
+        f.write(BASECONFIG)
+        f.write("[storage]\n")
+        f.write("enabled = true\n")
+        f.write("read_cache.size = 10MiB\n")
+        f.close()
+        c = client.Client(basedir)
+        read_cache = c.getServiceNamed("storage").read_cache
+        self.failUnlessEqual(read_cache.max_bytes, 10*1024*1024)
+
     def _permute(self, sb, key):
         return [ s.get_serverid() for s in sb.get_servers_for_psi(key) ]
 
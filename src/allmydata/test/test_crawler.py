@@ -82,6 +82,25 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class Killed(Exception):
+    pass
+
+class KillableCrawler(BucketEnumeratingCrawler):
+    # simulates a SIGKILL: raise out of the middle of a slice, without
+    # giving the crawler a chance to save its state
+    incremental = True
+    checkpoint_buckets = 2
+    def __init__(self, *args, **kwargs):
+        BucketEnumeratingCrawler.__init__(self, *args, **kwargs)
+        self.countdown = None
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        if self.countdown is not None:
+            if self.countdown == 0:
+                raise Killed()
+            self.countdown -= 1
+        BucketEnumeratingCrawler.process_bucket(self, cycle, prefix,
+                                                prefixdir, storage_index_b32)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -437,3 +456,96 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+    def test_incremental(self):
+        self.basedir = "crawler/Basic/incremental"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        prefixes = set([si[:2] for si in sis])
+        # pretend the buckets were created a while ago. Fresh prefixdirs
+        # are always listed again, in case their mtime is too coarse to
+        # reveal changes made in the same second.
+        def _age_prefixdirs():
+            then = time.time() - 100
+            for prefix in prefixes:
+                os.utime(os.path.join(ss.sharedir, prefix), (then, then))
+        _age_prefixdirs()
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.incremental = True
+        c.load_state()
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+        self.failUnlessEqual(sorted(os.listdir(c.bucket_list_dir)),
+                             sorted(prefixes))
+        self.failUnlessEqual(c.state["current-cycle-cached-prefixes"], 0)
+
+        # the second cycle reuses all of the bucket lists
+        c.finished_d = defer.Deferred()
+        c.all_buckets = []
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+        self.failUnlessEqual(c.state["current-cycle-cached-prefixes"],
+                             len(prefixes))
+        self.failUnlessEqual(c.state["current-cycle-buckets"], len(sis))
+
+        # a new bucket in an old prefixdir is noticed, because it changes
+        # the mtime of the prefixdir
+        new_si = self.write(0, ss, serverid, tail=1)
+        self.failUnlessIn(new_si[:2], prefixes)
+        c.finished_d = defer.Deferred()
+        c.all_buckets = []
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis + [new_si]), sorted(c.all_buckets))
+        self.failUnlessEqual(c.state["current-cycle-cached-prefixes"],
+                             len(prefixes) - 1)
+
+        # a new crawler uses the lists on disk
+        _age_prefixdirs()
+        c.finished_d = defer.Deferred()
+        c.all_buckets = []
+        c.start_current_prefix(time.time()) # records the aged mtime
+        c2 = BucketEnumeratingCrawler(ss, statefile)
+        c2.incremental = True
+        c2.load_state()
+        c2.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis + [new_si]), sorted(c2.all_buckets))
+        self.failUnlessEqual(c2.state["current-cycle-cached-prefixes"],
+                             len(prefixes))
+
+        p = c2.get_progress()
+        self.failUnlessEqual(p["incremental"], True)
+        self.failUnlessEqual(p["cycle-in-progress"], False)
+
+    def test_checkpoint(self):
+        self.basedir = "crawler/Basic/checkpoint"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+
+        c = KillableCrawler(ss, statefile)
+        c.load_state()
+        c.countdown = 5
+        self.failUnlessRaises(Killed, c.start_current_prefix, time.time())
+        self.failUnlessEqual(len(c.all_buckets), 5)
+        p = c.get_progress()
+        self.failUnlessEqual(p["cycle-in-progress"], True)
+        self.failUnlessEqual(p["buckets-processed"], 5)
+
+        # the state was saved after the fourth bucket, so a new crawler
+        # only repeats the fifth
+        c2 = KillableCrawler(ss, statefile)
+        c2.load_state()
+        self.failUnlessEqual(c2.state["current-cycle-buckets"], 4)
+        c2.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(c.all_buckets[:4] + c2.all_buckets),
+                             sorted(sis))
+        self.failUnlessEqual(c2.state["current-cycle"], None)
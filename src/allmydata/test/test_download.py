@@ -18,6 +18,12 @@ from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, DownloadStopped, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.share import Share
+from allmydata.immutable.downloader.segcache import SegmentCache
+from allmydata.immutable.downloader.metacache import DownloadMetadataCache
+from allmydata.immutable.filenode import PooledDecryptingConsumer
+from allmydata.util.workerpool import WorkerPool, WorkerError
+from pycryptopp.cipher.aes import AES
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import fireEventually, flushEventualQueue
 
@@ -202,6 +208,105 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(self.download_mutable)
         return d
 
+    def test_readv(self):
+        # servers which support readv() should get all the ranges that a
+        # share wants at once, instead of one read() per range
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        calls = {"read": 0, "readv": 0}
+        def _count_calls(br):
+            original_read = br.remote_read
+            def read(offset, length):
+                calls["read"] += 1
+                return original_read(offset, length)
+            br.remote_read = read
+            original_readv = br.remote_readv
+            def readv(readv):
+                calls["readv"] += 1
+                return original_readv(readv)
+            br.remote_readv = readv
+        for ss in self.g.servers_by_number.values():
+            def get_buckets(storage_index, ss=ss,
+                            original_get_buckets=ss.remote_get_buckets):
+                buckets = original_get_buckets(storage_index)
+                for br in buckets.values():
+                    _count_calls(br)
+                return buckets
+            ss.remote_get_buckets = get_buckets
+
+        # several segments, so the later blocks are fetched along with
+        # their hash chains
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.uri = ur.uri
+            return download_to_data(self.c0.create_node_from_uri(self.uri))
+        d.addCallback(_uploaded)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnless(calls["readv"] > 0, calls)
+            # each readv() is answered with one read() per range
+            self.failUnless(calls["read"] > calls["readv"], calls)
+        d.addCallback(_got_data)
+
+        # older servers get one read() per range
+        def _downgrade(ign):
+            for s in self.c0.storage_broker.get_connected_servers():
+                v1 = s.get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+                del v1["supports-immutable-readv"]
+            calls["read"] = calls["readv"] = 0
+        d.addCallback(_downgrade)
+        d.addCallback(lambda ign: download_to_data(
+            self.c0.create_node_from_uri(self.uri)))
+        def _got_data_unbatched(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(calls["readv"], 0)
+            self.failUnless(calls["read"] > 0, calls)
+        d.addCallback(_got_data_unbatched)
+        return d
+
+    def test_readv_limits(self):
+        # a share never sends more ranges in one readv() than the
+        # ReadVector constraint allows, and a server that answers with too
+        # few strings is treated as broken instead of leaving the missing
+        # ranges pending forever
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.patch(Share, "MAX_READV_LENGTH", 2)
+        lengths = []
+        bad_serverid = self.g.servers_by_number[0].my_nodeid
+        def _wrap_readv(br, short):
+            original_readv = br.remote_readv
+            def readv(readv):
+                lengths.append(len(readv))
+                datav = original_readv(readv)
+                if short:
+                    datav = datav[:-1]
+                return datav
+            br.remote_readv = readv
+        for ss in self.g.servers_by_number.values():
+            def get_buckets(storage_index, ss=ss,
+                            original_get_buckets=ss.remote_get_buckets):
+                buckets = original_get_buckets(storage_index)
+                for br in buckets.values():
+                    _wrap_readv(br, ss.my_nodeid == bad_serverid)
+                return buckets
+            ss.remote_get_buckets = get_buckets
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs
+        d = self.c0.upload(u)
+        d.addCallback(lambda ur: download_to_data(
+            self.c0.create_node_from_uri(ur.uri)))
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnless(lengths, lengths)
+            self.failUnless(max(lengths) <= 2, lengths)
+        d.addCallback(_got_data)
+        return d
+
     def test_download_failover(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -742,6 +847,278 @@ class DownloadTest(_Base, unittest.TestCase):
                             lambda: d0)
         return d
 
+    def _max_outstanding_segments(self, ds):
+        outstanding = set()
+        most = 0
+        for (etype, segnum, when, start, length, decodetime) \
+                in ds.segment_events:
+            if etype == "request":
+                outstanding.add(segnum)
+            else:
+                outstanding.discard(segnum)
+            most = max(most, len(outstanding))
+        return most
+
+    def _read_with_readahead(self, consumer, segments, size=1000):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.n = n = self.c0.create_node_from_uri(ur.uri)
+            n._cnode._maybe_create_download_node()
+            self.dn = n._cnode._node
+            self.dn._build_guessed_tables(u.max_segment_size)
+            self.dn.readahead_segments = segments
+            self.dn.readahead_bytes = size
+            return n.read(consumer)
+        d.addCallback(_uploaded)
+        return d
+
+    def _check_readahead(self, mc, expected_outstanding):
+        self.failUnlessEqual("".join(mc.chunks), plaintext)
+        ds = self.dn._download_status
+        self.failUnlessEqual(self._max_outstanding_segments(ds),
+                             expected_outstanding)
+
+    def test_readahead(self):
+        # once we learn the segment size (with the first one), the next two
+        # segments should be requested along with the one after it
+        d = self._read_with_readahead(MemoryConsumer(), 2)
+        d.addCallback(self._check_readahead, 3)
+        return d
+
+    def test_readahead_bytes(self):
+        # the byte limit only has room for one segment of read-ahead
+        d = self._read_with_readahead(MemoryConsumer(), 2, 100)
+        d.addCallback(self._check_readahead, 2)
+        return d
+
+    def test_no_readahead(self):
+        d = self._read_with_readahead(MemoryConsumer(), 0)
+        d.addCallback(self._check_readahead, 1)
+        return d
+
+    def test_readahead_pause(self):
+        d = self._read_with_readahead(PausingConsumer(), 2)
+        d.addCallback(self._check_readahead, 3)
+        return d
+
+    def test_stop_readahead(self):
+        # stopping the read must cancel the segments it was reading ahead
+        c = LateStoppingConsumer()
+        d = self.shouldFail(DownloadStopped, "test_stop_readahead",
+                            "our Consumer called stopProducing()",
+                            self._read_with_readahead, c, 2)
+        def _stopped(res):
+            requested = [segnum for (etype, segnum, when, start, length,
+                                     decodetime)
+                         in self.dn._download_status.segment_events
+                         if etype == "request"]
+            self.failUnlessEqual(requested, [0, 1, 2, 3])
+            self.failUnlessEqual(self.dn._segment_requests, [])
+            self.failUnlessEqual(self.dn._active_segment, None)
+        d.addCallback(_stopped)
+        return d
+
+    def _count_block_requests(self):
+        ds = self.dn._download_status
+        return sum([len(reqs) for reqs in ds.requests.values()])
+
+    def test_hedge_timeout(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.load_shares()
+        n = self.c0.create_node_from_uri(immutable_uri)
+        n._cnode._maybe_create_download_node()
+        dn = n._cnode._node
+        for i in range(20):
+            dn.add_block_latency("server-%d" % (i%2), float(i))
+        self.failUnlessEqual(dn.get_server_latency("server-0"), 10.0)
+        self.failUnlessEqual(dn.get_server_latency("server-1"), 11.0)
+        self.failUnlessEqual(dn.get_server_latency("server-2"), None)
+        # hedging is off unless asked for
+        self.failUnlessEqual(dn.get_hedge_timeout(), None)
+        dn.hedge_percentile = 90
+        self.failUnlessEqual(dn.get_hedge_timeout(), 18.0)
+        dn.hedge_percentile = 100
+        self.failUnlessEqual(dn.get_hedge_timeout(), 19.0)
+        # but not before there are enough samples
+        dn._latencies = dn._latencies[:5]
+        self.failUnlessEqual(dn.get_hedge_timeout(), None)
+
+    def test_hedge(self):
+        # the share that we like best stops answering after the first read.
+        # The next one should get its blocks from other shares, without
+        # waiting for it.
+        d = self._read_with_readahead(MemoryConsumer(), 0)
+        def _hang(mc):
+            dn = self.dn
+            dn.MIN_HEDGE_SAMPLES = 1
+            dn.hedge_percentile = 100
+            def _rank(s):
+                latency = dn.get_server_latency(s._server)
+                if latency is None:
+                    latency = s._dyhb_rtt
+                return (latency, s._shnum)
+            best = sorted(dn._shares, key=_rank)[0]
+            self.hung = best._rref
+            self.hung.hung_until = defer.Deferred()
+            return self.n.read(MemoryConsumer(), 0, len(plaintext))
+        d.addCallback(_hang)
+        def _check(mc):
+            self.failUnlessEqual("".join(mc.chunks), plaintext)
+            ds = self.dn._download_status
+            self.failUnless(ds.hedges_issued >= 1, ds.hedges_issued)
+            self.failUnless(ds.hedges_won >= 1, ds.hedges_won)
+            self.hung.hung_until.callback(None)
+            self.hung.hung_until = None
+        d.addCallback(_check)
+        return d
+
+    def test_segment_cache(self):
+        d = self._read_with_readahead(MemoryConsumer(), 2)
+        def _read_again(mc):
+            self.failUnlessEqual("".join(mc.chunks), plaintext)
+            self.dn._segment_cache = SegmentCache(1000)
+            # nothing was cached by the first read
+            return self.n.read(MemoryConsumer(), 100, 100)
+        d.addCallback(_read_again)
+        def _read_overlapping(mc):
+            self.failUnlessEqual("".join(mc.chunks), plaintext[100:200])
+            cache = self.dn._segment_cache
+            self.failUnlessEqual((cache.hits, cache.misses), (0, 2))
+            return self.n.read(MemoryConsumer(), 50, 200)
+        d.addCallback(_read_overlapping)
+        def _read_cached(mc):
+            self.failUnlessEqual("".join(mc.chunks), plaintext[50:250])
+            cache = self.dn._segment_cache
+            # segments 1 and 2 were cached, 0 and 3 were not
+            self.failUnlessEqual((cache.hits, cache.misses), (2, 4))
+            self.block_requests = self._count_block_requests()
+            return self.n.read(MemoryConsumer(), 70, 200)
+        d.addCallback(_read_cached)
+        def _check(mc):
+            self.failUnlessEqual("".join(mc.chunks), plaintext[70:270])
+            cache = self.dn._segment_cache
+            self.failUnlessEqual((cache.hits, cache.misses), (6, 4))
+            # and the servers were not asked for anything
+            self.failUnlessEqual(self._count_block_requests(),
+                                 self.block_requests)
+        d.addCallback(_check)
+        return d
+
+    def test_metadata_cache(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        cache = DownloadMetadataCache(os.path.join(self.basedir,
+                                                   "metadata.sqlite"))
+        nm = self.c0.nodemaker
+        nm.download_parameters = nm.download_parameters.copy()
+        nm.download_parameters["metadata_cache"] = cache
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.cap = uri.from_string(ur.uri)
+            n = nm._create_immutable(self.cap)
+            return download_to_data(n, 150, 100)
+        d.addCallback(_uploaded)
+        def _read_again(data):
+            self.failUnlessEqual(data, plaintext[150:250])
+            self.failUnlessEqual((cache.hits, cache.misses), (0, 1))
+            (UEB_s, share_hashes, locations) = cache.get(
+                self.cap.get_storage_index())
+            self.failUnless(share_hashes)
+            self.failUnless(locations)
+            # a new node knows the segment size and share hash chains
+            # before it asks anybody for anything
+            n = nm._create_immutable(self.cap)
+            n._cnode._maybe_create_download_node()
+            self.dn = n._cnode._node
+            self.failUnless(self.dn.have_UEB)
+            self.failUnlessEqual(self.dn.segment_size, 72) # multiple of k
+            for shnums in locations.values():
+                for shnum in shnums:
+                    self.failIf(self.dn.share_hash_tree.needed_hashes(shnum))
+            self.failUnlessEqual(self.dn.get_cached_share_locations(),
+                                 locations)
+            return download_to_data(n, 150, 100)
+        d.addCallback(_read_again)
+        def _check(data):
+            self.failUnlessEqual(data, plaintext[150:250])
+            self.failUnlessEqual((cache.hits, cache.misses), (2, 1))
+            # so the first segment it asked for was the right one
+            ds = self.dn._download_status
+            segnums = [ev[1] for ev in ds.segment_events
+                       if ev[0] == "request"]
+            self.failUnlessEqual(segnums[0], 2)
+            self.failUnlessEqual(sorted(set(segnums)), [2, 3])
+        d.addCallback(_check)
+        return d
+
+    def test_metadata_cache_bad_entry(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.load_shares()
+        cache = DownloadMetadataCache(os.path.join(self.basedir,
+                                                   "metadata.sqlite"))
+        cap = uri.from_string(immutable_uri)
+        cache.add(cap.get_storage_index(), "not the UEB", {}, {})
+        nm = self.c0.nodemaker
+        nm.download_parameters = nm.download_parameters.copy()
+        nm.download_parameters["metadata_cache"] = cache
+        n = nm._create_immutable(cap)
+        d = download_to_data(n)
+        def _check(data):
+            self.failUnlessEqual(data, plaintext)
+            # the bad entry was ignored, and then replaced
+            (UEB_s, share_hashes, locations) = cache.get(
+                cap.get_storage_index())
+            self.failUnlessEqual(hashutil.uri_extension_hash(UEB_s),
+                                 cap.uri_extension_hash)
+        d.addCallback(_check)
+        return d
+
+    def test_workers(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        pool = WorkerPool(2)
+        pool.startService()
+        nm = self.c0.nodemaker
+        nm.download_parameters = nm.download_parameters.copy()
+        nm.download_parameters["worker_pool"] = pool
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.n = nm._create_immutable(uri.from_string(ur.uri))
+            return download_to_data(self.n)
+        d.addCallback(_uploaded)
+        def _read_part(data):
+            self.failUnlessEqual(data, plaintext)
+            return download_to_data(self.n, 100, 200)
+        d.addCallback(_read_part)
+        def _check(data):
+            self.failUnlessEqual(data, plaintext[100:300])
+            if pool.is_parallel():
+                stats = pool.get_stats()
+                self.failUnless(stats["worker_pool.jobs_finished"] > 0)
+                self.failUnlessEqual(stats["worker_pool.jobs_finished"],
+                                     stats["worker_pool.jobs_started"])
+        d.addCallback(_check)
+        def _stop(res):
+            pool.stopService()
+            return res
+        d.addBoth(_stop)
+        return d
+
     def test_download_segment_bad_ciphertext_hash(self):
         # The crypttext_hash_tree asserts the integrity of the decoded
         # ciphertext, and exists to detect two sorts of problems. The first
@@ -907,6 +1284,12 @@ class StoppingConsumer(PausingConsumer):
     def write(self, data):
         self.producer.stopProducing()
 
+class LateStoppingConsumer(MemoryConsumer):
+    def write(self, data):
+        MemoryConsumer.write(self, data)
+        if len(self.chunks) == 2:
+            self.producer.stopProducing()
+
 class ImmediatelyStoppingConsumer(MemoryConsumer):
     def registerProducer(self, p, streaming):
         MemoryConsumer.registerProducer(self, p, streaming)
@@ -1212,6 +1595,160 @@ class DownloadV2(_Base, unittest.TestCase):
         d.addCallback(_uploaded)
         return d
 
+class Caching(unittest.TestCase):
+    def test_segment_cache(self):
+        c = SegmentCache(100)
+        self.failUnlessEqual(c.get("si1", 0), None)
+        c.add("si1", 0, 0, "a"*40)
+        c.add("si1", 1, 40, "b"*40)
+        c.add("si2", 0, 0, "c"*10)
+        self.failUnlessEqual(c.get("si1", 0), (0, "a"*40))
+        self.failUnlessEqual(c.get("si1", 1), (40, "b"*40))
+        self.failUnlessEqual(c.get("si2", 1), None)
+        self.failUnlessEqual(c.bytes, 90)
+        # si2:0 is now the least recently used, so it makes room for si1:2
+        c.add("si1", 2, 80, "d"*20)
+        self.failUnlessEqual(c.bytes, 100)
+        self.failUnlessEqual(c.get("si2", 0), None)
+        self.failUnlessEqual(c.get("si1", 0), (0, "a"*40))
+        # too big to cache at all
+        c.add("si3", 0, 0, "e"*101)
+        self.failUnlessEqual(c.get("si3", 0), None)
+        stats = c.get_stats()
+        self.failUnlessEqual(stats["downloader.segment_cache.hits"], 3)
+        self.failUnlessEqual(stats["downloader.segment_cache.misses"], 4)
+        self.failUnlessEqual(stats["downloader.segment_cache.hit_rate"],
+                             3.0 / 7)
+        self.failUnlessEqual(stats["downloader.segment_cache.bytes"], 100)
+        self.failUnlessEqual(stats["downloader.segment_cache.entries"], 3)
+
+    def test_metadata_cache(self):
+        basedir = "download/Caching/metadata_cache"
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "metadata.sqlite")
+        c = DownloadMetadataCache(dbfile)
+        self.failUnlessEqual(c.get("si1"), None)
+        share_hashes = {0: "a"*32, 2: "b"*32}
+        locations = {"server1": set([0, 1]), "server2": set([2])}
+        c.add("si1", "UEB1", share_hashes, locations)
+        self.failUnlessEqual(c.get("si1"), ("UEB1", share_hashes, locations))
+        c.add("si1", "UEB1", share_hashes, {"server3": set([4])})
+        self.failUnlessEqual(c.get("si1"),
+                             ("UEB1", share_hashes, {"server3": set([4])}))
+        c.close()
+        # it survives a restart
+        c = DownloadMetadataCache(dbfile)
+        self.failUnlessEqual(c.get("si1")[0], "UEB1")
+        # and the oldest entries make room for new ones, a tenth of
+        # MAX_FILES at a time
+        c.MAX_FILES = 10
+        for i in range(2, 12):
+            c.add("si%d" % i, "UEB%d" % i, {}, {})
+        self.failUnlessEqual(c.get("si1"), None)
+        self.failUnlessEqual(c.get("si2"), None)
+        self.failUnlessEqual(c.get("si3"), ("UEB3", {}, {}))
+        self.failUnlessEqual(c.get("si11"), ("UEB11", {}, {}))
+        self.failUnlessEqual(c._num_files, 9)
+        stats = c.get_stats()
+        self.failUnlessEqual(stats["downloader.metadata_cache.hits"], 3)
+        self.failUnlessEqual(stats["downloader.metadata_cache.misses"], 2)
+        # entries that were not committed yet are saved when we stop
+        c.COMMIT_INTERVAL = 1000
+        c.add("si12", "UEB12", {}, {})
+        c.stopService()
+        c = DownloadMetadataCache(dbfile)
+        self.failUnlessEqual(c.get("si12"), ("UEB12", {}, {}))
+        c.close()
+
+class ManualPool:
+    """I am a WorkerPool whose jobs finish when the test says so, in any
+    order."""
+    def __init__(self):
+        self.jobs = []
+    def run(self, f, *args):
+        d = defer.Deferred()
+        self.jobs.append((d, f, args))
+        return d
+    def finish(self, i):
+        (d, f, args) = self.jobs.pop(i)
+        d.callback(f(*args))
+    def fail(self, i):
+        (d, f, args) = self.jobs.pop(i)
+        d.errback(WorkerError("boom"))
+
+class FakeProducer:
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+    def stopProducing(self):
+        self.stopped = True
+
+class PooledDecryption(unittest.TestCase):
+    def setUp(self):
+        self.key = "k"*16
+        self.plaintext = os.urandom(100)
+        self.ciphertext = AES(self.key).process(self.plaintext)
+        self.pool = ManualPool()
+        self.mc = MemoryConsumer()
+        self.dc = PooledDecryptingConsumer(self.mc, self.key, 10, self.pool)
+        self.producer = FakeProducer()
+        self.dc.registerProducer(self.producer, True)
+
+    def test_order(self):
+        self.failUnlessIdentical(self.mc.producer, self.dc)
+        for (start, end) in [(10, 40), (40, 70), (70, 100)]:
+            self.dc.write(self.ciphertext[start:end])
+        self.dc.unregisterProducer()
+        fired = []
+        self.dc.when_done("result").addCallback(fired.append)
+        # the later writes are decrypted first, but must wait
+        self.pool.finish(2)
+        self.pool.finish(1)
+        self.failUnlessEqual(self.mc.chunks, [])
+        self.pool.finish(0)
+        self.failUnlessEqual("".join(self.mc.chunks), self.plaintext[10:])
+        self.failUnlessEqual(len(self.mc.chunks), 3)
+        # unregisterProducer was held back until now
+        self.failUnless(self.mc.done)
+        self.failUnlessEqual(fired, ["result"])
+
+    def test_backlog(self):
+        self.dc.MAX_PENDING_BYTES = 50
+        self.dc.write(self.ciphertext[10:40])
+        self.failIf(self.producer.paused)
+        self.dc.write(self.ciphertext[40:70])
+        self.failUnless(self.producer.paused)
+        # the consumer pauses and resumes while we are backlogged
+        self.dc.pauseProducing()
+        self.dc.resumeProducing()
+        self.failUnless(self.producer.paused)
+        self.pool.finish(0)
+        self.failIf(self.producer.paused)
+        # but we don't resume a producer that the consumer has paused
+        self.dc.write(self.ciphertext[70:100])
+        self.failUnless(self.producer.paused)
+        self.dc.pauseProducing()
+        self.pool.finish(0)
+        self.failUnless(self.producer.paused)
+        self.dc.resumeProducing()
+        self.failIf(self.producer.paused)
+        self.pool.finish(0)
+        self.failUnlessEqual("".join(self.mc.chunks), self.plaintext[10:])
+
+    def test_failure(self):
+        self.dc.write(self.ciphertext[10:40])
+        self.dc.write(self.ciphertext[40:70])
+        self.pool.fail(1)
+        self.failUnless(self.producer.stopped)
+        self.pool.finish(0)
+        self.failUnlessEqual(self.mc.chunks, [])
+        d = self.dc.when_done("result")
+        return self.assertFailure(d, WorkerError)
+
 class Status(unittest.TestCase):
     def test_status(self):
         now = 12345.1
@@ -1288,8 +1825,12 @@ class MySegmentFetcher(SegmentFetcher):
     def __init__(self, *args, **kwargs):
         SegmentFetcher.__init__(self, *args, **kwargs)
         self._test_start_shares = []
+        self._test_hedge_checks = 0
     def _start_share(self, share, shnum):
         self._test_start_shares.append(share)
+    def _hedge_slow_requests(self):
+        self._test_hedge_checks += 1
+        SegmentFetcher._hedge_slow_requests(self)
 
 class FakeNode:
     def __init__(self):
@@ -1297,6 +1838,15 @@ class FakeNode:
         self.failed = None
         self.processed = None
         self._si_prefix = "si_prefix"
+        self._download_status = DownloadStatus("si", 1000)
+        self.latencies = {}
+        self.hedge_timeout = None
+    def add_block_latency(self, server, latency):
+        self.latencies[server] = latency
+    def get_server_latency(self, server):
+        return self.latencies.get(server)
+    def get_hedge_timeout(self):
+        return self.hedge_timeout
     def want_more_shares(self):
         self.want_more += 1
     def fetch_failed(self, fetcher, f):
@@ -1307,6 +1857,88 @@ class FakeNode:
         return 1, True
 
 class Selection(unittest.TestCase):
+    def test_prefer_fast_servers(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None)
+        shares = [MyShare(i, make_server("peer-%d" % i), i) for i in range(10)]
+        # the servers with the first three shares were slow to deliver
+        # blocks, although they answered their DYHB queries quickly
+        for sh in shares[:3]:
+            node.latencies[sh._server] = 50.0
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares[3:6])
+            sf.stop()
+        d.addCallback(_check)
+        return d
+
+    def test_hedge(self):
+        node = FakeNode()
+        node.hedge_timeout = 0.1
+        sf = MySegmentFetcher(node, 0, 3, None)
+        shares = [MyShare(i, make_server("peer-%d" % i), i) for i in range(4)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares[:3])
+            for sh in shares[:2]:
+                sf._block_request_activity(sh, sh._shnum, COMPLETE,
+                                           "block-%d" % sh._shnum)
+            d1 = defer.Deferred()
+            reactor.callLater(0.2, d1.callback, None)
+            d1.addCallback(flushEventualQueue)
+            return d1
+        d.addCallback(_check1)
+        def _check2(ign):
+            # the third request was too slow, so the fourth share was asked
+            self.failUnlessEqual(sf._test_start_shares, shares)
+            self.failUnlessEqual(node._download_status.hedges_issued, 1)
+            sf._block_request_activity(shares[3], 3, COMPLETE, "block-3")
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            self.failUnlessEqual(node.processed, (0, {0: "block-0",
+                                                      1: "block-1",
+                                                      3: "block-3"}) )
+            self.failUnlessEqual(node._download_status.hedges_won, 1)
+            # the slow server is remembered as being at least that slow
+            self.failUnless(node.latencies[shares[2]._server] >= 0.1)
+        d.addCallback(_check3)
+        return d
+
+    def test_no_hedge_without_spares(self):
+        node = FakeNode()
+        node.hedge_timeout = 0.0
+        sf = MySegmentFetcher(node, 0, 3, None)
+        shares = [MyShare(i, make_server("peer-%d" % i), i) for i in range(3)]
+        spare = MyShare(3, make_server("peer-3"), 3)
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _wait(ign):
+            d1 = defer.Deferred()
+            reactor.callLater(0.1, d1.callback, None)
+            d1.addCallback(flushEventualQueue)
+            return d1
+        d.addCallback(_wait)
+        def _check(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares)
+            self.failUnlessEqual(node._download_status.hedges_issued, 0)
+            # the overdue requests are not checked again and again while
+            # there is nobody else to ask
+            self.failUnless(sf._test_hedge_checks <= 3,
+                            sf._test_hedge_checks)
+            # but a new share gets the slow request hedged
+            sf.add_shares([spare])
+            return _wait(None)
+        d.addCallback(_check)
+        def _check_spare(ign):
+            self.failUnlessEqual(node._download_status.hedges_issued, 1)
+            self.failUnlessEqual(sf._test_start_shares, shares + [spare])
+            sf.stop()
+        d.addCallback(_check_spare)
+        return d
+
     def test_no_shares(self):
         node = FakeNode()
         sf = SegmentFetcher(node, 0, 3, None)
@@ -351,6 +351,91 @@ class Encode(unittest.TestCase):
         # 5 segments: 25, 25, 25, 25, 1
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
+    def _upload_done(self, res):
+        # upload_d.called is set as soon as start() returns, so remember
+        # when its callback chain has actually finished
+        self.upload_finished = True
+        return res
+
+    def do_lookahead(self, lookahead, expected_encoded):
+        # the encoder should read and encode up to 'lookahead' segments
+        # beyond the one whose blocks the shareholders have not yet accepted
+        data = make_data(125)
+        e = encode.Encoder(lookahead_segments=lookahead)
+        u = upload.Data(data, convergence="some convergence string")
+        u.max_segment_size = 25
+        u.encoding_param_k = 25
+        u.encoding_param_happy = 75
+        u.encoding_param_n = 100
+        eu = upload.EncryptAnUploadable(u)
+        d = e.set_encrypted_uploadable(eu)
+        self.upload_finished = False
+
+        held = []
+        class SlowShareholder(FakeBucketReaderWriterProxy):
+            def put_block(self, segmentnum, data):
+                d = defer.Deferred()
+                d.addCallback(lambda ign:
+                    FakeBucketReaderWriterProxy.put_block(self, segmentnum,
+                                                          data))
+                held.append(d)
+                return d
+        all_shareholders = []
+        def _ready(res):
+            shareholders = {}
+            servermap = {}
+            for shnum in range(100):
+                peer = SlowShareholder()
+                shareholders[shnum] = peer
+                servermap.setdefault(shnum, set()).add(peer.get_peerid())
+                all_shareholders.append(peer)
+            e.set_shareholders(shareholders, servermap)
+            self.upload_d = e.start()
+            self.upload_d.addBoth(self._upload_done)
+        d.addCallback(_ready)
+        for i in range(20):
+            d.addCallback(fireEventually)
+        def _stalled(res):
+            # only the first segment has been sent
+            self.failUnlessEqual(len(held), 100)
+            self.failUnlessEqual(len(e._crypttext_hashes), expected_encoded)
+            # now let everything through
+            def _release():
+                while held:
+                    held.pop(0).callback(None)
+                return fireEventually()
+            def _loop(res):
+                if self.upload_finished:
+                    return self.upload_d
+                d2 = _release()
+                d2.addCallback(_loop)
+                return d2
+            return _loop(None)
+        d.addCallback(_stalled)
+        def _check(verifycap):
+            self.failUnless(isinstance(verifycap.uri_extension_hash, str))
+            for peer in all_shareholders:
+                self.failUnless(peer.closed)
+                self.failUnlessEqual(len(peer.blocks), 5)
+            times = e.get_times()
+            for name in ["cumulative_reading", "cumulative_encoding",
+                         "cumulative_sending", "cumulative_encode_wait"]:
+                self.failUnless(name in times, name)
+        d.addCallback(_check)
+        return d
+
+    def test_lookahead(self):
+        return self.do_lookahead(2, 3)
+
+    def test_no_lookahead(self):
+        return self.do_lookahead(0, 1)
+
+    def test_lookahead_memory_limit(self):
+        self.patch(encode.Encoder, "LOOKAHEAD_MEMORY", 100)
+        # each segment encodes into 100 one-byte blocks, so the memory limit
+        # allows one segment of look-ahead
+        return self.do_lookahead(2, 2)
+
 
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
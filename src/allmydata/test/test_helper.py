@@ -1,6 +1,7 @@
 import os
 from twisted.trial import unittest
 from twisted.application import service
+from twisted.internet import defer
 
 from foolscap.api import Tub, fireEventually, flushEventualQueue
 
@@ -37,6 +38,36 @@ class CHKUploadHelper_fake(offloaded.CHKUploadHelper):
         d.addCallback(_got_size)
         return d
 
+class CHKUploadHelper_reader(CHKUploadHelper_fake):
+    # I read all of the ciphertext in pieces, like the Encoder would, but
+    # don't encode it. I leave what I read, and how much of the ciphertext
+    # had arrived when I first got some of it, in my Helper.
+    READ_SIZE = 2000
+
+    def start_encrypted(self, eu):
+        d = eu.get_size()
+        def _got_size(size):
+            self._ciphertext = []
+            return self._read(eu, size)
+        d.addCallback(_got_size)
+        d.addCallback(lambda ign:
+                      CHKUploadHelper_fake.start_encrypted(self, eu))
+        return d
+
+    def _read(self, eu, size):
+        if len("".join(self._ciphertext)) >= size:
+            self._helper.read_ciphertext = "".join(self._ciphertext)
+            return
+        d = eu.read_encrypted(self.READ_SIZE, False)
+        def _got(data):
+            if not self._ciphertext:
+                self._helper.progress_at_first_read = \
+                    self._helper.get_upload_progress()
+            self._ciphertext.extend(data)
+            return self._read(eu, size)
+        d.addCallback(_got)
+        return d
+
 class CHKUploadHelper_already_uploaded(offloaded.CHKUploadHelper):
     def start(self):
         res = upload.UploadResults()
@@ -144,6 +175,111 @@ class AssistedUpload(unittest.TestCase):
 
         return d
 
+    def _watch_fetches(self):
+        # record the number of outstanding requests, and how far ahead of
+        # the encoder they reach, every time the fetcher sends some
+        self.patch(offloaded.CHKCiphertextFetcher, "CHUNK_SIZE", 1000)
+        self.outstanding = []
+        self.ahead = []
+        original_fill = offloaded.CHKCiphertextFetcher._fill
+        def _fill(fetcher):
+            original_fill(fetcher)
+            if fetcher._requests:
+                self.outstanding.append(len(fetcher._requests))
+                self.ahead.append(fetcher._requested - fetcher._consumed)
+        self.patch(offloaded.CHKCiphertextFetcher, "_fill", _fill)
+
+    def _upload_and_check_empty(self, convergence):
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        d = wait_a_few_turns()
+        d.addCallback(lambda res: upload_data(u, DATA, convergence))
+        def _uploaded(results):
+            self.failUnless("CHK" in results.uri, results.uri)
+            for dirname in ("CHK_encoding", "CHK_incoming"):
+                files = os.listdir(os.path.join(self.basedir, dirname))
+                self.failUnlessEqual(files, [])
+            self.failUnlessEqual(self.helper.get_upload_progress(), [])
+        d.addCallback(_uploaded)
+        return d
+
+    def test_pipelined(self):
+        self.basedir = "helper/AssistedUpload/test_pipelined"
+        self.setUpHelper(self.basedir)
+        self._watch_fetches()
+        d = self._upload_and_check_empty("some convergence string")
+        def _check(res):
+            self.failUnlessEqual(max(self.outstanding), 4)
+            self.failUnlessEqual(self.helper.get_stats()["chk_upload_helper.fetched_bytes"],
+                                 len(DATA))
+        d.addCallback(_check)
+        return d
+
+    def test_old_client_not_pipelined(self):
+        self.basedir = "helper/AssistedUpload/test_old_client_not_pipelined"
+        self.setUpHelper(self.basedir)
+        self._watch_fetches()
+        def remote_get_version(reu):
+            # older clients don't have this method at all
+            raise AttributeError("remote_get_version")
+        self.patch(upload.RemoteEncryptedUploadable, "remote_get_version",
+                   remote_get_version)
+        d = self._upload_and_check_empty("some convergence string")
+        def _check(res):
+            self.failUnlessEqual(max(self.outstanding), 1)
+            self.failUnlessEqual(self.helper.get_stats()["chk_upload_helper.fetched_bytes"],
+                                 len(DATA))
+        d.addCallback(_check)
+        return d
+
+    def test_encode_early(self):
+        self.basedir = "helper/AssistedUpload/test_encode_early"
+        self.setUpHelper(self.basedir)
+        self.helper.chk_upload_helper_class = CHKUploadHelper_reader
+        self.helper.encode_while_fetching = True
+        self.helper.fetch_ahead = 3000
+        self._watch_fetches()
+
+        d = self._upload_and_check_empty("test convergence string")
+        def _check(res):
+            k = FakeClient.DEFAULT_ENCODING_PARAMETERS["k"]
+            n = FakeClient.DEFAULT_ENCODING_PARAMETERS["n"]
+            segsize = mathutil.next_multiple(len(DATA), k)
+            key = hashutil.convergence_hash(k, n, segsize, DATA,
+                                            "test convergence string")
+            self.failUnlessEqual(self.helper.read_ciphertext,
+                                 AES(key).process(DATA))
+            # the encoder started reading before the fetch was finished, and
+            # the fetch did not get too far ahead of it
+            [(SI, size, fetched, encoded)] = self.helper.progress_at_first_read
+            self.failUnlessEqual(SI, hashutil.storage_index_hash(key))
+            self.failUnlessEqual(size, len(DATA))
+            self.failUnless(fetched < len(DATA), fetched)
+            self.failUnlessEqual(encoded, CHKUploadHelper_reader.READ_SIZE)
+            self.failUnless(max(self.ahead) <= 3000+1000, self.ahead)
+        d.addCallback(_check)
+        return d
+
+    def test_queued(self):
+        self.basedir = "helper/AssistedUpload/test_queued"
+        self.setUpHelper(self.basedir)
+        self.helper._max_active_uploads = 1
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        d = wait_a_few_turns()
+        def _ready(res):
+            return defer.gatherResults([upload_data(u, DATA, "one"),
+                                        upload_data(u, DATA, "two")])
+        d.addCallback(_ready)
+        def _uploaded(results):
+            self.failUnlessEqual(len(results), 2)
+            stats = self.helper.get_stats()
+            self.failUnlessEqual(stats["chk_upload_helper.upload_queued"], 1)
+            self.failUnlessEqual(stats["chk_upload_helper.queued_uploads"], 0)
+            self.failUnlessEqual(stats["chk_upload_helper.running_uploads"], 0)
+        d.addCallback(_uploaded)
+        return d
+
     def test_previous_upload_failed(self):
         self.basedir = "helper/AssistedUpload/test_previous_upload_failed"
         self.setUpHelper(self.basedir)
@@ -221,3 +357,119 @@ class AssistedUpload(unittest.TestCase):
         d.addCallback(_check_empty)
 
         return d
+
+
+class FakeUploadHelper:
+    def __init__(self, helper, name, size=0):
+        self._storage_index = hashutil.tagged_hash("test", name)[:16]
+        self._size = size
+        self.fetched = 0
+        self.admitted = False
+        helper._active_uploads[self._storage_index] = self
+
+    def admit(self):
+        self.admitted = True
+
+    def get_progress(self):
+        return (self._size, self.fetched, 0)
+
+    def get_upload_status(self):
+        return upload.UploadStatus()
+
+class FakeReader:
+    def __init__(self, tubid, size=0):
+        self._tubid = tubid
+        self._size = size
+
+    def getRemoteTubID(self):
+        return self._tubid
+
+    def callRemote(self, methname):
+        assert methname == "get_size"
+        return defer.succeed(self._size)
+
+class Scheduling(unittest.TestCase):
+    def make_helper(self, basedir, **kwargs):
+        fileutil.make_dirs(basedir)
+        return offloaded.Helper(basedir, None, None, None, None, **kwargs)
+
+    def request(self, helper, name, client, size=0):
+        uh = FakeUploadHelper(helper, name, size)
+        helper.request_admission(uh, FakeReader(client, size))
+        return uh
+
+    def test_max_active_uploads(self):
+        h = self.make_helper("helper/Scheduling/test_max_active_uploads",
+                             max_active_uploads=1)
+        a1 = self.request(h, "a1", "alice")
+        a2 = self.request(h, "a2", "alice")
+        a3 = self.request(h, "a3", "alice")
+        b1 = self.request(h, "b1", "bob")
+        self.failUnlessEqual([uh.admitted for uh in (a1, a2, a3, b1)],
+                             [True, False, False, False])
+        stats = h.get_stats()
+        self.failUnlessEqual(stats["chk_upload_helper.active_uploads"], 4)
+        self.failUnlessEqual(stats["chk_upload_helper.running_uploads"], 1)
+        self.failUnlessEqual(stats["chk_upload_helper.queued_uploads"], 3)
+        self.failUnlessEqual(stats["chk_upload_helper.upload_queued"], 3)
+        self.failUnless(stats["chk_upload_helper.queue_wait_longest"] >= 0)
+
+        # alice was waiting first, but once she has had a turn, bob gets his
+        # before her third upload
+        h.upload_finished(a1._storage_index, 0)
+        self.failUnless(a2.admitted)
+        self.failIf(a3.admitted or b1.admitted)
+        h.upload_finished(a2._storage_index, 0)
+        self.failUnless(b1.admitted)
+        self.failIf(a3.admitted)
+        h.upload_finished(b1._storage_index, 0)
+        self.failUnless(a3.admitted)
+        h.upload_finished(a3._storage_index, 0)
+        stats = h.get_stats()
+        self.failUnlessEqual(stats["chk_upload_helper.running_uploads"], 0)
+        self.failUnlessEqual(stats["chk_upload_helper.queued_uploads"], 0)
+
+    def test_unlimited(self):
+        h = self.make_helper("helper/Scheduling/test_unlimited")
+        uploads = [self.request(h, "u%d" % i, "alice") for i in range(10)]
+        self.failUnlessEqual([uh.admitted for uh in uploads], [True]*10)
+        self.failUnlessEqual(h.get_stats()["chk_upload_helper.upload_queued"],
+                             0)
+
+    def test_max_disk_usage(self):
+        basedir = "helper/Scheduling/test_max_disk_usage"
+        h = self.make_helper(basedir, max_disk_usage=1000)
+        a1 = self.request(h, "a1", "alice", 600)
+        self.failUnless(a1.admitted)
+        # a1 will need another 600 bytes, so this one has to wait
+        b1 = self.request(h, "b1", "bob", 500)
+        self.failIf(b1.admitted)
+        # and the queue is not jumped by something smaller
+        c1 = self.request(h, "c1", "carol", 100)
+        self.failIf(c1.admitted)
+
+        # the ciphertext that a1 has fetched so far is on disk
+        a1.fetched = 300
+        f = open(os.path.join(basedir, "CHK_incoming",
+                              si_b2a(a1._storage_index)), "wb")
+        f.write("a" * 300)
+        f.close()
+        h._admit_uploads()
+        self.failIf(b1.admitted)
+
+        h.upload_finished(a1._storage_index, 600)
+        os.unlink(os.path.join(basedir, "CHK_incoming",
+                               si_b2a(a1._storage_index)))
+        h._admit_uploads()
+        self.failUnless(b1.admitted)
+        self.failUnless(c1.admitted)
+
+    def test_bigger_than_max_disk_usage(self):
+        h = self.make_helper("helper/Scheduling/test_bigger_than_max_disk_usage",
+                             max_disk_usage=1000)
+        a1 = self.request(h, "a1", "alice", 5000)
+        self.failUnless(a1.admitted)
+        b1 = self.request(h, "b1", "bob", 10)
+        self.failIf(b1.admitted)
+        h.upload_finished(a1._storage_index, 5000)
+        self.failUnless(b1.admitted)
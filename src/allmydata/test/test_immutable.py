@@ -6,7 +6,7 @@ from twisted.internet import defer
 from twisted.trial import unittest
 import random
 
-from foolscap.api import eventually
+from foolscap.api import eventually, flushEventualQueue
 from allmydata.util import log
 
 from allmydata.immutable.downloader import finder
@@ -27,11 +27,14 @@ class MockNode(object):
         self.share_hash_tree = mock.Mock()
         self.share_hash_tree.needed_hashes.return_value = False
         self.on_want_more_shares = None
+        self.cached_locations = {}
 
     def when_finished(self):
         return self.finished_d
     def get_num_segments(self):
         return (5, True)
+    def get_cached_share_locations(self):
+        return self.cached_locations
     def _calculate_sizes(self, guessed_segment_size):
         return {'block_size': 4, 'num_segments': 5}
     def no_more_shares(self):
@@ -129,6 +132,41 @@ class TestShareFinder(unittest.TestCase):
 
         return mocknode.when_finished()
 
+    def test_ask_cached_locations_first(self):
+        rcap = uri.CHKFileURI('a'*32, 'a'*32, 3, 99, 100)
+        vcap = rcap.get_verify_cap()
+        asked = []
+        class MockIServer(object):
+            def __init__(self, serverid):
+                self.serverid = serverid
+                self.version = {
+                    'http://allmydata.org/tahoe/protocols/storage/v1': {}
+                    }
+            def get_serverid(self):
+                return self.serverid
+            def get_rref(self):
+                return self
+            def name(self):
+                return "name-%s" % self.serverid
+            def callRemote(self, methname, *args, **kwargs):
+                asked.append(self.serverid)
+                return defer.Deferred() # never answers
+        servers = [MockIServer("ms%d" % i) for i in range(4)]
+        mockstoragebroker = mock.Mock()
+        mockstoragebroker.get_servers_for_psi.return_value = servers
+        mocknode = MockNode(check_reneging=False, check_fetch_failed=False)
+        # these servers had shares the last time this file was downloaded
+        mocknode.cached_locations = {"ms3": set([0]), "ms1": set([1, 2])}
+
+        s = finder.ShareFinder(mockstoragebroker, vcap, mocknode, mock.Mock())
+        s.hungry()
+        d = flushEventualQueue()
+        def _check(ign):
+            s.stop()
+            self.failUnlessEqual(asked, ["ms1", "ms3", "ms0", "ms2"])
+        d.addCallback(_check)
+        return d
+
 class Test(common.ShareManglingMixin, common.ShouldFailMixin, unittest.TestCase):
     def test_test_code(self):
         # The following process of stashing the shares, running
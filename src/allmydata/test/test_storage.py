@@ -8,22 +8,29 @@ from twisted.internet import defer
 from twisted.application import service
 from foolscap.api import fireEventually
 import itertools
+from StringIO import StringIO
 from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
+from allmydata.storage.shareindex import ShareIndex
+from allmydata.storage.sharemaps import ShareMapCache
+from allmydata.storage.readcache import ReadCache
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_b2a
 from allmydata.storage.lease import LeaseInfo
-from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.crawler import BucketCountingCrawler, TimeSliceExceeded
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     examine_prefixdir, _get_multiprocessing
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.interfaces import BadWriteEnablerError
 from allmydata.test.common import LoggingServiceParent
 from allmydata.test.common_web import WebRenderingMixin
 from allmydata.web.storage import StorageStatus, remove_prefix
+from allmydata.scripts import debug
 
 class Marker:
     pass
@@ -97,6 +104,61 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_readv(self):
+        incoming, final = self.make_workdir("test_readv")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        bw.remote_write(50, "c"*7)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_readv([(25, 25), (0, 5), (50, 7)]),
+                             ["b"*25, "a"*5, "c"*7])
+        self.failUnlessEqual(br.remote_readv([]), [])
+
+    def test_writev(self):
+        incoming, final = self.make_workdir("test_writev")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.remote_writev([(25, "b"*25), (0, "a"*25)])
+        bw.remote_writev([])
+        bw.remote_write(50, "c"*7)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_read(0, 57), "a"*25 + "b"*25 + "c"*7)
+
+    def test_fsync_on_close(self):
+        incoming, final = self.make_workdir("test_fsync_on_close")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary(), fsync_policy="close")
+        synced = []
+        original_sync = bw.sync
+        def sync():
+            synced.append(os.path.exists(incoming))
+            original_sync()
+        bw.sync = sync
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        self.failUnlessEqual(synced, [])
+        bw.remote_close()
+        # the share is synced before it is moved into place
+        self.failUnlessEqual(synced, [True])
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_read(0, 50), "a"*25 + "b"*25)
+
+    def test_abort_closes_file(self):
+        incoming, final = self.make_workdir("test_abort_closes_file")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*25)
+        bw.remote_abort()
+        self.failIf(os.path.exists(incoming))
+        self.failUnlessEqual(bw._f, None)
+
 class RemoteBucket:
 
     def callRemote(self, methname, *args, **kwargs):
@@ -228,6 +290,41 @@ class BucketProxy(unittest.TestCase):
         return self._do_test_readwrite("test_readwrite_v2",
                                        0x44, WriteBucketProxy_v2, ReadBucketProxy)
 
+    def test_readwrite_writev(self):
+        class WritevProxy(WriteBucketProxy):
+            def __init__(self, *args, **kwargs):
+                kwargs["use_writev"] = True
+                WriteBucketProxy.__init__(self, *args, **kwargs)
+        return self._do_test_readwrite("test_readwrite_writev",
+                                       0x24, WritevProxy, ReadBucketProxy)
+
+    def test_writev_never_holds_blocks(self):
+        bw, rb, sharefname = self.make_bucket("test_writev_never_holds_blocks",
+                                              1000)
+        calls = []
+        original_callRemote = rb.callRemote
+        def callRemote(methname, *args, **kwargs):
+            calls.append((methname, args))
+            return original_callRemote(methname, *args, **kwargs)
+        rb.callRemote = callRemote
+        bp = WriteBucketProxy(rb, data_size=50, block_size=25,
+                              num_segments=2, num_share_hashes=3,
+                              uri_extension_size_max=100, nodeid=None,
+                              use_writev=True)
+        d = bp.put_header()
+        # the header is small, so it waits for the first block
+        d.addCallback(lambda ign: self.failUnlessEqual(calls, []))
+        d.addCallback(lambda ign: bp.put_block(0, "a"*25))
+        def _check_first_block(ign):
+            self.failUnlessEqual(calls, [("writev", ([(0, bp._offset_data),
+                                                      (0x24, "a"*25)],))])
+            del calls[:]
+        d.addCallback(_check_first_block)
+        d.addCallback(lambda ign: bp.put_block(1, "b"*25))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(calls, [("write", (0x24+25, "b"*25))]))
+        return d
+
 class Server(unittest.TestCase):
 
     def setUp(self):
@@ -391,6 +488,42 @@ class Server(unittest.TestCase):
         for i,wb in writers.items():
             wb.remote_abort()
 
+    def test_upload_batches(self):
+        ss = self.create("test_upload_batches")
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1["supports-upload-batches"])
+        requests = []
+        for si in ["si1", "si2"]:
+            renew_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+            cancel_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+            requests.append((si, renew_secret, cancel_secret, set([0,1]), 25))
+        results = ss.remote_allocate_buckets_many(requests, FakeCanary())
+        self.failUnlessEqual(len(results), 2)
+        buckets = []
+        for (already, writers) in results:
+            self.failUnlessEqual(already, set())
+            self.failUnlessEqual(set(writers.keys()), set([0,1]))
+            buckets.extend([writers[0], writers[1]])
+        writes = [(bw, [(0, "%10d" % i), (10, "%15d" % i)])
+                  for (i, bw) in enumerate(buckets)]
+        self.failUnlessEqual(ss.remote_writev_many(writes), [None] * 4)
+        self.failUnlessEqual(ss.remote_close_many(buckets), [None] * 4)
+        b = ss.remote_get_buckets("si2")
+        self.failUnlessEqual(b[1].remote_read(0, 25), "%10d%15d" % (3, 3))
+
+        # each request of a batch succeeds or fails on its own: a closed
+        # bucket is refused, and doesn't stop the writes to the others
+        already, writers = self.allocate(ss, "si3", [0], 10)
+        results = ss.remote_writev_many([(buckets[0], [(0, "x")]),
+                                         (writers[0], [(0, "%10d" % 0)])])
+        self.failUnlessEqual(results[1], None)
+        self.failUnlessIn("not an open bucket", results[0])
+        results = ss.remote_close_many([writers[0], writers[0]])
+        self.failUnlessEqual(results[0], None)
+        self.failUnlessIn("not an open bucket", results[1])
+        b = ss.remote_get_buckets("si3")
+        self.failUnlessEqual(b[0].remote_read(0, 10), "%10d" % 0)
+
     def test_bad_container_version(self):
         ss = self.create("test_bad_container_version")
         a,w = self.allocate(ss, "si1", [0], 10)
@@ -638,6 +771,115 @@ class Server(unittest.TestCase):
         leases = list(ss.get_leases("si3"))
         self.failUnlessEqual(len(leases), 2)
 
+    def test_add_leases(self):
+        ss = self.create("test_add_leases")
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1["supports-add-leases"])
+        canary = FakeCanary()
+        for si in ["si0", "si1"]:
+            already,writers = ss.remote_allocate_buckets(si, "\x00"*32,
+                                                         "\x01"*32,
+                                                         [0,1], 100, canary)
+            for wb in writers.values():
+                wb.remote_close()
+
+        rs = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        cs = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        results = ss.remote_add_leases([("si0", rs, cs),
+                                        ("si1", rs, cs),
+                                        ("si18", rs, cs)])
+        # missing storage indices are ignored, as with add_lease
+        self.failUnlessEqual(results, [None, None, None])
+        self.failUnlessEqual(len(list(ss.get_leases("si0"))), 2)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+
+        # a problem with one lease does not affect the others
+        original_add_lease = ss.remote_add_lease
+        def add_lease(storage_index, *args):
+            if storage_index == "si0":
+                raise KeyError("intentional failure")
+            return original_add_lease(storage_index, *args)
+        ss.remote_add_lease = add_lease
+        rs2 = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        results = ss.remote_add_leases([("si0", rs2, cs), ("si1", rs2, cs)])
+        self.failUnlessEqual(results,
+                             ["KeyError: 'intentional failure'", None])
+        self.failUnlessEqual(len(list(ss.get_leases("si0"))), 2)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 3)
+
+    def test_get_many_buckets(self):
+        ss = self.create("test_get_many_buckets")
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1["supports-get-many-buckets"])
+        already,writers = self.allocate(ss, "si0", [0,1], 100)
+        for wb in writers.values():
+            wb.remote_close()
+        already,writers = self.allocate(ss, "si1", [2], 100)
+        for wb in writers.values():
+            wb.remote_close()
+
+        results = ss.remote_get_many_buckets(["si1", "si2", "si0"])
+        self.failUnlessEqual(len(results), 3)
+        self.failUnlessEqual(results[0].keys(), [2])
+        self.failUnlessEqual(results[1], {})
+        self.failUnlessEqual(sorted(results[2].keys()), [0,1])
+        self.failUnlessEqual(ss.remote_get_many_buckets([]), [])
+
+    def test_group_commit(self):
+        workdir = self.workdir("test_group_commit")
+        counts = {}
+        class RecordingStatsProvider(FakeStatsProvider):
+            def count(self, name, delta=1):
+                counts[name] = counts.get(name, 0) + delta
+        ss = StorageServer(workdir, "\x00" * 20, fsync_policy=100,
+                           stats_provider=RecordingStatsProvider())
+        ss.setServiceParent(self.sparent)
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1["supports-immutable-writev"])
+
+        already,writers = self.allocate(ss, "si0", [0,1], 200)
+        writers[0].remote_write(0, "a"*60)
+        self.failIf("storage_server.group-commit" in counts, counts)
+        # the second uploader pushes us over the limit, so both open shares
+        # are synced together
+        writers[1].remote_writev([(0, "b"*30), (30, "c"*30)])
+        self.failUnlessEqual(counts["storage_server.group-commit"], 1)
+        self.failUnlessEqual(counts["storage_server.fsync"], 2)
+        self.failUnlessEqual(ss._unsynced_bytes, 0)
+
+        writers[0].remote_close()
+        writers[1].remote_write(60, "d"*100)
+        self.failUnlessEqual(counts["storage_server.group-commit"], 2)
+        self.failUnlessEqual(counts["storage_server.fsync"], 3)
+        writers[1].remote_close()
+
+        b = ss.remote_get_buckets("si0")
+        self.failUnlessEqual(b[1].remote_read(0, 160),
+                             "b"*30 + "c"*30 + "d"*100)
+
+        # a share smaller than the group commit threshold is synced when it
+        # is closed, along with the other shares that have unsynced data
+        already,writers = self.allocate(ss, "si1", [0,1,2], 200)
+        writers[0].remote_write(0, "e"*10)
+        writers[1].remote_write(0, "f"*10)
+        self.failUnlessEqual(counts["storage_server.group-commit"], 2)
+        synced = []
+        for bw in writers.values():
+            original_sync = bw.sync
+            def sync(bw=bw, original_sync=original_sync):
+                synced.append(os.path.exists(bw.incominghome))
+                original_sync()
+            bw.sync = sync
+        writers[0].remote_close()
+        self.failUnlessEqual(synced, [True, True])
+        self.failUnlessEqual(counts["storage_server.group-commit"], 3)
+        self.failUnlessEqual(counts["storage_server.fsync"], 5)
+        self.failUnlessEqual(ss._unsynced_bytes, 0)
+        # nothing is left to sync when the other one closes
+        writers[1].remote_close()
+        self.failUnlessEqual(counts["storage_server.group-commit"], 3)
+        writers[2].remote_abort()
+
     def test_readonly(self):
         workdir = self.workdir("test_readonly")
         ss = StorageServer(workdir, "\x00" * 20, readonly_storage=True)
@@ -1287,6 +1529,611 @@ class MutableServer(unittest.TestCase):
         self.failUnless(os.path.exists(prefixdir), prefixdir)
         self.failIf(os.path.exists(bucketdir), bucketdir)
 
+class ShareIndexing(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ShareIndexing", name)
+        return basedir
+
+    def create(self, name, share_index_enabled=True, rebuild=False):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20,
+                           stats_provider=FakeStatsProvider(),
+                           share_index_enabled=share_index_enabled,
+                           share_index_rebuild=rebuild)
+        if ss.share_index_crawler:
+            ss.share_index_crawler.slow_start = 0
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def create_indexed(self, name, rebuild=False):
+        ss = self.create(name, rebuild=rebuild)
+        d = self.poll(ss.share_index.is_complete)
+        d.addCallback(lambda ign: ss)
+        return d
+
+    def secrets(self):
+        return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        rs, cs = self.secrets()
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for i,wb in writers.items():
+            wb.remote_write(0, "%10d" % i)
+            wb.remote_close()
+        return rs, cs
+
+    def test_index(self):
+        basedir = self.workdir("test_index")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "share_index.sqlite")
+        si = ShareIndex(dbfile)
+        self.failUnless(si.was_reset)
+        self.failIf(si.is_complete())
+        # nothing is authoritative until its prefix has been walked
+        self.failUnlessEqual(si.get_shares("si1"), None)
+        si.add_share("si1", 0, "immutable", 100, 1, 12345)
+        self.failUnlessEqual(si.get_shares("si1"), None)
+        si.mark_prefix_indexed(si_b2a("si1")[:2])
+        self.failUnlessEqual(si.get_shares("si1"),
+                             {0: ("immutable", 100, 1, 12345)})
+        si.set_bucket("si1", {3: ("mutable", 200, 2, 23456)})
+        self.failUnlessEqual(si.get_shares("si1"),
+                             {3: ("mutable", 200, 2, 23456)})
+        si.remove_share("si1", 3)
+        self.failUnlessEqual(si.get_shares("si1"), {})
+        si.add_share("si1", 4, "immutable", 100, 1, 12345)
+        si.close()
+
+        # a clean shutdown preserves the index
+        si = ShareIndex(dbfile)
+        self.failIf(si.was_reset)
+        self.failUnlessEqual(si.get_shares("si1"),
+                             {4: ("immutable", 100, 1, 12345)})
+        # but if we crash, it must be rebuilt
+        del si
+        si = ShareIndex(dbfile)
+        self.failUnless(si.was_reset)
+        self.failUnlessEqual(si.get_shares("si1"), None)
+        self.failUnlessEqual(si.get_num_indexed_prefixes(), 0)
+        si.close()
+
+        # junk is replaced with a new index
+        fileutil.write(dbfile, "not a database" * 100)
+        si = ShareIndex(dbfile)
+        self.failUnless(si.was_reset)
+        si.close()
+
+    def test_maintained(self):
+        d = self.create_indexed("test_maintained")
+        def _indexed(ss):
+            self.failUnlessEqual(ss.share_index.get_shares("si1"), {})
+            rs, cs = self.allocate(ss, "si1", [0,1,2], 75)
+            shares = ss.share_index.get_shares("si1")
+            self.failUnlessEqual(sorted(shares.keys()), [0,1,2])
+            (sharetype, size, num_leases, expiration_time) = shares[0]
+            self.failUnlessEqual(sharetype, "immutable")
+            self.failUnlessEqual(size, 0x0c + 75 + ShareFile.LEASE_SIZE)
+            self.failUnlessEqual(num_leases, 1)
+
+            # the read paths no longer need to list the bucket directory
+            listed = []
+            orig_listdir = os.listdir
+            def _listdir(path):
+                listed.append(path)
+                return orig_listdir(path)
+            os.listdir = _listdir
+            try:
+                readers = ss.remote_get_buckets("si1")
+                missing = ss.remote_get_buckets("si2")
+            finally:
+                os.listdir = orig_listdir
+            self.failUnlessEqual(listed, [])
+            self.failUnlessEqual(sorted(readers.keys()), [0,1,2])
+            self.failUnlessEqual(readers[1].remote_read(0, 10), "%10d" % 1)
+            self.failUnlessEqual(missing, {})
+
+            # lease changes are reflected in the summary
+            rs2, cs2 = self.secrets()
+            ss.remote_add_lease("si1", rs2, cs2)
+            shares = ss.share_index.get_shares("si1")
+            self.failUnlessEqual(shares[2][2], 2)
+            ss.remote_cancel_lease("si1", cs)
+            shares = ss.share_index.get_shares("si1")
+            self.failUnlessEqual(shares[2][2], 1)
+            ss.remote_cancel_lease("si1", cs2)
+            self.failUnlessEqual(ss.share_index.get_shares("si1"), {})
+            self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+
+            # aborted uploads leave nothing behind
+            rs3, cs3 = self.secrets()
+            already, writers = ss.remote_allocate_buckets("si3", rs3, cs3,
+                                                          [0], 75,
+                                                          FakeCanary())
+            writers[0].remote_abort()
+            self.failUnlessEqual(ss.share_index.get_shares("si3"), {})
+
+            # mutable shares too
+            secrets = (hashutil.tagged_hash("we", "1"),) + self.secrets()
+            write = ss.remote_slot_testv_and_readv_and_writev
+            rc = write("si4", secrets, {0: ([], [(0,"data")], None)}, [])
+            self.failUnlessEqual(rc, (True, {}))
+            shares = ss.share_index.get_shares("si4")
+            self.failUnlessEqual(shares.keys(), [0])
+            self.failUnlessEqual(shares[0][0], "mutable")
+            self.failUnlessEqual(ss.remote_slot_readv("si4", [], [(0,4)]),
+                                 {0: ["data"]})
+            rc = write("si4", secrets, {0: ([], [], 0)}, [])
+            self.failUnlessEqual(ss.share_index.get_shares("si4"), {})
+
+            # shares which are deleted behind our back are noticed
+            self.allocate(ss, "si5", [0,1], 75)
+            sharedir = os.path.join(ss.sharedir, storage_index_to_dir("si5"))
+            os.unlink(os.path.join(sharedir, "0"))
+            self.failUnlessEqual(ss.remote_get_buckets("si5").keys(), [1])
+            self.failUnlessEqual(ss.share_index.get_shares("si5").keys(), [1])
+        d.addCallback(_indexed)
+        return d
+
+    def test_rebuild(self):
+        ss = self.create("test_rebuild", share_index_enabled=False)
+        self.allocate(ss, "si1", [0,1,2], 75)
+        self.allocate(ss, "si2", [5], 75)
+        d = defer.maybeDeferred(ss.disownServiceParent)
+        d.addCallback(lambda ign: self.create_indexed("test_rebuild"))
+        def _indexed(ss):
+            self.failUnlessEqual(sorted(ss.share_index.get_shares("si1")),
+                                 [0,1,2])
+            self.failUnlessEqual(ss.share_index.get_shares("si2").keys(), [5])
+            self.failUnlessEqual(ss.share_index.get_shares("si3"), {})
+            # the crawler goes away once the index is complete
+            self.failIf(ss.share_index_crawler.running)
+            # shares that arrive while the node is down are only noticed
+            # with a rebuild
+            self.allocate(ss, "si3", [0], 75)
+            return ss.disownServiceParent()
+        d.addCallback(_indexed)
+        def _add_share_offline(ign):
+            ss = self.create("test_rebuild", share_index_enabled=False)
+            ss.remote_cancel_lease("si3", ss.get_leases("si3").next().cancel_secret)
+            self.allocate(ss, "si4", [0], 75)
+            return ss.disownServiceParent()
+        d.addCallback(_add_share_offline)
+        def _restart_without_rebuild(ign):
+            ss = self.create("test_rebuild")
+            self.failUnlessEqual(ss.share_index_crawler, None)
+            self.failUnlessEqual(ss.share_index.get_shares("si3").keys(), [0])
+            self.failUnlessEqual(ss.share_index.get_shares("si4"), {})
+            return ss.disownServiceParent()
+        d.addCallback(_restart_without_rebuild)
+        d.addCallback(lambda ign: self.create_indexed("test_rebuild",
+                                                      rebuild=True))
+        def _rebuilt(ss):
+            self.failUnlessEqual(ss.share_index.get_shares("si3"), {})
+            self.failUnlessEqual(ss.share_index.get_shares("si4").keys(), [0])
+        d.addCallback(_rebuilt)
+        return d
+
+class LeaseDatabase(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "LeaseDatabase", name)
+        return basedir
+
+    def create(self, name, leasedb_enabled=True, **kwargs):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20,
+                           stats_provider=FakeStatsProvider(),
+                           leasedb_enabled=leasedb_enabled, **kwargs)
+        if ss.share_index_crawler:
+            ss.share_index_crawler.slow_start = 0
+        ss.lease_checker.slow_start = 0
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self):
+        return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        rs, cs = self.secrets()
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for i,wb in writers.items():
+            wb.remote_write(0, "%10d" % i)
+            wb.remote_close()
+        return rs, cs
+
+    def count_share_leases(self, ss, storage_index):
+        return [len(list(sf.get_leases()))
+                for sf in ss._iter_share_files(storage_index)]
+
+    def test_leases(self):
+        ss = self.create("test_leases", share_index_enabled=True)
+        d = self.poll(ss.share_index.is_complete)
+        d.addCallback(lambda ign: self._test_leases(ss))
+        return d
+
+    def _test_leases(self, ss):
+        rs, cs = self.allocate(ss, "si1", [0,1,2], 75)
+        leases = list(ss.get_leases("si1"))
+        self.failUnlessEqual(len(leases), 1)
+        self.failUnlessEqual(leases[0].renew_secret, rs)
+        self.failUnlessEqual(leases[0].nodeid, "\x00" * 20)
+
+        # new leases only go into the database
+        rs2, cs2 = self.secrets()
+        ss.remote_add_lease("si1", rs2, cs2)
+        ss.remote_add_lease("si1", rs2, cs2)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+        self.failUnlessEqual(self.count_share_leases(ss, "si1"), [1,1,1])
+        self.failUnlessEqual(ss.share_index.get_shares("si1")[0][2], 2)
+        # allocating existing shares adds a lease too
+        rs3, cs3 = self.allocate(ss, "si1", [0], 75)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 3)
+        ss.remote_add_lease("si2", rs2, cs2) # no shares, ignored
+        self.failUnlessEqual(list(ss.get_leases("si2")), [])
+
+        ss.lease_db.renew_lease("si1", rs2, 1000) # never shortened
+        ss.remote_renew_lease("si1", rs2)
+        (num_leases, expiration_time) = ss.lease_db.get_lease_summary("si1")
+        self.failUnlessEqual(num_leases, 3)
+        self.failUnless(expiration_time > time.time() + 30*24*60*60)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si1", cs2)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si2", rs2)
+
+        self.failUnlessRaises(IndexError, ss.remote_cancel_lease, "si1", rs)
+        self.failUnlessRaises(IndexError, ss.remote_cancel_lease, "si2", cs)
+        ss.remote_cancel_lease("si1", cs)
+        ss.remote_cancel_lease("si1", cs3)
+        self.failUnlessEqual(len(ss.remote_get_buckets("si1")), 3)
+        # the last lease takes the shares with it
+        ss.remote_cancel_lease("si1", cs2)
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        self.failUnlessEqual(ss.share_index.get_shares("si1"), {})
+        self.failUnlessEqual(list(ss.get_leases("si1")), [])
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si1"))))
+
+        # mutable shares get their leases from writev
+        secrets = (hashutil.tagged_hash("we", "1"),) + self.secrets()
+        write = ss.remote_slot_testv_and_readv_and_writev
+        rc = write("si3", secrets, {0: ([], [(0,"data")], None)}, [])
+        self.failUnlessEqual(rc, (True, {}))
+        leases = list(ss.get_leases("si3"))
+        self.failUnlessEqual(len(leases), 1)
+        self.failUnlessEqual(leases[0].renew_secret, secrets[1])
+        self.failUnlessEqual(self.count_share_leases(ss, "si3"), [0])
+        rc = write("si3", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(ss.lease_db.get_leases("si3"), [])
+
+    def test_import(self):
+        # 'tahoe debug migrate-leases' wants a node directory
+        nodedir = self.workdir("test_import")
+        ss = self.create(os.path.join("test_import", "storage"), leasedb_enabled=False)
+        rs, cs = self.allocate(ss, "si1", [0,1], 75)
+        rs2, cs2 = self.allocate(ss, "si2", [0], 75)
+        rs3, cs3 = self.secrets()
+        ss.remote_add_lease("si2", rs3, cs3)
+        d = defer.maybeDeferred(ss.disownServiceParent)
+        def _migrate(ign):
+            o = debug.MigrateLeasesOptions()
+            o.stdout, o.stderr = StringIO(), StringIO()
+            o.parseOptions([nodedir])
+            self.failUnlessEqual(debug.migrate_leases(o), 0)
+            self.failUnlessEqual(o.stdout.getvalue(),
+                                 "imported leases for 2 of 2 buckets\n")
+            ss = self.create(os.path.join("test_import", "storage"))
+            self.failUnlessEqual(len(ss.lease_db.get_leases("si1")), 1)
+            self.failUnlessEqual(len(ss.lease_db.get_leases("si2")), 2)
+            ss.remote_cancel_lease("si2", cs3)
+            self.failUnlessEqual(len(list(ss.get_leases("si2"))), 1)
+            # the share files are no longer consulted
+            self.failUnlessEqual(self.count_share_leases(ss, "si2"), [2])
+            return ss.disownServiceParent()
+        d.addCallback(_migrate)
+        def _add_offline(ign):
+            ss = self.create(os.path.join("test_import", "storage"), leasedb_enabled=False)
+            self.allocate(ss, "si4", [0], 75)
+            return ss.disownServiceParent()
+        d.addCallback(_add_offline)
+        def _import_on_demand(ign):
+            ss = self.create(os.path.join("test_import", "storage"))
+            self.failUnlessEqual(ss.lease_db.get_leases("si4"), [])
+            self.failUnlessEqual(len(list(ss.get_leases("si4"))), 1)
+            self.failUnlessEqual(len(ss.lease_db.get_leases("si4")), 1)
+        d.addCallback(_import_on_demand)
+        return d
+
+    def test_expire(self):
+        now = time.time()
+        # every lease granted from now on is expired
+        ss = self.create("test_expire",
+                         expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(now + 1000))
+        rs, cs = self.allocate(ss, "si1", [0,1], 75)
+        rs2, cs2 = self.allocate(ss, "si2", [0], 75)
+        # the database's idea of the lease wins over the one in the share
+        ss.lease_db.renew_lease("si2", rs2, now + 2000 + 31*24*60*60)
+
+        def _cycle_finished():
+            s = ss.lease_checker.get_state()
+            return s.get("last-cycle-finished") is not None
+        d = self.poll(_cycle_finished)
+        def _check(ign):
+            self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+            self.failUnlessEqual(list(ss.get_leases("si1")), [])
+            self.failUnlessEqual(ss.remote_get_buckets("si2").keys(), [0])
+            self.failUnlessEqual(len(list(ss.get_leases("si2"))), 1)
+            h = ss.lease_checker.get_state()["history"]
+            sr = h[0]["space-recovered"]
+            self.failUnlessEqual(sr["examined-buckets"], 2)
+            self.failUnlessEqual(sr["actual-buckets"], 1)
+            self.failUnlessEqual(sr["actual-shares"], 2)
+        d.addCallback(_check)
+        return d
+
+class ShareMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ShareMaps", name)
+        return basedir
+
+    def create(self, name, mmap_max_files=10):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20,
+                           stats_provider=FakeStatsProvider(),
+                           mmap_max_files=mmap_max_files)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self):
+        return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+    def test_cache(self):
+        basedir = self.workdir("test_cache")
+        fileutil.make_dirs(basedir)
+        def _make(name, data):
+            fn = os.path.join(basedir, name)
+            fileutil.write(fn, data)
+            return fn
+        a = _make("a", "aaaa")
+        b = _make("b", "bbbb")
+        c = _make("c", "cccc")
+        empty = _make("empty", "")
+
+        self.failUnlessEqual(ShareMapCache(0).get(a), None)
+
+        cache = ShareMapCache(2)
+        if not cache.max_files:
+            raise unittest.SkipTest("memory maps are not used on this platform")
+        self.failUnlessEqual(cache.get(a)[:], "aaaa")
+        self.failUnlessEqual(cache.get(b)[:], "bbbb")
+        self.failUnlessEqual(cache.get(a)[1:3], "aa")
+        # c pushes out b, the least recently used
+        self.failUnlessEqual(cache.get(c)[:], "cccc")
+        self.failUnlessEqual(sorted(cache._maps.keys()), sorted([a, c]))
+        self.failUnlessEqual(cache.get(a)[:], "aaaa")
+        self.failUnlessEqual((cache.hits, cache.misses), (2, 3))
+
+        # changes made behind our back are not noticed until the map is
+        # checked again, or until the server invalidates it
+        f = open(a, "ab")
+        f.write("AAAA")
+        f.close()
+        self.failUnlessEqual(cache.get(a)[:], "aaaa")
+        cache.invalidate(a)
+        self.failUnlessEqual(cache.get(a)[:], "aaaaAAAA")
+        self.failUnlessEqual(cache.get(c)[:], "cccc")
+        # a map that no longer matches its file is replaced
+        cache.revalidate_interval = 0
+        f = open(a, "ab")
+        f.write("BBBB")
+        f.close()
+        self.failUnlessEqual(cache.get(a)[:], "aaaaAAAABBBB")
+        os.unlink(c)
+        self.failUnlessEqual(cache.get(c), None)
+        self.failIf(c in cache._maps)
+        self.failUnlessEqual(cache.get(empty), None)
+
+        stats = cache.get_stats()
+        self.failUnlessEqual(stats["hits"], 4)
+        self.failUnlessEqual(stats["misses"], 7)
+        self.failUnlessEqual(stats["hit_rate"], 4.0/11)
+        self.failUnlessEqual(stats["open"], 1)
+        cache.clear()
+        self.failUnlessEqual(cache.get_stats()["open"], 0)
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        if not ss.share_maps.max_files:
+            raise unittest.SkipTest("memory maps are not used on this platform")
+        (we, rs, cs) = self.secrets()
+        already,writers = ss.remote_allocate_buckets("si0", rs, cs, [0], 100,
+                                                     FakeCanary())
+        writers[0].remote_write(0, "a"*50 + "b"*50)
+        writers[0].remote_close()
+
+        b = ss.remote_get_buckets("si0")
+        self.failUnlessEqual(b[0].remote_read(0, 50), "a"*50)
+        self.failUnlessEqual(b[0].remote_readv([(50, 10), (45, 10)]),
+                             ["b"*10, "a"*5 + "b"*5])
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.mmap.misses"], 1)
+        self.failUnlessEqual(stats["storage_server.mmap.hits"], 2)
+        self.failUnlessEqual(stats["storage_server.mmap.open"], 1)
+
+        # cancelling the last lease deletes the share, and its map with it
+        ss.remote_cancel_lease("si0", cs)
+        self.failUnlessEqual(ss.get_stats()["storage_server.mmap.open"], 0)
+        self.failUnlessEqual(ss.remote_get_buckets("si0"), {})
+
+        # servers without maps don't report them
+        ss2 = StorageServer(self.workdir("test_immutable_nomap"), "\x00" * 20)
+        self.failIf("storage_server.mmap.hits" in ss2.get_stats())
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        if not ss.share_maps.max_files:
+            raise unittest.SkipTest("memory maps are not used on this platform")
+        secrets = self.secrets()
+        write = ss.remote_slot_testv_and_readv_and_writev
+        read = ss.remote_slot_readv
+        def _write(datav, new_length=None):
+            (did_write, readv_data) = write("si1", secrets,
+                                            {0: ([], datav, new_length)}, [])
+            self.failUnless(did_write)
+        _write([(0, "x"*100)])
+        self.failUnlessEqual(read("si1", [0], [(10, 10)]), {0: ["x"*10]})
+        self.failUnlessEqual(read("si1", [0], [(95, 10)]), {0: ["x"*5]})
+        self.failUnlessEqual(ss.share_maps.hits, 1)
+
+        # growing the share moves the leases, and must not leave us reading
+        # through an old map
+        _write([(100, "y"*3000)])
+        self.failUnlessEqual(read("si1", [0], [(98, 4), (3098, 10)]),
+                             {0: ["xxyy", "yy"]})
+        _write([], new_length=50)
+        self.failUnlessEqual(read("si1", [0], [(40, 20)]), {0: ["x"*10]})
+        _write([], new_length=0)
+        self.failUnlessEqual(read("si1", [0], [(0, 10)]), {})
+        self.failUnlessEqual(ss.share_maps.get_stats()["open"], 0)
+
+class ReadCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ReadCaching", name)
+        return basedir
+
+    def create(self, name, read_cache_size=1000):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20,
+                           stats_provider=FakeStatsProvider(),
+                           read_cache_size=read_cache_size)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self):
+        return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+    def test_cache(self):
+        reads = []
+        def _read(readv):
+            reads.append(readv)
+            return [chr(ord("a")+offset) * length
+                    for (offset, length) in readv]
+        c = ReadCache(100)
+        self.failUnlessEqual(c.readv("si1", 0, [(0, 40), (1, 40)], _read),
+                             ["a"*40, "b"*40])
+        self.failUnlessEqual(reads, [[(0, 40), (1, 40)]])
+        # only the missing range is read
+        self.failUnlessEqual(c.readv("si1", 0, [(1, 40), (2, 10)], _read),
+                             ["b"*40, "c"*10])
+        self.failUnlessEqual(reads[-1], [(2, 10)])
+        self.failUnlessEqual((c.hits, c.misses, c.hit_bytes), (1, 3, 40))
+        self.failUnlessEqual(c.bytes, 90)
+
+        # (0,40) is now the least recently used, so it makes room for (3,40)
+        c.readv("si1", 0, [(3, 40)], _read)
+        self.failUnlessEqual(c.bytes, 90)
+        del reads[:]
+        c.readv("si1", 0, [(1, 40), (2, 10), (3, 40)], _read)
+        self.failUnlessEqual(reads, [])
+        c.readv("si1", 0, [(0, 40)], _read)
+        self.failUnlessEqual(reads, [[(0, 40)]])
+
+        # too big to cache at all
+        c.readv("si1", 0, [(4, 101)], _read)
+        self.failUnlessEqual(c.get_stats()["entries"], 3)
+        self.failUnlessEqual(c.bytes, 90)
+
+        c.readv("si1", 1, [(0, 10)], _read)
+        c.invalidate_share("si1", 0)
+        stats = c.get_stats()
+        self.failUnlessEqual(stats["entries"], 1)
+        self.failUnlessEqual(stats["bytes"], 10)
+        c.invalidate_share("si2", 0)
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        (we, rs, cs) = self.secrets()
+        already,writers = ss.remote_allocate_buckets("si0", rs, cs, [0], 100,
+                                                     FakeCanary())
+        writers[0].remote_write(0, "a"*50 + "b"*50)
+        writers[0].remote_close()
+
+        b = ss.remote_get_buckets("si0")
+        self.failUnlessEqual(b[0].remote_read(0, 50), "a"*50)
+        # a second reader of the same range is served from memory
+        b = ss.remote_get_buckets("si0")
+        self.failUnlessEqual(b[0].remote_readv([(0, 50), (50, 10)]),
+                             ["a"*50, "b"*10])
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.read_cache.hits"], 1)
+        self.failUnlessEqual(stats["storage_server.read_cache.misses"], 2)
+        self.failUnlessEqual(stats["storage_server.read_cache.hit_bytes"], 50)
+        self.failUnlessEqual(stats["storage_server.read_cache.bytes"], 60)
+
+        # cancelling the last lease deletes the share and forgets its data
+        ss.remote_cancel_lease("si0", cs)
+        self.failUnlessEqual(ss.get_stats()["storage_server.read_cache.bytes"],
+                             0)
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = self.secrets()
+        write = ss.remote_slot_testv_and_readv_and_writev
+        read = ss.remote_slot_readv
+        def _write(datav, new_length=None):
+            (did_write, readv_data) = write("si1", secrets,
+                                            {0: ([], datav, new_length)}, [])
+            self.failUnless(did_write)
+        _write([(0, "x"*100)])
+        self.failUnlessEqual(read("si1", [0], [(10, 10)]), {0: ["x"*10]})
+        self.failUnlessEqual(read("si1", [0], [(10, 10)]), {0: ["x"*10]})
+        self.failUnlessEqual(ss.read_cache.hits, 1)
+
+        _write([(10, "y"*10)])
+        self.failUnlessEqual(read("si1", [0], [(10, 10)]), {0: ["y"*10]})
+        _write([], new_length=15)
+        self.failUnlessEqual(read("si1", [0], [(10, 10)]), {0: ["y"*5]})
+        self.failUnlessEqual(ss.read_cache.hits, 1)
+
 class Stats(unittest.TestCase):
 
     def setUp(self):
@@ -1699,6 +2546,7 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             s = remove_tags(html)
             self.failUnlessIn("So far, this cycle has examined "
                               "1 shares in 1 buckets (0 mutable / 1 immutable) ", s)
+            self.failUnlessIn(" (1 buckets so far, ", s)
             self.failUnlessIn("and has recovered: "
                               "0 shares, 0 buckets (0 mutable / 0 immutable), "
                               "0 B (0 B / 0 B)", s)
@@ -2200,6 +3048,136 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def _make_expiring_shares(self, ss):
+        # like test_expire_age: the first lease of each share is 1000s old,
+        # and the second leases on immutable_si_1 and mutable_si_3 are new
+        self.make_shares(ss)
+        now = time.time()
+        for (si, rs) in zip(self.sis, [self.renew_secrets[i]
+                                       for i in (0, 1, 3, 4)]):
+            sf = list(ss._iter_share_files(si))[0]
+            self.backdate_lease(sf, rs, now - 1000)
+
+    def test_workers(self):
+        if _get_multiprocessing() is None:
+            raise unittest.SkipTest("expire.workers requires multiprocessing")
+        basedir = "storage/LeaseCrawler/workers"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           expiration_workers=2)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+        self._make_expiring_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def count_leases(si):
+            return len(list(list(ss._iter_share_files(si))[0].get_leases()))
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnless(lc.pool)
+            # the same results as test_expire_age
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2, 2: 2})
+            # four leases about 31 days old, and two fresh ones
+            self.failUnlessEqual([count for (minage, maxage, count)
+                                  in last["lease-age-histogram"]], [2, 4])
+            self.failUnlessEqual(last["corrupt-shares"], [])
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-buckets-mutable"], 2)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["original-shares"], 2)
+            self.failUnlessEqual(rec["configured-shares"], 2)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_examined_leases_are_rechecked(self):
+        # a lease that was renewed after a worker examined its share must
+        # not be cancelled
+        basedir = "storage/LeaseCrawler/examined_leases_are_rechecked"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        self._make_expiring_shares(ss)
+        immutable_si_0 = self.sis[0]
+        si_s = si_b2a(immutable_si_0)
+        prefixdir = os.path.join(ss.sharedir, si_s[:2])
+        examined = examine_prefixdir(prefixdir, True)[si_s]
+
+        ss.remote_renew_lease(immutable_si_0, self.renew_secrets[0])
+        lc.started_cycle(0)
+        lc.process_examined_bucket(os.path.join(prefixdir, si_s), examined,
+                                   None)
+        sf = list(ss._iter_share_files(immutable_si_0))[0]
+        self.failUnlessEqual(len(list(sf.get_leases())), 1)
+        # the statistics still describe what the worker saw
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["examined-shares"], 1)
+        self.failUnlessEqual(rec["configured-shares"], 1)
+
+    def test_workers_do_not_block(self):
+        # while the workers are behind, the crawler yields the reactor
+        # instead of waiting for them
+        basedir = "storage/LeaseCrawler/workers_do_not_block"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           expiration_workers=1)
+        lc = ss.lease_checker
+        self._make_expiring_shares(ss)
+        jobs = []
+        class SlowPool:
+            def run(self, f, *args):
+                d = defer.Deferred()
+                jobs.append((d, f, args))
+                return d
+        lc.pool = SlowPool()
+        si_s = si_b2a(self.sis[0])
+        prefix = si_s[:2]
+        prefixdir = os.path.join(ss.sharedir, prefix)
+        buckets = lc.list_buckets(prefixdir)
+        lc.started_cycle(0)
+        self.failUnlessRaises(TimeSliceExceeded, lc.process_prefixdir,
+                              0, prefix, prefixdir, buckets, time.time())
+        self.failUnlessEqual(len(jobs), lc.prefixes_per_worker)
+        self.failUnlessEqual(lc._waiting_for_prefix, prefix)
+        # asking again does not start the same jobs twice
+        self.failUnlessRaises(TimeSliceExceeded, lc.process_prefixdir,
+                              0, prefix, prefixdir, buckets, time.time())
+        self.failUnlessEqual(len(jobs), lc.prefixes_per_worker)
+
+        (d, f, args) = jobs[0]
+        d.callback(f(*args))
+        lc.cpu_slice = 500
+        lc.process_prefixdir(0, prefix, prefixdir, buckets, time.time())
+        self.failUnlessEqual(lc._waiting_for_prefix, None)
+        self.failIf(prefix in lc._pending_prefixes)
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["examined-buckets"], len(buckets))
+
     def test_bad_mode(self):
         basedir = "storage/LeaseCrawler/bad_mode"
         fileutil.make_dirs(basedir)
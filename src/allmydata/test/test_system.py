@@ -1217,6 +1217,7 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
                       self.GET("helper_status", followRedirect=True))
         def _got_helper_status(res):
             self.failUnless("Bytes Fetched:" in res)
+            self.failUnless("Active Uploads" in res)
             # touch a couple of files in the helper's working directory to
             # exercise more code paths
             workdir = os.path.join(self.getdir("client0"), "helper")
@@ -1393,6 +1394,7 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
             self.failUnlessEqual(data, expected_data)
         d.addCallback(_check)
         d.addCallback(lambda res: rref.callRemote("speed_test", 1, 200, False))
+        d.addCallback(lambda res: rref.callRemote("speed_test", 3, 200, "batch"))
         if sys.platform == "linux2":
             d.addCallback(lambda res: rref.callRemote("get_memory_usage"))
         d.addCallback(lambda res: rref.callRemote("measure_peer_response_time"))
@@ -4,22 +4,29 @@ import os, shutil
 from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from foolscap.api import fireEventually
 
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
 from allmydata.immutable import upload, encode
-from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
+from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError, \
+     ContentHashMismatchError
 from allmydata.util import log
 from allmydata.util.assertutil import precondition
+from allmydata.util.consumer import download_to_data
 from allmydata.util.deferredutil import DeferredListShouldSucceed
-from allmydata.test.no_network import GridTestMixin
+from allmydata.util.workerpool import WorkerPool
+from allmydata.util.hashutil import streaming_convergence_key
+from allmydata.immutable.keycache import ConvergentKeyCache
+from allmydata.test.no_network import GridTestMixin, IntentionalError
 from allmydata.test.common_util import ShouldFailMixin
 from allmydata.util.happinessutil import servers_of_happiness, \
                                          shares_by_server, merge_servers
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.server import storage_index_to_dir
+from pycryptopp.cipher.aes import AES
+from pycryptopp.hash.sha256 import SHA256
 
 MiB = 1024*1024
 
@@ -75,6 +82,105 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+    def _write(self, fn, data):
+        f = open(fn, "wb")
+        f.write(data)
+        f.close()
+
+    def test_convergent_key_blocks(self):
+        basedir = "upload/Uploadable/test_convergent_key_blocks"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        data = "".join([chr(i % 251) for i in range(4100)])
+        self._write(fn, data)
+        self.patch(upload, "HASH_BLOCKSIZE", 1000)
+        u = upload.FileName(fn, convergence="secret")
+        d = u.get_encryption_key()
+        def _got_key(key):
+            self.block_key = key
+            return upload.Data(data, convergence="secret").get_encryption_key()
+        d.addCallback(_got_key)
+        d.addCallback(lambda key: self.failUnlessEqual(key, self.block_key))
+        d.addCallback(lambda ign: u.read(5000))
+        d.addCallback(self.shouldEqual, data)
+        d.addCallback(lambda res: u.close())
+        return d
+
+    def test_key_cache(self):
+        basedir = "upload/Uploadable/test_key_cache"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        self._write(fn, "a"*41)
+        cache = ConvergentKeyCache(os.path.join(basedir, "keys.sqlite"))
+        # the file was just written: trust its stamp anyway
+        cache.MIN_AGE = 0
+        self.keys = []
+        def _get_key(convergence="secret"):
+            u = upload.FileName(fn, convergence=convergence, key_cache=cache)
+            d = u.get_encryption_key()
+            d.addCallback(self.keys.append)
+            d.addCallback(lambda ign: u.close())
+            return d
+        d = _get_key()
+        d.addCallback(lambda ign: _get_key())
+        def _check_hit(ign):
+            self.failUnlessEqual((cache.hits, cache.misses), (1, 1))
+            self.failUnlessEqual(self.keys[0], self.keys[1])
+            # a different secret gives a different key, and is not confused
+            # with the remembered one
+            return _get_key("other secret")
+        d.addCallback(_check_hit)
+        def _check_other_secret(ign):
+            self.failUnlessEqual((cache.hits, cache.misses), (1, 2))
+            self.failIfEqual(self.keys[2], self.keys[0])
+            self._write(fn, "b"*42)
+            return _get_key()
+        d.addCallback(_check_other_secret)
+        d.addCallback(lambda ign:
+                      upload.Data("b"*42, "secret").get_encryption_key())
+        def _check_changed(key):
+            self.failUnlessEqual((cache.hits, cache.misses), (1, 3))
+            self.failUnlessEqual(self.keys[3], key)
+            cache.close()
+        d.addCallback(_check_changed)
+        return d
+
+    def test_key_cache_untrusted_stamps(self):
+        basedir = "upload/Uploadable/test_key_cache_untrusted_stamps"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        self._write(fn, "a"*41)
+        cache = ConvergentKeyCache(os.path.join(basedir, "keys.sqlite"))
+        def _get_key(change=False):
+            u = upload.FileName(fn, convergence="secret", key_cache=cache)
+            if change:
+                original = u._hash_file
+                def _hash_file(hasher):
+                    original(hasher)
+                    # a same-size rewrite while the file was being hashed
+                    os.utime(fn, (1, 1))
+                u._hash_file = _hash_file
+            d = u.get_encryption_key()
+            d.addCallback(lambda ign: u.close())
+            return d
+        # a file that changed within the last MIN_AGE seconds might change
+        # again without changing its stamp, so its key is not remembered
+        d = _get_key()
+        d.addCallback(lambda ign: _get_key())
+        def _check_recent(ign):
+            self.failUnlessEqual((cache.hits, cache.misses), (0, 2))
+            cache.MIN_AGE = 0
+            return _get_key(change=True)
+        d.addCallback(_check_recent)
+        # nor is the key of a file whose stamp changed while it was hashed
+        def _check_changed(ign):
+            self.failUnlessEqual((cache.hits, cache.misses), (0, 3))
+            cache.cursor.execute("SELECT COUNT(*) FROM keys")
+            self.failUnlessEqual(cache.cursor.fetchone()[0], 0)
+            cache.close()
+        d.addCallback(_check_changed)
+        return d
+
     def test_data(self):
         s = "a"*41
         u = upload.Data(s, convergence=None)
@@ -319,6 +425,40 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def _count_uploads(self):
+        # record how many uploads are in progress whenever one starts
+        self.in_progress = []
+        self.concurrent = []
+        original = self.u._upload
+        def _upload(uploadable, history=None, batch=None):
+            self.in_progress.append(uploadable)
+            self.concurrent.append(len(self.in_progress))
+            d = original(uploadable, history, batch)
+            def _done(res):
+                self.in_progress.remove(uploadable)
+                return res
+            d.addBoth(_done)
+            return d
+        self.u._upload = _upload
+
+    def test_batch(self):
+        self.u.BATCH_CONCURRENCY = 2
+        self._count_uploads()
+        sizes = [SIZE_LARGE, SIZE_SMALL, SIZE_LARGE-1, SIZE_ZERO, SIZE_LARGE-2]
+        d = self.u.upload_batch([upload.Data(self.get_data(size), None)
+                                 for size in sizes])
+        def _check(results):
+            self.failUnlessEqual(len(results), len(sizes))
+            for (r, size) in zip(results, sizes):
+                if size > upload.Uploader.URI_LIT_SIZE_THRESHOLD:
+                    self._check_large(r.uri, size)
+                else:
+                    self._check_small(r.uri, size)
+            self.failUnlessEqual(len(self.concurrent), len(sizes))
+            self.failUnless(max(self.concurrent) <= 2, self.concurrent)
+        d.addCallback(_check)
+        return d
+
     def test_data_large_odd_segments(self):
         data = self.get_data(SIZE_LARGE)
         segsize = int(SIZE_LARGE / 2.5)
@@ -452,6 +592,23 @@ class ServerErrors(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(_check)
         return d
 
+    def test_batch_error(self):
+        self.make_node("first-fail")
+        self.u.BATCH_CONCURRENCY = 1
+        started = []
+        original = self.u._upload
+        def _upload(uploadable, history=None, batch=None):
+            started.append(uploadable)
+            return original(uploadable, history, batch)
+        self.u._upload = _upload
+        d = self.shouldFail(UploadUnhappinessError, "batch_error",
+                            "server selection failed",
+                            self.u.upload_batch,
+                            [upload.Data(DATA, None), upload.Data(DATA, None)])
+        # once the first upload has failed, the second is not attempted
+        d.addCallback(lambda ign: self.failUnlessEqual(len(started), 1))
+        return d
+
 class FullServer(unittest.TestCase):
     def setUp(self):
         self.node = FakeClient(mode="full")
@@ -468,11 +625,11 @@ class FullServer(unittest.TestCase):
         d.addBoth(self._should_fail)
         return d
 
-class ServerSelection(unittest.TestCase):
+class ServerSelection(unittest.TestCase, ShouldFailMixin):
 
-    def make_client(self, num_servers=50):
-        self.node = FakeClient(mode="good", num_servers=num_servers)
-        self.u = upload.Uploader()
+    def make_client(self, num_servers=50, parallel_queries=1, mode="good"):
+        self.node = FakeClient(mode=mode, num_servers=num_servers)
+        self.u = upload.Uploader(parallel_queries=parallel_queries)
         self.u.running = True
         self.u.parent = self.node
 
@@ -629,6 +786,483 @@ class ServerSelection(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_parallel_one_each(self):
+        # asking ten servers at a time gives the same placement as asking
+        # them one after another, in a tenth of the round trips
+        self.make_client(parallel_queries=10)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(25, 30, 50)
+        d = upload_data(self.u, data)
+        def _check(results):
+            self._check_large(results.uri, SIZE_LARGE)
+            for s in self.node.last_servers:
+                self.failUnlessEqual(len(s.allocated), 1)
+                self.failUnlessEqual(s.queries, 1)
+            self.failUnlessEqual(results.timings["peer_selection_rounds"], 5)
+            self.failUnless("peer_selection" in results.timings)
+        d.addCallback(_check)
+        return d
+
+    def test_sequential_rounds(self):
+        self.make_client(10)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(3, 7, 10)
+        d = upload_data(self.u, data)
+        def _check(results):
+            self.failUnlessEqual(results.timings["peer_selection_rounds"], 10)
+        d.addCallback(_check)
+        return d
+
+    def test_parallel_four_each(self):
+        # the second pass (which asks for several shares at a time) is still
+        # sequential, and gets the same two-queries-per-server placement
+        self.make_client(parallel_queries=20)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(100, 50, 200)
+        d = upload_data(self.u, data)
+        def _check(results):
+            self._check_large(results.uri, SIZE_LARGE)
+            for s in self.node.last_servers:
+                self.failUnlessEqual(len(s.allocated), 4)
+                self.failUnlessEqual(s.queries, 2)
+            # 50 first queries, 20 at a time, then 50 second queries
+            self.failUnlessEqual(results.timings["peer_selection_rounds"],
+                                 3+50)
+        d.addCallback(_check)
+        return d
+
+    def test_parallel_with_failures(self):
+        # servers that fail or are full while other queries are in flight
+        # leave their shares homeless, for the remaining servers to take
+        mode = dict([(i, "good") for i in range(20)])
+        for i in range(0, 20, 4):
+            mode[i] = "first-fail"
+        for i in range(1, 20, 4):
+            mode[i] = "full"
+        self.make_client(20, parallel_queries=8, mode=mode)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(3, 10, 10)
+        d = upload_data(self.u, data)
+        def _check(results):
+            self._check_large(results.uri, SIZE_LARGE)
+            holders = [s for s in self.node.last_servers if s.allocated]
+            self.failUnlessEqual(len(holders), 10)
+            for s in holders:
+                self.failUnlessEqual(len(s.allocated), 1)
+                self.failIfEqual(s.mode, "full")
+        d.addCallback(_check)
+        return d
+
+    def test_parallel_unhappy(self):
+        # the servers-of-happiness test still applies
+        mode = dict([(i, "full") for i in range(10)])
+        for i in range(4):
+            mode[i] = "good"
+        self.make_client(10, parallel_queries=5, mode=mode)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(3, 5, 10)
+        d = self.shouldFail(UploadUnhappinessError, "test_parallel_unhappy",
+                            "shares could be placed on only 4 server(s)",
+                            upload_data, self.u, data)
+        return d
+
+class Workers(unittest.TestCase, SetDEPMixin):
+    def setUp(self):
+        self.pool = WorkerPool(2)
+        self.pool.startService()
+
+    def tearDown(self):
+        return self.pool.stopService()
+
+    def upload_with(self, worker_pool, data, convergence="converge"):
+        self.node = FakeClient(mode="good")
+        # four segments, the last of which is short
+        self.set_encoding_parameters(3, 5, 10, max_segsize=30000)
+        u = upload.Uploader(worker_pool=worker_pool)
+        u.running = True
+        u.parent = self.node
+        return u.upload(upload.Data(data, convergence=convergence))
+
+    def test_same_results(self):
+        # the workers must produce exactly the shares that the node would
+        data = os.urandom(100001)
+        d = self.upload_with(None, data)
+        d.addCallback(extract_uri)
+        def _uploaded(uri_without_workers):
+            d2 = self.upload_with(self.pool, data)
+            d2.addCallback(extract_uri)
+            d2.addCallback(lambda uri_with_workers:
+                           self.failUnlessEqual(uri_with_workers,
+                                                uri_without_workers))
+            return d2
+        d.addCallback(_uploaded)
+        def _check_stats(ign):
+            stats = self.pool.get_stats()
+            if self.pool.is_parallel():
+                # each segment is encrypted, then encoded
+                self.failUnlessEqual(stats["worker_pool.jobs_finished"], 8)
+        d.addCallback(_check_stats)
+        return d
+
+    def test_encrypt_at(self):
+        key = "k"*16
+        plaintext = os.urandom(1000)
+        ciphertext = AES(key).process(plaintext)
+        for offset in [0, 1, 15, 16, 17, 500, 999]:
+            chunks = [plaintext[offset:offset+7], plaintext[offset+7:]]
+            self.failUnlessEqual("".join(upload.encrypt_at(key, offset,
+                                                           chunks)),
+                                 ciphertext[offset:])
+
+class ExistingFile(GridTestMixin, unittest.TestCase, ShouldFailMixin):
+    def setUp(self):
+        GridTestMixin.setUp(self)
+        self.basedir = "upload/ExistingFile/%s" % self.id().split(".")[-1]
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.getServiceNamed("uploader")._check_existing = True
+        self.data = "data" * 10000
+
+    def upload(self, convergence=""):
+        return self.c0.upload(upload.Data(self.data, convergence=convergence))
+
+    def test_dedup(self):
+        d = self.upload()
+        def _uploaded(results):
+            self.failIf(results.dedup_hit)
+            self.failUnlessEqual(results.pushed_shares, 10)
+            self.uri = results.uri
+            for ss in self.g.servers_by_number.values():
+                original = ss.remote_add_leases
+                def add_leases(leases, original=original):
+                    self.lease_calls.append(len(leases))
+                    return original(leases)
+                ss.remote_add_leases = add_leases
+            return self.upload()
+        self.lease_calls = []
+        d.addCallback(_uploaded)
+        def _uploaded_again(results):
+            self.failUnless(results.dedup_hit)
+            # our leases were added to the shares that were already there,
+            # with one batched add_leases() call per server
+            self.failUnlessEqual(self.lease_calls, [1] * 10)
+            self.failUnlessEqual(results.uri, self.uri)
+            self.failUnlessEqual(results.pushed_shares, 0)
+            self.failUnlessEqual(results.preexisting_shares, 10)
+            self.failUnlessEqual(len(results.servermap), 10)
+            self.failUnlessEqual(results.file_size, len(self.data))
+            self.failUnless("existence_check" in results.timings)
+            # nothing was encoded
+            self.failIf("total_encode_and_push" in results.timings)
+            return download_to_data(self.c0.create_node_from_uri(results.uri))
+        d.addCallback(_uploaded_again)
+        d.addCallback(lambda data: self.failUnlessEqual(data, self.data))
+        return d
+
+    def test_unhealthy(self):
+        # a file with missing shares is uploaded again, which repairs it
+        d = self.upload()
+        def _uploaded(results):
+            self.uri = results.uri
+            self.delete_shares_numbered(self.uri, [0, 1])
+            return self.upload()
+        d.addCallback(_uploaded)
+        def _uploaded_again(results):
+            self.failIf(results.dedup_hit)
+            self.failUnlessEqual(results.uri, self.uri)
+            self.failUnlessEqual(results.pushed_shares, 2)
+            self.failUnless("existence_check" in results.timings)
+            self.failUnlessEqual(len(self.find_uri_shares(self.uri)), 10)
+        d.addCallback(_uploaded_again)
+        return d
+
+    def test_random_key(self):
+        # there is no point in looking for a file with a random key
+        d = self.upload(convergence=None)
+        d.addCallback(lambda ign: self.upload(convergence=None))
+        def _uploaded(results):
+            self.failIf(results.dedup_hit)
+            self.failIf("existence_check" in results.timings)
+        d.addCallback(_uploaded)
+        return d
+
+    def stream(self, data, content_hash):
+        u = upload.StreamingUploadable(len(data))
+        u.set_convergence("", content_hash)
+        u.write(data)
+        return u
+
+    def test_stream(self):
+        # a streamed upload with a declared hash is convergent too, and must
+        # be checked even when nothing needs to be pushed
+        content_hash = SHA256(self.data).digest()
+        d = self.c0.upload(self.stream(self.data, content_hash))
+        def _uploaded(results):
+            self.failIf(results.dedup_hit)
+            self.uri = results.uri
+            return self.c0.upload(self.stream(self.data, content_hash))
+        d.addCallback(_uploaded)
+        def _uploaded_again(results):
+            self.failUnless(results.dedup_hit)
+            self.failUnlessEqual(results.uri, self.uri)
+            other = "atad" * 10000
+            return self.shouldFail(ContentHashMismatchError, "lying", None,
+                                   self.c0.upload,
+                                   self.stream(other, content_hash))
+        d.addCallback(_uploaded_again)
+        return d
+
+class Batch(GridTestMixin, unittest.TestCase):
+    def setUp(self):
+        GridTestMixin.setUp(self)
+        self.basedir = "upload/Batch/%s" % self.id().split(".")[-1]
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.calls = []
+        for ss in self.g.servers_by_number.values():
+            for methname in ["allocate_buckets", "allocate_buckets_many",
+                             "writev_many", "close_many"]:
+                self._count_calls(ss, methname)
+
+    def _count_calls(self, ss, methname):
+        # record the name and the number of requests of each message
+        original = getattr(ss, "remote_" + methname)
+        def _call(*args, **kwargs):
+            if methname == "allocate_buckets":
+                self.calls.append((methname, 1))
+            else:
+                self.calls.append((methname, len(args[0])))
+            return original(*args, **kwargs)
+        setattr(ss, "remote_" + methname, _call)
+
+    def count(self, methname):
+        calls = [n for (name, n) in self.calls if name == methname]
+        return (len(calls), sum(calls))
+
+    def test_batch(self):
+        files = ["%d %s" % (i, DATA * 100) for i in range(10)]
+        d = self.c0.upload_batch([upload.Data(data, None) for data in files])
+        def _uploaded(results):
+            self.failUnlessEqual(len(results), 10)
+            # server selection ran once: every file's shares went to the
+            # same servers, under the same share numbers
+            placements = [sorted([(shnum, sorted(serverids))
+                                  for (shnum, serverids)
+                                  in r.sharemap.items()])
+                          for r in results]
+            for placement in placements:
+                self.failUnlessEqual(placement, placements[0])
+            # all of the messages went through the batched calls (which
+            # call remote_allocate_buckets once per request), and the
+            # requests of different files shared them
+            (messages, requests) = self.count("allocate_buckets_many")
+            self.failUnlessEqual(requests, 10 + 9*10)
+            self.failUnlessEqual(self.count("allocate_buckets"),
+                                 (requests, requests))
+            self.failUnless(messages < requests, self.calls)
+            (messages, requests) = self.count("close_many")
+            self.failUnlessEqual(requests, 10*10)
+            self.failUnless(messages < requests, self.calls)
+            (messages, requests) = self.count("writev_many")
+            self.failUnless(messages < requests, self.calls)
+            ds = [download_to_data(self.c0.create_node_from_uri(r.uri))
+                  for r in results]
+            return defer.DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(_uploaded)
+        def _downloaded(res):
+            self.failUnlessEqual([data for (success, data) in res], files)
+        d.addCallback(_downloaded)
+        return d
+
+    def test_fallback(self):
+        # if a server of the batch's placement refuses a later file, that
+        # file selects servers for itself
+        ss = self.g.servers_by_number[0]
+        original = ss.remote_allocate_buckets_many
+        storage_indexes = []
+        def _allocate_buckets_many(requests, canary):
+            # only accept shares of the first file
+            for request in requests:
+                if request[0] not in storage_indexes:
+                    storage_indexes.append(request[0])
+            if len(storage_indexes) > 1:
+                raise IntentionalError("no more")
+            return original(requests, canary)
+        ss.remote_allocate_buckets_many = _allocate_buckets_many
+        files = ["%d %s" % (i, DATA * 100) for i in range(3)]
+        d = self.c0.upload_batch([upload.Data(data, None) for data in files])
+        def _uploaded(results):
+            self.failUnless(ss.my_nodeid in results[0].servermap)
+            for r in results[1:]:
+                self.failIf(ss.my_nodeid in r.servermap, r.servermap)
+                self.failUnlessEqual(len(r.sharemap), 10)
+            ds = [download_to_data(self.c0.create_node_from_uri(r.uri))
+                  for r in results]
+            return defer.DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(_uploaded)
+        def _downloaded(res):
+            self.failUnlessEqual([data for (success, data) in res], files)
+        d.addCallback(_downloaded)
+        return d
+
+    def test_nearby_servers(self):
+        # with N=2, the batch's placement is only reused by files whose own
+        # first four servers include it, so every file's shares stay near
+        # the front of its own permuted list
+        params = self.c0.DEFAULT_ENCODING_PARAMETERS.copy()
+        params.update({"k": 1, "happy": 1, "n": 2})
+        self.c0.DEFAULT_ENCODING_PARAMETERS = params
+        files = ["%d %s" % (i, DATA * 100) for i in range(10)]
+        d = self.c0.upload_batch([upload.Data(data, None) for data in files])
+        def _uploaded(results):
+            sb = self.c0.storage_broker
+            for r in results:
+                si = uri.from_string(r.uri).get_storage_index()
+                nearby = [s.get_serverid()
+                          for s in sb.get_servers_for_psi(si)[:4]]
+                for serverid in r.servermap:
+                    self.failUnlessIn(serverid, nearby)
+        d.addCallback(_uploaded)
+        return d
+
+    def test_short_reply(self):
+        # a server which answers close_many with too few results fails all
+        # the closes of that call, rather than leaving the upload waiting
+        # for the missing ones forever
+        ss = self.g.servers_by_number[0]
+        original = ss.remote_close_many
+        def _close_many(buckets):
+            return original(buckets)[:-1]
+        ss.remote_close_many = _close_many
+        files = ["%d %s" % (i, DATA * 100) for i in range(3)]
+        d = self.c0.upload_batch([upload.Data(data, None) for data in files])
+        def _uploaded(results):
+            for r in results:
+                self.failIf(ss.my_nodeid in r.servermap, r.servermap)
+            ds = [download_to_data(self.c0.create_node_from_uri(r.uri))
+                  for r in results]
+            return defer.DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(_uploaded)
+        def _downloaded(res):
+            self.failUnlessEqual([data for (success, data) in res], files)
+        d.addCallback(_downloaded)
+        return d
+
+    def test_unbatched_servers(self):
+        # servers which don't advertise 'supports-upload-batches' are sent
+        # the usual messages
+        for rref in self.g.wrappers_by_id.values():
+            v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1["supports-upload-batches"] = False
+        files = ["%d %s" % (i, DATA * 100) for i in range(3)]
+        d = self.c0.upload_batch([upload.Data(data, None) for data in files])
+        def _uploaded(results):
+            self.failUnlessEqual(self.count("allocate_buckets"), (30, 30))
+            self.failUnlessEqual(self.count("allocate_buckets_many"), (0, 0))
+            self.failUnlessEqual(self.count("close_many"), (0, 0))
+            ds = [download_to_data(self.c0.create_node_from_uri(r.uri))
+                  for r in results]
+            return defer.DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(_uploaded)
+        def _downloaded(res):
+            self.failUnlessEqual([data for (success, data) in res], files)
+        d.addCallback(_downloaded)
+        return d
+
+class FakeProducer:
+    def __init__(self):
+        self.paused = False
+    def pauseProducing(self):
+        assert not self.paused
+        self.paused = True
+    def resumeProducing(self):
+        assert self.paused
+        self.paused = False
+
+class Streaming(GridTestMixin, unittest.TestCase, ShouldFailMixin):
+    def setUp(self):
+        GridTestMixin.setUp(self)
+        self.data = "".join([chr(i % 251) for i in range(500*1000)])
+
+    def test_backpressure(self):
+        p = FakeProducer()
+        u = upload.StreamingUploadable(len(self.data), p)
+        u.BUFFER_SIZE = 1000
+        u.write(self.data[:600])
+        self.failIf(p.paused)
+        u.write(self.data[600:1200])
+        self.failUnless(p.paused)
+        d = u.read(500)
+        def _read1(datav):
+            self.failUnlessEqual("".join(datav), self.data[:500])
+            self.failIf(p.paused)
+            # a read that needs more than we have lets data in, whatever
+            # the buffer size
+            d = u.read(2000)
+            self.failIf(d.called)
+            u.write(self.data[1200:3000])
+            self.failIf(p.paused)
+            return d
+        d.addCallback(_read1)
+        def _read2(datav):
+            self.failUnlessEqual("".join(datav), self.data[500:2500])
+            # closing early lets the rest of the data through, unbuffered
+            u.write(self.data[3000:4000])
+            self.failUnless(p.paused)
+            d = u.close()
+            self.failIf(p.paused)
+            self.failIf(d.called)
+            u.write(self.data[4000:])
+            self.failUnless(d.called)
+            return d
+        d.addCallback(_read2)
+        return d
+
+    def test_hash_mismatch(self):
+        u = upload.StreamingUploadable(len(self.data))
+        u.set_convergence("", SHA256("other data").digest())
+        u.write(self.data)
+        d = u.read(len(self.data)-1)
+        d.addCallback(lambda ign:
+                      self.shouldFail(ContentHashMismatchError, "read", None,
+                                      u.read, 1))
+        d.addCallback(lambda ign: u.close())
+        return d
+
+    def test_connection_lost(self):
+        u = upload.StreamingUploadable(len(self.data))
+        u.write(self.data[:1000])
+        d = u.read(2000)
+        u.fail(ValueError("connection lost"))
+        return self.shouldFail(ValueError, "lost", "connection lost",
+                               lambda: d)
+
+    def test_upload(self):
+        self.basedir = "upload/Streaming/test_upload"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        content_hash = SHA256(self.data).digest()
+        u = upload.StreamingUploadable(len(self.data))
+        u.set_convergence("", content_hash)
+        # the data arrives a piece at a time, while the upload runs
+        def _write(offset):
+            u.write(self.data[offset:offset+30000])
+            if offset+30000 < len(self.data):
+                reactor.callLater(0, _write, offset+30000)
+        reactor.callLater(0, _write, 0)
+        d = c0.upload(u)
+        def _uploaded(results):
+            self.failUnlessEqual(results.pushed_shares, 10)
+            self.uri = results.uri
+            return u.get_all_encoding_parameters()
+        d.addCallback(_uploaded)
+        def _check_key((k, happy, n, segsize)):
+            key = streaming_convergence_key(k, n, segsize, "", content_hash)
+            self.failUnlessEqual(uri.from_string(self.uri).key, key)
+            return download_to_data(c0.create_node_from_uri(self.uri))
+        d.addCallback(_check_key)
+        d.addCallback(lambda data: self.failUnlessEqual(data, self.data))
+        return d
 
 class StorageIndex(unittest.TestCase):
     def test_params_must_matter(self):
@@ -953,6 +1587,56 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
             self.failUnless(self._has_happy_share_distribution()))
         return d
 
+    def test_writev(self):
+        # servers which support writev() should get the small writes of each
+        # share (header, hash trees, UEB) coalesced into fewer messages
+        self.basedir = "upload/EncodingParameters/writev"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        calls = {"write": 0, "writev": 0}
+        def _count_calls(bw):
+            original_write = bw.remote_write
+            def write(offset, data):
+                calls["write"] += 1
+                return original_write(offset, data)
+            bw.remote_write = write
+            original_writev = bw.remote_writev
+            def writev(datav):
+                calls["writev"] += 1
+                return original_writev(datav)
+            bw.remote_writev = writev
+        def _wrap_allocate_buckets(original):
+            def allocate_buckets(*args, **kwargs):
+                (alreadygot, writers) = original(*args, **kwargs)
+                for bw in writers.values():
+                    _count_calls(bw)
+                return (alreadygot, writers)
+            return allocate_buckets
+        for ss in self.g.servers_by_number.values():
+            ss.remote_allocate_buckets = \
+                _wrap_allocate_buckets(ss.remote_allocate_buckets)
+        DATA = "kittens" * 1000
+        d = c.upload(upload.Data(DATA, convergence=""))
+        def _uploaded(ur):
+            self.failUnless(calls["writev"] > 0, calls)
+            # each writev() turns into one write() per range
+            self.failUnless(calls["write"] > calls["writev"], calls)
+            self.coalesced = dict(calls)
+            for s in c.storage_broker.get_connected_servers():
+                v1 = s.get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+                del v1["supports-immutable-writev"]
+            calls["write"] = calls["writev"] = 0
+            return c.upload(upload.Data(DATA, convergence="downgraded"))
+        d.addCallback(_uploaded)
+        def _uploaded_without_writev(ur):
+            self.failUnlessEqual(calls["writev"], 0)
+            # the same shares are written either way
+            self.failUnlessEqual(calls["write"], self.coalesced["write"])
+            n = c.create_node_from_uri(ur.uri)
+            return download_to_data(n)
+        d.addCallback(_uploaded_without_writev)
+        d.addCallback(lambda data: self.failUnlessEqual(data, DATA))
+        return d
 
     def test_problem_layout_comment_52(self):
         def _basedir():
@@ -4,7 +4,7 @@ def foo(): pass # keep the line number constant
 import os, time, sys
 from StringIO import StringIO
 from twisted.trial import unittest
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.python.failure import Failure
 from twisted.python import log
 from pycryptopp.hash.sha256 import SHA256 as _hash
@@ -12,7 +12,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, workerpool
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 
@@ -844,6 +844,110 @@ class Limiter(unittest.TestCase):
         d.addCallback(_all_done)
         return d
 
+def _fail_in_worker(message):
+    # WorkerPool jobs must be module-level functions
+    raise ValueError(message)
+
+def _sleep_in_worker(seconds):
+    time.sleep(seconds)
+
+class WorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.stopService()
+
+    def make_pool(self, workers, job_timeout=600):
+        pool = workerpool.WorkerPool(workers, job_timeout=job_timeout)
+        pool.startService()
+        self.pools.append(pool)
+        return pool
+
+    def do_jobs(self, pool):
+        d = pool.run(hashutil.tagged_hash, "tag", "data")
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(res,
+                                           hashutil.tagged_hash("tag", "data")))
+        dl = [pool.run(len, "x"*i) for i in range(10)]
+        d.addCallback(lambda ign: defer.gatherResults(dl))
+        d.addCallback(lambda res: self.failUnlessEqual(res, range(10)))
+        return d
+
+    def test_in_process(self):
+        pool = self.make_pool(0)
+        self.failIf(pool.is_parallel())
+        d = self.do_jobs(pool)
+        def _check_error(ign):
+            d2 = pool.run(_fail_in_worker, "oops")
+            def _good(res):
+                self.fail("should have failed, not got %s" % (res,))
+            def _err(f):
+                # without workers, the original exception is delivered
+                f.trap(ValueError)
+                self.failUnless("oops" in str(f))
+            d2.addCallbacks(_good, _err)
+            return d2
+        d.addCallback(_check_error)
+        return d
+
+    def test_workers(self):
+        if workerpool._get_multiprocessing() is None:
+            raise unittest.SkipTest("the multiprocessing module is missing")
+        pool = self.make_pool(2)
+        self.failUnless(pool.is_parallel())
+        d = self.do_jobs(pool)
+        def _check_error(ign):
+            d2 = pool.run(_fail_in_worker, "oops")
+            def _good(res):
+                self.fail("should have failed, not got %s" % (res,))
+            def _err(f):
+                f.trap(workerpool.WorkerError)
+                self.failUnless("ValueError: oops" in str(f), str(f))
+            d2.addCallbacks(_good, _err)
+            return d2
+        d.addCallback(_check_error)
+        def _check_stats(ign):
+            stats = pool.get_stats()
+            self.failUnlessEqual(stats["worker_pool.workers"], 2)
+            self.failUnlessEqual(stats["worker_pool.jobs_started"], 12)
+            self.failUnlessEqual(stats["worker_pool.jobs_finished"], 12)
+            self.failUnlessEqual(stats["worker_pool.jobs_failed"], 0)
+        d.addCallback(_check_stats)
+        return d
+
+    def test_timeout(self):
+        if workerpool._get_multiprocessing() is None:
+            raise unittest.SkipTest("the multiprocessing module is missing")
+        pool = self.make_pool(1, job_timeout=0.1)
+        d = pool.run(_sleep_in_worker, 2)
+        def _good(res):
+            self.fail("should have failed, not got %s" % (res,))
+        def _err(f):
+            f.trap(workerpool.WorkerError)
+            self.failUnless("did not finish within" in str(f), str(f))
+            self.failUnlessEqual(pool.get_stats()["worker_pool.jobs_failed"],
+                                 1)
+            self.failUnlessEqual(pool._jobs, {})
+        d.addCallbacks(_good, _err)
+        return d
+
+    def test_stop(self):
+        if workerpool._get_multiprocessing() is None:
+            raise unittest.SkipTest("the multiprocessing module is missing")
+        pool = self.make_pool(1)
+        d = pool.run(_sleep_in_worker, 10)
+        def _good(res):
+            self.fail("should have failed, not got %s" % (res,))
+        def _err(f):
+            f.trap(workerpool.WorkerError)
+            self.failUnless("the worker pool was stopped" in str(f), str(f))
+        d.addCallbacks(_good, _err)
+        pool.stopService()
+        self.failUnlessEqual(pool.get_stats()["worker_pool.jobs_failed"], 1)
+        return d
+
 class TimeFormat(unittest.TestCase):
     def test_epoch(self):
         return self._help_test_epoch()
@@ -1571,6 +1675,92 @@ class Pipeline(unittest.TestCase):
 
         del d1,d2,d3,d4
 
+class SimulatedLink:
+    """I deliver messages over a link with the given round-trip time and
+    bandwidth (bytes per second), one after another, and acknowledge each
+    one when the far end has received it and its response has come back."""
+    def __init__(self, clock, rtt, bandwidth):
+        self.clock = clock
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.link_free = 0.0
+
+    def send(self, size):
+        now = self.clock.seconds()
+        self.link_free = max(now, self.link_free) + float(size)/self.bandwidth
+        d = defer.Deferred()
+        self.clock.callLater(self.link_free + self.rtt - now, d.callback, None)
+        return d
+
+class AdaptivePipeline(unittest.TestCase):
+    BLOCKSIZE = 43691 # the block size of k=3, 128KiB segments
+
+    def push(self, p, link, blocks):
+        # write 'blocks' blocks through the pipeline, as fast as it lets us,
+        # and return how many (simulated) seconds it took
+        clock = link.clock
+        done = []
+        def _next(ign, i):
+            if i == blocks:
+                p.flush().addCallback(done.append)
+                return
+            d = p.add(self.BLOCKSIZE, link.send, self.BLOCKSIZE)
+            d.addCallback(_next, i+1)
+        _next(None, 0)
+        while not done:
+            when = min([c.getTime() for c in clock.getDelayedCalls()])
+            clock.advance(when - clock.seconds())
+        return clock.seconds()
+
+    def test_long_fat_link(self):
+        # 200ms away at 10MB/s: 50KB in flight per round trip is only
+        # 250KB/s. The adaptive window grows towards the 2MB that the link
+        # could carry.
+        clock = task.Clock()
+        fixed = self.push(pipeline.Pipeline(50000),
+                          SimulatedLink(clock, 0.2, 10e6), 200)
+        clock = task.Clock()
+        p = pipeline.AdaptivePipeline(50000, clock=clock)
+        adaptive = self.push(p, SimulatedLink(clock, 0.2, 10e6), 200)
+        self.failUnless(p.capacity > 1000000, p.capacity)
+        self.failUnless(adaptive < fixed / 5, (adaptive, fixed))
+
+    def test_slow_server(self):
+        # 10ms away at 50KB/s: any window bigger than a couple of blocks
+        # just queues data up in front of the server. The adaptive window
+        # shrinks, without slowing the upload down.
+        clock = task.Clock()
+        fixed = self.push(pipeline.Pipeline(500000),
+                          SimulatedLink(clock, 0.01, 50e3), 40)
+        clock = task.Clock()
+        p = pipeline.AdaptivePipeline(500000, clock=clock)
+        adaptive = self.push(p, SimulatedLink(clock, 0.01, 50e3), 40)
+        self.failUnless(p.capacity < 200000, p.capacity)
+        self.failUnless(adaptive < fixed * 1.05, (adaptive, fixed))
+
+    def test_limits(self):
+        clock = task.Clock()
+        p = pipeline.AdaptivePipeline(50000, min_capacity=40000,
+                                      max_capacity=80000, clock=clock)
+        self.push(p, SimulatedLink(clock, 0.2, 10e6), 20)
+        self.failUnlessEqual(p.capacity, 80000)
+        p = pipeline.AdaptivePipeline(500000, min_capacity=400000,
+                                      max_capacity=800000, clock=clock)
+        self.push(p, SimulatedLink(clock, 0.01, 50e3), 40)
+        self.failUnlessEqual(p.capacity, 400000)
+
+    def test_small_messages(self):
+        # small messages are quicker than any full block, and would make
+        # the blocks look delayed if they were measured
+        clock = task.Clock()
+        link = SimulatedLink(clock, 0.2, 10e6)
+        p = pipeline.AdaptivePipeline(50000, clock=clock)
+        d = p.add(36, link.send, 36)
+        clock.advance(1)
+        self.failUnless(d.called)
+        self.failUnlessEqual(p.min_latency, None)
+        self.failUnlessEqual(p.adjustments, 0)
+
 class SampleError(Exception):
     pass
 
@@ -17,7 +17,7 @@ from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
 from allmydata.nodemaker import NodeMaker
 from allmydata.unknown import UnknownNode
-from allmydata.web import status, common
+from allmydata.web import status, common, unlinked
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.util import fileutil, base32
 from allmydata.util.consumer import download_to_data
@@ -32,6 +32,7 @@ from allmydata.test.no_network import GridTestMixin
 from allmydata.test.common_web import HTTPClientGETFactory, \
      HTTPClientHEADFactory
 from allmydata.client import Client, SecretHolder
+from pycryptopp.hash.sha256 import SHA256
 
 # create a fake uploader/downloader, and a couple of fake dirnodes, then
 # create a webserver that works against them
@@ -71,6 +72,9 @@ class FakeUploader(service.Service):
             return results
         d.addCallback(_got_data)
         return d
+    def upload_batch(self, uploadables, history=None):
+        return defer.gatherResults([self.upload(u, history)
+                                    for u in uploadables])
     def get_helper_info(self):
         return (None, False)
 
@@ -91,6 +95,16 @@ def build_one_ds():
     ds.add_segment_request(4, now)
     ds.add_segment_delivery(4, now, 0, 140, 0.5)
 
+    # a read that fetches segment 6 while segment 5 is still on its way
+    ds.add_segment_request(5, now+6)
+    ds.add_segment_request(6, now+7)
+    ds.add_segment_delivery(5, now+8, 500, 3000, 0.5)
+    ds.add_segment_delivery(6, now+9, 3500, 14000, 0.5)
+
+    ds.add_hedge_issued()
+    ds.add_hedge_issued()
+    ds.add_hedge_won()
+
     e = ds.add_dyhb_sent("serverid_a", now)
     e.finished([1,2], now+1)
     e = ds.add_dyhb_sent("serverid_b", now+2) # left unfinished
@@ -112,8 +126,13 @@ def build_one_ds():
 
     return ds
 
+def build_one_us():
+    us = upload.UploadStatus()
+    us.set_pipeline_windows({0: ("\x00"*20, 65536)})
+    return us
+
 class FakeHistory:
-    _all_upload_status = [upload.UploadStatus()]
+    _all_upload_status = [build_one_us()]
     _all_download_status = [build_one_ds()]
     _all_mapupdate_statuses = [servermap.UpdateStatus()]
     _all_publish_statuses = [publish.PublishStatus()]
@@ -345,7 +364,14 @@ class WebMixin(object):
         form.append('')
         form.append('UTF-8')
         form.append(sep)
+        items = []
         for name, value in fields.iteritems():
+            # a list of values means several fields with the same name
+            if isinstance(value, list):
+                items.extend([(name, v) for v in value])
+            else:
+                items.append((name, value))
+        for name, value in items:
             if isinstance(value, tuple):
                 filename, value = value
                 form.append('Content-Disposition: form-data; name="%s"; '
@@ -555,15 +581,22 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(lambda res: self.GET("/status/down-%d" % dl_num))
         def _check_dl(res):
             self.failUnless("File Download Status" in res, res)
+            # both of the overlapping segment fetches have their speed shown
+            self.failUnless("1.5kBps" in res, res)
+            self.failUnless("7.0kBps" in res, res)
+            self.failUnless("Hedged Block Requests: 2 issued, 1 won" in res,
+                            res)
         d.addCallback(_check_dl)
         d.addCallback(lambda res: self.GET("/status/down-%d?t=json" % dl_num))
         def _check_dl_json(res):
             data = simplejson.loads(res)
             self.failUnless(isinstance(data, dict))
+            self.failUnlessEqual(data["hedges"], {"issued": 2, "won": 1})
         d.addCallback(_check_dl_json)
         d.addCallback(lambda res: self.GET("/status/up-%d" % ul_num))
         def _check_ul(res):
             self.failUnless("File Upload Status" in res, res)
+            self.failUnless("sh#0 to [aaaaaaaa]: 65.5kB" in res, res)
         d.addCallback(_check_ul)
         d.addCallback(lambda res: self.GET("/status/mapupdate-%d" % mu_num))
         def _check_mapupdate(res):
@@ -902,6 +935,30 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                                                              self.NEWFILE_CONTENTS))
         return d
 
+    def test_PUT_NEWFILEURL_stream(self):
+        d = self.PUT(self.public_url + "/foo/new.txt?stream=true",
+                     self.NEWFILE_CONTENTS)
+        d.addCallback(self.failUnlessURIMatchesROChild, self._foo_node, u"new.txt")
+        d.addCallback(lambda res:
+                      self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                                      self.NEWFILE_CONTENTS))
+        return d
+
+    def test_PUT_NEWFILEURL_stream_mutable(self):
+        d = self.PUT(self.public_url + "/foo/new.txt?mutable=true",
+                     self.NEWFILE_CONTENTS)
+        d.addCallback(lambda ign:
+            self.shouldFail2(error.Error, "stream_mutable", "400 Bad Request",
+                             "stream=true cannot be used to modify a mutable file",
+                             self.PUT,
+                             self.public_url + "/foo/new.txt?stream=true",
+                             "new contents"))
+        d.addCallback(lambda res:
+                      self.failUnlessMutableChildContentsAre(self._foo_node,
+                                                             u"new.txt",
+                                                             self.NEWFILE_CONTENTS))
+        return d
+
     def test_PUT_NEWFILEURL_mutable_toobig(self):
         d = self.shouldFail2(error.Error, "test_PUT_NEWFILEURL_mutable_toobig",
                              "413 Request Entity Too Large",
@@ -1665,6 +1722,38 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                       self.failUnlessReallyEqual(res, self.NEWFILE_CONTENTS))
         return d
 
+    def test_POST_upload_batch(self):
+        contents = ["first file\n" * 10, "second file\n" * 10,
+                    self.NEWFILE_CONTENTS]
+        d = self.POST("/uri", t="upload-batch",
+                      file=[("%d.txt" % i, data)
+                            for (i, data) in enumerate(contents)])
+        def _check(res):
+            caps = simplejson.loads(res)
+            self.failUnlessEqual(len(caps), 3)
+            for (cap, data) in zip(caps, contents):
+                self.failUnlessCHKURIHasContents(cap, data)
+        d.addCallback(_check)
+        return d
+
+    def test_POST_upload_batch_no_files(self):
+        d = self.shouldFail2(error.Error, "test_POST_upload_batch_no_files",
+                             "400 Bad Request",
+                             "t=upload-batch requires at least one file= field",
+                             self.POST, "/uri", t="upload-batch")
+        return d
+
+    def test_POST_upload_batch_too_many_files(self):
+        self.patch(unlinked, "MAX_BATCH_FILES", 2)
+        d = self.shouldFail2(error.Error,
+                             "test_POST_upload_batch_too_many_files",
+                             "400 Bad Request",
+                             "t=upload-batch accepts at most 2 files, got 3",
+                             self.POST, "/uri", t="upload-batch",
+                             file=[("%d.txt" % i, "file %d\n" % i)
+                                   for i in range(3)])
+        return d
+
     def test_POST_upload_no_link_mutable(self):
         d = self.POST("/uri", t="upload", mutable="true",
                       file=("new.txt", self.NEWFILE_CONTENTS))
@@ -2906,6 +2995,41 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check2)
         return d
 
+    def test_PUT_NEWFILE_URI_stream(self):
+        # bigger than StreamingUploadable.BUFFER_SIZE
+        file_contents = "".join([chr(i % 256) for i in range(1500*1000)])
+        d = self.PUT("/uri?stream=true", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(FakeCHKFileNode.all_contents[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
+    def test_PUT_NEWFILE_URI_stream_hash(self):
+        file_contents = "New file contents here\n" * 1000
+        good = SHA256(file_contents).hexdigest()
+        d = self.PUT("/uri?stream=true", file_contents,
+                     headers={"x-tahoe-content-sha256": good})
+        def _check(uri):
+            self.failUnlessReallyEqual(FakeCHKFileNode.all_contents[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        bad = SHA256("other contents").hexdigest()
+        d.addCallback(lambda ign:
+            self.shouldFail2(error.Error, "stream_bad_hash", "400 Bad Request",
+                             "did not match its X-Tahoe-Content-SHA256",
+                             self.PUT, "/uri?stream=true", file_contents,
+                             headers={"x-tahoe-content-sha256": bad}))
+        d.addCallback(lambda ign:
+            self.shouldFail2(error.Error, "stream_short_hash",
+                             "400 Bad Request", "must be 64 hex digits",
+                             self.PUT, "/uri?stream=true", file_contents,
+                             headers={"x-tahoe-content-sha256": "abcd"}))
+        # the connection can still be used after an error
+        d.addCallback(lambda ign: self.PUT("/uri?stream=true", file_contents))
+        d.addCallback(_check)
+        return d
+
     def test_PUT_NEWFILE_URI_not_mutable(self):
         file_contents = "New file contents here\n"
         d = self.PUT("/uri?mutable=false", file_contents)
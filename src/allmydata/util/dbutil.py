@@ -0,0 +1,15 @@
+"""
+Helpers for the sqlite databases that a node keeps for itself (the share
+index and lease database of a storage server, and the caches of a client).
+"""
+
+def get_sqlite():
+    """Return the sqlite module: sqlite3 from the standard library, or the
+    pysqlite2 package on python2.4."""
+    try:
+        import sqlite3
+        sqlite = sqlite3 # pyflakes whines about 'import sqlite3 as sqlite' ..
+    except ImportError:
+        from pysqlite2 import dbapi2
+        sqlite = dbapi2 # .. when this clause does it too
+    return sqlite
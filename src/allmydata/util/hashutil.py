@@ -143,6 +143,18 @@ def convergence_hasher(k, n, segsize, convergence):
     tag = CONVERGENT_ENCRYPTION_TAG + netstring(convergence) + param_tag
     return tagged_hasher(tag, KEYLEN)
 
+STREAMING_CONVERGENT_ENCRYPTION_TAG = "allmydata_immutable_content_sha256_to_key_with_added_secret_v1+"
+def streaming_convergence_key(k, n, segsize, convergence, content_hash):
+    # for uploads whose contents are not available until the upload is
+    # under way: the key is derived from the SHA-256 hash of the contents,
+    # which the uploader must check against the data as it goes by. This
+    # gives a different key than convergence_hasher() for the same file.
+    assert isinstance(convergence, str)
+    assert len(content_hash) == 32
+    param_tag = netstring("%d,%d,%d" % (k, n, segsize))
+    tag = STREAMING_CONVERGENT_ENCRYPTION_TAG + netstring(convergence) + param_tag
+    return tagged_hash(tag, content_hash, KEYLEN)
+
 def random_key():
     return os.urandom(KEYLEN)
 
@@ -209,3 +221,12 @@ def constant_time_compare(a, b):
 BACKUPDB_DIRHASH_TAG = "allmydata_backupdb_dirhash_v1"
 def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
+
+CONVERGENT_KEY_CACHE_TAG = "allmydata_convergent_key_cache_params_v1"
+def convergent_key_cache_params(k, n, segsize, convergence):
+    # identifies the inputs of convergence_hasher() other than the file,
+    # without storing the convergence secret itself
+    assert isinstance(convergence, str)
+    param_tag = netstring("%d,%d,%d" % (k, n, segsize))
+    return tagged_hash(CONVERGENT_KEY_CACHE_TAG,
+                       netstring(convergence) + param_tag)
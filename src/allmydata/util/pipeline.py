@@ -1,5 +1,5 @@
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted.python import log
 from allmydata.util.assertutil import precondition
@@ -132,3 +132,77 @@ class Pipeline:
     def _eat_pipeline_errors(self, f):
         f.trap(PipelineError)
         return None
+
+
+class AdaptivePipeline(Pipeline):
+    """I am a Pipeline whose capacity follows the link it is feeding, in the
+    manner of TCP Vegas. I measure how long each operation takes to
+    complete. Once per window's worth of completed bytes, I compare the
+    average latency of that window against the lowest latency I have ever
+    seen. If they are close, the far end is keeping up and the link has room
+    for more, so I double my capacity. If the average has grown to several
+    times the minimum, data is queueing up somewhere (the server or the link
+    is slow), so I shrink my capacity, keeping less data in flight and in
+    memory for no gain. The capacity stays between min_capacity and
+    max_capacity.
+
+    Latencies are only measured on operations of at least SAMPLE_SIZE
+    bytes, since tiny messages (headers, close) complete faster than
+    anything carrying data, and would make every data message look
+    delayed."""
+
+    SAMPLE_SIZE = 1024
+    GROW_BELOW = 1.5 # grow if the average latency is below 1.5x the minimum
+    SHRINK_ABOVE = 3.0 # shrink if it is above 3x
+
+    def __init__(self, capacity, min_capacity=16*1024,
+                 max_capacity=2*1024*1024, clock=None):
+        Pipeline.__init__(self, capacity)
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        if clock is None:
+            clock = reactor
+        self._clock = clock
+        self.min_latency = None
+        self.adjustments = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_samples = 0
+
+    def add(self, _size, _func, *args, **kwargs):
+        started = self._clock.seconds()
+        def _call():
+            d = defer.maybeDeferred(_func, *args, **kwargs)
+            d.addCallback(self._measure, _size, started)
+            return d
+        return Pipeline.add(self, _size, _call)
+
+    def _measure(self, res, size, started):
+        # this runs before Pipeline._call_finished, so a new capacity
+        # takes effect right away
+        if size < self.SAMPLE_SIZE:
+            return res
+        latency = self._clock.seconds() - started
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        self._window_bytes += size
+        self._window_latency += latency
+        self._window_samples += 1
+        if self._window_bytes >= self.capacity:
+            self._adjust()
+        return res
+
+    def _adjust(self):
+        average = self._window_latency / self._window_samples
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_samples = 0
+        if average <= self.GROW_BELOW * self.min_latency:
+            capacity = min(self.capacity * 2, self.max_capacity)
+        elif average > self.SHRINK_ABOVE * self.min_latency:
+            capacity = max(self.capacity * 2 // 3, self.min_capacity)
+        else:
+            return
+        if capacity != self.capacity:
+            self.capacity = capacity
+            self.adjustments += 1
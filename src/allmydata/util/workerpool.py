@@ -0,0 +1,149 @@
+"""
+I run CPU-heavy functions (erasure coding, encryption, hashing) in a pool of
+worker processes, so that a node on a machine with several cores can spread
+the work of concurrent uploads across them instead of doing all of it in the
+reactor thread. zfec and pycryptopp hold the GIL while they work, so a pool
+of threads would not help.
+
+Jobs must be module-level functions of picklable arguments, and must not
+depend upon or modify any state of the node: they run in a forked copy of
+it. A WorkerPool with no workers (or on a python without the
+multiprocessing module) runs each job in the reactor thread instead, so
+callers can use the same code either way and get the same results.
+
+A job that has not finished job_timeout seconds after it was submitted (for
+example because its worker was killed, which multiprocessing never reports)
+fails with a WorkerError, and so does every job that is still outstanding
+when the pool is stopped.
+"""
+
+import signal, traceback
+from zope.interface import implements
+from twisted.application import service
+from twisted.internet import defer, reactor
+from allmydata.util import log
+from allmydata.interfaces import IStatsProducer
+
+def _get_multiprocessing():
+    try:
+        import multiprocessing
+    except ImportError:
+        return None # python2.5 and older
+    return multiprocessing
+
+class WorkerError(Exception):
+    """A job raised an exception in a worker process (and the message is
+    the traceback that the worker saw), did not finish in time, or was
+    abandoned when the pool was stopped."""
+
+def _init_worker():
+    # workers inherit the node's signal handlers, and twisted's SIGTERM
+    # handler (which only asks the reactor to stop) would keep them from
+    # dying when the pool terminates them. A ^C meant for the node should
+    # not kill the workers out from under it either.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _run_job(f, args):
+    # this runs in the worker process. Exceptions are reported as strings,
+    # since not all of them can be pickled.
+    try:
+        return (True, f(*args))
+    except Exception:
+        return (False, traceback.format_exc())
+
+class WorkerPool(service.Service):
+    implements(IStatsProducer)
+    name = "worker-pool"
+
+    def __init__(self, workers=0, stats_provider=None, job_timeout=600):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self._pool = None
+        self._jobs = {} # jobnum -> (Deferred, timeout IDelayedCall or None)
+        self._next_jobnum = 0
+        self.jobs_started = 0
+        self.jobs_finished = 0
+        self.jobs_failed = 0
+        if stats_provider:
+            stats_provider.register_producer(self)
+
+    def startService(self):
+        service.Service.startService(self)
+        if not self.workers:
+            return
+        multiprocessing = _get_multiprocessing()
+        if multiprocessing is None:
+            log.msg("workers= requires the multiprocessing module, doing"
+                    " the work in the node instead",
+                    facility="tahoe.workerpool", level=log.UNUSUAL,
+                    umid="q3GdKw")
+            self.workers = 0
+            return
+        self._pool = multiprocessing.Pool(self.workers, _init_worker)
+
+    def stopService(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+        # the jobs that were still waiting or running will never finish
+        jobs = self._jobs.values()
+        self._jobs = {}
+        for (d, timer) in jobs:
+            if timer:
+                timer.cancel()
+            self.jobs_failed += 1
+            d.errback(WorkerError("the worker pool was stopped"))
+        return service.Service.stopService(self)
+
+    def is_parallel(self):
+        """Return True if my jobs run in other processes."""
+        return self._pool is not None
+
+    def run(self, f, *args):
+        """Call f(*args) in a worker process, and return a Deferred that
+        fires with its result. If f raises an exception, the Deferred
+        errbacks with a WorkerError."""
+        if self._pool is None:
+            return defer.maybeDeferred(f, *args)
+        self.jobs_started += 1
+        jobnum = self._next_jobnum
+        self._next_jobnum += 1
+        d = defer.Deferred()
+        timer = None
+        if self.job_timeout:
+            timer = reactor.callLater(self.job_timeout, self._timed_out, jobnum)
+        self._jobs[jobnum] = (d, timer)
+        def _got_result(res):
+            # this is called in the pool's result-handling thread
+            reactor.callFromThread(self._done, jobnum, res)
+        self._pool.apply_async(_run_job, (f, args), callback=_got_result)
+        return d
+
+    def _done(self, jobnum, (ok, result)):
+        if jobnum not in self._jobs:
+            return # it already timed out, or the pool was stopped
+        (d, timer) = self._jobs.pop(jobnum)
+        if timer:
+            timer.cancel()
+        self.jobs_finished += 1
+        if ok:
+            d.callback(result)
+        else:
+            d.errback(WorkerError(result))
+
+    def _timed_out(self, jobnum):
+        (d, timer) = self._jobs.pop(jobnum)
+        self.jobs_failed += 1
+        log.msg("worker pool job did not finish within %d seconds"
+                % self.job_timeout,
+                facility="tahoe.workerpool", level=log.WEIRD, umid="n1fQGw")
+        d.errback(WorkerError("the job did not finish within %d seconds"
+                              % self.job_timeout))
+
+    def get_stats(self):
+        return {"worker_pool.workers": self.workers,
+                "worker_pool.jobs_started": self.jobs_started,
+                "worker_pool.jobs_finished": self.jobs_finished,
+                "worker_pool.jobs_failed": self.jobs_failed,
+                }
@@ -1,4 +1,5 @@
 
+import binascii
 import simplejson
 from twisted.web import http, server
 from twisted.python import log
@@ -9,8 +10,9 @@ from nevow.util import resource_filename
 from allmydata.interfaces import ExistingChildError, NoSuchChildError, \
      FileTooLargeError, NotEnoughSharesError, NoSharesError, \
      EmptyPathnameComponentError, MustBeDeepImmutableError, \
-     MustBeReadonlyError, MustNotBeUnknownRWError
+     MustBeReadonlyError, MustNotBeUnknownRWError, ContentHashMismatchError
 from allmydata.mutable.common import UnrecoverableFileError
+from allmydata.immutable.upload import FileHandle
 from allmydata.util import abbreviate
 from allmydata.util.encodingutil import to_str, quote_output
 
@@ -153,6 +155,24 @@ class WebError(Exception):
 # or make sure that childFactory returns a WebErrorResource (and never an
 # actual exception). The latter is growing increasingly annoying.
 
+def get_uploadable(req, convergence):
+    # the body of a ?stream=true request is still arriving, in
+    # req.upload_stream (see webish.MyRequest). The other kinds have already
+    # been written to req.content .
+    stream = getattr(req, "upload_stream", None)
+    if stream is None:
+        return FileHandle(req.content, convergence=convergence)
+    content_hash = req.getHeader("x-tahoe-content-sha256")
+    if content_hash:
+        try:
+            content_hash = binascii.unhexlify(content_hash.strip())
+        except TypeError:
+            content_hash = None
+        if not content_hash or len(content_hash) != 32:
+            raise WebError("X-Tahoe-Content-SHA256 must be 64 hex digits")
+        stream.set_convergence(convergence, content_hash)
+    return stream
+
 def should_create_intermediate_directories(req):
     t = get_arg(req, "t", "").strip()
     return bool(req.method in ("PUT", "POST") and
@@ -235,6 +255,9 @@ def humanize_failure(f):
         return (f.value.text, f.value.code)
     if f.check(FileTooLargeError):
         return (f.getTraceback(), http.REQUEST_ENTITY_TOO_LARGE)
+    if f.check(ContentHashMismatchError):
+        return ("The uploaded data did not match its X-Tahoe-Content-SHA256 "
+                "header.", http.BAD_REQUEST)
     return (str(f), None)
 
 class MyExceptionHandler(appserver.DefaultExceptionHandler):
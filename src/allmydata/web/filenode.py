@@ -13,7 +13,7 @@ from allmydata.util import log, base32
 
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
-     MyExceptionHandler, parse_replace_arg
+     MyExceptionHandler, parse_replace_arg, get_uploadable
 from allmydata.web.check_results import CheckResults, \
      CheckAndRepairResults, LiteralCheckResults
 from allmydata.web.info import MoreInfo
@@ -33,7 +33,7 @@ class ReplaceMeMixin:
                 return d2
             d.addCallback(_uploaded)
         else:
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_uploadable(req, client.convergence)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -279,6 +279,9 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return d
 
     def replace_my_contents(self, req):
+        if getattr(req, "upload_stream", None):
+            raise WebError("stream=true cannot be used to modify a mutable"
+                           " file")
         req.content.seek(0)
         new_contents = req.content.read()
         d = self.node.overwrite(new_contents)
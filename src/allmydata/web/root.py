@@ -68,6 +68,8 @@ class URIHandler(RenderMixin, rend.Page):
                 return unlinked.POSTUnlinkedSSK(req, self.client)
             else:
                 return unlinked.POSTUnlinkedCHK(req, self.client)
+        if t == "upload-batch":
+            return unlinked.POSTUnlinkedBatch(req, self.client)
         if t == "mkdir":
             return unlinked.POSTUnlinkedCreateDirectory(req, self.client)
         elif t == "mkdir-with-children":
@@ -30,6 +30,16 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
         d.addCallback(lambda res: res.preexisting_shares)
         return d
 
+    def render_dedup_hit(self, ctx, data):
+        d = self.upload_results()
+        def _render(res):
+            # results from older helpers do not have this attribute
+            if getattr(res, "dedup_hit", False):
+                return "yes"
+            return "no"
+        d.addCallback(_render)
+        return d
+
     def render_sharemap(self, ctx, data):
         d = self.upload_results()
         d.addCallback(lambda res: res.sharemap)
@@ -93,15 +103,30 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
     def data_time_peer_selection(self, ctx, data):
         return self._get_time("peer_selection")
 
+    def data_peer_selection_rounds(self, ctx, data):
+        d = self._get_time("peer_selection_rounds")
+        def _format(rounds):
+            if rounds is None:
+                return "" # the helper did the peer selection
+            return "(%d round trips)" % rounds
+        d.addCallback(_format)
+        return d
+
     def data_time_total_encode_and_push(self, ctx, data):
         return self._get_time("total_encode_and_push")
 
+    def data_time_cumulative_reading(self, ctx, data):
+        return self._get_time("cumulative_reading")
+
     def data_time_cumulative_encoding(self, ctx, data):
         return self._get_time("cumulative_encoding")
 
     def data_time_cumulative_sending(self, ctx, data):
         return self._get_time("cumulative_sending")
 
+    def data_time_cumulative_encode_wait(self, ctx, data):
+        return self._get_time("cumulative_encode_wait")
+
     def data_time_hashes_and_close(self, ctx, data):
         return self._get_time("hashes_and_close")
 
@@ -120,6 +145,9 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
     def data_rate_storage_index(self, ctx, data):
         return self._get_rate("storage_index")
 
+    def data_rate_read(self, ctx, data):
+        return self._get_rate("cumulative_reading")
+
     def data_rate_encode(self, ctx, data):
         return self._get_rate("cumulative_encoding")
 
@@ -207,6 +235,20 @@ class UploadStatusPage(UploadResultsRendererMixin, rend.Page):
     def render_status(self, ctx, data):
         return data.get_status()
 
+    def render_pipeline_windows(self, ctx, data):
+        windows = data.get_pipeline_windows()
+        if not windows:
+            return "(none)"
+        l = T.ul()
+        for shnum in sorted(windows.keys()):
+            (peerid, window) = windows[shnum]
+            peerid_s = "[None]"
+            if peerid:
+                peerid_s = idlib.shortnodeid_b2a(peerid)
+            l[T.li["sh#%d to [%s]: %s" % (shnum, peerid_s,
+                                           abbreviate_size(window))]]
+        return l
+
 class DownloadResultsRendererMixin(RateAndTimeMixin):
     # this requires a method named 'download_results'
 
@@ -377,8 +419,15 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
         data["requests"] = request_events
         data["segment"] = self.download_status.segment_events
         data["read"] = self.download_status.read_events
+        data["hedges"] = {"issued": self.download_status.hedges_issued,
+                          "won": self.download_status.hedges_won,
+                          }
         return simplejson.dumps(data, indent=1) + "\n"
 
+    def render_hedges(self, ctx, data):
+        ds = self.download_status
+        return "%d issued, %d won" % (ds.hedges_issued, ds.hedges_won)
+
     def render_events(self, ctx, data):
         if not self.download_status.storage_index:
             return
@@ -436,7 +485,9 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
         t = T.table(align="left",class_="status-download-events")
         t[T.tr[T.th["type"], T.th["segnum"], T.th["when"], T.th["range"],
                T.th["decodetime"], T.th["segtime"], T.th["speed"]]]
-        reqtime = (None, None)
+        # a read() that is reading ahead has several segment requests
+        # outstanding at once, so remember when each one was made
+        reqtimes = {}
         for s_ev in self.download_status.segment_events:
             (etype, segnum, when, segstart, seglen, decodetime) = s_ev
             if etype == "request":
@@ -448,10 +499,10 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
                     T.td["-"],
                     T.td["-"]]]
                     
-                reqtime = (segnum, when)
+                reqtimes.setdefault(segnum, when)
             elif etype == "delivery":
-                if reqtime[0] == segnum:
-                    segtime = when - reqtime[1]
+                if segnum in reqtimes:
+                    segtime = when - reqtimes.pop(segnum)
                     speed = self.render_rate(None, compute_rate(seglen, segtime))
                     segtime = self.render_time(None, segtime)
                 else:
@@ -462,6 +513,7 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
                        T.td[self.render_time(None,decodetime)],
                        T.td[segtime], T.td[speed]]]
             elif etype == "error":
+                reqtimes.pop(segnum, None)
                 t[T.tr[T.td["error"], T.td["seg%d" % segnum]]]
                 
         l[T.h2["Segment Events:"], t]
@@ -470,7 +522,6 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
         t = T.table(align="left",class_="status-download-events")
         t[T.tr[T.th["serverid"], T.th["shnum"], T.th["range"],
                T.th["txtime"], T.th["rxtime"], T.th["received"], T.th["RTT"]]]
-        reqtime = (None, None)
         request_events = []
         for serverid,requests in self.download_status.requests.iteritems():
             for req in requests:
@@ -1079,6 +1130,12 @@ class HelperStatus(rend.Page):
     def render_active_uploads(self, ctx, data):
         return data["chk_upload_helper.active_uploads"]
 
+    def render_queued_uploads(self, ctx, data):
+        return "%d (longest wait %s, mean wait %s)" % \
+               (data["chk_upload_helper.queued_uploads"],
+                abbreviate_time(data["chk_upload_helper.queue_wait_longest"]),
+                abbreviate_time(data["chk_upload_helper.queue_wait_mean"]))
+
     def render_incoming(self, ctx, data):
         return "%d bytes in %d files" % (data["chk_upload_helper.incoming_size"],
                                          data["chk_upload_helper.incoming_count"])
@@ -1102,6 +1159,21 @@ class HelperStatus(rend.Page):
     def render_upload_bytes_encoded(self, ctx, data):
         return str(data["chk_upload_helper.encoded_bytes"])
 
+    def render_upload_progress(self, ctx, data):
+        progress = self.helper.get_upload_progress()
+        if not progress:
+            return "None"
+        ul = T.ul()
+        for (storage_index, size, fetched, encoded) in progress:
+            if size is None:
+                sizes = "size not yet known"
+            else:
+                sizes = "%s of %s fetched, %s encoded" % \
+                        (abbreviate_size(fetched), abbreviate_size(size),
+                         abbreviate_size(encoded))
+            ul[T.li["%s: %s" % (base32.b2a(storage_index)[:5], sizes)]]
+        return ul
+
 
 class Statistics(rend.Page):
     docFactory = getxmlfile("statistics.xhtml")
@@ -112,8 +112,21 @@ class StorageStatus(rend.Page):
             if eta is not None:
                 eta_s = " (ETA %ds)" % eta
 
+            rate = p["buckets-per-second"]
+            rate_s = ""
+            if rate is not None:
+                rate_s = (" (%d buckets so far, %.1f buckets/s)"
+                          % (p["buckets-processed"], rate))
+
+            cached_s = ""
+            if p["incremental"]:
+                cached_s = (" (%d unchanged prefixes not re-listed)"
+                            % p["cached-bucket-lists"])
+
             return ["Current crawl %.1f%% complete" % pct,
                     eta_s,
+                    rate_s,
+                    cached_s,
                     " (next work in %s)" % abbreviate_time(soon),
                     cycletime_s,
                     ]
@@ -1,16 +1,20 @@
 
 import urllib
+import simplejson
 from twisted.web import http
 from twisted.internet import defer
 from nevow import rend, url, tags as T
 from allmydata.immutable.upload import FileHandle
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
-     convert_children_json, WebError
+     convert_children_json, WebError, get_uploadable
 from allmydata.web import status
 
+# the most files a single t=upload-batch request may carry
+MAX_BATCH_FILES = 100
+
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_uploadable(req, client.convergence)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.uri)
     # that fires with the URI of the new file
@@ -52,6 +56,28 @@ def POSTUnlinkedCHK(req, client):
     return d
 
 
+def POSTUnlinkedBatch(req, client):
+    # "POST /uri?t=upload-batch", to upload several unlinked files at once.
+    # Each one is a file= field of the form.
+    if not (req.fields and "file" in req.fields):
+        raise WebError("t=upload-batch requires at least one file= field",
+                       http.BAD_REQUEST)
+    contents = req.fields["file"]
+    if not isinstance(contents, list):
+        contents = [contents]
+    if len(contents) > MAX_BATCH_FILES:
+        raise WebError("t=upload-batch accepts at most %d files, got %d"
+                       % (MAX_BATCH_FILES, len(contents)),
+                       http.BAD_REQUEST)
+    uploadables = [FileHandle(c.file, client.convergence) for c in contents]
+    d = client.upload_batch(uploadables)
+    def _done(upload_results):
+        req.setHeader("content-type", "text/plain")
+        return simplejson.dumps([r.uri for r in upload_results]) + "\n"
+    d.addCallback(_done)
+    return d
+
+
 class UploadResultsPage(status.UploadResultsRendererMixin, rend.Page):
     """'POST /uri', to create an unlinked file."""
     docFactory = getxmlfile("upload-results.xhtml")
@@ -1,9 +1,11 @@
 import re, time
+from cStringIO import StringIO
 from twisted.application import service, strports, internet
 from twisted.web import http
 from twisted.internet import defer
 from nevow import appserver, inevow, static
 from allmydata.util import log, fileutil
+from allmydata.immutable.upload import StreamingUploadable
 
 from allmydata.web import introweb, root
 from allmydata.web.common import IOpHandleTable, MyExceptionHandler
@@ -16,15 +18,85 @@ from allmydata.web.common import IOpHandleTable, MyExceptionHandler
 # surgery may induce a dependency upon a particular version of twisted.web
 
 parse_qs = http.parse_qs
+TRUE_ARGS = ("true", "t", "1", "on")
+
 class MyRequest(appserver.NevowRequest):
     fields = None
     _tahoe_request_had_error = None
 
+    # A PUT of an immutable file with ?stream=true is processed as soon as
+    # its headers have arrived, and its body is written into
+    # self.upload_stream (a StreamingUploadable) instead of self.content .
+    upload_stream = None
+    _processing_started = False
+    _body_received = False
+    _finish_pending = None # or the 'success' flag of finishRequest()
+
+    def gotLength(self, length):
+        appserver.NevowRequest.gotLength(self, length)
+        if length and self._wants_streaming():
+            self.content = StringIO()
+            self.upload_stream = StreamingUploadable(length,
+                                                     self.channel.transport)
+            # this peeks at HTTPChannel's notion of the request line, which
+            # it will hand to requestReceived() once the body is complete
+            self.requestReceived(self.channel._command, self.channel._path,
+                                 self.channel._version)
+
+    def _wants_streaming(self):
+        command = getattr(self.channel, "_command", None)
+        path = getattr(self.channel, "_path", None)
+        if command != "PUT" or not path or "?" not in path:
+            return False
+        path, argstring = path.split("?", 1)
+        if path != "/uri" and not path.startswith("/uri/"):
+            return False
+        args = parse_qs(argstring, 1)
+        def arg(name):
+            return args.get(name, [""])[0].strip().lower()
+        if arg("stream") not in TRUE_ARGS:
+            return False
+        if arg("t") or arg("mutable") in TRUE_ARGS:
+            return False
+        if self.getHeader("content-range"):
+            return False
+        return True
+
+    def handleContentChunk(self, data):
+        if self.upload_stream is not None:
+            self.upload_stream.write(data)
+        else:
+            appserver.NevowRequest.handleContentChunk(self, data)
+
+    def finishRequest(self, success):
+        if self.upload_stream is not None and not self._body_received:
+            # the response must not be finished until the request body has
+            # been read, or the rest of the body would be taken as the next
+            # request on this connection
+            self._finish_pending = success
+            self.upload_stream.drain()
+            return
+        appserver.NevowRequest.finishRequest(self, success)
+
+    def connectionLost(self, reason):
+        if self.upload_stream is not None:
+            self.upload_stream.fail(reason)
+        return appserver.NevowRequest.connectionLost(self, reason)
+
     def requestReceived(self, command, path, version):
         """Called by channel when all data has been received.
 
         This method is not intended for users.
         """
+        if self._processing_started:
+            # we started processing this (streaming) request when its
+            # headers arrived, and now its body has arrived too
+            self._body_received = True
+            if self._finish_pending is not None:
+                appserver.NevowRequest.finishRequest(self,
+                                                     self._finish_pending)
+            return
+        self._processing_started = True
         self.content.seek(0,0)
         self.args = {}
         self.stack = []